@@ -35,7 +35,8 @@ extensions = [
             os.path.join(ext_base_path, "mass_decomposer_cpp.pyx"),
             os.path.join(ext_base_path, "mass_decomposer_common.cpp"),
             os.path.join(ext_base_path, "mass_decomposer_money_changing.cpp"),
-            os.path.join(ext_base_path, "mass_decomposer_parallel.cpp")
+            os.path.join(ext_base_path, "mass_decomposer_parallel.cpp"),
+            os.path.join(ext_base_path, "mass_decomposer_subformula.cpp")
         ],
         include_dirs=[numpy.get_include(), ext_base_path],
         extra_compile_args=cpp_compile_args + openmp_compile_args,
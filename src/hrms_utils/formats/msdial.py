@@ -6,8 +6,16 @@ from ms_entropy import calculate_spectral_entropy, calculate_entropy_similarity
 from dataclasses import dataclass
 from typing import List, Tuple, Dict
 from numba import  jit
-from ..formula_annotation.isotopic_pattern import deduce_isotopic_pattern
-from ..formula_annotation.mass_decomposition import decompose_mass_per_bounds, clean_and_normalize_spectra_known_precursor, NUM_ELEMENTS
+from ..formula_annotation import expressions  # noqa: F401, registers the pl.Expr.hrms namespace
+from ..formula_annotation.mass_decomposition import (
+    decompose_mass_per_bounds,
+    decompose_mass_with_isotopes,
+    clean_and_normalize_spectra_candidate_precursors,
+    candidate_ranking_config,
+    isotope_scoring_config,
+    NUM_ELEMENTS,
+)
+from ..formula_annotation.mass_tolerance import mass_tolerance_config
 from ..formula_annotation.element_table import ELEMENT_INDEX, ELEMENT_MASSES
 
 PROTON_MASS = ELEMENT_MASSES[ELEMENT_INDEX['H']]
@@ -230,6 +238,7 @@ def annotate_chromatogram_with_formulas(
     isotopic_minimum_intensity: float = 5e4,
     isotopic_intensity_absolute_tolerance: float = 5e5,
     isotopic_intensity_relative_tolerance: float = 0.05,
+    top_k_formulas: int | None = None,
 ) -> pl.DataFrame:
     """
     Annotate an MSDIAL chromatogram with isotopic patterns, candidate elemental formulas
@@ -243,7 +252,8 @@ def annotate_chromatogram_with_formulas(
     - For each candidate formula, shift MS/MS fragment m/z values to the non-ionized
       frame (subtracting addcut_mass), then clean and normalize the fragment spectrum
       against the candidate formula (matching fragment masses with tolerance and
-      filtering/noise handling).
+      filtering/noise handling). The fragments of a spectrum are decomposed once for all
+      of its candidate formulas.
     - Explode the chromatogram so each output row corresponds to one candidate precursor
       formula (i.e., one decomposition), with accompanying cleaned MS/MS results.
 
@@ -293,6 +303,13 @@ def annotate_chromatogram_with_formulas(
         Relative intensity tolerance (fraction) used when comparing expected vs
         observed isotope intensities.
 
+    - top_k_formulas: int | None
+        If given, the precursor decomposition also scores every candidate against the
+        observed MS1 isotope envelope (decompose_mass_with_isotopes, with the isotopic
+        parameters above) and keeps only the top_k_formulas best candidates per
+        feature, best first, so far fewer rows reach the cleaning step. None keeps
+        every candidate within the deduced bounds.
+
     Returned DataFrame (columns added / meaning)
     The returned polars DataFrame contains the original chromatogram columns plus the
     following annotations (types indicated informally):
@@ -323,77 +340,92 @@ def annotate_chromatogram_with_formulas(
         Mass errors (in ppm) for the matched fragments after cleaning/normalization.
 
     Notes and behavior
-    - The function relies on domain utilities: deduce_isotopic_pattern,
-      decompose_mass_per_bounds and clean_and_normalize_spectra_known_precursor. Any
+    - The function relies on domain utilities: deduce_isotopic_bounds (as pl.Expr.hrms.isotope_bounds),
+      decompose_mass_per_bounds and clean_and_normalize_spectra_candidate_precursors. Any
       change in those APIs must be propagated here.
     - One input precursor row may expand into multiple output rows (one per candidate
       decomposition) because of the explosion of "decomposed_formulas".
     - Mass tolerances are expressed in ppm; callers should pass values appropriate
       for their instrument and data quality.
-    - The function performs no downstream filtering of candidate formulas; downstream
-      ranking/selection is the caller's responsibility.
+    - Without top_k_formulas the function performs no filtering of candidate formulas;
+      downstream ranking/selection is the caller's responsibility.
     """
-    # Isotopic pattern deduction
+    # Isotopic pattern deduction, straight into the min_bounds / max_bounds columns
     chromatogram = chromatogram.with_columns(
-        pl.struct(
-            ["Precursor_mz_MSDIAL", "ms1_isotopes_m/z", "ms1_isotopes_intensity"]
-        ).map_batches(
-            lambda batch: deduce_isotopic_pattern(
-                batch.struct.field("Precursor_mz_MSDIAL"),
-                batch.struct.field("ms1_isotopes_m/z"),
-                batch.struct.field("ms1_isotopes_intensity"),
-                ms1_mass_tolerance_ppm=precursor_mass_accuracy_ppm,
-                isotopic_mass_tolerance_ppm=isotopic_mass_accuracy_ppm,
+        pl.col("Precursor_mz_MSDIAL").hrms.isotope_bounds(
+            "ms1_isotopes_m/z",
+            "ms1_isotopes_intensity",
+            ms1_mass_tolerance_ppm=precursor_mass_accuracy_ppm,
+            isotopic_mass_tolerance_ppm=isotopic_mass_accuracy_ppm,
+            minimum_intensity=isotopic_minimum_intensity,
+            intensity_absolute_tolerance=isotopic_intensity_absolute_tolerance,
+            intensity_relative_tolerance=isotopic_intensity_relative_tolerance,
+            max_bounds=max_bounds,
+        ).alias("bounds")
+    ).unnest("bounds")
+
+    # Mass decomposition
+    def decompose(batch: pl.Series) -> pl.Series:
+        if top_k_formulas is None:
+            return decompose_mass_per_bounds(
+                batch.struct.field("non_ionized_mass"),
+                batch.struct.field("min_bounds"),
+                batch.struct.field("max_bounds"),
+                tolerance_ppm=precursor_mass_accuracy_ppm,
+            )
+        # candidates are pruned and ranked by the MS1 isotope envelope inside the decomposer
+        return decompose_mass_with_isotopes(
+            batch.struct.field("non_ionized_mass"),
+            batch.struct.field("Precursor_mz_MSDIAL"),
+            batch.struct.field("ms1_isotopes_m/z"),
+            batch.struct.field("ms1_isotopes_intensity"),
+            batch.struct.field("min_bounds"),
+            batch.struct.field("max_bounds"),
+            isotopes=isotope_scoring_config(
                 minimum_intensity=isotopic_minimum_intensity,
                 intensity_absolute_tolerance=isotopic_intensity_absolute_tolerance,
                 intensity_relative_tolerance=isotopic_intensity_relative_tolerance,
-                max_bounds=max_bounds,
+                ms1_tolerance=mass_tolerance_config(ppm=precursor_mass_accuracy_ppm),
+                isotopic_tolerance=mass_tolerance_config(ppm=isotopic_mass_accuracy_ppm),
             ),
-            return_dtype=pl.Array(inner=pl.Int32, shape=(2*NUM_ELEMENTS,))
-        ).alias("bounds")
-    ).with_columns(
-        pl.col("bounds").arr.slice(0, length=NUM_ELEMENTS).list.to_array(width=NUM_ELEMENTS).alias("min_bounds"),
-        pl.col("bounds").arr.slice(NUM_ELEMENTS, length=NUM_ELEMENTS).list.to_array(width=NUM_ELEMENTS).alias("max_bounds")
-    )
+            tolerance_ppm=precursor_mass_accuracy_ppm,
+            ranking=candidate_ranking_config(top_k=top_k_formulas),
+        )
 
-    # Mass decomposition
     chromatogram = chromatogram.with_columns(
         non_ionized_mass = pl.col("Precursor_mz_MSDIAL") - addcut_mass
     ).with_columns(
         pl.struct(
-            ["non_ionized_mass", "min_bounds", "max_bounds"]
+            ["non_ionized_mass", "min_bounds", "max_bounds", "Precursor_mz_MSDIAL", "ms1_isotopes_m/z", "ms1_isotopes_intensity"]
         ).map_batches(
-            lambda batch: decompose_mass_per_bounds(
-                batch.struct.field("non_ionized_mass"),
-                batch.struct.field("min_bounds"),
-                batch.struct.field("max_bounds"),
-                tolerance_ppm=precursor_mass_accuracy_ppm,
-            ),
+            decompose,
             return_dtype=pl.List(pl.Array(inner=pl.Int32, shape=(NUM_ELEMENTS,)))
         ).alias("decomposed_formulas")
-    ).drop(["bounds"])
+    )
     
     chromatogram = chromatogram.with_columns(pl.col("msms_m/z").sub(addcut_mass).alias("non_ionized_msms_m/z"))
-    chromatogram = chromatogram.explode("decomposed_formulas")
-    
-    # Cleaning + normalization (updated API requires observed precursor mass series)
+
+    # Cleaning + normalization, one result per candidate formula; the candidates of a row share
+    # one decomposition of its fragments, so the row is exploded only afterwards.
     chromatogram = chromatogram.with_columns(
         pl.struct(["decomposed_formulas", "non_ionized_mass", "non_ionized_msms_m/z", "msms_intensity"]).map_batches(
-            lambda batch: clean_and_normalize_spectra_known_precursor(
-                precursor_formula_series=batch.struct.field("decomposed_formulas"),
+            lambda batch: clean_and_normalize_spectra_candidate_precursors(
+                candidate_formulas_series=batch.struct.field("decomposed_formulas"),
                 precursor_masses_series=batch.struct.field("non_ionized_mass"),
                 fragment_masses_series=batch.struct.field("non_ionized_msms_m/z"),
                 fragment_intensities_series=batch.struct.field("msms_intensity"),
                 tolerance_ppm=fragment_mass_accuracy_ppm,
                 max_allowed_normalized_mass_error_ppm=normalized_fragment_mass_accuracy_ppm,
             ),
-            return_dtype=pl.Struct({
+            return_dtype=pl.List(pl.Struct({
                 "masses_normalized": pl.List(pl.Float64),
                 "cleaned_intensities": pl.List(pl.Float64),
                 "fragment_formulas": pl.List(pl.Array(inner=pl.Int32, shape=(NUM_ELEMENTS,))),
                 "fragment_errors_ppm": pl.List(pl.Float64),
-            }),
+            })),
         ).alias("cleaned_spectra")
+    ).explode(
+        ["decomposed_formulas", "cleaned_spectra"]
     ).with_columns(
         pl.col("cleaned_spectra").struct.unnest()
     ).rename(
@@ -1,14 +1,44 @@
 from .mass_decomposition import (
     decompose_mass,
     decompose_mass_per_bounds,
+    decompose_mass_with_isotopes,
+    iter_decompose_mass,
+    count_mass_decompositions,
+    estimate_decomposition_cost,
+    filter_formulas,
+    decompose_spectra,
     decompose_spectra_known_precursor,
     clean_spectra_known_precursor,
     clean_and_normalize_spectra_known_precursor,
+    clean_and_normalize_spectra_candidate_precursors,
+    get_residue_table_cache_stats,
+    set_residue_table_cache_capacity,
+    clear_residue_table_cache,
+    parallel_config,
+    chemistry_rules_config,
+    candidate_ranking_config,
+    isotope_scoring_config,
+    use_parallel_config,
+    get_parallel_config,
+    use_decomposition_cache,
 )
+from .decomposition_cache import decomposition_cache
+from .mass_lattice import build_mass_lattice, mass_lattice
+from .mass_tolerance import mass_tolerance_config
 from .isotopic_pattern import (
     isotopic_pattern_config,
     fits_isotopic_pattern_batch,
-    deduce_isotopic_pattern
+    fits_isotopic_pattern_arrays,
+    deduce_isotopic_pattern,
+    deduce_isotopic_bounds,
+)
+from .expressions import hrms_expressions
+from .isotope_envelope import (
+    predict_isotope_envelopes,
+    score_isotope_envelopes,
+    get_isotope_envelope_cache_stats,
+    set_isotope_envelope_cache_capacity,
+    clear_isotope_envelope_cache,
 )
 from .sirius import (
     get_all_compounds,
@@ -24,4 +54,6 @@ from .utils import (
     formula_to_array,
     element_masses,
     formula_array_element_dtype,
+    compact_formulas,
+    expand_formulas,
 )
\ No newline at end of file
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import numpy as np
+from numpy.typing import NDArray
+from pathlib import Path
+from typing import Any, Dict, Iterable, Tuple
+
+
+class decomposition_cache:
+    """
+    Persistent memo of precursor decompositions, shared across runs and processes through one local
+    SQLite file (stdlib, safe for concurrent readers and writers, updated in place).
+
+    Masses are quantized to buckets of mass_quantum_da. An entry holds every formula within the
+    tolerance window of any mass of its bucket (a slightly widened decomposition of the bucket
+    center), under one set of decomposition settings (bounds, tolerance, DBE range, chemistry rules,
+    the element table registered in the decomposer). decompose_mass and decompose_mass_per_bounds filter the entry to the exact
+    window of the requested mass, so cached and computed results are identical.
+
+    When the stored formulas exceed max_bytes, the least recently used entries are evicted.
+    hits / misses / stores / evictions count this object's lookups; entries and stored_bytes
+    describe the file.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30, mass_quantum_da: float = 1e-3):
+        assert isinstance(max_bytes, int) and max_bytes > 0, f"max_bytes should be a positive integer, but got {max_bytes}"
+        assert isinstance(mass_quantum_da, (float, int)) and mass_quantum_da > 0, (
+            f"mass_quantum_da should be a positive number, but got {mass_quantum_da}"
+        )
+        self.path = Path(path).expanduser()
+        self.max_bytes = max_bytes
+        self.mass_quantum_da = float(mass_quantum_da)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=60.0, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS decompositions ("
+            " settings TEXT NOT NULL, bucket INTEGER NOT NULL, formulas BLOB NOT NULL,"
+            " nbytes INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (settings, bucket))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS decompositions_last_used ON decompositions (last_used)")
+        self._connection.commit()
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+
+    def settings_key(self, settings: Dict[str, Any]) -> str:
+        """Digest of everything besides the mass that determines a decomposition."""
+        canonical = json.dumps({"mass_quantum_da": self.mass_quantum_da, **settings}, sort_keys=True, default=_json_default)
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def buckets(self, masses: NDArray[np.float64]) -> NDArray[np.int64]:
+        return np.rint(np.asarray(masses, dtype=np.float64) / self.mass_quantum_da).astype(np.int64)
+
+    def lookup(self, keys: Iterable[Tuple[str, int]], num_elements: int) -> Dict[Tuple[str, int], NDArray[np.int32]]:
+        """Stored (n, num_elements) int32 formulas of every key found; marks them as recently used."""
+        found = {}
+        with self._lock:
+            for settings, bucket in keys:
+                row = self._connection.execute(
+                    "SELECT formulas FROM decompositions WHERE settings = ? AND bucket = ?", (settings, int(bucket))
+                ).fetchone()
+                if row is None:
+                    self._misses += 1
+                    continue
+                self._hits += 1
+                found[(settings, bucket)] = np.frombuffer(row[0], dtype=np.int32).reshape(-1, num_elements)
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE decompositions SET last_used = ? WHERE settings = ? AND bucket = ?",
+                [(now, settings, int(bucket)) for settings, bucket in found],
+            )
+            self._connection.commit()
+        return found
+
+    def store(self, entries: Dict[Tuple[str, int], NDArray[np.int32]]) -> None:
+        """Insert or replace entries, then evict least recently used ones above max_bytes."""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for (settings, bucket), formulas in entries.items():
+            blob = np.ascontiguousarray(formulas, dtype=np.int32).tobytes()
+            rows.append((settings, int(bucket), blob, len(blob), now))
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO decompositions (settings, bucket, formulas, nbytes, last_used) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._stores += len(rows)
+            self._evict_locked()
+            self._connection.commit()
+
+    def _evict_locked(self) -> None:
+        stored_bytes = self._connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM decompositions").fetchone()[0]
+        while stored_bytes > self.max_bytes:
+            oldest = self._connection.execute(
+                "SELECT rowid, nbytes FROM decompositions ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not oldest:
+                break
+            evicted = []
+            for rowid, nbytes in oldest:
+                if stored_bytes <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                stored_bytes -= nbytes
+            self._connection.executemany("DELETE FROM decompositions WHERE rowid = ?", evicted)
+            self._evictions += len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        """hits, misses, stores, evictions, entries, stored_bytes, capacity_bytes."""
+        with self._lock:
+            entries, stored_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM decompositions"
+            ).fetchone()
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "stores": self._stores,
+            "evictions": self._evictions,
+            "entries": int(entries),
+            "stored_bytes": int(stored_bytes),
+            "capacity_bytes": self.max_bytes,
+        }
+
+    def clear(self) -> None:
+        """Drop every stored entry and reset the counters."""
+        with self._lock:
+            self._connection.execute("DELETE FROM decompositions")
+            self._connection.commit()
+            self._hits = self._misses = self._stores = self._evictions = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> 'decomposition_cache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        # NaN (disabled ratio rules) is not valid JSON
+        return [None if isinstance(v, float) and np.isnan(v) else v for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot use {type(value)} in a decomposition cache key")
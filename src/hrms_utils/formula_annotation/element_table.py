@@ -1,10 +1,18 @@
 """
-Single source of truth for formula element definitions used in Python code.
+Single source of truth for formula element definitions, in Python and in the C++ decomposer.
 
 - Only the elements listed here are supported by formula functions.
-- The order is fixed and must not be changed; it is by increasing monoisotopic mass.
-- All formula arrays, element lookups, and mass calculations must use this order.
-- Do not add, remove, or reorder elements without updating all dependent code.
+- The order is by increasing monoisotopic mass; all formula arrays, element lookups, and mass
+  calculations use this order.
+- The C++ decomposer has no element table of its own: mass_decomposition registers ELEMENTS (masses,
+  DBE contributions, valences) when it is imported, and every formula it returns is an
+  Array(Int32, NUM_ELEMENTS). The alphabet is fixed at that import; there is no public way to swap
+  it afterwards, since every module here sizes its arrays from NUM_ELEMENTS.
+- Adding an element, e.g. Se or a labeled isotope such as D, is an entry in ELEMENTS (and in
+  DEFAULT_MAX_BOUND) made before hrms_utils.formula_annotation is imported. It needs no rebuild, up
+  to the 32 elements the C++ formulas can hold (MAX_ELEMENTS there).
+  The C++ kernels store only the elements a decomposition can use, so an element that is usually
+  zero costs nothing until a bound allows it.
 """
 
 from typing import NamedTuple, Tuple, Dict, Optional
@@ -23,54 +31,56 @@ class ElementInfo(NamedTuple):
     isotope: str # Most abundant isotope symbol (may be same as element)
     isotope_mass_diff: float  # Mass difference to base isotope (0 if not relevant)
     isotopic_distribution: Optional[IsotopicDistribution] # None if not relevant
+    twice_dbe_coefficient: int  # Contribution of one atom to 2*DBE (e.g. C: 2, N: 1, O: 0, H and halogens: -1)
+    valence: int  # Lowest common valence, used by the Senior rules
 
 # Ordered by monoisotopic mass (lowest to highest)
 ELEMENTS: Tuple[ElementInfo, ...] = (
-    ElementInfo('H',   1.007825,    r'H(\d+|[A-Z]|$){1}',    '1H',   0.0, None),
-    ElementInfo('B',  11.009305,    r'B(\d+|[A-Z]|$){1}',   '11B',   0.0, None),
+    ElementInfo('H',   1.007825,    r'H(\d+|[A-Z]|$){1}',    '1H',   0.0, None, -1, 1),
+    ElementInfo('B',  11.009305,    r'B(\d+|[A-Z]|$){1}',   '11B',   0.0, None, 1, 3),
     ElementInfo('C',  12.000000,    r'C(\d+|[A-Z]|$){1}',   '12C',   0.0,
         IsotopicDistribution(
             mass_differences=(1.003355,), 
             abundances=(0.9893, 0.0107), 
             isotope_symbols=("12C", "13C")
-        )
+        ), 2, 4
     ),
     ElementInfo('N',  14.003074,    r'N(\d+|[A-Z]|$){1}',   '14N',   0.0,
         IsotopicDistribution(
             mass_differences=(0.997035,), 
             abundances=(0.996, 0.004), 
             isotope_symbols=("14N", "15N")
-        )
+        ), 1, 3
     ),
-    ElementInfo('O',  15.994915,    r'O(\d+|[A-Z]|$){1}',   '16O',   0.0, None),
-    ElementInfo('F',  18.998403,    r'F(\d+|[A-Z]|$){1}',   '19F',   0.0, None),
-    ElementInfo('Na', 22.989770,    r'Na(\d+|[A-Z]|$){1}',  '23Na',  0.0, None),
-    ElementInfo('Si', 27.9769265,   r'Si(\d+|[A-Z]|$){1}',  '28Si',  0.0, None),
-    ElementInfo('P',  30.973762,    r'P(\d+|[A-Z]|$){1}',   '31P',   0.0, None),
+    ElementInfo('O',  15.994915,    r'O(\d+|[A-Z]|$){1}',   '16O',   0.0, None, 0, 2),
+    ElementInfo('F',  18.998403,    r'F(\d+|[A-Z]|$){1}',   '19F',   0.0, None, -1, 1),
+    ElementInfo('Na', 22.989770,    r'Na(\d+|[A-Z]|$){1}',  '23Na',  0.0, None, 0, 1),
+    ElementInfo('Si', 27.9769265,   r'Si(\d+|[A-Z]|$){1}',  '28Si',  0.0, None, 2, 4),
+    ElementInfo('P',  30.973762,    r'P(\d+|[A-Z]|$){1}',   '31P',   0.0, None, 3, 3),
     ElementInfo('S',  31.972071,    r'S(\d+|[A-Z]|$){1}',   '32S',   0.0,
         IsotopicDistribution(
             mass_differences=(1.995796,), 
             abundances=(0.9493, 0.0429), 
             isotope_symbols=("32S", "34S")
-        )
+        ), 0, 2
     ),
     ElementInfo('Cl', 34.96885271,  r'Cl(\d+|[A-Z]|$){1}',  '35Cl',  1.99705,
         IsotopicDistribution(
             mass_differences=(1.99705,), 
             abundances=(0.7578, 0.2422), 
             isotope_symbols=("35Cl", "37Cl")
-        )
+        ), -1, 1
     ),
-    ElementInfo('K',  38.963707,    r'K(\d+|[A-Z]|$){1}',   '39K',   1.99820, None),
-    ElementInfo('As', 74.921596,    r'As(\d+|[A-Z]|$){1}',  '75As',  0.0, None),
+    ElementInfo('K',  38.963707,    r'K(\d+|[A-Z]|$){1}',   '39K',   1.99820, None, 0, 1),
+    ElementInfo('As', 74.921596,    r'As(\d+|[A-Z]|$){1}',  '75As',  0.0, None, 1, 3),
     ElementInfo('Br', 78.918338,    r'Br(\d+|[A-Z]|$){1}',  '79Br',  1.99795,
         IsotopicDistribution(
             mass_differences=(1.99795,), 
             abundances=(0.5069, 0.4931), 
             isotope_symbols=("79Br", "81Br")
-        )
+        ), -1, 1
     ),
-    ElementInfo('I', 126.904468,    r'I(\d+|[A-Z]|$){1}',   '127I',  0.0, None),
+    ElementInfo('I', 126.904468,    r'I(\d+|[A-Z]|$){1}',   '127I',  0.0, None, -1, 1),
 )
 
 NUM_ELEMENTS: int = len(ELEMENTS)
@@ -80,6 +90,8 @@ ELEMENT_REGEXES: Tuple[str, ...] = tuple(e.regex for e in ELEMENTS)
 ELEMENT_ISOTOPES: Tuple[str, ...] = tuple(e.isotope for e in ELEMENTS)
 ELEMENT_ISOTOPE_MASS_DIFFS: Tuple[float, ...] = tuple(e.isotope_mass_diff for e in ELEMENTS)
 ELEMENT_ISOTOPIC_DISTRIBUTIONS: Tuple[Optional[IsotopicDistribution], ...] = tuple(e.isotopic_distribution for e in ELEMENTS)
+ELEMENT_TWICE_DBE_COEFFICIENTS: Tuple[int, ...] = tuple(e.twice_dbe_coefficient for e in ELEMENTS)
+ELEMENT_VALENCES: Tuple[int, ...] = tuple(e.valence for e in ELEMENTS)
 DEFAULT_MIN_BOUND = {symbol: 0 for symbol in ELEMENT_SYMBOLS}
 DEFAULT_MAX_BOUND = {
     'H': 100,
@@ -99,6 +111,23 @@ DEFAULT_MAX_BOUND = {
     'I': 5,
 }
 
+# Every stable isotope, as (mass difference to the isotope whose mass is in ELEMENTS, natural
+# abundance), IUPAC representative abundances. Used by the isotope envelope prediction; the
+# isotopic_distribution entries above keep the first heavy isotope of the elements that the
+# isotopic bound deduction looks at. Elements missing here are monoisotopic.
+ELEMENT_ISOTOPE_ABUNDANCES: Dict[str, Tuple[Tuple[float, float], ...]] = {
+    'H': ((0.0, 0.999885), (1.0062767, 0.000115)),
+    'B': ((-0.9963684, 0.199), (0.0, 0.801)),
+    'C': ((0.0, 0.9893), (1.0033548, 0.0107)),
+    'N': ((0.0, 0.99636), (0.9970349, 0.00364)),
+    'O': ((0.0, 0.99757), (1.0042171, 0.00038), (2.0042464, 0.00205)),
+    'Si': ((0.0, 0.92223), (0.9995682, 0.04685), (1.9968437, 0.03092)),
+    'S': ((0.0, 0.9499), (0.9993878, 0.0075), (1.9957962, 0.0425), (3.9950101, 0.0001)),
+    'Cl': ((0.0, 0.7576), (1.9970499, 0.2424)),
+    'K': ((0.0, 0.932581), (1.0002918, 0.000117), (1.9981189, 0.067302)),
+    'Br': ((0.0, 0.5069), (1.9979535, 0.4931)),
+}
+
 # For fast lookup by symbol
 ELEMENT_INDEX: Dict[str, int] = {e.symbol: i for i, e in enumerate(ELEMENTS)}
 
@@ -0,0 +1,46 @@
+import polars as pl
+from typing import Any
+from .isotopic_pattern import deduce_isotopic_bounds, ISOTOPE_BOUNDS_DTYPE
+
+
+def _expression(column: str | pl.Expr) -> pl.Expr:
+    return pl.col(column) if isinstance(column, str) else column
+
+
+@pl.api.register_expr_namespace("hrms")
+class hrms_expressions:
+    """
+    hrms_utils functions as Polars expressions, registered as pl.Expr.hrms when
+    hrms_utils.formula_annotation is imported. Each one runs on the Arrow buffers of its input
+    columns, one batch at a time, and works in lazy and streaming queries.
+    """
+
+    def __init__(self, expr: pl.Expr):
+        self._expr = expr
+
+    def isotope_bounds(self, ms1_mzs: str | pl.Expr, ms1_intensities: str | pl.Expr, **kwargs: Any) -> pl.Expr:
+        """
+        deduce_isotopic_bounds of this precursor m/z expression and the MS1 peak list columns (names
+        or expressions); kwargs are those of deduce_isotopic_pattern. A Struct expression with
+        min_bounds and max_bounds Array(Int32, NUM_ELEMENTS) fields, e.g.
+
+            df.with_columns(
+                pl.col("precursor_mz").hrms.isotope_bounds("ms1_mzs", "ms1_intensities", max_bounds={"Cl": 4}).alias("bounds")
+            ).unnest("bounds")
+        """
+        bounds = pl.struct(
+            self._expr.alias("precursor_mz"),
+            _expression(ms1_mzs).alias("ms1_mzs"),
+            _expression(ms1_intensities).alias("ms1_intensities"),
+        ).map_batches(
+            lambda batch: deduce_isotopic_bounds(
+                batch.struct.field("precursor_mz"),
+                batch.struct.field("ms1_mzs"),
+                batch.struct.field("ms1_intensities"),
+                **kwargs,
+            ),
+            return_dtype=ISOTOPE_BOUNDS_DTYPE,
+            is_elementwise=True,
+        )
+        name = self._expr.meta.output_name(raise_if_undetermined=False)
+        return bounds if name is None else bounds.alias(name)
@@ -0,0 +1,436 @@
+import math
+import threading
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+from numba import njit, prange
+from numpy.typing import NDArray
+from collections import OrderedDict
+from typing import Dict
+from .element_table import ELEMENT_SYMBOLS, ELEMENT_ISOTOPE_ABUNDANCES
+from .isotopic_pattern import _list_buffers
+from .mass_decomposition import isotope_scoring_config
+
+NUM_ELEMENTS = len(ELEMENT_SYMBOLS)
+# an observed isotope peak is summed over mass_shift +- (ENVELOPE_SPREAD_WIDTH * mass_spread + isotopic tolerance)
+ENVELOPE_SPREAD_WIDTH = 2.0
+
+
+def _atom_isotope_tables() -> tuple[NDArray[np.float64], int, NDArray[np.int64], NDArray[np.bool_]]:
+    """
+    (3, NUM_ELEMENTS, n_shifts) abundance, abundance * mass shift and abundance * mass shift**2 of
+    one atom per nominal shift (from the lowest one); the lowest nominal shift; how far below the
+    monoisotopic peak one atom reaches (10B); and which elements have more than one isotope.
+    """
+    nominal = [int(round(shift)) for isotopes in ELEMENT_ISOTOPE_ABUNDANCES.values() for shift, _ in isotopes]
+    lowest, highest = min(nominal + [0]), max(nominal + [0])
+    tables = np.zeros((3, NUM_ELEMENTS, highest - lowest + 1))
+    negative_reach = np.zeros(NUM_ELEMENTS, dtype=np.int64)
+    has_isotopes = np.zeros(NUM_ELEMENTS, dtype=np.bool_)
+    for index, symbol in enumerate(ELEMENT_SYMBOLS):
+        isotopes = ELEMENT_ISOTOPE_ABUNDANCES.get(symbol, ((0.0, 1.0),))
+        has_isotopes[index] = len(isotopes) > 1
+        for shift, abundance in isotopes:
+            k = int(round(shift)) - lowest
+            tables[0, index, k] += abundance
+            tables[1, index, k] += abundance * shift
+            tables[2, index, k] += abundance * shift * shift
+            negative_reach[index] = max(negative_reach[index], -int(round(shift)))
+    return tables, lowest, negative_reach, has_isotopes
+
+
+ATOM_ISOTOPE_TABLES, LOWEST_ATOM_SHIFT, NEGATIVE_REACH, HAS_ISOTOPES = _atom_isotope_tables()
+
+
+@njit(cache=True)
+def _convolve(a, b, out, size, offset):
+    """out = a * b over nominal shifts (index = shift + offset, truncated to size), with mass-shift moments."""
+    out[:, :] = 0.0
+    for i in range(size):
+        if a[0, i] == 0.0:
+            continue
+        for j in range(size):
+            if b[0, j] == 0.0:
+                continue
+            k = i + j - offset
+            if k < 0 or k >= size:
+                continue
+            out[0, k] += a[0, i] * b[0, j]
+            out[1, k] += a[1, i] * b[0, j] + a[0, i] * b[1, j]
+            out[2, k] += a[2, i] * b[0, j] + 2.0 * a[1, i] * b[1, j] + a[0, i] * b[2, j]
+
+
+@njit(parallel=True, cache=True)
+def _isotope_envelope_kernel(formulas, atom_tables, lowest_shift, negative_reach, has_isotopes, n_peaks, out):
+    """
+    out[r] = (abundance, mass shift, mass spread) of the M+0 .. M+n_peaks-1 peaks of formula r:
+    each element's one-atom polynomial over nominal shifts raised to its count by squaring, and the
+    elements multiplied together, carrying the first two moments of the exact mass shift so every
+    nominal peak keeps the centroid and width of its fine structure. The window keeps the shifts
+    that can still contribute to M+0 .. M+n_peaks-1 (below M when 10B is present).
+    """
+    n_elements = formulas.shape[1]
+    n_atom_shifts = atom_tables.shape[2]
+    for r in prange(formulas.shape[0]):
+        offset = 0
+        for e in range(n_elements):
+            offset += formulas[r, e] * negative_reach[e]
+        size = n_peaks + 2 * offset
+        result = np.zeros((3, size))
+        result[0, offset] = 1.0
+        scratch = np.empty((3, size))
+        base = np.empty((3, size))
+        for e in range(n_elements):
+            count = formulas[r, e]
+            if count <= 0 or not has_isotopes[e]:
+                continue
+            base[:, :] = 0.0
+            for s in range(n_atom_shifts):
+                k = s + lowest_shift + offset
+                if 0 <= k < size:
+                    base[:, k] = atom_tables[:, e, s]
+            while True:
+                if count & 1:
+                    _convolve(result, base, scratch, size, offset)
+                    result, scratch = scratch, result
+                count >>= 1
+                if count == 0:
+                    break
+                _convolve(base, base, scratch, size, offset)
+                base, scratch = scratch, base
+        for k in range(n_peaks):
+            abundance = result[0, offset + k]
+            out[r, 0, k] = abundance
+            if abundance > 0.0:
+                mean = result[1, offset + k] / abundance
+                out[r, 1, k] = mean
+                out[r, 2, k] = math.sqrt(max(result[2, offset + k] / abundance - mean * mean, 0.0))
+            else:
+                out[r, 1, k] = np.nan
+                out[r, 2, k] = np.nan
+
+
+@njit(parallel=True, cache=True)
+def _formula_hashes(formulas):
+    """64-bit FNV-1a hash of each formula row."""
+    hashes = np.empty(formulas.shape[0], dtype=np.uint64)
+    for r in prange(formulas.shape[0]):
+        h = np.uint64(14695981039346656037)
+        for e in range(formulas.shape[1]):
+            h = (h ^ np.uint64(formulas[r, e])) * np.uint64(1099511628211)
+        hashes[r] = h
+    return hashes
+
+
+class _envelope_memo:
+    """
+    Process-wide memo of predicted envelopes keyed by (n_peaks, formula), so repeated candidates
+    across calls are not recomputed. Envelopes live in one growing array per n_peaks; a dict in
+    least-recently-used order maps each formula to its row, so a call costs O(its batch size)
+    whatever the number of entries. Beyond capacity, the least recently used entries are evicted
+    and their rows reused.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._rows: OrderedDict = OrderedDict()  # (n_peaks, formula bytes) -> row, least recently used first
+        self._envelopes: Dict[int, NDArray[np.float64]] = {}
+        self._free_rows: Dict[int, list] = {}
+        self._used_rows: Dict[int, int] = {}
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _keys(formulas) -> list:
+        return np.ascontiguousarray(formulas).view(np.dtype((np.void, formulas.shape[1] * formulas.itemsize))).reshape(-1).tolist()
+
+    def lookup(self, n_peaks: int, formulas, envelopes) -> NDArray[np.bool_]:
+        found = np.zeros(len(formulas), dtype=np.bool_)
+        with self._lock:
+            if n_peaks in self._envelopes and len(formulas) > 0:
+                rows = np.empty(len(formulas), dtype=np.int64)
+                for i, key in enumerate(self._keys(formulas)):
+                    row = self._rows.get((n_peaks, key))
+                    if row is not None:
+                        self._rows.move_to_end((n_peaks, key))
+                        found[i] = True
+                        rows[i] = row
+                envelopes[found] = self._envelopes[n_peaks][rows[found]]
+            self._hits += int(found.sum())
+            self._misses += int(len(found) - found.sum())
+        return found
+
+    def store(self, n_peaks: int, formulas, envelopes) -> None:
+        if self.capacity == 0 or len(formulas) == 0:
+            return
+        if len(formulas) > self.capacity:
+            formulas, envelopes = formulas[-self.capacity:], envelopes[-self.capacity:]
+        with self._lock:
+            keys = [(n_peaks, key) for key in self._keys(formulas)]
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            for _ in range(len(self._rows) + len(new) - self.capacity):
+                (evicted_peaks, _), row = self._rows.popitem(last=False)
+                self._free_rows[evicted_peaks].append(row)
+            stored = self._envelopes.get(n_peaks, np.empty((0, 3, n_peaks)))
+            free_rows = self._free_rows.setdefault(n_peaks, [])
+            used_rows = self._used_rows.get(n_peaks, 0)
+            n_fresh = max(0, len(new) - len(free_rows))
+            if used_rows + n_fresh > len(stored):
+                grown = np.empty((max(2 * len(stored), used_rows + n_fresh, 1024), 3, n_peaks))
+                grown[:used_rows] = stored[:used_rows]
+                stored = grown
+            rows = np.empty(len(new), dtype=np.int64)
+            for j, i in enumerate(new):
+                if free_rows:
+                    rows[j] = free_rows.pop()
+                else:
+                    rows[j] = used_rows
+                    used_rows += 1
+                self._rows[keys[i]] = int(rows[j])
+            stored[rows] = envelopes[new]
+            self._envelopes[n_peaks] = stored
+            self._used_rows[n_peaks] = used_rows
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": len(self._rows),
+                "capacity": self.capacity,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
+            self._envelopes.clear()
+            self._free_rows.clear()
+            self._used_rows.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+_ENVELOPE_MEMO = _envelope_memo(capacity=1_000_000)
+
+
+def get_isotope_envelope_cache_stats() -> Dict[str, int]:
+    """
+    Statistics of the process-wide memo of predicted isotope envelopes, keyed by formula and
+    n_peaks. Keys: hits, misses (unique formulas per call), entries, capacity (formulas).
+    """
+    return _ENVELOPE_MEMO.stats()
+
+
+def set_isotope_envelope_cache_capacity(capacity: int) -> None:
+    """Set the maximum number of memoized envelopes; 0 disables the memo."""
+    assert isinstance(capacity, int) and capacity >= 0, f"capacity should be a non-negative integer, but got {capacity}"
+    _ENVELOPE_MEMO.capacity = capacity
+    _ENVELOPE_MEMO.clear()
+
+
+def clear_isotope_envelope_cache() -> None:
+    """Drop every memoized envelope and reset the statistics."""
+    _ENVELOPE_MEMO.clear()
+
+
+def _predict_envelopes(formulas: NDArray[np.int32], n_peaks: int) -> NDArray[np.float64]:
+    """(n, 3, n_peaks) abundance / mass shift / mass spread of (n, NUM_ELEMENTS) formulas, each unique formula computed once."""
+    formulas = np.ascontiguousarray(formulas, dtype=np.int32)
+    assert np.all(formulas >= 0), "formulas should not have negative counts"
+    hashes = _formula_hashes(formulas)
+    unique_hashes, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    unique_formulas = formulas[first]
+    unique_envelopes = np.empty((len(unique_hashes), 3, n_peaks))
+    found = _ENVELOPE_MEMO.lookup(n_peaks, unique_formulas, unique_envelopes)
+    missing = np.flatnonzero(~found)
+    if len(missing) > 0:
+        computed = np.empty((len(missing), 3, n_peaks))
+        _isotope_envelope_kernel(
+            unique_formulas[missing], ATOM_ISOTOPE_TABLES, LOWEST_ATOM_SHIFT, NEGATIVE_REACH, HAS_ISOTOPES, n_peaks, computed
+        )
+        unique_envelopes[missing] = computed
+        _ENVELOPE_MEMO.store(n_peaks, unique_formulas[missing], computed)
+    envelopes = unique_envelopes[inverse.reshape(-1)]
+    # distinct formulas with the same hash
+    collided = np.flatnonzero(np.any(formulas != unique_formulas[inverse.reshape(-1)], axis=1))
+    if len(collided) > 0:
+        computed = np.empty((len(collided), 3, n_peaks))
+        _isotope_envelope_kernel(formulas[collided], ATOM_ISOTOPE_TABLES, LOWEST_ATOM_SHIFT, NEGATIVE_REACH, HAS_ISOTOPES, n_peaks, computed)
+        envelopes[collided] = computed
+    return envelopes
+
+
+def _formula_array(formulas: pl.Series) -> tuple[NDArray[np.int32], NDArray[np.int64] | None]:
+    """(n, NUM_ELEMENTS) formulas of an Array or List(Array) Series, and the candidate counts of the List form."""
+    if isinstance(formulas.dtype, pl.List):
+        assert formulas.dtype == pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)), (
+            f"formulas should be of type Array(Int32, {NUM_ELEMENTS}) or List(Array(Int32, {NUM_ELEMENTS})), but got {formulas.dtype}"
+        )
+        counts = formulas.list.len().fill_null(0).to_numpy().astype(np.int64)
+        values = pc.list_flatten(pc.list_flatten(formulas.to_arrow()))
+    else:
+        assert formulas.dtype == pl.Array(pl.Int32, NUM_ELEMENTS), (
+            f"formulas should be of type Array(Int32, {NUM_ELEMENTS}) or List(Array(Int32, {NUM_ELEMENTS})), but got {formulas.dtype}"
+        )
+        assert formulas.null_count() == 0, "formulas should not contain nulls"
+        counts = None
+        values = pc.list_flatten(formulas.to_arrow())
+    return np.asarray(values.to_numpy(zero_copy_only=False), dtype=np.int32).reshape(-1, NUM_ELEMENTS), counts
+
+
+def predict_isotope_envelopes(formulas: pl.Series, n_peaks: int = 4) -> pl.Series:
+    """
+    Isotope envelope of each formula (neutral, or an ion formula, the electron mass does not matter
+    here): a Struct Series named "isotope_envelope" with, per nominal peak M+0 .. M+n_peaks-1,
+        abundance: fraction of the molecules in the peak (M+0 is the monoisotopic one),
+        mass_shift: abundance-weighted mean mass difference to M+0 of its isotopologues (Da),
+        mass_spread: their standard deviation (Da), the width of the unresolved fine structure,
+    as Array(Float64, n_peaks) fields; mass_shift and mass_spread are NaN where abundance is 0.
+
+    Every stable isotope of element_table.ELEMENT_ISOTOPE_ABUNDANCES is used, combined as
+    polynomials over nominal shifts truncated to the requested peaks (no approximation within
+    them). Each unique formula is computed once, and remembered across calls, see
+    get_isotope_envelope_cache_stats.
+
+    formulas is a pl.Array(pl.Int32, NUM_ELEMENTS) Series without nulls.
+    """
+    assert isinstance(n_peaks, int) and n_peaks >= 1, f"n_peaks should be a positive integer, but got {n_peaks}"
+    assert formulas.dtype == pl.Array(pl.Int32, NUM_ELEMENTS), (
+        f"formulas should be of type Array(Int32, {NUM_ELEMENTS}), but got {formulas.dtype}"
+    )
+    formula_array, _ = _formula_array(formulas)
+    envelopes = _predict_envelopes(formula_array, n_peaks)
+    return pl.DataFrame({
+        "abundance": pl.Series(envelopes[:, 0, :], dtype=pl.Array(pl.Float64, n_peaks)),
+        "mass_shift": pl.Series(envelopes[:, 1, :], dtype=pl.Array(pl.Float64, n_peaks)),
+        "mass_spread": pl.Series(envelopes[:, 2, :], dtype=pl.Array(pl.Float64, n_peaks)),
+    }).to_struct("isotope_envelope")
+
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def _score_envelopes_kernel(
+    envelopes,            # (M, 3, n_peaks) predicted abundance / mass shift / mass spread per candidate
+    spectrum_of_row,      # (M,) int64
+    precursor_mzs,        # (N,)
+    mz_values,            # all MS1 m/z values, concatenated
+    intensity_values,     # matching intensities
+    offsets,              # (N + 1,) int64
+    ms1_windows,          # (N,) Da
+    isotopic_windows,     # (N,) Da
+    minimum_intensity,
+    intensity_absolute_tolerance,
+    intensity_relative_tolerance,
+    spread_width,
+    out,                  # (M,) deviation, inf if rejected, NaN without a monoisotopic peak
+):
+    n_spectra = precursor_mzs.shape[0]
+    monoisotopic_mzs = np.zeros(n_spectra)
+    monoisotopic_intensities = np.zeros(n_spectra)
+    for i in prange(n_spectra):
+        # M: the most intense peak within the MS1 window, as in deduce_isotopic_pattern
+        for p in range(offsets[i], offsets[i + 1]):
+            if abs(mz_values[p] - precursor_mzs[i]) <= ms1_windows[i] and intensity_values[p] > monoisotopic_intensities[i]:
+                monoisotopic_mzs[i] = mz_values[p]
+                monoisotopic_intensities[i] = intensity_values[p]
+    for r in prange(envelopes.shape[0]):
+        i = spectrum_of_row[r]
+        monoisotopic_intensity = monoisotopic_intensities[i]
+        if not monoisotopic_intensity > 0.0:
+            out[r] = np.nan
+            continue
+        deviation = 0.0
+        for k in range(1, envelopes.shape[2]):
+            shift = envelopes[r, 1, k]
+            if shift != shift:
+                continue
+            predicted = envelopes[r, 0, k] / envelopes[r, 0, 0]
+            half_window = spread_width * envelopes[r, 2, k] + isotopic_windows[i]
+            intensity = 0.0
+            for p in range(offsets[i], offsets[i + 1]):
+                if abs(mz_values[p] - (monoisotopic_mzs[i] + shift)) <= half_window:
+                    intensity += intensity_values[p]
+            if intensity < minimum_intensity:
+                # absent or below the detection limit: anything up to the limit fits
+                observed = 0.0
+                lower = 0.0
+                upper = minimum_intensity / monoisotopic_intensity
+            else:
+                observed = intensity / monoisotopic_intensity
+                lower = max(0.0, (intensity * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) / monoisotopic_intensity)
+                upper = (intensity * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) / monoisotopic_intensity
+            if predicted < lower or predicted > upper:
+                deviation = np.inf
+                break
+            half_width = upper - observed if predicted > observed else observed - lower
+            if half_width > 0.0:
+                normalized = (predicted - observed) / half_width
+                deviation += normalized * normalized
+        out[r] = deviation
+
+
+def score_isotope_envelopes(
+    formulas: pl.Series,
+    precursor_mzs: pl.Series,
+    ms1_mzs: pl.Series,
+    ms1_intensities: pl.Series,
+    scoring: isotope_scoring_config | None = None,
+    n_peaks: int = 4,
+) -> pl.Series:
+    """
+    Deviation of each candidate's predicted isotope envelope (predict_isotope_envelopes) from its
+    MS1 spectrum, lower is better; the same measure as the isotope ranking of
+    decompose_mass_with_isotopes, over the full envelope M+1 .. M+n_peaks-1:
+
+    M is the most intense peak within scoring.ms1_tolerance of the precursor m/z. For each
+    isotope peak the observed intensity is the sum of the peaks within the predicted mass_shift
+    +- (ENVELOPE_SPREAD_WIDTH * mass_spread + scoring.isotopic_tolerance) of M, which gives an
+    accepted interval of its ratio to M (scoring.minimum_intensity and the intensity tolerances,
+    see isotope_scoring_config). The deviation is the sum over peaks of the squared
+    interval-normalized differences between predicted and observed ratios; it is inf when a
+    predicted ratio falls outside its interval, and null when the spectrum has no M peak.
+
+    formulas is pl.Array(pl.Int32, NUM_ELEMENTS), one candidate per spectrum row, giving a Float64 Series;
+    or pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)), the candidates of each spectrum, giving a List(Float64)
+    Series. precursor_mzs (Float64), ms1_mzs and ms1_intensities (List(Float64)) have one row per
+    spectrum. scoring None uses the isotope_scoring_config defaults.
+    """
+    scoring = isotope_scoring_config() if scoring is None else scoring
+    assert isinstance(scoring, isotope_scoring_config), f"scoring should be an isotope_scoring_config, but got {type(scoring)}"
+    assert isinstance(n_peaks, int) and n_peaks >= 2, f"n_peaks should be an integer of at least 2, but got {n_peaks}"
+    assert len(precursor_mzs) == len(formulas) == len(ms1_mzs) == len(ms1_intensities), (
+        "formulas, precursor_mzs, ms1_mzs and ms1_intensities should have the same length"
+    )
+    formula_array, candidate_counts = _formula_array(formulas)
+    spectrum_of_row = (
+        np.arange(len(formulas), dtype=np.int64) if candidate_counts is None
+        else np.repeat(np.arange(len(formulas), dtype=np.int64), candidate_counts)
+    )
+    mz_values, mz_offsets = _list_buffers(ms1_mzs)
+    intensity_values, intensity_offsets = _list_buffers(ms1_intensities)
+    assert np.array_equal(mz_offsets, intensity_offsets), "ms1_mzs and ms1_intensities should have the same list lengths"
+    precursor_mz_array = precursor_mzs.cast(pl.Float64).fill_null(np.nan).to_numpy()
+
+    deviations = np.empty(len(formula_array))
+    _score_envelopes_kernel(
+        _predict_envelopes(formula_array, n_peaks),
+        spectrum_of_row,
+        precursor_mz_array,
+        mz_values,
+        intensity_values,
+        mz_offsets,
+        scoring.ms1_tolerance.tolerance_da(precursor_mz_array),
+        scoring.isotopic_tolerance.tolerance_da(precursor_mz_array),
+        float(scoring.minimum_intensity),
+        float(scoring.intensity_absolute_tolerance),
+        float(scoring.intensity_relative_tolerance),
+        ENVELOPE_SPREAD_WIDTH,
+        deviations,
+    )
+    values = pa.array(deviations, mask=np.isnan(deviations), type=pa.float64())
+    if candidate_counts is not None:
+        offsets = np.zeros(len(formulas) + 1, dtype=np.int64)
+        np.cumsum(candidate_counts, out=offsets[1:])
+        values = pa.LargeListArray.from_arrays(pa.array(offsets, type=pa.int64()), values)
+    return pl.Series("isotope_deviation", values)
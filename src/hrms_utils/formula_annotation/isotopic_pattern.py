@@ -1,10 +1,15 @@
+import math
 import numpy as np
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 import polars as pl
 from typing import Dict, TypeVar, overload
 from .element_table import ELEMENTS, ELEMENT_SYMBOLS, DEFAULT_MIN_BOUND, DEFAULT_MAX_BOUND
-from numba import njit, jit
+from .mass_tolerance import mass_tolerance_config
+import pyarrow as pa
+import pyarrow.compute as pc
+from numba import njit, prange
 NITROGEN_SEPARATION_RESOLUTION=1e5
 
 @dataclass
@@ -36,7 +41,6 @@ class isotopic_pattern_config:
         kwargs['mass_tolerance'] = mass_tolerance
         kwargs['ms1_resolution'] = ms1_resolution
         return cls(**kwargs)
-MASS_ACCURACY_PPM_TO_DA_THRESHOLD = 200.0
 
 # Get isotopic pattern info from ELEMENTS
 def get_isotopic_pattern_dict():
@@ -63,66 +67,34 @@ def fits_isotopic_pattern_batch(mzs_batch, intensities_batch, formulas, precurso
     precursor_mzs: array, length=batch
     config: isotopic_pattern_config (same for all)
     Returns: array of bool, shape (batch,)
+
+    For formula arrays and polars columns, fits_isotopic_pattern_arrays avoids parsing the strings.
     """
     if len(formulas) == 0:
         return np.array([], dtype=bool)
-
-    batch_size = len(formulas)
     # Get element numbers for all formulas (shape: batch, n_elements)
-    element_numbers_batch = np.stack([get_element_numbers(f) for f in formulas])
-
-    # Find precursor indices and intensities for each spectrum
-    precursor_indices = []
-    precursor_intensities = []
-    for i in range(batch_size):
-        mzs = mzs_batch[i]
-        intensities = intensities_batch[i]
-        diffs = np.abs(mzs - precursor_mzs[i])
-        idx = diffs.argmin()
-        precursor_indices.append(idx)
-        precursor_intensities.append(intensities[idx])
-
-    # Prepare element_fits (batch, n_elements)
-    n_iso = len(isotopic_pattern_dict)
-    element_fits = np.zeros((batch_size, n_iso), dtype=bool)
-    iso_keys = list(isotopic_pattern_dict.keys())
-
-    # C and N
-    if config.ms1_resolution > NITROGEN_SEPARATION_RESOLUTION:
-        # C
-        for idx in range(batch_size):
-            element_fits[idx, iso_keys.index('C')] = check_element_fit(
-                config, iso_keys.index('C'), mzs_batch[idx], intensities_batch[idx],
-                element_numbers_batch[idx, ELEMENT_SYMBOLS.index('C')], precursor_mzs[idx], precursor_intensities[idx]
-            )
-        # N
-        for idx in range(batch_size):
-            element_fits[idx, iso_keys.index('N')] = check_element_fit(
-                config, iso_keys.index('N'), mzs_batch[idx], intensities_batch[idx],
-                element_numbers_batch[idx, ELEMENT_SYMBOLS.index('N')], precursor_mzs[idx], precursor_intensities[idx]
-            )
-    else:
-        # CN combined
-        for idx in range(batch_size):
-            CN_fit = check_CN_fit(
-                config, mzs_batch[idx], intensities_batch[idx],
-                element_numbers_batch[idx, ELEMENT_SYMBOLS.index('C')],
-                element_numbers_batch[idx, ELEMENT_SYMBOLS.index('N')],
-                precursor_mzs[idx], precursor_intensities[idx]
-            )
-            element_fits[idx, iso_keys.index('C')] = CN_fit
-            element_fits[idx, iso_keys.index('N')] = CN_fit
-
-    # S, Cl, Br
-    for symbol in ['S', 'Cl', 'Br']:
-        i = iso_keys.index(symbol)
-        for idx in range(batch_size):
-            element_fits[idx, i] = check_element_fit(
-                config, i, mzs_batch[idx], intensities_batch[idx],
-                element_numbers_batch[idx, ELEMENT_SYMBOLS.index(symbol)], precursor_mzs[idx], precursor_intensities[idx]
-            )
-
-    return np.all(element_fits, axis=1)
+    element_numbers_batch = np.stack([get_element_numbers(f) for f in formulas]).astype(np.int32)
+    offsets = np.zeros(len(formulas) + 1, dtype=np.int64)
+    np.cumsum([len(mzs) for mzs in mzs_batch], out=offsets[1:])
+    fits = np.empty(len(formulas), dtype=np.int8)
+    _fits_isotopic_pattern_kernel(
+        element_numbers_batch,
+        np.arange(len(formulas), dtype=np.int64),
+        np.asarray(precursor_mzs, dtype=np.float64),
+        np.concatenate([np.asarray(mzs, dtype=np.float64) for mzs in mzs_batch]),
+        np.concatenate([np.asarray(intensities, dtype=np.float64) for intensities in intensities_batch]),
+        offsets,
+        float(config.mass_tolerance),
+        float(config.minimum_intensity),
+        float(config.max_intensity_ratio),
+        config.ms1_resolution > NITROGEN_SEPARATION_RESOLUTION,
+        FIT_ISOTOPE_COLUMNS,
+        FIT_ISOTOPE_MASS_DIFFS,
+        FIT_ISOTOPE_ZERO_PROBS,
+        FIT_ISOTOPE_FIRST_PROBS,
+        fits,
+    )
+    return fits == 1
 
 def get_element_numbers(formula:str) -> np.ndarray:
     # Returns array of element counts in the order of ELEMENT_SYMBOLS
@@ -135,71 +107,194 @@ def get_element_numbers(formula:str) -> np.ndarray:
             arr[i] = int(num.group()) if num is not None else 1
     return arr
 
-def check_element_fit(
-        config:isotopic_pattern_config,
-        i:int,
-        mzs:np.ndarray,
-        intensities:np.ndarray,
-        element_number:int,
-        precursor_mz:float,
-        precursor_intensity:float):
-    if element_number == 0:
-        return True
-    iso_keys = list(isotopic_pattern_dict.keys())
-    iso = isotopic_pattern_dict[iso_keys[i]]
-    zero_isotope_intensity = np.power(iso["zero_isotope_probability"], element_number)
-    computed_isotope_relative_intensity = iso["first_isotope_probability"] * element_number / zero_isotope_intensity
-    computed_isotope_intensity = precursor_intensity * computed_isotope_relative_intensity
-    if computed_isotope_intensity < config.minimum_intensity:
-        return True
-    computed_isotope_mass = precursor_mz + iso["mass_difference"]
-    best_fit_index = (np.abs(mzs-computed_isotope_mass)).argmin()
-    isotope_mass = mzs[best_fit_index]
+def fits_isotopic_pattern_arrays(
+    formulas: pl.Series,
+    precursor_mzs: pl.Series,
+    ms1_mzs: pl.Series,
+    ms1_intensities: pl.Series,
+    config: isotopic_pattern_config,
+) -> pl.Series:
+    """
+    fits_isotopic_pattern_batch for formula arrays: whether the MS1 peaks of each candidate's
+    spectrum agree with its C, N, S, Cl and Br isotope peaks, all candidates and elements evaluated
+    in one compiled pass.
 
-    if not np.isclose(isotope_mass,computed_isotope_mass,rtol=config.mass_tolerance):
-        return False
+    formulas is either pl.Array(pl.Int32, NUM_ELEMENTS), one candidate per spectrum row (e.g. an exploded
+    candidate table), giving a pl.Boolean Series; or pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)), the candidates
+    of each spectrum as returned by decompose_mass_per_bounds, giving a pl.List(pl.Boolean) Series.
+    precursor_mzs (Float64), ms1_mzs and ms1_intensities (List(Float64)) have one row per spectrum.
+    The result is null where the spectrum has no peaks.
+
+    Per element, as in fits_isotopic_pattern_batch: the precursor intensity is that of the peak
+    nearest to the precursor m/z; if the predicted isotope peak is above config.minimum_intensity,
+    the peak nearest to its m/z must be within config.mass_tolerance (relative) and its intensity
+    within a factor config.max_intensity_ratio of the prediction. Below
+    NITROGEN_SEPARATION_RESOLUTION, C and N are tested as one combined M+1 peak.
+    """
+    n_elements = len(ELEMENT_SYMBOLS)
+    nested = isinstance(formulas.dtype, pl.List)
+    expected_dtype = pl.List(pl.Array(pl.Int32, n_elements)) if nested else pl.Array(pl.Int32, n_elements)
+    assert formulas.dtype == expected_dtype, (
+        f"formulas should be of type Array(Int32, {n_elements}) or List(Array(Int32, {n_elements})), but got {formulas.dtype}"
+    )
+    assert isinstance(config, isotopic_pattern_config), f"config should be an isotopic_pattern_config, but got {type(config)}"
+    assert len(precursor_mzs) == len(formulas) == len(ms1_mzs) == len(ms1_intensities), (
+        "formulas, precursor_mzs, ms1_mzs and ms1_intensities should have the same length"
+    )
+    mz_values, mz_offsets = _list_buffers(ms1_mzs)
+    intensity_values, intensity_offsets = _list_buffers(ms1_intensities)
+    assert np.array_equal(mz_offsets, intensity_offsets), "ms1_mzs and ms1_intensities should have the same list lengths"
+    if nested:
+        candidate_counts = formulas.list.len().fill_null(0).to_numpy()
+        flat_formulas = pc.list_flatten(pc.list_flatten(formulas.to_arrow()))
+        spectrum_of_row = np.repeat(np.arange(len(formulas), dtype=np.int64), candidate_counts)
     else:
-        isotope_intensity = intensities[best_fit_index]
-        intensity_ratio = isotope_intensity/computed_isotope_intensity
-        if intensity_ratio > config.max_intensity_ratio or intensity_ratio < 1/config.max_intensity_ratio:
-            return False
+        assert formulas.null_count() == 0, "formulas should not contain nulls"
+        flat_formulas = pc.list_flatten(formulas.to_arrow())
+        spectrum_of_row = np.arange(len(formulas), dtype=np.int64)
+    formula_array = np.asarray(flat_formulas.to_numpy(zero_copy_only=False), dtype=np.int32).reshape(-1, n_elements)
+
+    fits = np.empty(len(spectrum_of_row), dtype=np.int8)
+    _fits_isotopic_pattern_kernel(
+        formula_array,
+        spectrum_of_row,
+        np.nan_to_num(precursor_mzs.cast(pl.Float64).to_numpy(), nan=-np.inf),
+        mz_values,
+        intensity_values,
+        mz_offsets,
+        float(config.mass_tolerance),
+        float(config.minimum_intensity),
+        float(config.max_intensity_ratio),
+        config.ms1_resolution > NITROGEN_SEPARATION_RESOLUTION,
+        FIT_ISOTOPE_COLUMNS,
+        FIT_ISOTOPE_MASS_DIFFS,
+        FIT_ISOTOPE_ZERO_PROBS,
+        FIT_ISOTOPE_FIRST_PROBS,
+        fits,
+    )
+    values = pa.array(fits == 1, mask=fits < 0, type=pa.bool_())
+    if nested:
+        offsets = np.zeros(len(formulas) + 1, dtype=np.int64)
+        np.cumsum(candidate_counts, out=offsets[1:])
+        values = pa.LargeListArray.from_arrays(pa.array(offsets, type=pa.int64()), values)
+    return pl.Series("fits", values)
+
+# the elements tested by the fits functions, in the order of isotopic_pattern_dict: C, N, S, Cl, Br
+FIT_ISOTOPE_COLUMNS = np.array([iso["index"] for iso in isotopic_pattern_dict.values()], dtype=np.int64)
+FIT_ISOTOPE_MASS_DIFFS = np.array([iso["mass_difference"] for iso in isotopic_pattern_dict.values()])
+FIT_ISOTOPE_ZERO_PROBS = np.array([iso["zero_isotope_probability"] for iso in isotopic_pattern_dict.values()])
+FIT_ISOTOPE_FIRST_PROBS = np.array([iso["first_isotope_probability"] for iso in isotopic_pattern_dict.values()])
+_FIT_C, _FIT_N = list(isotopic_pattern_dict).index('C'), list(isotopic_pattern_dict).index('N')
+
+@njit(cache=True)
+def _nearest_peak(mzs, start, end, is_sorted, target):
+    """Index of the peak nearest to target (the first one on ties, like argmin), -1 for no peaks."""
+    if end <= start:
+        return -1
+    if not is_sorted:
+        best = start
+        for j in range(start + 1, end):
+            if abs(mzs[j] - target) < abs(mzs[best] - target):
+                best = j
+        return best
+    low, high = start, end
+    while low < high:
+        middle = (low + high) // 2
+        if mzs[middle] < target:
+            low = middle + 1
         else:
-            return True
-
-def check_CN_fit(
-        config:isotopic_pattern_config,
-        mzs:np.ndarray,
-        intensities:np.ndarray,
-        C_number:int,
-        N_number:int,
-        precursor_mz:float,
-        precursor_intensity:float):
-    '''checks for fit of the combined N and C isotopic ratio'''
-    iso_C = isotopic_pattern_dict['C']
-    iso_N = isotopic_pattern_dict['N']
-    if N_number == 0:
-        return check_element_fit(config, list(isotopic_pattern_dict.keys()).index('C'), mzs, intensities, C_number, precursor_mz, precursor_intensity)
-    if C_number == 0:
-        return check_element_fit(config, list(isotopic_pattern_dict.keys()).index('N'), mzs, intensities, N_number, precursor_mz, precursor_intensity)
-
-    zero_isotope_intensity = np.power(iso_C["zero_isotope_probability"], C_number) * np.power(iso_N["zero_isotope_probability"], N_number)
-    computed_isotope_relative_intensity = (iso_C["first_isotope_probability"]*C_number + iso_N["first_isotope_probability"]*N_number) / zero_isotope_intensity
-    computed_isotope_intensity = precursor_intensity * computed_isotope_relative_intensity
-    if computed_isotope_intensity < config.minimum_intensity:
-        return True
-    computed_isotope_mass = precursor_mz + iso_C["mass_difference"]
-    best_fit_index = (np.abs(mzs-computed_isotope_mass)).argmin()
-    isotope_mass = mzs[best_fit_index]
+            high = middle
+    if low == end:
+        best = end - 1
+    elif low == start or abs(mzs[low] - target) < abs(mzs[low - 1] - target):
+        best = low
+    else:
+        best = low - 1
+    # the first of equal m/z values
+    while best > start and mzs[best - 1] == mzs[best]:
+        best -= 1
+    return best
 
-    if not np.isclose(isotope_mass,computed_isotope_mass,rtol=config.mass_tolerance):
+@njit(cache=True)
+def _isotope_peak_fits(
+    mzs, intensities, start, end, is_sorted, precursor_mz, precursor_intensity,
+    mass_difference, relative_intensity, mass_tolerance, minimum_intensity, max_intensity_ratio,
+):
+    computed_isotope_intensity = precursor_intensity * relative_intensity
+    if computed_isotope_intensity < minimum_intensity:
+        return True
+    computed_isotope_mass = precursor_mz + mass_difference
+    best_fit_index = _nearest_peak(mzs, start, end, is_sorted, computed_isotope_mass)
+    # np.isclose(isotope_mass, computed_isotope_mass, rtol=mass_tolerance)
+    if not abs(mzs[best_fit_index] - computed_isotope_mass) <= 1e-8 + mass_tolerance * abs(computed_isotope_mass):
         return False
-    else:
-        isotope_intensity = intensities[best_fit_index]
-        intensity_ratio = isotope_intensity/computed_isotope_intensity
-        if intensity_ratio > config.max_intensity_ratio or intensity_ratio < 1/config.max_intensity_ratio:
-            return False
-        else:
-            return True
+    intensity_ratio = intensities[best_fit_index] / computed_isotope_intensity
+    return not (intensity_ratio > max_intensity_ratio or intensity_ratio < 1 / max_intensity_ratio)
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def _fits_isotopic_pattern_kernel(
+    formulas: np.ndarray,           # (M, NUM_ELEMENTS) int32 candidates
+    spectrum_of_row: np.ndarray,    # (M,) int64 spectrum of each candidate
+    precursor_mzs: np.ndarray,      # (N,) float64
+    mz_values: np.ndarray,          # all MS1 m/z values, concatenated
+    intensity_values: np.ndarray,   # matching intensities
+    offsets: np.ndarray,            # (N + 1,) int64 spectrum starts in mz_values
+    mass_tolerance: float,
+    minimum_intensity: float,
+    max_intensity_ratio: float,
+    separate_nitrogen: bool,
+    columns: np.ndarray,            # formula columns of C, N, S, Cl, Br
+    mass_diffs: np.ndarray,
+    zero_probs: np.ndarray,
+    first_probs: np.ndarray,
+    out: np.ndarray,                # (M,) int8: 1 fits, 0 does not, -1 spectrum without peaks
+) -> None:
+    n_spectra = precursor_mzs.shape[0]
+    is_sorted = np.ones(n_spectra, dtype=np.bool_)
+    precursor_intensities = np.zeros(n_spectra)
+    for i in prange(n_spectra):
+        for j in range(offsets[i] + 1, offsets[i + 1]):
+            if mz_values[j] < mz_values[j - 1]:
+                is_sorted[i] = False
+                break
+        precursor = _nearest_peak(mz_values, offsets[i], offsets[i + 1], is_sorted[i], precursor_mzs[i])
+        if precursor >= 0:
+            precursor_intensities[i] = intensity_values[precursor]
+    for r in prange(formulas.shape[0]):
+        i = spectrum_of_row[r]
+        start = offsets[i]
+        end = offsets[i + 1]
+        if end <= start:
+            out[r] = -1
+            continue
+        fits = True
+        for k in range(columns.shape[0]):
+            count = formulas[r, columns[k]]
+            if count == 0 or (not separate_nitrogen and k == _FIT_N):
+                continue
+            if not separate_nitrogen and k == _FIT_C and formulas[r, columns[_FIT_N]] > 0:
+                # C and N combined into one M+1 peak, at the carbon mass difference
+                n_count = formulas[r, columns[_FIT_N]]
+                zero_isotope_intensity = math.pow(zero_probs[_FIT_C], float(count)) * math.pow(zero_probs[_FIT_N], float(n_count))
+                relative_intensity = (first_probs[_FIT_C] * count + first_probs[_FIT_N] * n_count) / zero_isotope_intensity
+            else:
+                relative_intensity = first_probs[k] * count / math.pow(zero_probs[k], float(count))
+            if not _isotope_peak_fits(
+                mz_values, intensity_values, start, end, is_sorted[i], precursor_mzs[i], precursor_intensities[i],
+                mass_diffs[k], relative_intensity, mass_tolerance, minimum_intensity, max_intensity_ratio,
+            ):
+                fits = False
+                break
+        if not separate_nitrogen and formulas[r, columns[_FIT_C]] == 0 and formulas[r, columns[_FIT_N]] > 0 and fits:
+            # without carbon, the combined test is the nitrogen test
+            count = formulas[r, columns[_FIT_N]]
+            fits = _isotope_peak_fits(
+                mz_values, intensity_values, start, end, is_sorted[i], precursor_mzs[i], precursor_intensities[i],
+                mass_diffs[_FIT_N], first_probs[_FIT_N] * count / math.pow(zero_probs[_FIT_N], float(count)),
+                mass_tolerance, minimum_intensity, max_intensity_ratio,
+            )
+        out[r] = 1 if fits else 0
+
 iso_mass_diffs = np.array([
     isotopic_pattern_dict['C']["mass_difference"],
     isotopic_pattern_dict['S']["mass_difference"],
@@ -220,6 +315,90 @@ iso_first_probs = np.array([
 ])
 
 # this function will work on polars series, and will return an array
+def _isotopic_bounds_array(
+    precursor_mzs: pl.Series,
+    ms1_mzs: pl.Series,
+    ms1_intensities: pl.Series,
+    ms1_mass_tolerance_ppm: float,
+    isotopic_mass_tolerance_ppm: float,
+    minimum_intensity: float,
+    intensity_absolute_tolerance: float,
+    intensity_relative_tolerance: float,
+    min_bounds: Dict[str, int] | None,
+    max_bounds: Dict[str, int] | None,
+    ms1_tolerance: mass_tolerance_config | None,
+    isotopic_tolerance: mass_tolerance_config | None,
+) -> np.ndarray:
+    """
+    The work of deduce_isotopic_pattern, same arguments: (N, 2 * NUM_ELEMENTS) int32, min_bounds in
+    the first NUM_ELEMENTS columns and max_bounds in the last.
+    """
+    # if some bound is not given, use the default.
+    if min_bounds is None:
+        min_bounds = DEFAULT_MIN_BOUND.copy()
+    else:
+        # Merge user-provided min_bounds with defaults
+        min_bounds = {**DEFAULT_MIN_BOUND, **min_bounds}
+        for key in min_bounds.keys():
+            if key not in ELEMENT_SYMBOLS:
+                print(f"Warning: The hrms_utils isotopic pattern and mass decomposition does not handle the element {key}.")
+    # same for maximum
+    if max_bounds is None:
+        max_bounds = DEFAULT_MAX_BOUND.copy()
+    else:
+        # Merge user-provided max_bounds with defaults
+        max_bounds = {**DEFAULT_MAX_BOUND, **max_bounds}
+        for key in max_bounds.keys():
+            if key not in ELEMENT_SYMBOLS:
+                print(f"Warning: The hrms_utils isotopic pattern and mass decomposition does not handle the element {key}.")
+    # now do some sanity checks: max >= min for all keys, min >=0 for all
+    for key in ELEMENT_SYMBOLS:
+        if max_bounds[key] < min_bounds[key]:
+            print(f"Warning: Inconsistent bounds for {key}: max < min.")
+        if min_bounds[key] < 0:
+            print(f"Warning: Negative lower bound for {key}.")
+    #debug:
+    # print(f"Using min bounds: {min_bounds}")
+    # print(f"Using max bounds: {max_bounds}")
+
+    # windows in Da per precursor, evaluated once for the whole batch
+    if ms1_tolerance is None:
+        ms1_tolerance = mass_tolerance_config(ppm=ms1_mass_tolerance_ppm)
+    if isotopic_tolerance is None:
+        isotopic_tolerance = mass_tolerance_config(ppm=isotopic_mass_tolerance_ppm)
+    precursor_mz_array = precursor_mzs.cast(pl.Float64).to_numpy()
+    ms1_absolute_tolerances = ms1_tolerance.tolerance_da(precursor_mz_array)
+    isotopic_absolute_tolerances = isotopic_tolerance.tolerance_da(precursor_mz_array)
+
+    mz_values, mz_offsets = _list_buffers(ms1_mzs)
+    intensity_values, intensity_offsets = _list_buffers(ms1_intensities)
+    assert np.array_equal(mz_offsets, intensity_offsets), "ms1_mzs and ms1_intensities should have the same list lengths"
+    # one row of the base bounds, min_bounds (first NUM_ELEMENTS) and max_bounds (last NUM_ELEMENTS)
+    base_bounds = np.zeros(2 * len(ELEMENT_SYMBOLS), dtype=np.int32)
+    for idx, symbol in enumerate(ELEMENT_SYMBOLS):
+        base_bounds[idx] = min_bounds[symbol]
+        base_bounds[idx + len(ELEMENT_SYMBOLS)] = max_bounds[symbol]
+    bounds_array = np.empty((len(precursor_mz_array), 2 * len(ELEMENT_SYMBOLS)), dtype=np.int32)
+    _deduce_isotopic_pattern_batch(
+        np.nan_to_num(precursor_mz_array, nan=-np.inf),
+        mz_values,
+        intensity_values,
+        mz_offsets,
+        ms1_absolute_tolerances,
+        isotopic_absolute_tolerances,
+        float(minimum_intensity),
+        float(intensity_absolute_tolerance),
+        float(intensity_relative_tolerance),
+        iso_mass_diffs,
+        iso_zero_probs,
+        iso_first_probs,
+        ISOTOPE_BOUND_COLUMNS,
+        base_bounds,
+        sulfur_halogen_ratio_table(max(int(max_bounds['S']), 0), max(int(max_bounds['Cl']), 0), max(int(max_bounds['Br']), 0)),
+        bounds_array,
+    )
+    return bounds_array
+
 def deduce_isotopic_pattern(
     precursor_mzs: pl.Series,
     ms1_mzs: pl.Series,
@@ -231,6 +410,8 @@ def deduce_isotopic_pattern(
     intensity_relative_tolerance: float = 0.05,
     min_bounds: Dict[str, int] | None = None,
     max_bounds: Dict[str, int] | None = None,
+    ms1_tolerance: mass_tolerance_config | None = None,
+    isotopic_tolerance: mass_tolerance_config | None = None,
 )-> pl.Series:
     """
     Deduce the isotopic pattern from the given precursor and MS1 data for each precursor ion.
@@ -245,6 +426,8 @@ def deduce_isotopic_pattern(
         minimum_intensity (float): the entire range between zero and this value is equivalent, so any peaks in this range (including any non-existent peak) will be considered to be both at zero (for lower bound) and at this value (for upper bound). hence, if a precursor is detected with intensity 5*minimum_intensity, we do expect to see its Cl and Br isotopes (so if the isotopic peaks are absent, we decide they are 0), but we don't expect to see its carbon isotopic peak if it's below ~20, so we can only say that the upper bound is 20, and the lower is 0. note that if we do see the carbon isotopic peak, we will consider it the same as 0.
         max_bounds (Dict[str, int] | None): Maximum bounds for each element's isotopic pattern, used if no other value can be obtained (which is true for most elements expect C,S,Cl,Br currently).
         min_bounds (Dict[str, int] | None): Minimum bounds for each element's isotopic pattern, used if no other value can be obtained (which is true for most elements expect C,S,Cl,Br currently).
+        ms1_tolerance (mass_tolerance_config | None): Replaces ms1_mass_tolerance_ppm by a mass-dependent window, e.g. the same object passed to the mass decomposition.
+        isotopic_tolerance (mass_tolerance_config | None): Replaces isotopic_mass_tolerance_ppm in the same way.
 
     Returns:
         pl.Series: A series of arrays, each containing the deduced isotopic pattern for the corresponding precursor, with th
@@ -253,169 +436,323 @@ def deduce_isotopic_pattern(
         It searches for peaks corresponding to the expected isotopic mass differences (C, N, S, Cl, Br)
         within the given ppm tolerance    
         """
-    
-    # if some bound is not given, use the default.
-    if min_bounds is None:
-        min_bounds = DEFAULT_MIN_BOUND.copy()
+    bounds_array = _isotopic_bounds_array(
+        precursor_mzs,
+        ms1_mzs,
+        ms1_intensities,
+        ms1_mass_tolerance_ppm=ms1_mass_tolerance_ppm,
+        isotopic_mass_tolerance_ppm=isotopic_mass_tolerance_ppm,
+        minimum_intensity=minimum_intensity,
+        intensity_absolute_tolerance=intensity_absolute_tolerance,
+        intensity_relative_tolerance=intensity_relative_tolerance,
+        min_bounds=min_bounds,
+        max_bounds=max_bounds,
+        ms1_tolerance=ms1_tolerance,
+        isotopic_tolerance=isotopic_tolerance,
+    )
+    return pl.Series(values=bounds_array, dtype=pl.Array(inner=pl.Int32, shape=(2 * len(ELEMENT_SYMBOLS),)))
+
+ISOTOPE_BOUNDS_DTYPE = pl.Struct({
+    "min_bounds": pl.Array(pl.Int32, len(ELEMENT_SYMBOLS)),
+    "max_bounds": pl.Array(pl.Int32, len(ELEMENT_SYMBOLS)),
+})
+
+def deduce_isotopic_bounds(
+    precursor_mzs: pl.Series,
+    ms1_mzs: pl.Series,
+    ms1_intensities: pl.Series,
+    ms1_mass_tolerance_ppm: float = 5.0,
+    isotopic_mass_tolerance_ppm: float = 3.0,
+    minimum_intensity: float = 5e4,
+    intensity_absolute_tolerance: float = 5e4,
+    intensity_relative_tolerance: float = 0.05,
+    min_bounds: Dict[str, int] | None = None,
+    max_bounds: Dict[str, int] | None = None,
+    ms1_tolerance: mass_tolerance_config | None = None,
+    isotopic_tolerance: mass_tolerance_config | None = None,
+) -> pl.Series:
+    """
+    deduce_isotopic_pattern, same arguments, as a Struct Series named "isotope_bounds" of type
+    ISOTOPE_BOUNDS_DTYPE: the min_bounds and max_bounds Array(Int32, NUM_ELEMENTS) fields that
+    decompose_mass_per_bounds takes. Available as a Polars expression through
+    pl.col(precursor_mz).hrms.isotope_bounds(ms1_mzs, ms1_intensities, ...).
+    """
+    bounds_array = _isotopic_bounds_array(
+        precursor_mzs,
+        ms1_mzs,
+        ms1_intensities,
+        ms1_mass_tolerance_ppm=ms1_mass_tolerance_ppm,
+        isotopic_mass_tolerance_ppm=isotopic_mass_tolerance_ppm,
+        minimum_intensity=minimum_intensity,
+        intensity_absolute_tolerance=intensity_absolute_tolerance,
+        intensity_relative_tolerance=intensity_relative_tolerance,
+        min_bounds=min_bounds,
+        max_bounds=max_bounds,
+        ms1_tolerance=ms1_tolerance,
+        isotopic_tolerance=isotopic_tolerance,
+    )
+    n_elements = len(ELEMENT_SYMBOLS)
+    return pl.DataFrame({
+        "min_bounds": pl.Series(bounds_array[:, :n_elements], dtype=pl.Array(pl.Int32, n_elements)),
+        "max_bounds": pl.Series(bounds_array[:, n_elements:], dtype=pl.Array(pl.Int32, n_elements)),
+    }).to_struct("isotope_bounds")
+
+# columns of C, S, Cl, Br in a formula array, in the order of iso_mass_diffs
+ISOTOPE_BOUND_COLUMNS = np.array([ELEMENT_SYMBOLS.index(symbol) for symbol in ('C', 'S', 'Cl', 'Br')], dtype=np.int64)
+# M+2, M+4, M+6: the peaks that tell S, Cl and Br counts apart
+HALOGEN_PEAKS = 3
+
+@lru_cache(maxsize=None)
+def isotope_ratio_table(symbol: str, max_count: int, n_peaks: int = HALOGEN_PEAKS) -> np.ndarray:
+    """
+    (max_count + 1, n_peaks + 1) expected intensity of the M + k * (mass difference) peak relative to M,
+    k = 0..n_peaks, for 0..max_count atoms of symbol: binomial in the first heavy isotope of its
+    isotopic_distribution. Built once per arguments, read only.
+    """
+    isotope = isotopic_pattern_dict[symbol]
+    ratio = isotope["first_isotope_probability"] / isotope["zero_isotope_probability"]
+    table = np.array([[math.comb(n, k) * ratio**k for k in range(n_peaks + 1)] for n in range(max_count + 1)])
+    table.setflags(write=False)
+    return table
+
+@lru_cache(maxsize=None)
+def sulfur_halogen_ratio_table(max_sulfur: int, max_chlorine: int, max_bromine: int) -> np.ndarray:
+    """
+    (max_sulfur + 1, max_chlorine + 1, max_bromine + 1, HALOGEN_PEAKS) expected M+2 / M, M+4 / M and
+    M+6 / M of every (S, Cl, Br) count triple, the product of their isotope_ratio_table polynomials.
+    The 34S, 37Cl and 81Br shifts lie within 2.2 mDa of each other, so above a few hundred m/z their
+    peaks fall in one isotopic tolerance and are taken as one. Built once per bounds, read only.
+    """
+    sulfur = isotope_ratio_table('S', max_sulfur)
+    chlorine = isotope_ratio_table('Cl', max_chlorine)
+    bromine = isotope_ratio_table('Br', max_bromine)
+    table = np.zeros((max_sulfur + 1, max_chlorine + 1, max_bromine + 1, HALOGEN_PEAKS))
+    for peak in range(1, HALOGEN_PEAKS + 1):
+        for k_sulfur in range(peak + 1):
+            for k_chlorine in range(peak - k_sulfur + 1):
+                table[:, :, :, peak - 1] += (
+                    sulfur[:, k_sulfur, None, None]
+                    * chlorine[None, :, k_chlorine, None]
+                    * bromine[None, None, :, peak - k_sulfur - k_chlorine]
+                )
+    table.setflags(write=False)
+    return table
+
+def _list_buffers(series: pl.Series) -> tuple[np.ndarray, np.ndarray]:
+    """(flat float64 values, int64 offsets) of a list Series; null lists are empty, null values NaN."""
+    series = series.cast(pl.List(pl.Float64))
+    offsets = np.zeros(len(series) + 1, dtype=np.int64)
+    np.cumsum(series.list.len().fill_null(0).to_numpy(), out=offsets[1:])
+    values = pc.list_flatten(series.to_arrow()).to_numpy(zero_copy_only=False)
+    return np.ascontiguousarray(values, dtype=np.float64), offsets
+
+@njit(cache=True)
+def _strongest_peak_near(mzs, intensities, start, end, is_sorted, center, tolerance):
+    """Index of the most intense peak within tolerance of center (the first one on ties), -1 if none."""
+    best = -1
+    if is_sorted:
+        # first peak at or above the window, then walk through it
+        low, high = start, end
+        while low < high:
+            middle = (low + high) // 2
+            if mzs[middle] < center - tolerance:
+                low = middle + 1
+            else:
+                high = middle
+        for j in range(low, end):
+            if mzs[j] - center > tolerance:
+                break
+            if abs(mzs[j] - center) <= tolerance and (best < 0 or intensities[j] > intensities[best]):
+                best = j
     else:
-        # Merge user-provided min_bounds with defaults
-        min_bounds = {**DEFAULT_MIN_BOUND, **min_bounds}
-        for key in min_bounds.keys():
-            if key not in ELEMENT_SYMBOLS:
-                print(f"Warning: The hrms_utils isotopic pattern and mass decomposition does not handle the element {key}.")
-    # same for maximum
-    if max_bounds is None:
-        max_bounds = DEFAULT_MAX_BOUND.copy()
+        for j in range(start, end):
+            if abs(mzs[j] - center) <= tolerance and (best < 0 or intensities[j] > intensities[best]):
+                best = j
+    return best
+
+@njit(cache=True)
+def _summed_intensity(mzs, intensities, start, end, is_sorted, low_mz, high_mz):
+    """Total intensity of the peaks in [low_mz, high_mz]."""
+    total = 0.0
+    if is_sorted:
+        low, high = start, end
+        while low < high:
+            middle = (low + high) // 2
+            if mzs[middle] < low_mz:
+                low = middle + 1
+            else:
+                high = middle
+        for j in range(low, end):
+            if mzs[j] > high_mz:
+                break
+            total += intensities[j]
     else:
-        # Merge user-provided max_bounds with defaults
-        max_bounds = {**DEFAULT_MAX_BOUND, **max_bounds}
-        for key in max_bounds.keys():
-            if key not in ELEMENT_SYMBOLS:
-                print(f"Warning: The hrms_utils isotopic pattern and mass decomposition does not handle the element {key}.")
-    # now do some sanity checks: max >= min for all keys, min >=0 for all
-    for key in ELEMENT_SYMBOLS:
-        if max_bounds[key] < min_bounds[key]:
-            print(f"Warning: Inconsistent bounds for {key}: max < min.")
-        if min_bounds[key] < 0:
-            print(f"Warning: Negative lower bound for {key}.")
-    #debug:
-    # print(f"Using min bounds: {min_bounds}")
-    # print(f"Using max bounds: {max_bounds}")
+        for j in range(start, end):
+            if low_mz <= mzs[j] <= high_mz:
+                total += intensities[j]
+    return total
 
-    ms1_mzs = ms1_mzs.to_numpy()
-    ms1_intensities = ms1_intensities.to_numpy()
-    deduced_bounds = [None] * len(precursor_mzs)
-    for i in range(len(precursor_mzs)):
-        result = deduce_isotopic_pattern_inner(
-            precursor_mz=precursor_mzs[i],
-            ms1_mzs=ms1_mzs[i],
-            ms1_intensities=ms1_intensities[i],
-            ms1_mass_tolerance_ppm=ms1_mass_tolerance_ppm,
-            isotopic_mass_tolerance_ppm=isotopic_mass_tolerance_ppm,
-            minimum_intensity=minimum_intensity,
-            intensity_absolute_tolerance=intensity_absolute_tolerance,
-            intensity_relative_tolerance=intensity_relative_tolerance,
-            iso_mass_diffs=iso_mass_diffs,
-            iso_zero_probs=iso_zero_probs,
-            iso_first_probs=iso_first_probs
-        )
-        # print(result)
-        if result is None:
-            # Fill with NaNs or zeros
-            result = [-1] * 8  # or [0.0] * 8
-        deduced_bounds[i] = result
-    # convert to a 2d array of shape (N, 8)
-    deduced_bounds = np.array(deduced_bounds, dtype=np.float64).reshape(-1, 8)
-    # construct one row of the base bound, from min_bounds and max bounds
-    base_bounds = np.zeros((1, 30), dtype=np.float64)
-    # fill in the default values now:
-    # Fill in the base_bounds array with min_bounds (first 15) and max_bounds (last 15)
-    for idx, symbol in enumerate(ELEMENT_SYMBOLS):
-        base_bounds[0, idx] = min_bounds[symbol]
-        base_bounds[0, idx + 15] = max_bounds[symbol]
-    # Now create the bounds_array by repeating base_bounds for each precursor
-    bounds_array = np.repeat(base_bounds, len(deduced_bounds), axis=0)
-    
-    # now we copy the values, using vectorized operations
-    # Copy deduced bounds for C, S, Cl, Br into the bounds_array.
-    # The deduced_bounds array has shape (N, 8): [C_lower, S_lower, Cl_lower, Br_lower, C_upper, S_upper, Cl_upper, Br_upper]
-    # The bounds_array has shape (N, 30): [min_bounds..., max_bounds...]
-    # Fill in the appropriate indices for C, S, Cl, Br (both lower and upper bounds).
-    for idx, symbol in enumerate(['C', 'S', 'Cl', 'Br']):
-        bounds_array[:, ELEMENT_SYMBOLS.index(symbol)] = np.ceil(deduced_bounds[:, idx])      # lower bound
-        bounds_array[:, ELEMENT_SYMBOLS.index(symbol) + 15] = np.floor(deduced_bounds[:, idx + 4])  # upper bound
-
-    return pl.Series(values=bounds_array.astype(np.int32), dtype=pl.Array(inner=pl.Int32, shape=(30,)))
-
-@jit(nopython=False)
-def deduce_isotopic_pattern_inner(
-        precursor_mz: float,
-        ms1_mzs: np.ndarray,
-        ms1_intensities: np.ndarray,
-        ms1_mass_tolerance_ppm: float,
-        isotopic_mass_tolerance_ppm: float,
-        minimum_intensity: float,
-        intensity_absolute_tolerance: float,
-        intensity_relative_tolerance: float,
-        iso_mass_diffs: np.ndarray,
-        iso_zero_probs: np.ndarray,
-        iso_first_probs: np.ndarray
+@njit(cache=True)
+def _isotope_count_range(
+    peak_intensity, precursor_intensity, zero_probability, first_probability,
+    minimum_intensity, intensity_absolute_tolerance, intensity_relative_tolerance,
 ):
-    MASS_ACCURACY_PPM_TO_DA_THRESHOLD = 200
-    ms1_mzs = np.atleast_1d(ms1_mzs)
-    ms1_intensities = np.atleast_1d(ms1_intensities)
-    # use this to detect the precursor
-    MS1_absolute_tolerance = np.max(np.array([precursor_mz, MASS_ACCURACY_PPM_TO_DA_THRESHOLD])) * ms1_mass_tolerance_ppm * 1e-6
-    # use this to detect the isotopic peaks
-    isotopic_absolute_tolerance = np.max(np.array([precursor_mz, MASS_ACCURACY_PPM_TO_DA_THRESHOLD])) * isotopic_mass_tolerance_ppm * 1e-6
-    precursor_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, precursor_mz, atol=MS1_absolute_tolerance, rtol=0.0)))[0]
-    if len(precursor_idx) == 0:
-        return None
-    
-    #the real mass measured for the precursor in the ms1
-    precursor_ms1_mz = ms1_mzs[precursor_idx[ms1_intensities[precursor_idx].argmax()]] 
-    precursor_ms1_intensity = ms1_intensities[precursor_idx].max()
-
-    # C
-    c_peak_mz = precursor_ms1_mz + iso_mass_diffs[0]
-    c_peaks_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, c_peak_mz, atol=isotopic_absolute_tolerance, rtol=0.0)))[0]
-    C_peak_total_intensities = ms1_intensities[c_peaks_idx].max() if len(c_peaks_idx) > 0 else 0
-    if C_peak_total_intensities < minimum_intensity:
-        C_lower = 0
-        C_upper = (minimum_intensity * iso_zero_probs[0]) / (iso_first_probs[0] * precursor_ms1_intensity)
-    else:
-        C_lower = ((C_peak_total_intensities * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) * iso_zero_probs[0]) / (iso_first_probs[0] * precursor_ms1_intensity)
-        C_upper = ((C_peak_total_intensities * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) * iso_zero_probs[0]) / (iso_first_probs[0] * precursor_ms1_intensity)
-
-    # S
-    s_peak_mz = precursor_ms1_mz + iso_mass_diffs[1]
-    s_peaks_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, s_peak_mz, atol=isotopic_absolute_tolerance, rtol=0.0)))[0]
-    S_peak_total_intensities = ms1_intensities[s_peaks_idx].max() if len(s_peaks_idx) > 0 else 0
-    if S_peak_total_intensities < minimum_intensity:
-        S_lower = 0
-        S_upper = (minimum_intensity * iso_zero_probs[1]) / (iso_first_probs[1] * precursor_ms1_intensity)
-    else:
-        S_lower = ((S_peak_total_intensities * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) * iso_zero_probs[1]) / (iso_first_probs[1] * precursor_ms1_intensity)
-        S_upper = ((S_peak_total_intensities * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) * iso_zero_probs[1]) / (iso_first_probs[1] * precursor_ms1_intensity)
-
-    # Cl
-    cl_peak_mz = precursor_ms1_mz + iso_mass_diffs[2]
-    cl_peaks_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, cl_peak_mz, atol=isotopic_absolute_tolerance, rtol=0.0)))[0]
-    Cl_peak_total_intensities = ms1_intensities[cl_peaks_idx].max() if len(cl_peaks_idx) > 0 else 0
-    if Cl_peak_total_intensities < minimum_intensity:
-        Cl_lower = 0
-        Cl_upper = (minimum_intensity * iso_zero_probs[2]) / (iso_first_probs[2] * precursor_ms1_intensity)
-    else:
-        Cl_lower = ((Cl_peak_total_intensities * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) * iso_zero_probs[2]) / (iso_first_probs[2] * precursor_ms1_intensity)
-        Cl_upper = ((Cl_peak_total_intensities * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) * iso_zero_probs[2]) / (iso_first_probs[2] * precursor_ms1_intensity)
-    # second Cl peak- the M+4
-    # we need this because 2 Cl and 1 Br look very similar
-    # we do this only if we got a positive estimation on Cl_lower, and at least 2 on Cl_upper
-    if Cl_lower > 0 and Cl_upper >= 2:
-        second_cl_peak_mz = precursor_ms1_mz + iso_mass_diffs[2] * 2
-        cl_peaks_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, second_cl_peak_mz, atol=isotopic_absolute_tolerance, rtol=0.0)))[0]
-        second_Cl_peak_total_intensities = ms1_intensities[cl_peaks_idx].max() if len(cl_peaks_idx) > 0 else 0
-        # now, if truly there are at least 2 Cls, then we can get a ratio between the first Cl peak and the second
-        expected_Cl_ratio = iso_first_probs[2] / (2*iso_zero_probs[2])
-        actual_Cl_ratio = second_Cl_peak_total_intensities / Cl_peak_total_intensities
-        if expected_Cl_ratio * Cl_peak_total_intensities > minimum_intensity * (1+intensity_relative_tolerance): # we expect to see the second peak, even with the noise of the intesity
-            Cl_deviation = np.abs((actual_Cl_ratio - expected_Cl_ratio) / expected_Cl_ratio)
-            if Cl_deviation > intensity_relative_tolerance:
-                Cl_lower = 0
-                Cl_upper = 1
-
-    # Br
-    br_peak_mz = precursor_ms1_mz + iso_mass_diffs[3]
-    br_peaks_idx = np.where(np.atleast_1d(np.isclose(ms1_mzs, br_peak_mz, atol=isotopic_absolute_tolerance, rtol=0.0)))[0]
-    Br_peak_total_intensities = ms1_intensities[br_peaks_idx].max() if len(br_peaks_idx) > 0 else 0
-    if Br_peak_total_intensities < minimum_intensity:
-        Br_lower = 0
-        Br_upper = (minimum_intensity * iso_zero_probs[3]) / (iso_first_probs[3] * precursor_ms1_intensity)
-    else:
-        Br_lower = ((Br_peak_total_intensities * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) * iso_zero_probs[3]) / (iso_first_probs[3] * precursor_ms1_intensity)
-        Br_upper = ((Br_peak_total_intensities * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) * iso_zero_probs[3]) / (iso_first_probs[3] * precursor_ms1_intensity)
-    # TODO: Add support for second isotope for Br (M+4)
+    """(lower, upper) atom count from the M+k / M ratio; a peak below minimum_intensity only gives an upper bound."""
+    if peak_intensity < minimum_intensity:
+        return 0.0, (minimum_intensity * zero_probability) / (first_probability * precursor_intensity)
+    lower = ((peak_intensity * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) * zero_probability) / (first_probability * precursor_intensity)
+    upper = ((peak_intensity * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) * zero_probability) / (first_probability * precursor_intensity)
+    return lower, upper
+
+@njit(cache=True)
+def _ratio_interval(
+    peak_intensity, precursor_intensity, minimum_intensity, intensity_absolute_tolerance, intensity_relative_tolerance,
+):
+    """(lower, upper) accepted M+k / M ratio; a peak below minimum_intensity allows anything up to the limit."""
+    if peak_intensity < minimum_intensity:
+        return 0.0, minimum_intensity / precursor_intensity
+    lower = max(0.0, (peak_intensity * (1 - intensity_relative_tolerance) - intensity_absolute_tolerance) / precursor_intensity)
+    upper = (peak_intensity * (1 + intensity_relative_tolerance) + intensity_absolute_tolerance) / precursor_intensity
+    return lower, upper
 
-    return [C_lower, S_lower, Cl_lower, Br_lower, C_upper, S_upper, Cl_upper, Br_upper]
+@njit(cache=True)
+def _sulfur_halogen_count_range(ratio_table, lower_ratios, upper_ratios, out):
+    """
+    out = (min S, max S, min Cl, max Cl, min Br, max Br) over the (S, Cl, Br) triples of ratio_table
+    whose M+2, M+4 and M+6 ratios all lie in [lower_ratios, upper_ratios]; False if none fits. The
+    M+2 ratio grows with the Br count, so for each S and Cl count the fitting Br counts are found by
+    bisection.
+    """
+    found = False
+    n_bromine = ratio_table.shape[2]
+    for sulfur in range(ratio_table.shape[0]):
+        for chlorine in range(ratio_table.shape[1]):
+            low, high = 0, n_bromine
+            while low < high:
+                middle = (low + high) // 2
+                if ratio_table[sulfur, chlorine, middle, 0] < lower_ratios[0]:
+                    low = middle + 1
+                else:
+                    high = middle
+            for bromine in range(low, n_bromine):
+                if ratio_table[sulfur, chlorine, bromine, 0] > upper_ratios[0]:
+                    break
+                fits = True
+                for peak in range(1, ratio_table.shape[3]):
+                    ratio = ratio_table[sulfur, chlorine, bromine, peak]
+                    if ratio < lower_ratios[peak] or ratio > upper_ratios[peak]:
+                        fits = False
+                        break
+                if not fits:
+                    continue
+                if not found:
+                    out[0] = out[1] = sulfur
+                    out[2] = out[3] = chlorine
+                    out[4] = out[5] = bromine
+                    found = True
+                out[0] = min(out[0], sulfur)
+                out[1] = max(out[1], sulfur)
+                out[2] = min(out[2], chlorine)
+                out[3] = max(out[3], chlorine)
+                out[4] = min(out[4], bromine)
+                out[5] = max(out[5], bromine)
+    return found
 
+@njit(cache=True)
+def _count_to_int32(value, fallback):
+    if value != value:
+        return fallback
+    return np.int32(min(max(value, -2147483648.0), 2147483647.0))
 
+@njit(parallel=True, cache=True, error_model="numpy")
+def _deduce_isotopic_pattern_batch(
+    precursor_mzs: np.ndarray,        # (N,) float64, -inf where missing
+    mz_values: np.ndarray,            # all MS1 m/z values, concatenated
+    intensity_values: np.ndarray,     # matching intensities
+    offsets: np.ndarray,              # (N + 1,) int64 row starts in mz_values
+    ms1_tolerances: np.ndarray,       # (N,) Da, precursor match
+    isotopic_tolerances: np.ndarray,  # (N,) Da, isotope peak match
+    minimum_intensity: float,
+    intensity_absolute_tolerance: float,
+    intensity_relative_tolerance: float,
+    iso_mass_diffs: np.ndarray,       # C, S, Cl, Br
+    iso_zero_probs: np.ndarray,
+    iso_first_probs: np.ndarray,
+    bound_columns: np.ndarray,        # formula columns of C, S, Cl, Br
+    base_bounds: np.ndarray,          # (30,) int32 default min and max bounds
+    ratio_table: np.ndarray,          # sulfur_halogen_ratio_table of the S, Cl and Br max bounds
+    out: np.ndarray,                  # (N, 30) int32, written in place
+) -> None:
+    """
+    Isotopic bounds of every row, the batch form of deduce_isotopic_pattern: the most intense peak
+    within the MS1 tolerance is the precursor, and the most intense peak within the isotopic
+    tolerance of precursor + mass difference gives the count range of C (ceil of the lower, floor
+    of the upper). S, Cl and Br get the range of the count triples in ratio_table whose M+2, M+4
+    and M+6 ratios fit the summed peaks between the 34S and 81Br shifts; when no triple fits, each
+    gets its own M+2 range like C, and Cl above 1 is dropped if the M+4 peak does not match it.
+    Rows without a precursor peak get -1 for both bounds of these elements. Sorted rows are
+    searched by bisection, unsorted ones by a linear scan.
+    """
+    n_elements = base_bounds.shape[0] // 2
+    for i in prange(precursor_mzs.shape[0]):
+        lower_ratios = np.empty(HALOGEN_PEAKS)
+        upper_ratios = np.empty(HALOGEN_PEAKS)
+        count_range = np.empty(6, dtype=np.int64)
+        out[i, :] = base_bounds
+        start = offsets[i]
+        end = offsets[i + 1]
+        is_sorted = True
+        for j in range(start + 1, end):
+            if mz_values[j] < mz_values[j - 1]:
+                is_sorted = False
+                break
+        precursor = _strongest_peak_near(mz_values, intensity_values, start, end, is_sorted, precursor_mzs[i], ms1_tolerances[i])
+        if precursor < 0:
+            for k in range(bound_columns.shape[0]):
+                out[i, bound_columns[k]] = -1
+                out[i, bound_columns[k] + n_elements] = -1
+            continue
+        precursor_ms1_mz = mz_values[precursor]
+        precursor_ms1_intensity = intensity_values[precursor]
+        peak_intensities = np.zeros(bound_columns.shape[0])
+        for k in range(bound_columns.shape[0]):
+            peak = _strongest_peak_near(
+                mz_values, intensity_values, start, end, is_sorted, precursor_ms1_mz + iso_mass_diffs[k], isotopic_tolerances[i]
+            )
+            peak_intensities[k] = intensity_values[peak] if peak >= 0 else 0.0
+        lower = np.empty(bound_columns.shape[0])
+        upper = np.empty(bound_columns.shape[0])
+        for k in range(bound_columns.shape[0]):
+            lower[k], upper[k] = _isotope_count_range(
+                peak_intensities[k], precursor_ms1_intensity, iso_zero_probs[k], iso_first_probs[k],
+                minimum_intensity, intensity_absolute_tolerance, intensity_relative_tolerance,
+            )
+        # S, Cl and Br together, from the M+2, M+4 and M+6 peaks
+        for peak in range(HALOGEN_PEAKS):
+            m2_intensity = _summed_intensity(
+                mz_values, intensity_values, start, end, is_sorted,
+                precursor_ms1_mz + (peak + 1) * iso_mass_diffs[1] - isotopic_tolerances[i],
+                precursor_ms1_mz + (peak + 1) * iso_mass_diffs[3] + isotopic_tolerances[i],
+            )
+            lower_ratios[peak], upper_ratios[peak] = _ratio_interval(
+                m2_intensity, precursor_ms1_intensity, minimum_intensity, intensity_absolute_tolerance, intensity_relative_tolerance,
+            )
+        if _sulfur_halogen_count_range(ratio_table, lower_ratios, upper_ratios, count_range):
+            for k in range(3):
+                lower[k + 1] = count_range[2 * k]
+                upper[k + 1] = count_range[2 * k + 1]
+        elif lower[2] > 0 and upper[2] >= 2:
+            # more than one Cl: the M+4 peak should follow
+            second = _strongest_peak_near(
+                mz_values, intensity_values, start, end, is_sorted, precursor_ms1_mz + iso_mass_diffs[2] * 2, isotopic_tolerances[i]
+            )
+            second_intensity = intensity_values[second] if second >= 0 else 0.0
+            expected_ratio = iso_first_probs[2] / (2 * iso_zero_probs[2])
+            actual_ratio = second_intensity / peak_intensities[2]
+            if expected_ratio * peak_intensities[2] > minimum_intensity * (1 + intensity_relative_tolerance):
+                if np.abs((actual_ratio - expected_ratio) / expected_ratio) > intensity_relative_tolerance:
+                    lower[2] = 0.0
+                    upper[2] = 1.0
+        for k in range(bound_columns.shape[0]):
+            out[i, bound_columns[k]] = _count_to_int32(np.ceil(lower[k]), 0)
+            out[i, bound_columns[k] + n_elements] = _count_to_int32(np.floor(upper[k]), 2147483647)
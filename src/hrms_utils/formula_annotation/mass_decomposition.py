@@ -1,23 +1,515 @@
 from .mass_decomposition_impl.mass_decomposer_cpp import (
     decompose_mass_parallel,
     decompose_mass_parallel_per_bounds,
+    decompose_mass_with_isotopes_parallel,
     decompose_spectra_parallel,
     decompose_spectra_parallel_per_bounds,
     decompose_spectra_known_precursor_parallel, 
-    get_num_elements,
     clean_spectra_known_precursor_parallel,
-    clean_and_normalize_spectra_known_precursor_parallel,  # NEW
+    clean_and_normalize_spectra_known_precursor_parallel,
+    clean_and_normalize_spectra_candidate_precursors_parallel,
+    residue_table_cache_stats,
+    set_residue_table_cache_capacity_bytes,
+    clear_residue_table_cache_tables,
+    FRAGMENT_ENGINES,
+    count_mass_parallel,
+    count_mass_parallel_per_bounds,
+    PARALLEL_SCHEDULES,
+    estimate_decomposition_cost_parallel,
+    filter_formulas_parallel,
+    _register_element_table,
+    get_element_info,
 )
-NUM_ELEMENTS = get_num_elements()
+from .element_table import (
+    ELEMENTS,
+    ELEMENT_INDEX,
+    ELEMENT_SYMBOLS,
+    ELEMENT_MASSES,
+    ELEMENT_TWICE_DBE_COEFFICIENTS,
+    ELEMENT_VALENCES,
+    NUM_ELEMENTS,
+)
+from .mass_tolerance import mass_tolerance_config, _tolerance_kwargs
+from .decomposition_cache import decomposition_cache
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
 import numpy as np
 from numpy.typing import NDArray
-from typing import Iterable
-from pathlib import Path
+from typing import Iterator
 from typing import List, Dict,Any
+from dataclasses import dataclass, replace
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+
+# element_table.ELEMENTS is the alphabet of the C++ code as well, fixed for the process from here on
+_register_element_table(ELEMENT_SYMBOLS, ELEMENT_MASSES, ELEMENT_TWICE_DBE_COEFFICIENTS, ELEMENT_VALENCES)
+
+
+
+
+def get_residue_table_cache_stats() -> Dict[str, int]:
+    """
+    Statistics of the process-wide Extended Residue Table (ERT) cache.
+
+    The ERT only depends on which elements are allowed (max bound > 0), so every
+    decomposition with the same element alphabet reuses one table regardless of its
+    count bounds. Keys: hits, misses, evictions, entries, memory_bytes, capacity_bytes.
+    """
+    return residue_table_cache_stats()
+
+def set_residue_table_cache_capacity(capacity_bytes: int) -> None:
+    """
+    Set the memory cap (bytes) of the ERT cache. Least recently used tables are evicted
+    once the cap is exceeded; a single table is roughly 6000 * n_active_elements * 8 bytes.
+    """
+    assert isinstance(capacity_bytes, int) and capacity_bytes >= 0, f"capacity_bytes should be a non-negative integer, but got {capacity_bytes}"
+    set_residue_table_cache_capacity_bytes(capacity_bytes)
+
+def clear_residue_table_cache() -> None:
+    """Drop every cached ERT and reset the cache statistics."""
+    clear_residue_table_cache_tables()
+
+@dataclass(frozen=True)
+class parallel_config:
+    """
+    OpenMP settings of the C++ decomposition kernels.
+
+    n_threads: team size per call; None uses the OpenMP default (OMP_NUM_THREADS, else all cores).
+    schedule: loop schedule over masses/spectra, "static", "dynamic" or "guided".
+    schedule_chunk_size: masses/spectra handed to a thread at a time; 0 uses the schedule's default.
+    cost_ordering: start masses/spectra in descending estimate_decomposition_cost order (results keep
+        the input order), so a few heavy items do not finish last on one thread. Pays off with the
+        "dynamic" and "guided" schedules.
+
+    The process-wide default is read from the environment variables HRMS_UTILS_NUM_THREADS,
+    HRMS_UTILS_SCHEDULE, HRMS_UTILS_SCHEDULE_CHUNK_SIZE and HRMS_UTILS_COST_ORDERING ("0" disables
+    it); use_parallel_config overrides it for a
+    block of code (per thread / asyncio task), and the n_threads, schedule and schedule_chunk_size
+    arguments of each wrapper override both for a single call.
+    """
+    n_threads: int | None = None
+    schedule: str = "dynamic"
+    schedule_chunk_size: int = 1
+    cost_ordering: bool = True
+
+    def __post_init__(self):
+        assert self.n_threads is None or (isinstance(self.n_threads, int) and self.n_threads > 0), (
+            f"n_threads should be None or a positive integer, but got {self.n_threads}"
+        )
+        assert self.schedule in PARALLEL_SCHEDULES, f"schedule should be one of {list(PARALLEL_SCHEDULES)}, but got {self.schedule}"
+        assert isinstance(self.schedule_chunk_size, int) and self.schedule_chunk_size >= 0, (
+            f"schedule_chunk_size should be a non-negative integer, but got {self.schedule_chunk_size}"
+        )
+        assert isinstance(self.cost_ordering, bool), f"cost_ordering should be a bool, but got {type(self.cost_ordering)}"
+
+    @classmethod
+    def from_env(cls) -> 'parallel_config':
+        n_threads = os.environ.get("HRMS_UTILS_NUM_THREADS")
+        return cls(
+            n_threads=int(n_threads) if n_threads else None,
+            schedule=os.environ.get("HRMS_UTILS_SCHEDULE", "dynamic"),
+            schedule_chunk_size=int(os.environ.get("HRMS_UTILS_SCHEDULE_CHUNK_SIZE", "1")),
+            cost_ordering=os.environ.get("HRMS_UTILS_COST_ORDERING", "1") != "0",
+        )
+
+_active_parallel_config: ContextVar[parallel_config | None] = ContextVar("hrms_utils_parallel_config", default=None)
+
+def get_parallel_config() -> parallel_config:
+    """The parallel_config in effect: the innermost use_parallel_config block, else the environment default."""
+    config = _active_parallel_config.get()
+    return config if config is not None else parallel_config.from_env()
+
+@contextmanager
+def use_parallel_config(
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+    cost_ordering: bool | None = None,
+):
+    """
+    Override the OpenMP settings of every decomposition call inside the block; arguments left as
+    None keep the current value.
+
+    Example usage (several annotation workers per node, each limited to 4 threads):
+
+        with use_parallel_config(n_threads=4, schedule="guided"):
+            df = annotate_chromatogram_with_formulas(df, ...)
+    """
+    config = _resolve_parallel_config(n_threads, schedule, schedule_chunk_size, cost_ordering)
+    token = _active_parallel_config.set(config)
+    try:
+        yield config
+    finally:
+        _active_parallel_config.reset(token)
+
+def _resolve_parallel_config(
+    n_threads: int | None,
+    schedule: str | None,
+    schedule_chunk_size: int | None,
+    cost_ordering: bool | None = None,
+) -> parallel_config:
+    config = get_parallel_config()
+    overrides = {
+        name: value for name, value in (
+            ("n_threads", n_threads), ("schedule", schedule), ("schedule_chunk_size", schedule_chunk_size),
+            ("cost_ordering", cost_ordering),
+        ) if value is not None
+    }
+    return replace(config, **overrides) if overrides else config
+
+def _parallel_kwargs(
+    n_threads: int | None,
+    schedule: str | None,
+    schedule_chunk_size: int | None,
+) -> Dict[str, Any]:
+    """Keyword arguments for the Cython wrappers (n_threads=0 means the OpenMP default)."""
+    config = _resolve_parallel_config(n_threads, schedule, schedule_chunk_size)
+    return {
+        "n_threads": config.n_threads or 0,
+        "schedule": config.schedule,
+        "schedule_chunk_size": config.schedule_chunk_size,
+        "cost_ordering": config.cost_ordering,
+    }
+
+@dataclass(frozen=True)
+class chemistry_rules_config:
+    """
+    Seven-Golden-Rules-style plausibility filters (Kind & Fiehn 2007), applied inside the C++
+    enumerator: subtrees that can no longer satisfy a ratio are skipped, so implausible formulas are
+    never materialized.
+
+    Ratios are element count / carbon count, checked as count <= max * C and count >= min * C, so a
+    formula without carbon passes only if it contains none of the ratio-limited elements (H
+    included). None disables a ratio. The defaults are the "common" ranges covering 99.7% of known
+    compounds; chemistry_rules_config.extended() gives the 99.99% ranges.
+
+    senior_rules: with the lowest common valences, the valence sum is even, at least twice the
+    largest valence and at least 2 * (atoms - 1). Only meaningful for neutral molecule masses.
+    """
+    min_h_to_c: float | None = 0.2
+    max_h_to_c: float | None = 3.1
+    max_n_to_c: float | None = 1.3
+    max_o_to_c: float | None = 1.2
+    max_p_to_c: float | None = 0.3
+    max_s_to_c: float | None = 0.8
+    max_si_to_c: float | None = 0.5
+    max_f_to_c: float | None = 1.5
+    max_cl_to_c: float | None = 0.8
+    max_br_to_c: float | None = 0.8
+    max_i_to_c: float | None = None
+    senior_rules: bool = True
+
+    def __post_init__(self):
+        for name in self.__dataclass_fields__:
+            value = getattr(self, name)
+            if name == "senior_rules":
+                assert isinstance(value, bool), f"senior_rules should be a bool, but got {type(value)}"
+            else:
+                assert value is None or (isinstance(value, (float, int)) and value >= 0), (
+                    f"{name} should be None or a non-negative number, but got {value}"
+                )
+
+    @classmethod
+    def extended(cls, senior_rules: bool = True) -> 'chemistry_rules_config':
+        """The extended ranges, covering 99.99% of known compounds."""
+        return cls(
+            min_h_to_c=0.1, max_h_to_c=6.0, max_n_to_c=4.0, max_o_to_c=3.0, max_p_to_c=2.0,
+            max_s_to_c=3.0, max_si_to_c=1.0, max_f_to_c=6.0, max_cl_to_c=2.0, max_br_to_c=2.0,
+            senior_rules=senior_rules,
+        )
+
+    def _wrapper_kwargs(self) -> Dict[str, Any]:
+        """Per-element ratio arrays (NaN = disabled) for the Cython wrappers."""
+        min_ratio_to_carbon = np.full(NUM_ELEMENTS, np.nan)
+        max_ratio_to_carbon = np.full(NUM_ELEMENTS, np.nan)
+        if self.min_h_to_c is not None and "H" in ELEMENT_INDEX:
+            min_ratio_to_carbon[ELEMENT_INDEX["H"]] = self.min_h_to_c
+        for symbol, ratio in (
+            ("H", self.max_h_to_c), ("N", self.max_n_to_c), ("O", self.max_o_to_c), ("P", self.max_p_to_c),
+            ("S", self.max_s_to_c), ("Si", self.max_si_to_c), ("F", self.max_f_to_c), ("Cl", self.max_cl_to_c),
+            ("Br", self.max_br_to_c), ("I", self.max_i_to_c),
+        ):
+            # ratios of elements missing from a customized element_table are skipped
+            if ratio is not None and symbol in ELEMENT_INDEX:
+                max_ratio_to_carbon[ELEMENT_INDEX[symbol]] = ratio
+        return {
+            "min_ratio_to_carbon": min_ratio_to_carbon,
+            "max_ratio_to_carbon": max_ratio_to_carbon,
+            "senior_rules": self.senior_rules,
+        }
+
+def _chemistry_kwargs(chemistry_rules: chemistry_rules_config | None) -> Dict[str, Any]:
+    assert chemistry_rules is None or isinstance(chemistry_rules, chemistry_rules_config), (
+        f"chemistry_rules should be None or a chemistry_rules_config, but got {type(chemistry_rules)}"
+    )
+    return {} if chemistry_rules is None else chemistry_rules._wrapper_kwargs()
+
+@dataclass(frozen=True)
+class candidate_ranking_config:
+    """
+    Top-k mode of the mass decomposition. Without it, decomposition stops at max_results in
+    enumeration (integer mass) order, which can drop the best matches. With it, every formula within
+    tolerance is scored and the top_k best per mass are kept in a bounded heap inside the C++
+    enumerator, returned best first.
+
+    score = |mass error ppm| + sum of element_penalty_ppm[symbol] * count of that element, e.g.
+    element_penalty_ppm={"F": 0.5, "Si": 1.0} prefers formulas without rare elements among near-equal
+    mass matches. Ties are broken by element counts, so the output is deterministic.
+    max_results is ignored while ranking is on.
+    """
+    top_k: int = 50
+    element_penalty_ppm: Dict[str, float] | None = None
+
+    def __post_init__(self):
+        assert isinstance(self.top_k, int) and self.top_k > 0, f"top_k should be a positive integer, but got {self.top_k}"
+        for symbol, penalty in (self.element_penalty_ppm or {}).items():
+            assert symbol in ELEMENT_INDEX, f"Unknown element {symbol!r} in element_penalty_ppm"
+            assert isinstance(penalty, (float, int)) and np.isfinite(penalty), (
+                f"element_penalty_ppm[{symbol!r}] should be a finite number, but got {penalty}"
+            )
+
+    def _wrapper_kwargs(self) -> Dict[str, Any]:
+        """top_k and a per-element penalty array for the Cython wrappers."""
+        element_penalty_ppm = np.zeros(NUM_ELEMENTS)
+        for symbol, penalty in (self.element_penalty_ppm or {}).items():
+            element_penalty_ppm[ELEMENT_INDEX[symbol]] = penalty
+        return {"top_k": self.top_k, "element_penalty_ppm": element_penalty_ppm}
+
+def _ranking_kwargs(ranking: candidate_ranking_config | None) -> Dict[str, Any]:
+    assert ranking is None or isinstance(ranking, candidate_ranking_config), (
+        f"ranking should be None or a candidate_ranking_config, but got {type(ranking)}"
+    )
+    return {} if ranking is None else ranking._wrapper_kwargs()
+
+@dataclass(frozen=True)
+class isotope_scoring_config:
+    """
+    MS1 isotope evidence for decompose_mass_with_isotopes. Per feature, the monoisotopic peak M is
+    the most intense peak within ms1_tolerance of the precursor m/z; M+1 and M+2 are the summed
+    intensities of the peaks in the m/z range of the +1 isotopologues (13C, 15N) and +2 ones (34S,
+    37Cl, 81Br, 13C2, ...), widened by isotopic_tolerance. minimum_intensity, intensity_absolute_tolerance
+    and intensity_relative_tolerance have the meaning of deduce_isotopic_pattern: a sum below
+    minimum_intensity is an absent peak, which allows predicted ratios up to minimum_intensity / M.
+
+    Formulas whose predicted M+1/M or M+2/M (from the isotopic_distribution entries of
+    element_table.ELEMENTS) fall outside the accepted intervals are dropped during the enumeration,
+    the rest are ranked by |mass error ppm| + weight_ppm * (squared interval-normalized deviations).
+    Features without a monoisotopic peak are decomposed without isotope constraints.
+    """
+    minimum_intensity: float = 5e4
+    intensity_absolute_tolerance: float = 5e4
+    intensity_relative_tolerance: float = 0.05
+    ms1_tolerance: mass_tolerance_config = mass_tolerance_config(ppm=5.0)
+    isotopic_tolerance: mass_tolerance_config = mass_tolerance_config(ppm=3.0)
+    weight_ppm: float = 1.0
+
+    def __post_init__(self):
+        for name in ("minimum_intensity", "intensity_absolute_tolerance", "intensity_relative_tolerance", "weight_ppm"):
+            value = getattr(self, name)
+            assert isinstance(value, (float, int)) and np.isfinite(value) and value >= 0, (
+                f"{name} should be a non-negative number, but got {value}"
+            )
+        assert self.minimum_intensity > 0, f"minimum_intensity should be positive, but got {self.minimum_intensity}"
+        assert isinstance(self.ms1_tolerance, mass_tolerance_config), f"ms1_tolerance should be a mass_tolerance_config, but got {type(self.ms1_tolerance)}"
+        assert isinstance(self.isotopic_tolerance, mass_tolerance_config), f"isotopic_tolerance should be a mass_tolerance_config, but got {type(self.isotopic_tolerance)}"
+
+    def _wrapper_kwargs(self) -> Dict[str, Any]:
+        """Per-element isotope ratios, shift windows and tolerances for the Cython wrapper."""
+        isotope_ratios, isotope_shift_windows = _isotope_envelope_model()
+        return {
+            "isotope_ratios": isotope_ratios,
+            "isotope_shift_windows": isotope_shift_windows,
+            "ms1_tolerance_model": self.ms1_tolerance._wrapper_kwargs()["tolerance_model"],
+            "isotopic_tolerance_model": self.isotopic_tolerance._wrapper_kwargs()["tolerance_model"],
+            "minimum_intensity": float(self.minimum_intensity),
+            "intensity_absolute_tolerance": float(self.intensity_absolute_tolerance),
+            "intensity_relative_tolerance": float(self.intensity_relative_tolerance),
+            "isotope_weight_ppm": float(self.weight_ppm),
+        }
+
+def _isotope_envelope_model() -> tuple[NDArray[np.float64], NDArray[np.float64]]:
+    """
+    (NUM_ELEMENTS, 2) heavy/light abundance ratios of each element's +1 and +2 isotope, and the
+    (2, 2) [min, max] m/z shift of the M+1 and M+2 isotopologues (M+2 includes two +1 isotopes).
+    """
+    isotope_ratios = np.zeros((NUM_ELEMENTS, 2))
+    shifts: Dict[int, List[float]] = {1: [], 2: []}
+    for index, element in enumerate(ELEMENTS):
+        distribution = element.isotopic_distribution
+        if distribution is None:
+            continue
+        nominal_shift = int(round(distribution.mass_differences[0]))
+        assert nominal_shift in shifts, f"{element.symbol}: only +1 and +2 isotopes are modelled, got +{nominal_shift}"
+        isotope_ratios[index, nominal_shift - 1] = distribution.abundances[1] / distribution.abundances[0]
+        shifts[nominal_shift].append(distribution.mass_differences[0])
+    shifts[2].extend(first + second for first in shifts[1] for second in shifts[1])
+    isotope_shift_windows = np.array([
+        [min(shifts[k], default=float(k)), max(shifts[k], default=float(k))] for k in (1, 2)
+    ])
+    return isotope_ratios, isotope_shift_windows
+
+def _validate_fragment_engine(fragment_engine: str, max_subformula_lattice_size: int) -> None:
+    assert fragment_engine in FRAGMENT_ENGINES, f"fragment_engine should be one of {list(FRAGMENT_ENGINES)}, but got {fragment_engine}"
+    # sub-formulas are encoded as uint32 mixed-radix codes in C++
+    assert isinstance(max_subformula_lattice_size, int) and 0 <= max_subformula_lattice_size < 2**32, (
+        f"max_subformula_lattice_size should be an integer in [0, 2**32), but got {max_subformula_lattice_size}"
+    )
+
+_active_decomposition_cache: ContextVar[decomposition_cache | None] = ContextVar("hrms_utils_decomposition_cache", default=None)
+
+@contextmanager
+def use_decomposition_cache(cache: decomposition_cache | None):
+    """
+    Memoize every decompose_mass / decompose_mass_per_bounds call inside the block in cache (a
+    decomposition_cache), unless the call passes its own; None disables the block's cache.
+
+    Example usage (suspects and background ions recur across runs):
+
+        with decomposition_cache("~/hrms_decompositions.sqlite") as cache, use_decomposition_cache(cache):
+            for run in runs:
+                df = annotate_chromatogram_with_formulas(run, ...)
+        print(cache.stats())
+    """
+    assert cache is None or isinstance(cache, decomposition_cache), f"cache should be None or a decomposition_cache, but got {type(cache)}"
+    token = _active_decomposition_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _active_decomposition_cache.reset(token)
 
+def _resolve_decomposition_cache(cache: decomposition_cache | None) -> decomposition_cache | None:
+    assert cache is None or isinstance(cache, decomposition_cache), f"cache should be None or a decomposition_cache, but got {type(cache)}"
+    return cache if cache is not None else _active_decomposition_cache.get()
 
+def _formula_rows(series: pl.Series) -> tuple[NDArray[np.int64], NDArray[np.int32]]:
+    """(offsets, (n, NUM_ELEMENTS) formulas) of a List(Array(Int32, NUM_ELEMENTS)) Series without nulls."""
+    offsets = np.zeros(series.len() + 1, dtype=np.int64)
+    np.cumsum(series.list.len().to_numpy(), out=offsets[1:])
+    values = pc.list_flatten(pc.list_flatten(series.to_arrow()))
+    return offsets, np.asarray(values.to_numpy(zero_copy_only=False), dtype=np.int32).reshape(-1, NUM_ELEMENTS)
 
+def _kept_formula_lists(
+    formulas: NDArray[np.int32], lengths: NDArray[np.int64], keep: NDArray[np.bool_], max_results: int,
+) -> pl.Series:
+    """List(Array(Int32, NUM_ELEMENTS)) Series of the first max_results kept formulas of each row, rows given by lengths."""
+    row_of_formula = np.repeat(np.arange(len(lengths)), lengths)
+    kept_so_far = np.cumsum(keep)
+    row_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    kept_before_row = np.concatenate([[0], kept_so_far])[row_offsets[:-1]]
+    keep = keep & (kept_so_far - kept_before_row[row_of_formula] <= max_results)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_of_formula[keep], minlength=len(lengths)), out=offsets[1:])
+    values = pa.FixedSizeListArray.from_arrays(pa.array(formulas[keep].reshape(-1), type=pa.int32()), NUM_ELEMENTS)
+    return pl.Series("decomposed_formula", pa.LargeListArray.from_arrays(pa.array(offsets, type=pa.int64()), values))
+
+def _decompose_with_cache(
+    cache: decomposition_cache,
+    masses: NDArray[np.float64],
+    min_bounds: NDArray[np.int32],
+    max_bounds: NDArray[np.int32],
+    tolerance_ppm: float,
+    tolerance: mass_tolerance_config | None,
+    min_dbe: float,
+    max_dbe: float,
+    max_results: int,
+    dbe_pruning: bool,
+    chemistry_rules: chemistry_rules_config | None,
+    parallel_kwargs: Dict[str, Any],
+) -> pl.Series:
+    """
+    decompose_mass_parallel_per_bounds through cache, for (n, NUM_ELEMENTS) bound rows. A missing
+    bucket is decomposed once at its center with an absolute window covering the window of every
+    mass in it; each mass then keeps the formulas within its own window (the decomposer's exact-mass
+    and DBE test), in enumeration order and capped at max_results, so the output equals a direct
+    call. Buckets whose widened decomposition reaches max_results are not stored, their masses are
+    decomposed directly. Null (NaN) masses give empty lists, as in a direct call.
+    """
+    valid = np.isfinite(masses)
+    if not np.all(valid):
+        kept = _decompose_with_cache(
+            cache, masses[valid], min_bounds[valid], max_bounds[valid], tolerance_ppm, tolerance,
+            min_dbe, max_dbe, max_results, dbe_pruning, chemistry_rules, parallel_kwargs,
+        )
+        lengths = np.zeros(len(masses), dtype=np.int64)
+        lengths[valid] = kept.list.len().to_numpy()
+        offsets = np.zeros(len(masses) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = pc.list_flatten(kept.to_arrow())
+        return pl.Series("decomposed_formula", pa.LargeListArray.from_arrays(pa.array(offsets, type=pa.int64()), values))
+    tolerance = tolerance if tolerance is not None else mass_tolerance_config(ppm=tolerance_ppm)
+    chemistry_kwargs = _chemistry_kwargs(chemistry_rules)
+    shared_settings = {
+        "tolerance": tolerance._wrapper_kwargs()["tolerance_model"],
+        "dbe_range": (float(min_dbe), float(max_dbe)),
+        "chemistry": chemistry_kwargs,
+        # the registered alphabet: a cache directory may be shared by processes with different ELEMENTS
+        "elements": get_element_info(),
+    }
+    bound_pairs, pair_of_row = np.unique(np.concatenate([min_bounds, max_bounds], axis=1), axis=0, return_inverse=True)
+    settings_of_pair = [cache.settings_key({**shared_settings, "bounds": pair}) for pair in bound_pairs]
+    row_keys = list(zip((settings_of_pair[pair] for pair in pair_of_row.reshape(-1)), cache.buckets(masses).tolist()))
+    pair_of_key = dict(zip(row_keys, pair_of_row.reshape(-1).tolist()))
+
+    def decompose(target_masses, pair_indices, window_kwargs):
+        return decompose_mass_parallel_per_bounds(
+            target_masses=pl.Series(target_masses, dtype=pl.Float64),
+            min_bounds_per_mass=pl.Series(bound_pairs[pair_indices, :NUM_ELEMENTS], dtype=pl.Array(pl.Int32, NUM_ELEMENTS)),
+            max_bounds_per_mass=pl.Series(bound_pairs[pair_indices, NUM_ELEMENTS:], dtype=pl.Array(pl.Int32, NUM_ELEMENTS)),
+            tolerance_ppm=tolerance_ppm,
+            **window_kwargs,
+            min_dbe=min_dbe,
+            max_dbe=max_dbe,
+            max_results=max_results,
+            dbe_pruning=dbe_pruning,
+            **chemistry_kwargs,
+            **parallel_kwargs,
+        )
+
+    entries = cache.lookup(pair_of_key, NUM_ELEMENTS)
+    missing = [key for key in pair_of_key if key not in entries]
+    if missing:
+        half_quantum = cache.mass_quantum_da / 2
+        centers = np.array([bucket for _, bucket in missing], dtype=np.float64) * cache.mass_quantum_da
+        windows = np.max([tolerance.tolerance_da(centers + offset) for offset in (-half_quantum, 0.0, half_quantum)], axis=0)
+        windows = windows * (1 + 1e-6) + half_quantum
+        # one call per window level, rounded up to a 5% grid
+        levels = np.power(1.05, np.ceil(np.log(windows) / np.log(1.05)))
+        new_entries = {}
+        for level in np.unique(levels):
+            indices = np.flatnonzero(levels == level)
+            results = decompose(
+                centers[indices], [pair_of_key[missing[i]] for i in indices],
+                mass_tolerance_config.absolute(float(level))._wrapper_kwargs(),
+            )
+            offsets, formulas = _formula_rows(results)
+            for j, i in enumerate(indices):
+                if offsets[j + 1] - offsets[j] < max_results:
+                    new_entries[missing[i]] = formulas[offsets[j]:offsets[j + 1]]
+        cache.store(new_entries)
+        entries.update(new_entries)
+
+    # rows whose bucket could not be stored
+    direct_rows = [row for row, key in enumerate(row_keys) if key not in entries]
+    direct = {}
+    if direct_rows:
+        results = decompose(masses[direct_rows], pair_of_row.reshape(-1)[direct_rows], _tolerance_kwargs(tolerance))
+        offsets, formulas = _formula_rows(results)
+        direct = {row: formulas[offsets[j]:offsets[j + 1]] for j, row in enumerate(direct_rows)}
+
+    candidates = [direct[row] if row in direct else entries[key] for row, key in enumerate(row_keys)]
+    lengths = np.array([len(c) for c in candidates], dtype=np.int64)
+    formulas = np.concatenate(candidates) if candidates else np.empty((0, NUM_ELEMENTS), dtype=np.int32)
+    keep = filter_formulas_parallel(
+        formulas=formulas,
+        target_masses=np.repeat(masses, lengths),
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        min_dbe=min_dbe,
+        max_dbe=max_dbe,
+    )
+    return _kept_formula_lists(formulas, lengths, keep, max_results)
 
 def decompose_mass(
     mass_series:pl.Series,
@@ -28,10 +520,41 @@ def decompose_mass(
     max_dbe: float = 40.0,
 
     max_results: int = 100000,
+    dbe_pruning: bool = True,
+    chemistry_rules: chemistry_rules_config | None = None,
+    ranking: candidate_ranking_config | None = None,
+    tolerance: mass_tolerance_config | None = None,
+    cache: decomposition_cache | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
 ):
     """
     Wrapper for decompose_mass_parallel, fixed bounds only, with validation of input types.
 
+    Element count bounds prune the enumeration per level (a subtree is skipped as soon as the
+    remaining mass cannot be covered by the lighter elements within their bounds). With
+    dbe_pruning=True, subtrees whose reachable DBE range misses [min_dbe, max_dbe] are skipped
+    as well; the results are identical either way, only the amount of work changes.
+
+    chemistry_rules (a chemistry_rules_config) additionally drops chemically implausible formulas
+    (element/carbon ratios, Senior rules) during the enumeration; None keeps every formula.
+
+    ranking (a candidate_ranking_config) keeps only the top_k best-scoring formulas per mass, best
+    first, instead of the first max_results in enumeration order.
+
+    tolerance (a mass_tolerance_config) replaces tolerance_ppm by a mass-dependent window (ppm floor
+    mass, absolute floor in Da, calibrated ppm polynomial). It is accepted by every decomposition,
+    cleaning and filtering wrapper in this module; None keeps tolerance_ppm over max(mass, 200).
+
+    cache (a decomposition_cache, or the one of an enclosing use_decomposition_cache block) memoizes
+    the results on disk across calls and runs; the output is identical to an uncached call. It is
+    not used together with ranking.
+
+    n_threads, schedule and schedule_chunk_size control the OpenMP loop over masses; None falls back
+    to use_parallel_config / the HRMS_UTILS_* environment variables (see parallel_config). The same
+    arguments are accepted by every decomposition and cleaning wrapper in this module.
+
     Example usage:
 
         df = pl.DataFrame({
@@ -48,11 +571,11 @@ def decompose_mass(
                     min_dbe=0.0,
                     max_dbe=40.0
                 ),
-                return_dtype=pl.List(pl.Array(pl.Int32, 15))
+                return_dtype=pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))
             ).alias("decomposed_formulas")
         )
 
-        min_formula = np.zeros(15, dtype=np.int32)
+        min_formula = np.zeros(NUM_ELEMENTS, dtype=np.int32)
         max_formula = np.array([100, 0, 40, 20, 10, 5, 2, 1, 0, 0, 0, 0, 0, 0, 0], dtype=np.int32)
 
         df = pl.DataFrame({
@@ -65,13 +588,13 @@ def decompose_mass(
             pl.col("mass").map_batches(
                 function=lambda x: decompose_mass(
                     mass_series=x,
-                    min_bounds=np.zeros(15, dtype=np.int32),
+                    min_bounds=np.zeros(NUM_ELEMENTS, dtype=np.int32),
                     max_bounds=np.array([100, 0, 40, 20, 10, 5, 2, 1, 0, 0, 0, 0, 0, 0, 0], dtype=np.int32),
                     tolerance_ppm=5.0,
                     min_dbe=0.0,
                     max_dbe=40.0
                 ),
-                return_dtype=pl.List(pl.Array(pl.Int32, 15)),
+                return_dtype=pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)),
                 is_elementwise=True
             ).alias("decomposed_formula")
         )
@@ -90,15 +613,28 @@ def decompose_mass(
     assert isinstance(min_dbe, (float, int)), f"min_dbe should be a float or int, but got {type(min_dbe)}"
     assert isinstance(max_dbe, (float, int)), f"max_dbe should be a float or int, but got {type(max_dbe)}"
     assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}"
+    assert isinstance(dbe_pruning, bool), f"dbe_pruning should be a bool, but got {type(dbe_pruning)}"
 
+    cache = _resolve_decomposition_cache(cache)
+    if cache is not None and ranking is None:
+        return _decompose_with_cache(
+            cache, mass_series.to_numpy(), np.tile(min_bounds, (mass_series.len(), 1)), np.tile(max_bounds, (mass_series.len(), 1)),
+            tolerance_ppm, tolerance, min_dbe, max_dbe, max_results, dbe_pruning, chemistry_rules,
+            _parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+        )
     results = decompose_mass_parallel(
         target_masses=mass_series,
         min_bounds=min_bounds,
         max_bounds=max_bounds,
         tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
         min_dbe=min_dbe,
         max_dbe=max_dbe,
         max_results=max_results,
+        dbe_pruning=dbe_pruning,
+        **_chemistry_kwargs(chemistry_rules),
+        **_ranking_kwargs(ranking),
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
     )
     return results
 
@@ -110,16 +646,26 @@ def decompose_mass_per_bounds(
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,  
     max_results: int = 100000,
+    dbe_pruning: bool = True,
+    chemistry_rules: chemistry_rules_config | None = None,
+    ranking: candidate_ranking_config | None = None,
+    tolerance: mass_tolerance_config | None = None,
+    cache: decomposition_cache | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
 ) -> pl.Series:
     """
     Return a Polars Series of possible formulas for the mass.
 
     The data type is:
-        pl.Series(pl.List(pl.Array(inner=pl.int32, shape=(15,))))
+        pl.Series(pl.List(pl.Array(inner=pl.int32, shape=(NUM_ELEMENTS,))))
+
+    The keyword arguments are those of decompose_mass, including cache.
 
     Example usage:
 
-        min_formula = np.zeros(15, dtype=np.int32)
+        min_formula = np.zeros(NUM_ELEMENTS, dtype=np.int32)
         max_formula = np.array([100, 0, 40, 20, 10, 5, 2, 1, 0, 0, 0, 0, 0, 0, 0], dtype=np.int32)
 
         df = pl.DataFrame({
@@ -138,7 +684,7 @@ def decompose_mass_per_bounds(
                     min_dbe=0.0,
                     max_dbe=40.0
                 ),
-                return_dtype=pl.List(pl.Array(pl.Int32, 15)),
+                return_dtype=pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)),
                 is_elementwise=True
             ).alias("decomposed_formula")
         )
@@ -153,19 +699,330 @@ def decompose_mass_per_bounds(
     assert isinstance(min_dbe   , (float, int)), f"min_dbe should be a float or int, but got {type(min_dbe)}"
     assert isinstance(max_dbe   , (float, int)), f"max_dbe should be a float or int, but got {type(max_dbe)}"
     assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}" 
+    assert isinstance(dbe_pruning, bool), f"dbe_pruning should be a bool, but got {type(dbe_pruning)}"
 
-
+    cache = _resolve_decomposition_cache(cache)
+    if cache is not None and ranking is None:
+        return _decompose_with_cache(
+            cache, mass_series.to_numpy(),
+            min_bounds.to_numpy().reshape(-1, NUM_ELEMENTS).astype(np.int32), max_bounds.to_numpy().reshape(-1, NUM_ELEMENTS).astype(np.int32),
+            tolerance_ppm, tolerance, min_dbe, max_dbe, max_results, dbe_pruning, chemistry_rules,
+            _parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+        )
     results = decompose_mass_parallel_per_bounds(
         target_masses=mass_series,
         min_bounds_per_mass=min_bounds,
         max_bounds_per_mass=max_bounds,
         tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
         min_dbe=min_dbe,
         max_dbe=max_dbe,
         max_results=max_results,
+        dbe_pruning=dbe_pruning,
+        **_chemistry_kwargs(chemistry_rules),
+        **_ranking_kwargs(ranking),
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
     )
     return results  
                       
+def decompose_mass_with_isotopes(
+    mass_series: pl.Series,
+    precursor_mz_series: pl.Series,
+    ms1_mzs: pl.Series,
+    ms1_intensities: pl.Series,
+    min_bounds: pl.Series,
+    max_bounds: pl.Series,
+    isotopes: isotope_scoring_config | None = None,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    chemistry_rules: chemistry_rules_config | None = None,
+    ranking: candidate_ranking_config | None = None,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> pl.Series:
+    """
+    decompose_mass_per_bounds that also uses the MS1 isotope envelope of each feature, in one native
+    pass: the observed M+1/M and M+2/M ratios (see isotope_scoring_config) first lower the max bounds
+    of the isotope-bearing elements, then every formula is checked against them inside the
+    enumerator, and with a ranking only the top_k formulas by mass error plus envelope deviation are
+    kept, best first. The bounds are typically the output of deduce_isotopic_pattern, which only
+    keeps integer limits; the envelope adds the continuous evidence.
+
+    mass_series holds the neutral masses to decompose, precursor_mz_series the m/z of the same
+    features in ms1_mzs / ms1_intensities (List(Float64) per feature). None for isotopes uses the
+    isotope_scoring_config defaults. The result has the type of decompose_mass_per_bounds.
+    """
+    assert isinstance(mass_series, pl.Series) and mass_series.dtype == pl.Float64, f"mass_series should be a Float64 Polars Series, but got {type(mass_series)}"
+    assert isinstance(precursor_mz_series, pl.Series) and precursor_mz_series.len() == mass_series.len(), (
+        "precursor_mz_series should be a Polars Series with one m/z per mass"
+    )
+    for name, series in (("ms1_mzs", ms1_mzs), ("ms1_intensities", ms1_intensities)):
+        assert isinstance(series, pl.Series) and isinstance(series.dtype, pl.List), f"{name} should be a Polars Series of lists, but got {type(series)}"
+        assert series.len() == mass_series.len(), f"{name} should have one row per mass, but got {series.len()} rows for {mass_series.len()} masses"
+    assert isinstance(min_bounds, pl.Series) and min_bounds.dtype == pl.Array(pl.Int32,shape=(NUM_ELEMENTS,)), f"min_bounds should be a Polars Series of int32 arrays, but got {type(min_bounds)} with dtype {min_bounds.dtype}"
+    assert isinstance(max_bounds, pl.Series) and max_bounds.dtype == pl.Array(pl.Int32,shape=(NUM_ELEMENTS,)), f"max_bounds should be a Polars Series of int32 arrays, but got {type(max_bounds)} with dtype {max_bounds.dtype}"
+    assert isotopes is None or isinstance(isotopes, isotope_scoring_config), f"isotopes should be None or an isotope_scoring_config, but got {type(isotopes)}"
+    assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive number, but got {tolerance_ppm}"
+    assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}"
+    assert isinstance(dbe_pruning, bool), f"dbe_pruning should be a bool, but got {type(dbe_pruning)}"
+
+    return decompose_mass_with_isotopes_parallel(
+        target_masses=mass_series,
+        precursor_mzs=precursor_mz_series.cast(pl.Float64),
+        ms1_mzs_series=ms1_mzs.cast(pl.List(pl.Float64)),
+        ms1_intensities_series=ms1_intensities.cast(pl.List(pl.Float64)),
+        min_bounds_per_mass=min_bounds,
+        max_bounds_per_mass=max_bounds,
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        min_dbe=min_dbe,
+        max_dbe=max_dbe,
+        max_results=max_results,
+        dbe_pruning=dbe_pruning,
+        **_chemistry_kwargs(chemistry_rules),
+        **_ranking_kwargs(ranking),
+        **(isotopes or isotope_scoring_config())._wrapper_kwargs(),
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+    )
+
+def iter_decompose_mass(
+    mass_series: pl.Series,
+    min_bounds: NDArray[np.int32] | pl.Series,
+    max_bounds: NDArray[np.int32] | pl.Series,
+    chunk_size: int = 10_000,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    chemistry_rules: chemistry_rules_config | None = None,
+    ranking: candidate_ranking_config | None = None,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> Iterator[pl.DataFrame]:
+    """
+    Decompose masses chunk by chunk, yielding one Polars DataFrame per chunk so that peak memory is
+    bounded by the results of a single chunk rather than of the whole series.
+
+    Bounds are either uniform (1D int32 numpy arrays, as in decompose_mass) or per mass
+    (pl.Series of pl.Array(pl.Int32, NUM_ELEMENTS), as in decompose_mass_per_bounds).
+
+    Each yielded DataFrame has the columns:
+        "mass_index":         pl.UInt64, position of the mass in mass_series
+        "decomposed_formula": pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))
+    The formula column is backed by flat Arrow buffers (offsets + int32 values), ready to be
+    written out with e.g. pl.DataFrame.write_parquet or pyarrow.ipc without further conversion.
+
+    Example usage:
+
+        for chunk in iter_decompose_mass(df["mass"], min_formula, max_formula, chunk_size=5_000):
+            chunk.explode("decomposed_formula").write_parquet(out_dir / f"{chunk['mass_index'][0]}.parquet")
+    """
+    assert isinstance(mass_series, pl.Series), f"mass_series should be a Polars Series, but got {type(mass_series)}"
+    assert isinstance(chunk_size, int) and chunk_size > 0, f"chunk_size should be a positive integer, but got {chunk_size}"
+    per_mass_bounds = isinstance(min_bounds, pl.Series)
+    if per_mass_bounds:
+        assert isinstance(max_bounds, pl.Series), "min_bounds and max_bounds should both be Polars Series for per-mass bounds"
+        assert min_bounds.len() == mass_series.len() and max_bounds.len() == mass_series.len(), (
+            "min_bounds and max_bounds should have one row per mass"
+        )
+
+    for start in range(0, mass_series.len(), chunk_size):
+        masses = mass_series.slice(start, chunk_size)
+        if per_mass_bounds:
+            formulas = decompose_mass_per_bounds(
+                masses, min_bounds.slice(start, chunk_size), max_bounds.slice(start, chunk_size),
+                tolerance_ppm=tolerance_ppm, min_dbe=min_dbe, max_dbe=max_dbe,
+                max_results=max_results, dbe_pruning=dbe_pruning, chemistry_rules=chemistry_rules, ranking=ranking, tolerance=tolerance,
+                n_threads=n_threads, schedule=schedule, schedule_chunk_size=schedule_chunk_size,
+            )
+        else:
+            formulas = decompose_mass(
+                masses, min_bounds, max_bounds,
+                tolerance_ppm=tolerance_ppm, min_dbe=min_dbe, max_dbe=max_dbe,
+                max_results=max_results, dbe_pruning=dbe_pruning, chemistry_rules=chemistry_rules, ranking=ranking, tolerance=tolerance,
+                n_threads=n_threads, schedule=schedule, schedule_chunk_size=schedule_chunk_size,
+            )
+        yield pl.DataFrame({
+            "mass_index": pl.int_range(start, start + masses.len(), dtype=pl.UInt64, eager=True),
+            "decomposed_formula": formulas,
+        })
+
+def count_mass_decompositions(
+    mass_series: pl.Series,
+    min_bounds: NDArray[np.int32] | pl.Series,
+    max_bounds: NDArray[np.int32] | pl.Series,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    chemistry_rules: chemistry_rules_config | None = None,
+    ranking: candidate_ranking_config | None = None,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> pl.Series:
+    """
+    Number of candidate formulas per mass (pl.Int64 Series named "candidate_count"), without
+    materializing the formulas. Counts are exactly the lengths decompose_mass /
+    decompose_mass_per_bounds would return, including the max_results (or ranking top_k) cap, so this is meant for
+    triage (e.g. skipping hopeless masses) and for choosing a tolerance adaptively before the
+    real decomposition.
+
+    Bounds are uniform (1D int32 numpy arrays) or per mass (pl.Series of pl.Array(pl.Int32, NUM_ELEMENTS)).
+    """
+    assert isinstance(mass_series, pl.Series), f"mass_series should be a Polars Series, but got {type(mass_series)}"
+    assert mass_series.dtype == pl.Float64, f"mass_series should be of type Float64, but got {mass_series.dtype}"
+    assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive value, but got {tolerance_ppm}"
+    assert isinstance(min_dbe, (float, int)), f"min_dbe should be a float or int, but got {type(min_dbe)}"
+    assert isinstance(max_dbe, (float, int)), f"max_dbe should be a float or int, but got {type(max_dbe)}"
+    assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}"
+    assert isinstance(dbe_pruning, bool), f"dbe_pruning should be a bool, but got {type(dbe_pruning)}"
+
+    if isinstance(min_bounds, pl.Series):
+        expected_dtype = pl.Array(pl.Int32, shape=(NUM_ELEMENTS,))
+        assert min_bounds.dtype == expected_dtype, f"min_bounds should be a Polars Series of int32 arrays, but got dtype {min_bounds.dtype}"
+        assert isinstance(max_bounds, pl.Series) and max_bounds.dtype == expected_dtype, (
+            f"max_bounds should be a Polars Series of int32 arrays, but got {type(max_bounds)}"
+        )
+        return count_mass_parallel_per_bounds(
+            target_masses=mass_series,
+            min_bounds_per_mass=min_bounds,
+            max_bounds_per_mass=max_bounds,
+            tolerance_ppm=tolerance_ppm,
+            **_tolerance_kwargs(tolerance),
+            min_dbe=min_dbe,
+            max_dbe=max_dbe,
+            max_results=max_results,
+            dbe_pruning=dbe_pruning,
+            **_chemistry_kwargs(chemistry_rules),
+            **_ranking_kwargs(ranking),
+            **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+        )
+
+    assert isinstance(min_bounds, np.ndarray) and min_bounds.ndim == 1 and min_bounds.dtype == np.int32, (
+        f"min_bounds should be a 1D int32 numpy array, but got {type(min_bounds)}"
+    )
+    assert isinstance(max_bounds, np.ndarray) and max_bounds.ndim == 1 and max_bounds.dtype == np.int32, (
+        f"max_bounds should be a 1D int32 numpy array, but got {type(max_bounds)}"
+    )
+    return count_mass_parallel(
+        target_masses=mass_series,
+        min_bounds=min_bounds,
+        max_bounds=max_bounds,
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        min_dbe=min_dbe,
+        max_dbe=max_dbe,
+        max_results=max_results,
+        dbe_pruning=dbe_pruning,
+        **_chemistry_kwargs(chemistry_rules),
+        **_ranking_kwargs(ranking),
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+    )
+
+def estimate_decomposition_cost(
+    mass_series: pl.Series,
+    min_bounds: NDArray[np.int32] | pl.Series,
+    max_bounds: NDArray[np.int32] | pl.Series,
+    tolerance_ppm: float = 5.0,
+    tolerance: mass_tolerance_config | None = None,
+) -> pl.Series:
+    """
+    Relative cost of decomposing each mass (pl.Float64 Series named "estimated_cost"): the
+    tolerance window in integer-mass steps of the residue table times the volume of the element
+    count bounds the enumeration can reach at that mass. Only ratios are meaningful.
+
+    The C++ kernels already use it to start expensive masses first (parallel_config.cost_ordering);
+    it is exposed to split large batches across processes with similar total work, e.g. by
+    assigning masses greedily to the shard with the lowest accumulated cost.
+
+    Bounds are uniform (1D int32 numpy arrays) or per mass (pl.Series of pl.Array(pl.Int32, NUM_ELEMENTS)).
+    """
+    assert isinstance(mass_series, pl.Series), f"mass_series should be a Polars Series, but got {type(mass_series)}"
+    assert mass_series.dtype == pl.Float64, f"mass_series should be of type Float64, but got {mass_series.dtype}"
+    assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive value, but got {tolerance_ppm}"
+
+    if isinstance(min_bounds, pl.Series):
+        expected_dtype = pl.Array(pl.Int32, shape=(NUM_ELEMENTS,))
+        assert min_bounds.dtype == expected_dtype, f"min_bounds should be a Polars Series of int32 arrays, but got dtype {min_bounds.dtype}"
+        assert isinstance(max_bounds, pl.Series) and max_bounds.dtype == expected_dtype, (
+            f"max_bounds should be a Polars Series of int32 arrays, but got {type(max_bounds)}"
+        )
+        min_bounds_per_mass = min_bounds.to_numpy()
+        max_bounds_per_mass = max_bounds.to_numpy()
+    else:
+        assert isinstance(min_bounds, np.ndarray) and min_bounds.ndim == 1 and min_bounds.dtype == np.int32, (
+            f"min_bounds should be a 1D int32 numpy array, but got {type(min_bounds)}"
+        )
+        assert isinstance(max_bounds, np.ndarray) and max_bounds.ndim == 1 and max_bounds.dtype == np.int32, (
+            f"max_bounds should be a 1D int32 numpy array, but got {type(max_bounds)}"
+        )
+        min_bounds_per_mass = np.broadcast_to(min_bounds, (mass_series.len(), NUM_ELEMENTS))
+        max_bounds_per_mass = np.broadcast_to(max_bounds, (mass_series.len(), NUM_ELEMENTS))
+
+    return estimate_decomposition_cost_parallel(
+        target_masses=mass_series,
+        min_bounds_per_mass=min_bounds_per_mass,
+        max_bounds_per_mass=max_bounds_per_mass,
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+    )
+
+def filter_formulas(
+    formulas: pl.Series,
+    target_masses: pl.Series | float,
+    tolerance_ppm: float = 5.0,
+    dbe_range: tuple[float, float] = (0.0, 40.0),
+    tolerance: mass_tolerance_config | None = None,
+) -> pl.Series:
+    """
+    The exact-mass and DBE filter of the decomposer, applied to existing formulas: a pl.Boolean
+    Series named "fits" that is True where the formula's mass is within the tolerance window of its
+    target (same window as decompose_mass, tolerance_ppm or a mass_tolerance_config) and its DBE is
+    an integer within dbe_range.
+
+    formulas is a pl.Series of pl.Array(pl.Int32, NUM_ELEMENTS) without nulls; target_masses is a
+    Float64 Series of the same length or a single mass for all rows. To filter the nested output of
+    decompose_mass, explode it first and pass the matching masses.
+    """
+    expected_dtype = pl.Array(pl.Int32, shape=(NUM_ELEMENTS,))
+    assert isinstance(formulas, pl.Series) and formulas.dtype == expected_dtype, (
+        f"formulas should be a Polars Series of int32 arrays, but got {type(formulas) if not isinstance(formulas, pl.Series) else formulas.dtype}"
+    )
+    assert formulas.null_count() == 0, "formulas should not contain nulls"
+    if isinstance(target_masses, pl.Series):
+        assert target_masses.dtype == pl.Float64, f"target_masses should be of type Float64, but got {target_masses.dtype}"
+        assert target_masses.len() == formulas.len(), (
+            f"target_masses should have one mass per formula, but got {target_masses.len()} masses for {formulas.len()} formulas"
+        )
+        assert target_masses.null_count() == 0, "target_masses should not contain nulls"
+        target_mass_array = target_masses.to_numpy()
+    else:
+        assert isinstance(target_masses, (float, int)), f"target_masses should be a Polars Series or a float, but got {type(target_masses)}"
+        target_mass_array = np.full(formulas.len(), float(target_masses))
+    assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive value, but got {tolerance_ppm}"
+    assert len(dbe_range) == 2 and dbe_range[0] <= dbe_range[1], f"dbe_range should be a (min_dbe, max_dbe) pair, but got {dbe_range}"
+
+    keep = filter_formulas_parallel(
+        formulas=formulas.to_numpy().reshape(-1, NUM_ELEMENTS),
+        target_masses=target_mass_array,
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        min_dbe=dbe_range[0],
+        max_dbe=dbe_range[1],
+    )
+    return pl.Series("fits", keep, dtype=pl.Boolean)
+
 def decompose_spectra(
     precursor_mass_series: pl.Series,
     fragment_masses_series: pl.Series,
@@ -175,162 +1032,122 @@ def decompose_spectra(
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,
     max_results: int = 100000,
-):
+    fragment_intensities_series: pl.Series | None = None,
+    top_k: int | None = None,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> pl.Series:
     """
-    NOT IMPLEMENTED YET, DO NOT USE THIS FUNCTION.
-    Wrapper for spectrum decomposition (unknown precursor).
-    Handles both uniform and per-spectrum bounds.
+    Decomposes spectra with unknown precursor formula in one native pass: the precursor mass is
+    decomposed, the fragments of every candidate are matched to its sub-formulas (enumerated once per
+    spectrum against the element-wise maximum of the candidates), and the nested result is returned
+    without an explode / decompose_spectra_known_precursor round trip.
+    Handles both uniform (1D numpy arrays) and per-spectrum (Series of arrays) bounds.
+
+    Returns one row per spectrum, a list with one struct per precursor candidate:
+    precursor, precursor_mass, precursor_error_ppm, explained_intensity (summed intensity of the
+    fragments with at least one sub-formula, or their count without fragment_intensities_series),
+    and fragments / fragment_masses / fragment_errors_ppm with one inner list per fragment.
+
+    top_k keeps only the k candidates with the highest explained_intensity per spectrum (best first,
+    ties broken by the smaller absolute precursor error); None keeps every candidate in enumeration order.
+    fragment_engine and max_subformula_lattice_size are as in decompose_spectra_known_precursor.
 
     Example usage:
     Uniform bounds:
-    min_formula = np.zeros(15, dtype=np.int32)
+    min_formula = np.zeros(NUM_ELEMENTS, dtype=np.int32)
     max_formula = np.array([100,0,40,20,10,5,2,1,0,0,0,0,0,0,0], dtype=np.int32)
 
-    df = pl.DataFrame({
-        "precursor_mass": [500.0, 600.0],
-        "fragment_masses": [[100.0, 200.0, 300.0], [150.0, 250.0, 350.0]]
-    })
-    df = df.with_columns(
-        decompose_spectra(
-            precursor_mass_series=pl.col("precursor_mass"),
-            fragment_masses_series=pl.col("fragment_masses"),
-            min_bounds=min_formula,
-            max_bounds=max_formula,
-            tolerance_ppm=5.0,
-            min_dbe=0.0,
-            max_dbe=40.0,
-        ).alias("decomposed_spectra")
-    )
-
-    Per-spectrum bounds:
-    min_formula = np.zeros(15, dtype=np.int32)
-    max_formula = np.array([100,0,40,20,10,5,2,1,0,0,0,0,0,0,0], dtype=np.int32)
     df = pl.DataFrame({
         "precursor_mass": [500.0, 600.0],
         "fragment_masses": [[100.0, 200.0, 300.0], [150.0, 250.0, 350.0]],
-        "min_bounds": [min_formula, min_formula],
-        "max_bounds": [max_formula, max_formula]
+        "fragment_intensities": [[10.0, 100.0, 30.0], [5.0, 50.0, 20.0]],
     })
     df = df.with_columns(
-        decompose_spectra(
-            precursor_mass_series=pl.col("precursor_mass"),
-            fragment_masses_series=pl.col("fragment_masses"),
-            min_bounds=pl.col("min_bounds"),
-            max_bounds=pl.col("max_bounds"),
-            tolerance_ppm=5.0,
-            min_dbe=0.0,
-            max_dbe=40.0,
+        pl.struct(["precursor_mass", "fragment_masses", "fragment_intensities"]).map_batches(
+            lambda s: decompose_spectra(
+                precursor_mass_series=s.struct.field("precursor_mass"),
+                fragment_masses_series=s.struct.field("fragment_masses"),
+                fragment_intensities_series=s.struct.field("fragment_intensities"),
+                min_bounds=min_formula,
+                max_bounds=max_formula,
+                tolerance_ppm=5.0,
+                top_k=5,
+            )
         ).alias("decomposed_spectra")
     )
+
+    Per-spectrum bounds: pass min_bounds / max_bounds as pl.Series of pl.Array(pl.Int32, NUM_ELEMENTS),
+    one row per spectrum.
     """
-    raise NotImplementedError("This function is not implemented yet. docmpose the mass of the precursor, explode each option to different rows, and then use decompose_spectra_known_precursor instead.")
-    precursor_masses = precursor_mass_series.to_numpy()
-    fragment_masses_list = fragment_masses_series.to_list()
+    assert isinstance(precursor_mass_series, pl.Series), f"precursor_mass_series should be a Polars Series, but got {type(precursor_mass_series)}"
+    assert isinstance(fragment_masses_series, pl.Series), f"fragment_masses_series should be a Polars Series, but got {type(fragment_masses_series)}"
+    assert fragment_intensities_series is None or isinstance(fragment_intensities_series, pl.Series), f"fragment_intensities_series should be a Polars Series or None, but got {type(fragment_intensities_series)}"
+    assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive value, but got {tolerance_ppm}"
+    assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}"
+    assert top_k is None or (isinstance(top_k, int) and top_k > 0), f"top_k should be None or a positive integer, but got {top_k}"
+    _validate_fragment_engine(fragment_engine, max_subformula_lattice_size)
+    shared_kwargs = dict(
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        min_dbe=min_dbe,
+        max_dbe=max_dbe,
+        max_results=max_results,
+        top_k_precursors=top_k or 0,
+        fragment_engine=fragment_engine,
+        max_subformula_lattice_size=max_subformula_lattice_size,
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+    )
     # Uniform bounds
     if isinstance(min_bounds, np.ndarray) and min_bounds.ndim == 1:
-        spectra_data = [
-            {"precursor_mass": pm, "fragment_masses": fm}
-            for pm, fm in zip(precursor_masses, fragment_masses_list)
-        ]
-        results = decompose_spectra_parallel(
-            spectra_data=spectra_data,
-            min_bounds=min_bounds,
-            max_bounds=max_bounds,
-            tolerance_ppm=tolerance_ppm,
-            min_dbe=min_dbe,
-            max_dbe=max_dbe,
-            max_results=max_results,
+        assert isinstance(max_bounds, np.ndarray) and max_bounds.shape == min_bounds.shape, "max_bounds should be a 1D numpy array like min_bounds"
+        return decompose_spectra_parallel(
+            precursor_mass_series,
+            fragment_masses_series,
+            fragment_intensities_series,
+            np.ascontiguousarray(min_bounds, dtype=np.int32),
+            np.ascontiguousarray(max_bounds, dtype=np.int32),
+            **shared_kwargs,
         )
     # Per-spectrum bounds
-    elif isinstance(min_bounds, pl.Series) and isinstance(max_bounds, pl.Series):
-        min_bounds_np = min_bounds.to_numpy()
-        max_bounds_np = max_bounds.to_numpy()
-        spectra_data = [
-            {
-                "precursor_mass": pm,
-                "fragment_masses": fm,
-                "min_bounds": min_b,
-                "max_bounds": max_b,
-            }
-            for pm, fm, min_b, max_b in zip(
-                precursor_masses, fragment_masses_list, min_bounds_np, max_bounds_np
-            )
-        ]
-        
-        results = decompose_spectra_parallel_per_bounds(
-            spectra_data=spectra_data,
-            tolerance_ppm=tolerance_ppm,
-            min_dbe=min_dbe,
-            max_dbe=max_dbe,
-            max_results=max_results,
-        )
-    else:
-        raise ValueError("min_bounds and max_bounds must both be either 1D numpy arrays or Polars Series of arrays.")
-    # now, the type of the ruslts hsould be:
-    # List[List[Dict]]
-    # and the dict is of the format:
-    #
-    #     {
-    #     'precursor': np.ndarray, # Shape: (NUM_ELEMENTS,), dtype: int32
-    #     'precursor_mass': float, # Calculated mass of the precursor
-    #     'precursor_error_ppm': float, # PPM error for precursor mass
-    #     'fragments': List[List[np.ndarray]], # Nested structure of fragment formulas
-    #     'fragment_masses': List[List[float]], # Corresponding calculated masses
-    #     'fragment_errors_ppm': List[List[float]] # Corresponding PPM errors
-    # }
-    # now we print the format of the results
-    # results should be  a list of lists of np.ndarray
-    # but we only care its an iterable, not necessarily a list
-    assert isinstance(results, Iterable), f"Results should be an iterable, but got {type(results)}"
-    #now we care the same about the first element of results
-    assert isinstance(results[0], Iterable), f"First entry (and all entries, but we check only the first) of results should be an iterable, but got {type(results[0])}"
-    # and the first element of the first entry should be a dict
-    assert isinstance(results[0][0], dict), f"First entry of the first result should be a dict, but got {type(results[0][0])}"
-    # now validate each key, and the type nad shape of the values
-    assert "precursor" in results[0][0].keys(), f"First entry of the first result should contain 'precursor' key, but got keys: {list(results[0][0].keys())}"
-    assert isinstance(results[0][0]["precursor"], np.ndarray), f"Value of 'precursor' should be a numpy array, but got {type(results[0][0]['precursor'])}"
-    assert results[0][0]["precursor"].dtype == np.int32, f"Value of 'precursor' should be a numpy array of int32, but got dtype {results[0][0]['precursor'].dtype}"
-    assert results[0][0]["precursor"].shape[0] == len(min_bounds), f"Shape of 'precursor' should match the length of min_bounds, which is {len(min_bounds)}, but got {results[0][0]['precursor'].shape[0]}"
-    assert "precursor_mass" in results[0][0].keys(), f"First entry of the first result should contain 'precursor_mass' key, but got keys: {list(results[0][0].keys())}"
-    assert isinstance(results[0][0]["precursor_mass"], float), f"Value of 'precursor_mass' should be a float, but got {type(results[0][0]['precursor_mass'])}"
-    assert "precursor_error_ppm" in results[0][0].keys(), f"First entry of the first result should contain 'precursor_error_ppm' key, but got keys: {list(results[0][0].keys())}"
-    assert isinstance(results[0][0]["precursor_error_ppm"], float), f"Value of 'precursor_error_ppm' should be a float, but got {type(results[0][0]['precursor_error_ppm'])}"
-    assert "fragments" in results[0][0].keys(), f"First entry of the first result should contain 'fragments' key, but got keys: {list(results[0][0].keys())}"
-    assert isinstance(results[0][0]["fragments"], Iterable), f"Value of 'fragments' should be a list, but is {type(results[0][0]['fragments'])}"
-    assert isinstance(results[0][0]["fragments"][0], Iterable), f"Each entry in 'fragments' should be a list, but got {type(results[0][0]['fragments'][0])} for the first fragment"
-    ##### note that we might have no fragments retuned
-    # check that each fragment is a numpy array
-    if len(results[0][0]["fragments"][0]) > 0:
-        for idx, f in enumerate(results[0][0]["fragments"][0]):
-            assert isinstance(f, np.ndarray), f"Fragment at index {idx} should be a numpy array, but got {type(f)}"
-
-    return pl.Series(
-        results, 
-        dtype=pl.List(
-                pl.Struct(
-                {
-                    "precursor": pl.Array(pl.Int32, len(min_bounds)),  # Precursor formula as an array
-                    "precursor_mass": pl.Float64,  # Calculated mass of the precursor
-                    "precursor_error_ppm": pl.Float64,  # PPM error for precursor   
-                    "fragments": pl.List(pl.List(pl.Array(pl.Int32, len(min_bounds)))),  # Nested structure of fragment formulas
-                    "fragment_masses": pl.List(pl.List(pl.Float64)),  # Corresponding calculated masses
-                    "fragment_errors_ppm": pl.List(pl.List(pl.Float64)),  # Correspond
-                }
-                )
-            ),
-            strict=False
+    if isinstance(min_bounds, pl.Series) and isinstance(max_bounds, pl.Series):
+        return decompose_spectra_parallel_per_bounds(
+            precursor_mass_series,
+            fragment_masses_series,
+            fragment_intensities_series,
+            min_bounds,
+            max_bounds,
+            **shared_kwargs,
         )
+    raise ValueError("min_bounds and max_bounds must both be either 1D numpy arrays or Polars Series of arrays.")
 
 def decompose_spectra_known_precursor(
     precursor_formula_series: pl.Series,
     fragment_masses_series: pl.Series,
     tolerance_ppm: float = 5.0,
     max_results: int = 100000,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
 ):
     """
     Decomposes the fragments, when the precursor was already decomposed.
     The bounds for fragment masses are determined by the precursor formula (not accounting for water absorption in orbitraps, WIP) and by the "zero fragment" from below.
 
+    fragment_engine selects how fragments are matched:
+    - "money_changing" (default): a full money-changing decomposition per fragment, bounded by the precursor.
+    - "subformula_index": all sub-formulas of the precursor are enumerated once per spectrum,
+      sorted by exact mass, and each fragment is answered by binary search. Precursors with more than
+      max_subformula_lattice_size sub-formulas fall back to money-changing automatically.
+    Both engines return the same formulas; the sub-formula index returns them in increasing mass order.
+
     Example usage:
 
         # Decompose precursor masses to formulas
@@ -363,11 +1180,16 @@ def decompose_spectra_known_precursor(
         )
     """
 
+    _validate_fragment_engine(fragment_engine, max_subformula_lattice_size)
     results = decompose_spectra_known_precursor_parallel(
         precursor_formula_series,
         fragment_masses_series,
         tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
         max_results=max_results,
+        fragment_engine=fragment_engine,
+        max_subformula_lattice_size=max_subformula_lattice_size,
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
     )
     return results
 
@@ -378,6 +1200,12 @@ def clean_spectra_known_precursor(
     *,
     tolerance_ppm: float = 5.0,
     max_results: int = 100000,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
 ) -> pl.Series:
     """
     Parallel spectrum cleaning for known precursors.
@@ -405,6 +1233,7 @@ def clean_spectra_known_precursor(
     Notes:
     - Fails fast on mismatched series lengths or invalid dtypes.
     - All heavy lifting is done in C++ with OpenMP; this wrapper is thin and explicit.
+    - fragment_engine / max_subformula_lattice_size: see decompose_spectra_known_precursor.
 
     Example:
         cleaned = clean_spectra_known_precursor(
@@ -433,6 +1262,8 @@ def clean_spectra_known_precursor(
         f"fragment_intensities_series.dtype must be List(Float64), got {fragment_intensities_series.dtype}"
     )
 
+    _validate_fragment_engine(fragment_engine, max_subformula_lattice_size)
+
     n = precursor_formula_series.len()
     if fragment_masses_series.len() != n or fragment_intensities_series.len() != n:
         raise ValueError("All input series must have the same length (one entry per spectrum).")
@@ -443,7 +1274,11 @@ def clean_spectra_known_precursor(
         fragment_masses_series=fragment_masses_series,
         fragment_intensities_series=fragment_intensities_series,
         tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
         max_results=max_results,
+        fragment_engine=fragment_engine,
+        max_subformula_lattice_size=max_subformula_lattice_size,
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
     )
 
 def clean_and_normalize_spectra_known_precursor(
@@ -455,6 +1290,12 @@ def clean_and_normalize_spectra_known_precursor(
     tolerance_ppm: float = 5.0,
     max_results: int = 100000,
     max_allowed_normalized_mass_error_ppm: float = 5.0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
 ) -> pl.Series:
     """
     Parallel cleaner for spectra with known precursor that:
@@ -476,6 +1317,8 @@ def clean_and_normalize_spectra_known_precursor(
             "fragment_formulas": pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)),
             "fragment_errors_ppm": pl.List(pl.Float64),
         }
+
+    fragment_engine / max_subformula_lattice_size: see decompose_spectra_known_precursor.
     """
     assert isinstance(precursor_formula_series, pl.Series), "precursor_formula_series must be a Polars Series"
     assert isinstance(precursor_masses_series, pl.Series), "precursor_masses_series must be a Polars Series"
@@ -504,6 +1347,7 @@ def clean_and_normalize_spectra_known_precursor(
         fragment_intensities_series.len() != n or
         precursor_masses_series.len() != n):
         raise ValueError("All input series must have the same length (one entry per spectrum).")
+    _validate_fragment_engine(fragment_engine, max_subformula_lattice_size)
 
     return clean_and_normalize_spectra_known_precursor_parallel(
         precursor_formula_series=precursor_formula_series,
@@ -511,8 +1355,85 @@ def clean_and_normalize_spectra_known_precursor(
         fragment_masses_series=fragment_masses_series,
         fragment_intensities_series=fragment_intensities_series,
         tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
         max_results=max_results,
         max_allowed_normalized_mass_error_ppm=max_allowed_normalized_mass_error_ppm,
+        fragment_engine=fragment_engine,
+        max_subformula_lattice_size=max_subformula_lattice_size,
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
     )
 
+def clean_and_normalize_spectra_candidate_precursors(
+    candidate_formulas_series: pl.Series,
+    precursor_masses_series: pl.Series,
+    fragment_masses_series: pl.Series,
+    fragment_intensities_series: pl.Series,
+    *,
+    tolerance_ppm: float = 5.0,
+    max_results: int = 100000,
+    max_allowed_normalized_mass_error_ppm: float = 5.0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    tolerance: mass_tolerance_config | None = None,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> pl.Series:
+    """
+    clean_and_normalize_spectra_known_precursor for spectra with several candidate precursor
+    formulas each (e.g. the un-exploded output of decompose_mass_per_bounds), without exploding
+    first: the fragments of each spectrum are decomposed once against the element-wise maximum of
+    its candidates and then assigned to every candidate by sub-formula containment, instead of
+    being re-decomposed per candidate. Results are the same as cleaning each candidate separately.
+
+    Input schema per spectrum (row-wise):
+    - candidate_formulas_series: pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))
+    - precursor_masses_series: pl.Float64
+    - fragment_masses_series:   pl.List(pl.Float64)
+    - fragment_intensities_series: pl.List(pl.Float64)
+
+    Output: a pl.List Series with one struct per candidate, in candidate order, with the fields of
+    clean_and_normalize_spectra_known_precursor. Explode it together with the candidates:
+
+        df.with_columns(cleaned_spectra=clean_and_normalize_spectra_candidate_precursors(...)).explode(
+            ["decomposed_formulas", "cleaned_spectra"]
+        )
+    """
+    assert isinstance(candidate_formulas_series, pl.Series), "candidate_formulas_series must be a Polars Series"
+    assert isinstance(precursor_masses_series, pl.Series), "precursor_masses_series must be a Polars Series"
+    assert isinstance(fragment_masses_series, pl.Series), "fragment_masses_series must be a Polars Series"
+    assert isinstance(fragment_intensities_series, pl.Series), "fragment_intensities_series must be a Polars Series"
+
+    expected_candidates = pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))
+    if candidate_formulas_series.dtype != expected_candidates:
+        raise TypeError(
+            f"candidate_formulas_series.dtype must be {expected_candidates}, got {candidate_formulas_series.dtype}"
+        )
+    if precursor_masses_series.dtype != pl.Float64:
+        raise TypeError(f"precursor_masses_series.dtype must be Float64, got {precursor_masses_series.dtype}")
+    expected_list = pl.List(pl.Float64)
+    if fragment_masses_series.dtype != expected_list:
+        raise TypeError(f"fragment_masses_series.dtype must be List(Float64), got {fragment_masses_series.dtype}")
+    if fragment_intensities_series.dtype != expected_list:
+        raise TypeError(f"fragment_intensities_series.dtype must be List(Float64), got {fragment_intensities_series.dtype}")
+
+    n = candidate_formulas_series.len()
+    if (fragment_masses_series.len() != n or
+        fragment_intensities_series.len() != n or
+        precursor_masses_series.len() != n):
+        raise ValueError("All input series must have the same length (one entry per spectrum).")
+    _validate_fragment_engine(fragment_engine, max_subformula_lattice_size)
 
+    return clean_and_normalize_spectra_candidate_precursors_parallel(
+        candidate_formulas_series=candidate_formulas_series,
+        precursor_masses_series=precursor_masses_series,
+        fragment_masses_series=fragment_masses_series,
+        fragment_intensities_series=fragment_intensities_series,
+        tolerance_ppm=tolerance_ppm,
+        **_tolerance_kwargs(tolerance),
+        max_results=max_results,
+        max_allowed_normalized_mass_error_ppm=max_allowed_normalized_mass_error_ppm,
+        fragment_engine=fragment_engine,
+        max_subformula_lattice_size=max_subformula_lattice_size,
+        **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+    )
@@ -1,210 +1,295 @@
+"""
+Benchmark suite of the mass decomposition engine.
+
+Every case runs on a deterministic synthetic dataset (fixed seed), is repeated, and reports the
+best and median wall time plus the amount of output, so two runs on the same machine can be
+compared case by case:
+
+    python -m hrms_utils.formula_annotation.mass_decomposition_impl.benchmark --output new.json
+    python -m hrms_utils.formula_annotation.mass_decomposition_impl.benchmark --output new.json --compare old.json
+
+--quick shrinks the datasets for a smoke run, --filter keeps the cases whose name contains the
+given text. The pure-Python SiriusMassDecomposer (python_impl) is timed on a few masses as a
+baseline, and its formulas are checked against decompose_mass.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
 import time
 import numpy as np
-import mass_decomposer_cpp
+import polars as pl
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+from hrms_utils.formula_annotation import (
+    decompose_mass,
+    decompose_mass_per_bounds,
+    clean_spectra_known_precursor,
+    clean_and_normalize_spectra_known_precursor,
+)
+from hrms_utils.formula_annotation.element_table import (
+    ELEMENT_SYMBOLS,
+    ELEMENT_MASSES,
+    ELEMENT_INDEX,
+    ELEMENT_TWICE_DBE_COEFFICIENTS,
+)
+from hrms_utils.formula_annotation.mass_decomposition_impl.python_impl import SiriusMassDecomposer
+
+SEED = 20
+NUM_ELEMENTS = len(ELEMENT_SYMBOLS)
+BENCHMARK_BOUNDS = {'H': 80, 'C': 40, 'N': 10, 'O': 15, 'F': 6, 'P': 2, 'S': 3, 'Cl': 3, 'Br': 1, 'I': 1}
+# python_impl only knows a few elements, and is far too slow for wide bounds
+BASELINE_BOUNDS = {'H': 60, 'C': 30, 'N': 6, 'O': 10, 'P': 1, 'S': 2}
+MASS_RANGES = {"low": (100.0, 300.0), "high": (300.0, 600.0)}
+TOLERANCES_PPM = (2.0, 5.0)
+# relative change of the best time that --compare flags
+REGRESSION_THRESHOLD = 0.10
+
+
+@dataclass
+class benchmark_case:
+    name: str
+    params: Dict[str, Any]
+    run: Callable[[], int]  # returns the number of output items, recorded as a sanity check
+    repeat: int = 3
+    results: Dict[str, Any] = field(default_factory=dict)
+
+
+def _bounds(bounds: Dict[str, int]) -> tuple[np.ndarray, np.ndarray]:
+    max_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
+    for symbol, count in bounds.items():
+        max_bounds[ELEMENT_INDEX[symbol]] = count
+    return np.zeros(NUM_ELEMENTS, dtype=np.int32), max_bounds
+
+
+def synthetic_masses(n: int, mass_range: tuple[float, float], seed: int = SEED) -> pl.Series:
+    """n masses drawn uniformly from mass_range."""
+    rng = np.random.default_rng(seed)
+    return pl.Series("mass", rng.uniform(*mass_range, n), dtype=pl.Float64)
+
 
-def setup_bounds():
+def synthetic_spectra(n: int, n_fragments: int, seed: int = SEED) -> pl.DataFrame:
     """
-    Sets up the min and max bounds arrays based on the element order
-    from the Cython module.
+    n spectra of random CHNOS(Cl) precursors with integer DBE; fragments are random subformulas
+    (5 ppm mass error) plus one in five noise peaks that no subformula explains.
     """
-    bounds_dict = {
-        'C': (0, 50), 'H': (0, 100), 'N': (0, 20), 'O': (0, 40),
-        'S': (0, 6), 'P': (0, 5), 'Na': (0, 0), 'F': (0, 40),
-        'Cl': (0, 0), 'Br': (0, 0), 'I': (0, 4),
-    }
+    rng = np.random.default_rng(seed)
+    element_masses = np.array(ELEMENT_MASSES)
+    precursors = np.zeros((n, NUM_ELEMENTS), dtype=np.int32)
+    precursors[:, ELEMENT_INDEX['C']] = rng.integers(8, 30, n)
+    precursors[:, ELEMENT_INDEX['N']] = rng.integers(0, 5, n)
+    precursors[:, ELEMENT_INDEX['O']] = rng.integers(0, 8, n)
+    precursors[:, ELEMENT_INDEX['S']] = rng.integers(0, 2, n)
+    precursors[:, ELEMENT_INDEX['Cl']] = rng.integers(0, 2, n)
+    # H and Cl have the same parity contribution, N the opposite: keep DBE an integer
+    max_h = 2 * precursors[:, ELEMENT_INDEX['C']] + 2 + precursors[:, ELEMENT_INDEX['N']] - precursors[:, ELEMENT_INDEX['Cl']]
+    hydrogens = rng.integers(0, max_h // 2 + 1) * 2 + (precursors[:, ELEMENT_INDEX['N']] + precursors[:, ELEMENT_INDEX['Cl']]) % 2
+    precursors[:, ELEMENT_INDEX['H']] = np.minimum(hydrogens, max_h)
+    precursor_masses = precursors @ element_masses
+    fragment_masses = []
+    fragment_intensities = []
+    for precursor, precursor_mass in zip(precursors, precursor_masses):
+        fragments = rng.integers(0, precursor + 1, size=(n_fragments, NUM_ELEMENTS))
+        masses = (fragments @ element_masses) * (1 + rng.uniform(-5e-6, 5e-6, n_fragments))
+        noise = rng.random(n_fragments) < 0.2
+        masses[noise] = rng.uniform(50.0, precursor_mass, noise.sum())
+        masses = np.sort(masses[masses > 10.0])
+        fragment_masses.append(masses.tolist())
+        fragment_intensities.append(rng.uniform(1.0, 100.0, len(masses)).tolist())
+    return pl.DataFrame({
+        "precursor_formula": pl.Series(precursors, dtype=pl.Array(pl.Int32, NUM_ELEMENTS)),
+        "precursor_mass": precursor_masses,
+        "fragment_masses": pl.Series(fragment_masses, dtype=pl.List(pl.Float64)),
+        "fragment_intensities": pl.Series(fragment_intensities, dtype=pl.List(pl.Float64)),
+    })
 
-    element_info = mass_decomposer_cpp.get_element_info()
-    element_order = element_info['order']
-    num_elements = element_info['count']
-
-    min_bounds = np.zeros(num_elements, dtype=np.int32)
-    max_bounds = np.zeros(num_elements, dtype=np.int32)
-
-    for i, element in enumerate(element_order):
-        if element in bounds_dict:
-            min_val, max_val = bounds_dict[element]
-            min_bounds[i] = min_val
-            max_bounds[i] = max_val
-        # Other elements will remain at their default (0, 0) bounds
-
-    return min_bounds, max_bounds, element_order
-
-def formula_dict_to_array(formula_dict, element_order):
-    """Converts a formula dictionary to a numpy array."""
-    num_elements = len(element_order)
-    formula_array = np.zeros(num_elements, dtype=np.int32)
-    for i, element in enumerate(element_order):
-        if element in formula_dict:
-            formula_array[i] = formula_dict[element]
-    return formula_array
-
-def run_mass_decomposition_tests(mass, min_bounds, max_bounds, num_parallel=1000):
-    """Tests for single, parallel (uniform), and parallel (per-bounds) mass decomposition."""
-    print("\n--- Testing Mass Decomposition ---")
-    
-    # --- Single Mass Decomposition ---
-    print("\n[1] Testing `decompose_mass` (single-threaded)...")
-    start_time = time.perf_counter()
-    results_single = mass_decomposer_cpp.decompose_mass(
-        target_mass=mass,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Found {len(results_single)} formulas in {end_time - start_time:.4f} seconds.")
-    if results_single:
-        print(f"First result: {results_single[0]}")
-
-    # --- Parallel Mass Decomposition (same bounds) ---
-    print("\n[2] Testing `decompose_mass_parallel` (multi-threaded, uniform bounds)...")
-    masses_list = [mass] * num_parallel 
-    start_time = time.perf_counter()
-    results_parallel = mass_decomposer_cpp.decompose_mass_parallel(
-        target_masses=masses_list,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Decomposed {len(masses_list)} masses in {end_time - start_time:.4f} seconds.")
-    if results_parallel:
-        print(f"Found {len(results_parallel[0])} formulas for the first mass.")
-
-    # --- Parallel Mass Decomposition (per-bounds) ---
-    print("\n[2b] Testing `decompose_mass_parallel_per_bounds` (multi-threaded, per-bounds)...")
-    per_mass_bounds = [(min_bounds.copy(), max_bounds.copy()) for _ in range(num_parallel)]
-    start_time = time.perf_counter()
-    results_per_bounds = mass_decomposer_cpp.decompose_mass_parallel_per_bounds(
-        target_masses=masses_list,
-        per_mass_bounds=per_mass_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Decomposed {len(masses_list)} masses (per-bounds) in {end_time - start_time:.4f} seconds.")
-    if results_per_bounds:
-        print(f"Found {len(results_per_bounds[0])} formulas for the first mass (per-bounds).")
-    # Optional: check correctness
-    if results_parallel and results_per_bounds:
-        if np.all([np.array_equal(results_parallel[i][0], results_per_bounds[i][0]) for i in range(len(results_parallel)) if results_parallel[i] and results_per_bounds[i]]):
-            print("Uniform and per-bounds results match for first formula of each mass.")
-        else:
-            print("Warning: Uniform and per-bounds results differ.")
-
-    return results_single
-
-def run_spectrum_decomposition_tests(precursor_mass, fragments, min_bounds, max_bounds, num_parallel=1000):
-    """Tests for single, parallel (uniform), and parallel (per-bounds) spectrum decomposition."""
-    print("\n--- Testing Spectrum Decomposition ---")
-
-    # --- Single Spectrum Decomposition ---
-    print("\n[3] Testing `decompose_spectrum` (single-threaded)...")
-    start_time = time.perf_counter()
-    results_single = mass_decomposer_cpp.decompose_spectrum(
-        precursor_mass=precursor_mass,
-        fragment_masses=fragments,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Found {len(results_single)} precursor decompositions in {end_time - start_time:.4f} seconds.")
-    if results_single:
-        print(f"First result precursor: {results_single[0]['precursor']}")
-
-    # --- Parallel Spectrum Decomposition (uniform bounds) ---
-    print("\n[4] Testing `decompose_spectra_parallel` (multi-threaded, uniform bounds)...")
-    spectra_list = [{'precursor_mass': precursor_mass, 'fragment_masses': fragments}] * num_parallel
-    start_time = time.perf_counter()
-    results_parallel = mass_decomposer_cpp.decompose_spectra_parallel(
-        spectra_data=spectra_list,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Decomposed {len(spectra_list)} spectra in {end_time - start_time:.4f} seconds.")
-    if results_parallel:
-        print(f"Found {len(results_parallel[0])} decompositions for the first spectrum.")
-
-    # --- Parallel Spectrum Decomposition (per-bounds) ---
-    print("\n[4b] Testing `decompose_spectra_parallel_per_bounds` (multi-threaded, per-bounds)...")
-    spectra_per_bounds = [
-        {
-            'precursor_mass': precursor_mass,
-            'fragment_masses': fragments,
-            'min_bounds': min_bounds.copy(),
-            'max_bounds': max_bounds.copy()
-        }
-        for _ in range(num_parallel)
+
+def _output_size(series: pl.Series) -> int:
+    return int(series.list.len().sum())
+
+
+def decomposition_cases(n_masses: int, thread_counts: List[int]) -> List[benchmark_case]:
+    min_bounds, max_bounds = _bounds(BENCHMARK_BOUNDS)
+    cases = []
+    for range_name, mass_range in MASS_RANGES.items():
+        masses = synthetic_masses(n_masses, mass_range)
+        single = masses.head(1)
+        for tolerance_ppm in TOLERANCES_PPM:
+            params = {"mass_range": range_name, "tolerance_ppm": tolerance_ppm}
+            cases.append(benchmark_case(
+                f"decompose_mass/single/{range_name}/{tolerance_ppm:g}ppm",
+                {**params, "n_masses": 1, "n_threads": 1},
+                lambda single=single, tolerance_ppm=tolerance_ppm: _output_size(
+                    decompose_mass(single, min_bounds, max_bounds, tolerance_ppm=tolerance_ppm, n_threads=1)
+                ),
+                repeat=5,
+            ))
+            for n_threads in thread_counts:
+                cases.append(benchmark_case(
+                    f"decompose_mass/batch/{range_name}/{tolerance_ppm:g}ppm/{n_threads}t",
+                    {**params, "n_masses": n_masses, "n_threads": n_threads},
+                    lambda masses=masses, tolerance_ppm=tolerance_ppm, n_threads=n_threads: _output_size(
+                        decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=tolerance_ppm, n_threads=n_threads)
+                    ),
+                ))
+        # per-mass bounds: half the rows without halogens
+        per_min = pl.Series([min_bounds] * n_masses, dtype=pl.Array(pl.Int32, NUM_ELEMENTS))
+        no_halogens = max_bounds.copy()
+        no_halogens[[ELEMENT_INDEX[s] for s in ('F', 'Cl', 'Br', 'I')]] = 0
+        per_max = pl.Series([max_bounds if i % 2 else no_halogens for i in range(n_masses)], dtype=pl.Array(pl.Int32, NUM_ELEMENTS))
+        for n_threads in thread_counts:
+            cases.append(benchmark_case(
+                f"decompose_mass_per_bounds/{range_name}/5ppm/{n_threads}t",
+                {"mass_range": range_name, "tolerance_ppm": 5.0, "n_masses": n_masses, "n_threads": n_threads},
+                lambda masses=masses, per_min=per_min, per_max=per_max, n_threads=n_threads: _output_size(
+                    decompose_mass_per_bounds(masses, per_min, per_max, tolerance_ppm=5.0, n_threads=n_threads)
+                ),
+            ))
+    return cases
+
+
+def cleaning_cases(n_spectra: int, n_fragments: int, thread_counts: List[int]) -> List[benchmark_case]:
+    spectra = synthetic_spectra(n_spectra, n_fragments)
+    cases = []
+    for tolerance_ppm in TOLERANCES_PPM:
+        for n_threads in thread_counts:
+            params = {"n_spectra": n_spectra, "n_fragments": n_fragments, "tolerance_ppm": tolerance_ppm, "n_threads": n_threads}
+            cases.append(benchmark_case(
+                f"clean_spectra_known_precursor/{tolerance_ppm:g}ppm/{n_threads}t",
+                params,
+                lambda tolerance_ppm=tolerance_ppm, n_threads=n_threads: int(clean_spectra_known_precursor(
+                    spectra["precursor_formula"], spectra["fragment_masses"], spectra["fragment_intensities"],
+                    tolerance_ppm=tolerance_ppm, n_threads=n_threads,
+                ).struct.field("cleaned_intensities").list.len().sum()),
+            ))
+            cases.append(benchmark_case(
+                f"clean_and_normalize_spectra_known_precursor/{tolerance_ppm:g}ppm/{n_threads}t",
+                params,
+                lambda tolerance_ppm=tolerance_ppm, n_threads=n_threads: int(clean_and_normalize_spectra_known_precursor(
+                    spectra["precursor_formula"], spectra["precursor_mass"], spectra["fragment_masses"], spectra["fragment_intensities"],
+                    tolerance_ppm=tolerance_ppm, n_threads=n_threads,
+                ).struct.field("cleaned_intensities").list.len().sum()),
+            ))
+    return cases
+
+
+def _baseline_formulas(mass: float, tolerance_ppm: float) -> set:
+    decomposer = SiriusMassDecomposer({symbol: (0, count) for symbol, count in BASELINE_BOUNDS.items()}, mass, tolerance_ppm)
+    return {tuple(formula.get(symbol, 0) for symbol in ELEMENT_SYMBOLS) for formula in decomposer.decompose()}
+
+
+def baseline_cases(n_masses: int) -> List[benchmark_case]:
+    """
+    python_impl.SiriusMassDecomposer against decompose_mass on the same masses and bounds, with an
+    unbounded DBE range (decompose_mass still requires an integer DBE, python_impl has no DBE rule).
+    Both use ppm of the mass above 200 Da; formulas within 1e-5 Da of a window edge are ignored in
+    the comparison, python_impl has slightly different element masses.
+    """
+    min_bounds, max_bounds = _bounds(BASELINE_BOUNDS)
+    masses = synthetic_masses(n_masses, (200.0, 400.0))
+    element_masses = np.array(ELEMENT_MASSES)
+    twice_dbe_coefficients = np.array(ELEMENT_TWICE_DBE_COEFFICIENTS)
+    tolerance_ppm = 5.0
+    # python_impl has no DBE rule; the timed and the compared decompose_mass calls both drop it
+    no_dbe_rule = {"min_dbe": -1e9, "max_dbe": 1e9, "dbe_pruning": False}
+
+    def compare() -> int:
+        native = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=tolerance_ppm, **no_dbe_rule)
+        for mass, formulas in zip(masses.to_list(), native.to_list()):
+            window = mass * tolerance_ppm / 1e6
+            expected = {
+                formula for formula in _baseline_formulas(mass, tolerance_ppm)
+                if np.dot(formula, twice_dbe_coefficients) % 2 == 0
+            }
+            found = {tuple(formula) for formula in formulas}
+            for formula in expected ^ found:
+                distance_to_edge = abs(abs(np.dot(formula, element_masses) - mass) - window)
+                if distance_to_edge > 1e-5:
+                    raise AssertionError(f"python_impl and decompose_mass disagree on {formula} at mass {mass}")
+        return _output_size(native)
+
+    return [
+        benchmark_case(
+            "python_impl/SiriusMassDecomposer", {"n_masses": n_masses, "tolerance_ppm": tolerance_ppm},
+            lambda: sum(len(_baseline_formulas(mass, tolerance_ppm)) for mass in masses.to_list()), repeat=1,
+        ),
+        benchmark_case(
+            "python_impl/decompose_mass_same_bounds", {"n_masses": n_masses, "tolerance_ppm": tolerance_ppm, "n_threads": 1},
+            lambda: _output_size(decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=tolerance_ppm, n_threads=1, **no_dbe_rule)),
+        ),
+        benchmark_case("python_impl/correctness", {"n_masses": n_masses}, compare, repeat=1),
     ]
-    start_time = time.perf_counter()
-    results_per_bounds = mass_decomposer_cpp.decompose_spectra_parallel_per_bounds(
-        spectra_data=spectra_per_bounds,
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Decomposed {len(spectra_per_bounds)} spectra (per-bounds) in {end_time - start_time:.4f} seconds.")
-    if results_per_bounds:
-        print(f"Found {len(results_per_bounds[0])} decompositions for the first spectrum (per-bounds).")
-    # Optional: check correctness
-    if results_parallel and results_per_bounds:
-        if results_parallel[0] and results_per_bounds[0]:
-            if np.array_equal(results_parallel[0][0]['precursor'], results_per_bounds[0][0]['precursor']):
-                print("Uniform and per-bounds results match for first precursor formula.")
-            else:
-                print("Warning: Uniform and per-bounds results differ.")
-
-def run_known_precursor_tests(precursor_formula_arr, fragments, min_bounds, max_bounds, num_parallel=1000):
-    """Tests for known precursor decomposition."""
-    if precursor_formula_arr is None:
-        print("\n--- Skipping Known Precursor Tests (no valid precursor found) ---")
-        return
-        
-    print("\n--- Testing Known Precursor Spectrum Decomposition ---")
-
-    # --- Single Known Precursor Decomposition ---
-    print("\n[5] Testing `decompose_spectrum_known_precursor` (single-threaded)...")
-    start_time = time.perf_counter()
-    results_single = mass_decomposer_cpp.decompose_spectrum_known_precursor(
-        precursor_formula=precursor_formula_arr,
-        fragment_masses=fragments,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds, # max_bounds is used for fragment bounds
-        tolerance_ppm=5.0
-    )
-    end_time = time.perf_counter()
-    print(f"Found explanations for {len(results_single)} fragments in {end_time - start_time:.4f} seconds.")
-    if results_single:
-        print(f"First fragment explained by {len(results_single[0])} formulas.")
-
-    # --- Parallel Known Precursor Decomposition ---
-    print("\n[6] Testing `decompose_spectra_known_precursor_parallel` (multi-threaded)...")
-    spectra_list = [{'precursor_formula': precursor_formula_arr, 'fragment_masses': fragments}] * num_parallel
-    start_time = time.perf_counter()
-    results_parallel = mass_decomposer_cpp.decompose_spectra_known_precursor_parallel(
-        spectra_data=spectra_list,
-        min_bounds=min_bounds,
-        max_bounds=max_bounds,
-        tolerance_ppm=5.0
+
+
+def run_case(case: benchmark_case) -> Dict[str, Any]:
+    case.run()  # warm-up: residue tables, thread pool, lazy imports
+    times = []
+    output_size = 0
+    for _ in range(case.repeat):
+        start = time.perf_counter()
+        output_size = case.run()
+        times.append(time.perf_counter() - start)
+    case.results = {
+        "params": case.params,
+        "best_s": min(times),
+        "median_s": float(np.median(times)),
+        "repeat": case.repeat,
+        "output_size": output_size,
+    }
+    return case.results
+
+
+def compare_results(new: Dict[str, Any], old: Dict[str, Any], threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """One line per case present in both runs; slower/faster beyond threshold are flagged."""
+    lines = []
+    for name, result in new["cases"].items():
+        if name not in old["cases"]:
+            continue
+        before = old["cases"][name]["best_s"]
+        change = result["best_s"] / before - 1 if before > 0 else 0.0
+        flag = "SLOWER" if change > threshold else "faster" if change < -threshold else ""
+        if result["output_size"] != old["cases"][name]["output_size"]:
+            flag += " OUTPUT CHANGED"
+        lines.append(f"{name:70s} {before:9.4f} -> {result['best_s']:9.4f} s {change:+7.1%} {flag}")
+    return lines
+
+
+def main(argv: List[str] | None = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this text")
+    parser.add_argument("--quick", action="store_true", help="small datasets, for a smoke run")
+    parser.add_argument("--threads", type=int, nargs="+", help="thread counts of the parallel cases (default: 1 and all cores)")
+    args = parser.parse_args(argv)
+
+    thread_counts = args.threads or sorted({1, os.cpu_count() or 1})
+    scale = 1 if args.quick else 10
+    cases = (
+        decomposition_cases(n_masses=50 * scale, thread_counts=thread_counts)
+        + cleaning_cases(n_spectra=50 * scale, n_fragments=30, thread_counts=thread_counts)
+        + baseline_cases(n_masses=3 if args.quick else 10)
     )
-    end_time = time.perf_counter()
-    print(f"Decomposed {len(spectra_list)} spectra in {end_time - start_time:.4f} seconds.")
-    if results_parallel:
-        print(f"Found explanations for {len(results_parallel[0])} fragments in the first spectrum.")
+    cases = [case for case in cases if args.filter in case.name]
+    results = {
+        "machine": {"platform": platform.platform(), "python": sys.version.split()[0], "cpu_count": os.cpu_count()},
+        "seed": SEED,
+        "quick": args.quick,
+        "cases": {},
+    }
+    for case in cases:
+        result = run_case(case)
+        results["cases"][case.name] = result
+        print(f"{case.name:70s} {result['best_s']:9.4f} s (median {result['median_s']:.4f}) {result['output_size']:>10d} items")
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=1)
+    if args.compare:
+        with open(args.compare) as handle:
+            print("\n".join(compare_results(results, json.load(handle))))
+    return results
+
 
 if __name__ == "__main__":
-    # --- Configuration ---
-    TARGET_MASS = 281.152812
-    FRAGMENT_MASSES = [281.152812, 241.121512, 237.090212, 221.095297, 93.070425]
-    num_parallel = 10000  # Number of parallel tests to run
-    print("Setting up element bounds...")
-    min_b, max_b, element_order = setup_bounds()
-    print(f"Element order: {element_order}")
-
-    # --- Run Tests ---
-    mass_results = run_mass_decomposition_tests(TARGET_MASS, min_b, max_b, num_parallel=num_parallel)
-    run_spectrum_decomposition_tests(TARGET_MASS, FRAGMENT_MASSES, min_b, max_b, num_parallel=num_parallel)
-    # Use the first valid formula from mass decomposition for the known precursor test
-    first_formula = mass_results[0] if mass_results else None
-    run_known_precursor_tests(first_formula, FRAGMENT_MASSES, min_b, max_b, num_parallel=num_parallel)
\ No newline at end of file
+    main()
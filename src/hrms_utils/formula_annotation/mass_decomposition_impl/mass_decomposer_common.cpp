@@ -1,68 +1,334 @@
 #include "mass_decomposer_common.hpp"
 #include <stdexcept>
 
-MassDecomposer::MassDecomposer(const Formula& min_bounds, const Formula& max_bounds)
-    : min_bounds_(min_bounds), max_bounds_(max_bounds), 
-      precision_(1.0 / 5963.337687), is_initialized_(false) {
-    // No longer need to initialize atomic masses or element indices here
+namespace {
+struct RankedFormula {
+    double score;
+    Formula formula;
+};
+
+bool ranks_before(const RankedFormula& a, const RankedFormula& b) {
+    if (a.score != b.score) return a.score < b.score;
+    return a.formula < b.formula;
 }
 
-inline bool MassDecomposer::check_dbe(const Formula& formula, double min_dbe, double max_dbe) const {
-    int c_count = formula[FormulaAnnotation::C]+ formula[FormulaAnnotation::Si];
-    int h_count = formula[FormulaAnnotation::H];
-    int n_count = formula[FormulaAnnotation::N]+ formula[FormulaAnnotation::B]+ formula[FormulaAnnotation::As];
-    int p_count = formula[FormulaAnnotation::P];
-    int x_count = formula[FormulaAnnotation::F] + formula[FormulaAnnotation::Cl] + 
-                  formula[FormulaAnnotation::Br] + formula[FormulaAnnotation::I];
+double ranking_score(const Formula& formula, double formula_mass, double target_mass, const CandidateRanking& ranking) {
+    double score = std::abs(formula_mass - target_mass) * 1e6 / target_mass;
+    for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) score += ranking.element_penalty_ppm[e] * formula[e];
+    return score;
+}
 
-    double dbe = (2.0 + 2.0*c_count + 3.0*p_count + n_count - h_count - x_count) / 2.0;
-    
-    if (dbe < min_dbe || dbe > max_dbe) return false;
-    if (std::abs(dbe - std::round(dbe)) > 1e-8) return false;
-    
+std::mutex element_table_mutex;
+
+std::shared_ptr<const FormulaAnnotation::ElementTable>& registered_element_table() {
+    static std::shared_ptr<const FormulaAnnotation::ElementTable> table =
+        std::make_shared<const FormulaAnnotation::ElementTable>();
+    return table;
+}
+}  // namespace
+
+std::shared_ptr<const FormulaAnnotation::ElementTable> FormulaAnnotation::element_table() {
+    std::lock_guard<std::mutex> lock(element_table_mutex);
+    return registered_element_table();
+}
+
+void FormulaAnnotation::register_element_table(
+    const std::vector<std::string>& symbols, const std::vector<double>& masses,
+    const std::vector<int>& twice_dbe_coefficients, const std::vector<int>& valences) {
+    const std::size_t n = symbols.size();
+    if (masses.size() != n || twice_dbe_coefficients.size() != n || valences.size() != n) {
+        throw std::invalid_argument("The element symbols, masses, DBE coefficients and valences must have the same length");
+    }
+    if (n > static_cast<std::size_t>(MAX_ELEMENTS)) {
+        throw std::invalid_argument(
+            "The element table has " + std::to_string(n) + " entries, at most MAX_ELEMENTS = " +
+            std::to_string(MAX_ELEMENTS) + " are supported");
+    }
+    auto table = std::make_shared<ElementTable>();
+    table->num_elements = static_cast<int>(n);
+    for (std::size_t e = 0; e < n; ++e) {
+        if (!(masses[e] > 0.0)) throw std::invalid_argument("Element masses must be positive (" + symbols[e] + ")");
+        table->symbols[e] = symbols[e];
+        table->masses[e] = masses[e];
+        table->twice_dbe_coefficients[e] = twice_dbe_coefficients[e];
+        table->valences[e] = valences[e];
+        if (symbols[e] == "C") table->carbon_index = static_cast<int>(e);
+    }
+    {
+        std::lock_guard<std::mutex> lock(element_table_mutex);
+        table->generation = registered_element_table()->generation + 1;
+        registered_element_table() = std::move(table);
+    }
+    // Residue tables of the previous alphabet are unreachable under the new generation.
+    ResidueTableCache::instance().clear();
+}
+
+IsotopeEnvelope observe_isotope_envelope(
+    double precursor_mz, DoubleSpan ms1_mzs, DoubleSpan ms1_intensities, const IsotopeScoring& scoring) {
+    IsotopeEnvelope envelope{};
+    // M: the most intense peak within the MS1 window, as in deduce_isotopic_pattern
+    const double ms1_window = scoring.ms1_tolerance.window(precursor_mz);
+    double monoisotopic_mz = 0.0;
+    double monoisotopic_intensity = 0.0;
+    for (std::size_t p = 0; p < ms1_mzs.size(); ++p) {
+        if (std::abs(ms1_mzs[p] - precursor_mz) <= ms1_window && ms1_intensities[p] > monoisotopic_intensity) {
+            monoisotopic_mz = ms1_mzs[p];
+            monoisotopic_intensity = ms1_intensities[p];
+        }
+    }
+    if (!(monoisotopic_intensity > 0.0)) return envelope;
+    envelope.observed = true;
+
+    const double isotopic_window = scoring.isotopic_tolerance.window(precursor_mz);
+    for (int k = 0; k < NUM_ISOTOPE_SHIFTS; ++k) {
+        const double from = monoisotopic_mz + scoring.shift_min[k] - isotopic_window;
+        const double to = monoisotopic_mz + scoring.shift_max[k] + isotopic_window;
+        double intensity = 0.0;
+        for (std::size_t p = 0; p < ms1_mzs.size(); ++p) {
+            if (ms1_mzs[p] >= from && ms1_mzs[p] <= to) intensity += ms1_intensities[p];
+        }
+        if (intensity < scoring.minimum_intensity) {
+            // absent or below the detection limit: anything up to the limit fits
+            envelope.observed_ratio[k] = 0.0;
+            envelope.lower[k] = 0.0;
+            envelope.upper[k] = scoring.minimum_intensity / monoisotopic_intensity;
+        } else {
+            envelope.observed_ratio[k] = intensity / monoisotopic_intensity;
+            envelope.lower[k] = std::max(0.0,
+                (intensity * (1.0 - scoring.intensity_relative_tolerance) - scoring.intensity_absolute_tolerance) / monoisotopic_intensity);
+            envelope.upper[k] =
+                (intensity * (1.0 + scoring.intensity_relative_tolerance) + scoring.intensity_absolute_tolerance) / monoisotopic_intensity;
+        }
+    }
+    return envelope;
+}
+
+void predicted_isotope_ratios(const Formula& formula, const IsotopeScoring& scoring, double* ratios) {
+    double first = 0.0;
+    double first_squares = 0.0;
+    double second = 0.0;
+    for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) {
+        if (formula[e] == 0) continue;
+        const double r1 = scoring.element_ratio[0][e];
+        first += formula[e] * r1;
+        first_squares += formula[e] * r1 * r1;
+        second += formula[e] * scoring.element_ratio[1][e];
+    }
+    ratios[0] = first;
+    ratios[1] = second + 0.5 * (first * first - first_squares);
+}
+
+void tighten_bounds_by_isotopes(const IsotopeEnvelope& envelope, const IsotopeScoring& scoring, Formula& max_bounds) {
+    if (!envelope.observed) return;
+    for (int k = 0; k < NUM_ISOTOPE_SHIFTS; ++k) {
+        for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) {
+            const double ratio = scoring.element_ratio[k][e];
+            if (ratio <= 0.0) continue;
+            const double allowed = std::floor(envelope.upper[k] / ratio);
+            if (allowed < max_bounds[e]) max_bounds[e] = static_cast<int32_t>(allowed);
+        }
+    }
+}
+
+double isotope_envelope_deviation(const Formula& formula, const IsotopeEnvelope& envelope, const IsotopeScoring& scoring) {
+    double predicted[NUM_ISOTOPE_SHIFTS];
+    predicted_isotope_ratios(formula, scoring, predicted);
+    double deviation = 0.0;
+    for (int k = 0; k < NUM_ISOTOPE_SHIFTS; ++k) {
+        if (predicted[k] < envelope.lower[k] || predicted[k] > envelope.upper[k]) return -1.0;
+        const double observed = envelope.observed_ratio[k];
+        const double half_width = predicted[k] > observed ? envelope.upper[k] - observed : observed - envelope.lower[k];
+        if (half_width > 0.0) {
+            const double normalized = (predicted[k] - observed) / half_width;
+            deviation += normalized * normalized;
+        }
+    }
+    return deviation;
+}
+
+FormulaBlockEvaluator::FormulaBlockEvaluator(
+    const std::vector<int>& slots, const FormulaAnnotation::ElementTable& elements)
+    : active_elements_(slots) {
+    for (std::size_t j = 0; j < active_elements_.size(); ++j) {
+        positions_in_row_.push_back(static_cast<int>(j));
+        element_masses_.push_back(elements.masses[active_elements_[j]]);
+        element_twice_dbe_coefficients_.push_back(elements.twice_dbe_coefficients[active_elements_[j]]);
+    }
+    columns_.resize(active_elements_.size() * BLOCK_SIZE);
+}
+
+void FormulaBlockEvaluator::evaluate_rows(
+    const int32_t* rows, std::size_t row_width, const int* positions, std::size_t n,
+    double* masses, int32_t* twice_dbes) {
+    const std::size_t k = active_elements_.size();
+    for (std::size_t j = 0; j < k; ++j) {
+        int32_t* column = columns_.data() + j * BLOCK_SIZE;
+        const int32_t* counts = rows + positions[j];
+        for (std::size_t c = 0; c < n; ++c) column[c] = counts[c * row_width];
+    }
+    for (std::size_t c = 0; c < n; ++c) {
+        masses[c] = 0.0;
+        twice_dbes[c] = 2;
+    }
+    for (std::size_t j = 0; j < k; ++j) {
+        const int32_t* column = columns_.data() + j * BLOCK_SIZE;
+        const double element_mass = element_masses_[j];
+        const int32_t twice_dbe_coefficient = element_twice_dbe_coefficients_[j];
+        for (std::size_t c = 0; c < n; ++c) {
+            masses[c] += column[c] * element_mass;
+            twice_dbes[c] += column[c] * twice_dbe_coefficient;
+        }
+    }
+}
+
+void filter_formulas(
+    const int32_t* formulas, std::size_t row_width, const double* target_masses, std::size_t n,
+    const MassTolerance& tolerance, double min_dbe, double max_dbe, std::uint8_t* keep,
+    const FormulaAnnotation::ElementTable& elements) {
+    // Active elements: every element present in at least one formula.
+    std::vector<int> present;
+    for (std::size_t e = 0; e < row_width; ++e) {
+        for (std::size_t i = 0; i < n; ++i) {
+            if (formulas[i * row_width + e] != 0) {
+                present.push_back(static_cast<int>(e));
+                break;
+            }
+        }
+    }
+    FormulaBlockEvaluator evaluator(present, elements);
+    double masses[FormulaBlockEvaluator::BLOCK_SIZE];
+    int32_t twice_dbes[FormulaBlockEvaluator::BLOCK_SIZE];
+    for (std::size_t start = 0; start < n; start += FormulaBlockEvaluator::BLOCK_SIZE) {
+        const std::size_t block = std::min(FormulaBlockEvaluator::BLOCK_SIZE, n - start);
+        evaluator.evaluate_dense(formulas + start * row_width, row_width, block, masses, twice_dbes);
+        for (std::size_t c = 0; c < block; ++c) {
+            const double target_mass = target_masses[start + c];
+            keep[start + c] = std::abs(masses[c] - target_mass) <= tolerance.window(target_mass) &&
+                              FormulaBlockEvaluator::twice_dbe_accepted(twice_dbes[c], min_dbe, max_dbe);
+        }
+    }
+}
+
+bool chemistry_rules_accepted(
+    const Formula& formula, const ChemistryRules& rules, const FormulaAnnotation::ElementTable& elements) {
+    if (!rules.enabled) return true;
+    const double carbon = elements.carbon_index >= 0 ? formula[elements.carbon_index] : 0.0;
+    for (int e = 0; e < elements.num_elements; ++e) {
+        if (e == elements.carbon_index) continue;
+        if (rules.max_ratio_to_carbon[e] >= 0.0 && formula[e] > rules.max_ratio_to_carbon[e] * carbon) return false;
+        if (rules.min_ratio_to_carbon[e] > 0.0 && formula[e] < rules.min_ratio_to_carbon[e] * carbon) return false;
+    }
+    if (rules.senior_rules) {
+        long long valence_sum = 0;
+        long long atoms = 0;
+        int max_valence = 0;
+        for (int e = 0; e < elements.num_elements; ++e) {
+            if (formula[e] <= 0) continue;
+            valence_sum += static_cast<long long>(elements.valences[e]) * formula[e];
+            atoms += formula[e];
+            max_valence = std::max(max_valence, elements.valences[e]);
+        }
+        if (valence_sum % 2 != 0) return false;
+        if (valence_sum < 2LL * max_valence) return false;
+        if (valence_sum < 2 * (atoms - 1)) return false;
+    }
     return true;
 }
 
+MassDecomposer::MassDecomposer(
+    const Formula& min_bounds, const Formula& max_bounds,
+    std::shared_ptr<const FormulaAnnotation::ElementTable> elements)
+    : min_bounds_(min_bounds), max_bounds_(max_bounds), elements_(std::move(elements)),
+      slots_(FormulaList::support(max_bounds)), carbon_weight_(-1), ert_(nullptr),
+      precision_(0.0), min_error_(0.0), max_error_(0.0), is_initialized_(false),
+      candidate_evaluator_(slots_, *elements_) {
+    // The residue table is fetched lazily from ResidueTableCache on first decompose().
+}
+
+
 
+FormulaList MassDecomposer::decompose(double target_mass, const DecompositionParams& params) {
+    FormulaList results(slots_);
+    decompose_into(target_mass, params, &results);
+    return results;
+}
 
-std::vector<Formula> MassDecomposer::decompose(double target_mass, const DecompositionParams& params) {
+FormulaList MassDecomposer::decompose(
+    double target_mass, const DecompositionParams& params, const IsotopeEnvelope& isotopes) {
+    FormulaList results(slots_);
+    decompose_into(target_mass, params, &results, &isotopes);
+    return results;
+}
+
+std::size_t MassDecomposer::count(double target_mass, const DecompositionParams& params) {
+    return decompose_into(target_mass, params, nullptr);
+}
+
+std::size_t MassDecomposer::decompose_into(
+    double target_mass, const DecompositionParams& params, FormulaList* results,
+    const IsotopeEnvelope* isotopes) {
     if (!is_initialized_) {
         init_money_changing();
-        discretize_masses();
-        divide_by_gcd();
-        calc_ert();
-        compute_errors();
         is_initialized_ = true;
     }
     
-    // Use max(target_mass, 200.0) for tolerance calculation, since below it stops being in relative terms
-    double tolerance = std::max(target_mass, 200.0) * params.tolerance_ppm / 1e6;
+    double tolerance = params.tolerance.window(target_mass);
     std::pair<long long, long long> bounds = integer_bound(target_mass - tolerance, target_mass + tolerance);
     long long start = bounds.first;
     long long end = bounds.second;
     
-    std::vector<Formula> results;
-    for (long long mass = start; mass <= end; ++mass) {
-        auto mass_results = integer_decompose(mass);
-        for (const auto& result : mass_results) {
-            double exact_mass = 0.0;
-            for (int i = 0; i < FormulaAnnotation::NUM_ELEMENTS; ++i) {
-                exact_mass += result[i] * FormulaAnnotation::ATOMIC_MASSES[i];
-            }
+    const DbePruning dbe_pruning{params.dbe_pruning, 2.0 * params.min_dbe, 2.0 * params.max_dbe};
 
-            // Check floating-point mass error
-            double mass_error = std::abs(exact_mass - target_mass);
-            if (mass_error > tolerance) {
-                continue;
-            }
-            // Use unified constraint checking
-            if (!check_dbe(result, params.min_dbe, params.max_dbe)) {
-                continue;
+    // Only the candidates of one integer mass are held at a time; in count mode nothing else is kept.
+    // Exact mass and DBE are checked a block of candidates at a time.
+    double masses[FormulaBlockEvaluator::BLOCK_SIZE];
+    int32_t twice_dbes[FormulaBlockEvaluator::BLOCK_SIZE];
+    std::size_t n_accepted = 0;
+    const std::size_t top_k = static_cast<std::size_t>(std::max(params.ranking.top_k, 0));
+    std::vector<RankedFormula> best;  // max-heap under ranks_before: the worst kept formula is at the front
+    const bool score_isotopes = isotopes != nullptr && isotopes->observed && params.isotope_scoring.enabled;
+    FormulaList mass_results(slots_);  // reused across integer masses
+    for (long long mass = start; mass <= end; ++mass) {
+        mass_results.clear();
+        integer_decompose(mass, dbe_pruning, params.chemistry_rules, mass_results);
+        for (std::size_t block_start = 0; block_start < mass_results.size(); block_start += FormulaBlockEvaluator::BLOCK_SIZE) {
+            const std::size_t block = std::min(FormulaBlockEvaluator::BLOCK_SIZE, mass_results.size() - block_start);
+            candidate_evaluator_.evaluate(mass_results.row(block_start), block, masses, twice_dbes);
+            for (std::size_t c = 0; c < block; ++c) {
+                if (std::abs(masses[c] - target_mass) > tolerance) continue;
+                if (!FormulaBlockEvaluator::twice_dbe_accepted(twice_dbes[c], params.min_dbe, params.max_dbe)) continue;
+                double isotope_deviation = 0.0;
+                if (score_isotopes) {
+                    isotope_deviation = isotope_envelope_deviation(mass_results[block_start + c], *isotopes, params.isotope_scoring);
+                    if (isotope_deviation < 0.0) continue;
+                }
+                ++n_accepted;
+                if (top_k > 0) {
+                    if (results == nullptr) continue;
+                    const Formula formula = mass_results[block_start + c];
+                    RankedFormula candidate{
+                        ranking_score(formula, masses[c], target_mass, params.ranking)
+                            + params.isotope_scoring.weight_ppm * isotope_deviation,
+                        formula};
+                    if (best.size() < top_k) {
+                        best.push_back(candidate);
+                        std::push_heap(best.begin(), best.end(), ranks_before);
+                    } else if (ranks_before(candidate, best.front())) {
+                        std::pop_heap(best.begin(), best.end(), ranks_before);
+                        best.back() = candidate;
+                        std::push_heap(best.begin(), best.end(), ranks_before);
+                    }
+                    continue;
+                }
+                if (results != nullptr) results->push_back(mass_results, block_start + c);
+                if (static_cast<int>(n_accepted) >= params.max_results) return n_accepted;
             }
-            results.push_back(result);
-            if (static_cast<int>(results.size()) >= params.max_results) break;
         }
-        if (static_cast<int>(results.size()) >= params.max_results) break;
     }
-    return results;
-}
\ No newline at end of file
+    if (top_k == 0) return n_accepted;
+    if (results != nullptr) {
+        std::sort_heap(best.begin(), best.end(), ranks_before);
+        for (const RankedFormula& ranked : best) results->push_back(ranked.formula);
+    }
+    return std::min(n_accepted, top_k);
+}
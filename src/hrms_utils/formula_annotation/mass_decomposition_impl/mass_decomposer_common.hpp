@@ -9,58 +9,227 @@
 #include <array>
 #include <cstdint>
 #include <cstddef>
+#include <list>
+#include <mutex>
+#include <unordered_map>
 
 namespace FormulaAnnotation {
-    // Centralized Element Definition
-    constexpr int NUM_ELEMENTS = 15;
+    // Capacity of a formula. The alphabet itself is runtime data (see ElementTable) of up to
+    // MAX_ELEMENTS elements, the limit of the 32-bit active element masks of ResidueTableCache.
+    constexpr int MAX_ELEMENTS = 32;
 
-    constexpr std::array<const char*, NUM_ELEMENTS> ELEMENT_SYMBOLS = {
-        "H", "B", "C", "N", "O", "F", "Na", "Si", "P", "S", "Cl", "K", "As", "Br", "I"
-    };
+    // Working formula of the kernels (bounds, scratch): slot e is element e of the registered
+    // table, slots from ElementTable::num_elements on are zero. Results are kept as FormulaList.
+    using Formula = std::array<int32_t, MAX_ELEMENTS>;
 
-    constexpr std::array<double, NUM_ELEMENTS> ATOMIC_MASSES = {
-        1.007825, 11.009305, 12.000000, 14.003074, 15.994915, 18.998403, 
-        22.989770, 27.9769265, 30.973762, 31.972071, 34.96885271, 
-        38.963707, 74.921596, 78.918338, 126.904468
+    // The registered element alphabet: what each formula slot means. Every mass, DBE and valence
+    // computation reads it, so elements (Se, D, ...) are added by registering a longer table,
+    // without a rebuild. There is no built-in alphabet: the table is empty until the Python package
+    // registers element_table.ELEMENTS.
+    struct ElementTable {
+        int num_elements = 0;
+        std::uint64_t generation = 0;  // incremented by every registration
+        std::array<std::string, MAX_ELEMENTS> symbols;
+        std::array<double, MAX_ELEMENTS> masses{};
+        std::array<int, MAX_ELEMENTS> twice_dbe_coefficients{};
+        std::array<int, MAX_ELEMENTS> valences{};
+        int carbon_index = -1;  // slot of "C", -1 without carbon (ratio rules then see zero carbons)
     };
 
-    enum ElementIndex {
-        H = 0, B = 1, C = 2, N = 3, O = 4, F = 5, Na = 6, Si = 7, P = 8, 
-        S = 9, Cl = 10, K = 11, As = 12, Br = 13, I = 14
-    };
+    // Immutable snapshot of the registered table. A registration swaps in a new table instead of
+    // changing this one, so a call that took a snapshot (DecompositionParams::elements) keeps a
+    // consistent alphabet while the GIL is released, whatever registers concurrently.
+    std::shared_ptr<const ElementTable> element_table();
+
+    // Replaces the alphabet; all vectors must have the same length, at most MAX_ELEMENTS, and
+    // masses must be positive (throws std::invalid_argument). Cached residue tables of the previous
+    // alphabet are dropped; a decomposition still running on it keys its tables by generation.
+    void register_element_table(
+        const std::vector<std::string>& symbols, const std::vector<double>& masses,
+        const std::vector<int>& twice_dbe_coefficients, const std::vector<int>& valences);
+
+    inline int num_elements() { return element_table()->num_elements; }
+}
+
+// Result structure for formulas
+using Formula = FormulaAnnotation::Formula;
+
+// Formulas over a fixed set of element slots, storing only the counts of those slots: memory per
+// formula scales with the active elements, not with the alphabet. A decomposition only produces
+// formulas that are zero outside the elements its bounds allow, so the kernels keep their results
+// in this form and widen them to the registered alphabet only when writing the Arrow buffers.
+class FormulaList {
+public:
+    FormulaList() = default;
+    // slots in increasing order; formulas added later must be zero outside them
+    explicit FormulaList(std::vector<int> slots) : slots_(std::move(slots)) {}
+
+    // Slots with a positive count in formula (e.g. the max bounds of a decomposition).
+    static std::vector<int> support(const Formula& formula) {
+        std::vector<int> slots;
+        for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) {
+            if (formula[e] > 0) slots.push_back(e);
+        }
+        return slots;
+    }
+
+    // n dense rows of width row_width, over the slots non-zero in any of them.
+    static FormulaList from_dense_rows(const int32_t* rows, std::size_t n, int row_width) {
+        std::vector<int> slots;
+        for (int e = 0; e < row_width; ++e) {
+            for (std::size_t i = 0; i < n; ++i) {
+                if (rows[i * row_width + e] != 0) {
+                    slots.push_back(e);
+                    break;
+                }
+            }
+        }
+        FormulaList list(std::move(slots));
+        list.reserve(n);
+        for (std::size_t i = 0; i < n; ++i) {
+            int32_t* row = list.append_row();
+            for (std::size_t j = 0; j < list.slots_.size(); ++j) row[j] = rows[i * row_width + list.slots_[j]];
+        }
+        return list;
+    }
+
+    const std::vector<int>& slots() const { return slots_; }
+    std::size_t size() const { return size_; }
+    bool empty() const { return size_ == 0; }
+    void reserve(std::size_t n) { counts_.reserve(n * slots_.size()); }
+    void clear() {
+        counts_.clear();
+        size_ = 0;
+    }
+    void swap(FormulaList& other) {
+        slots_.swap(other.slots_);
+        counts_.swap(other.counts_);
+        std::swap(size_, other.size_);
+    }
+    std::size_t memory_bytes() const { return counts_.capacity() * sizeof(int32_t) + slots_.capacity() * sizeof(int); }
 
-    // New Formula Type
-    using Formula = std::array<int32_t, NUM_ELEMENTS>;
+    // Counts of formula i, one per slot.
+    const int32_t* row(std::size_t i) const { return counts_.data() + i * slots_.size(); }
 
-    // Inline accessors so Cython can call functions instead of linking to constexpr objects.
-    inline const char* element_symbol_at(int i) { return ELEMENT_SYMBOLS[i]; }
-    inline double atomic_mass_at(int i) { return ATOMIC_MASSES[i]; }
+    // Appends a formula and returns its counts to fill, one per slot.
+    int32_t* append_row() {
+        counts_.resize(counts_.size() + slots_.size());
+        ++size_;
+        return counts_.data() + (size_ - 1) * slots_.size();
+    }
+    void push_back(const Formula& formula) {
+        int32_t* counts = append_row();
+        for (std::size_t j = 0; j < slots_.size(); ++j) counts[j] = formula[slots_[j]];
+    }
+    // Appends formula i of other, which must have the same slots.
+    void push_back(const FormulaList& other, std::size_t i) {
+        const int32_t* counts = other.row(i);
+        std::copy(counts, counts + slots_.size(), append_row());
+    }
 
-    // Size helpers for safe bulk copies
-    inline constexpr std::size_t FORMULA_NBYTES() {
-        return sizeof(int32_t) * static_cast<std::size_t>(NUM_ELEMENTS);
+    Formula operator[](std::size_t i) const {
+        Formula formula{};
+        const int32_t* counts = row(i);
+        for (std::size_t j = 0; j < slots_.size(); ++j) formula[slots_[j]] = counts[j];
+        return formula;
     }
-    inline const int32_t* formula_data_const(const Formula& f) noexcept {
-        return f.data();
+
+    // Writes the formulas as size() rows of width row_width (> every slot), zero outside the slots.
+    void write_dense(int32_t* out, int row_width) const {
+        std::fill(out, out + size_ * static_cast<std::size_t>(row_width), 0);
+        for (std::size_t i = 0; i < size_; ++i) {
+            const int32_t* counts = row(i);
+            int32_t* dense = out + i * static_cast<std::size_t>(row_width);
+            for (std::size_t j = 0; j < slots_.size(); ++j) dense[slots_[j]] = counts[j];
+        }
     }
-    inline int32_t* formula_data(Formula& f) noexcept {
-        return f.data();
+
+private:
+    std::vector<int> slots_;
+    std::vector<int32_t> counts_;  // size_ x slots_.size(), row-major
+    std::size_t size_ = 0;
+};
+
+// Non-owning view of contiguous doubles, e.g. one row of an Arrow List(Float64) values buffer.
+// Why: lets the Cython layer hand Arrow buffers to C++ without building Python lists or vectors.
+// The viewed buffer must outlive every call that receives the span.
+struct DoubleSpan {
+    const double* data = nullptr;
+    std::size_t length = 0;
+
+    DoubleSpan() = default;
+    DoubleSpan(const double* data_, std::size_t length_) : data(data_), length(length_) {}
+    DoubleSpan(const std::vector<double>& values) : data(values.data()), length(values.size()) {}
+
+    std::size_t size() const { return length; }
+    bool empty() const { return length == 0; }
+    const double& operator[](std::size_t i) const { return data[i]; }
+    const double* begin() const { return data; }
+    const double* end() const { return data + length; }
+};
+
+// Arrow large_list layout of nested results: row i of the list column is values[offsets[i], offsets[i + 1]).
+// Why: the Cython layer sizes the Arrow buffers once and fills them here, so nested results reach
+// Polars as a few flat buffers instead of one Python object per formula.
+template <typename T>
+std::size_t total_items(const std::vector<std::vector<T>>& rows) {
+    std::size_t total = 0;
+    for (const auto& row : rows) total += row.size();
+    return total;
+}
+
+// Writes rows.size() + 1 offsets starting at first_offset and copies every row to values[offset...].
+// values is the start of the whole values buffer, so consecutive calls can fill one column.
+// With release_rows each row is freed once copied, keeping peak memory near one copy of the results.
+// Returns the offset after the last copied item.
+template <typename T>
+int64_t flatten_rows(
+    std::vector<std::vector<T>>& rows, int64_t first_offset, int64_t* offsets, T* values, bool release_rows) {
+    int64_t offset = first_offset;
+    offsets[0] = offset;
+    for (std::size_t i = 0; i < rows.size(); ++i) {
+        std::copy(rows[i].begin(), rows[i].end(), values + offset);
+        offset += static_cast<int64_t>(rows[i].size());
+        offsets[i + 1] = offset;
+        if (release_rows) std::vector<T>().swap(rows[i]);
     }
+    return offset;
 }
 
-// Result structure for formulas
-using Formula = FormulaAnnotation::Formula;
+// The same for formula lists, written as dense rows of the registered alphabet: values is a
+// (total, num_elements) int32 buffer and offsets count formulas.
+inline std::size_t total_items(const std::vector<FormulaList>& rows) {
+    std::size_t total = 0;
+    for (const auto& row : rows) total += row.size();
+    return total;
+}
+
+inline int64_t flatten_formula_rows(
+    std::vector<FormulaList>& rows, int64_t first_offset, int64_t* offsets, int32_t* values, int num_elements,
+    bool release_rows) {
+    int64_t offset = first_offset;
+    offsets[0] = offset;
+    for (std::size_t i = 0; i < rows.size(); ++i) {
+        rows[i].write_dense(values + offset * num_elements, num_elements);
+        offset += static_cast<int64_t>(rows[i].size());
+        offsets[i + 1] = offset;
+        if (release_rows) FormulaList().swap(rows[i]);
+    }
+    return offset;
+}
 
 // Spectrum structure for batch processing
 struct Spectrum {
     double precursor_mass;
-    std::vector<double> fragment_masses;
+    DoubleSpan fragment_masses;
+    DoubleSpan fragment_intensities;  // aligned with fragment_masses, or empty to weight every fragment 1
 };
 
 // New structure for spectrum with custom bounds for parallel processing
 struct SpectrumWithBounds {
     double precursor_mass;
-    std::vector<double> fragment_masses;
+    DoubleSpan fragment_masses;
+    DoubleSpan fragment_intensities;
     Formula precursor_min_bounds;
     Formula precursor_max_bounds;
 };
@@ -68,15 +237,16 @@ struct SpectrumWithBounds {
 // Spectrum structure with known precursor formula
 struct SpectrumWithKnownPrecursor {
     Formula precursor_formula;
-    std::vector<double> fragment_masses;
+    DoubleSpan fragment_masses;
 };
 
 // Proper spectrum results structure where fragments are subsets of precursors
 struct SpectrumDecomposition {
     Formula precursor;
-    std::vector<std::vector<Formula>> fragments;  // fragments[i] = all possible formulas for fragment mass i
+    std::vector<FormulaList> fragments;  // fragments[i] = all possible formulas for fragment mass i
     double precursor_mass;
     double precursor_error_ppm;
+    double explained_intensity;  // summed intensity of the fragments with at least one sub-formula
     std::vector<std::vector<double>> fragment_masses;    // fragment_masses[i] = masses for fragment i formulas
     std::vector<std::vector<double>> fragment_errors_ppm; // fragment_errors_ppm[i] = errors for fragment i formulas
 };
@@ -85,74 +255,417 @@ struct ProperSpectrumResults {
     std::vector<SpectrumDecomposition> decompositions;
 };
 
+// Engine used to decompose fragment masses when the precursor formula is known
+enum FragmentEngine : int {
+    FRAGMENT_ENGINE_MONEY_CHANGING = 0,   // full money-changing decomposition per fragment
+    FRAGMENT_ENGINE_SUBFORMULA_INDEX = 1  // sorted sub-formula mass table per precursor, binary search per fragment
+};
+
+// Loop schedule of the OpenMP kernels; values match omp_sched_t
+enum ParallelSchedule : int {
+    PARALLEL_SCHEDULE_STATIC = 1,
+    PARALLEL_SCHEDULE_DYNAMIC = 2,
+    PARALLEL_SCHEDULE_GUIDED = 3
+};
+
+// Seven-Golden-Rules-style plausibility filters, applied inside the enumerator (Kind & Fiehn 2007).
+// Ratios are element count / carbon count and are checked as count <= max * C and count >= min * C,
+// so a formula without carbon passes only if it has none of the ratio-limited elements.
+struct ChemistryRules {
+    bool enabled;
+    double min_ratio_to_carbon[FormulaAnnotation::MAX_ELEMENTS];  // <= 0 disables
+    double max_ratio_to_carbon[FormulaAnnotation::MAX_ELEMENTS];  // < 0 disables
+    // Senior rules over the element table valences: valence sum even, >= 2 * largest valence, >= 2 * (atoms - 1)
+    bool senior_rules;
+};
+
+// Exact check of all enabled rules on a complete formula.
+bool chemistry_rules_accepted(
+    const Formula& formula, const ChemistryRules& rules, const FormulaAnnotation::ElementTable& elements);
+
+// Top-k mode of decompose(): instead of stopping at max_results in enumeration order, every
+// formula is scored and the top_k lowest scores are kept in a bounded heap, best first.
+// score = |error ppm| + sum over elements of element_penalty_ppm[e] * count[e]; ties are broken
+// by the formula's element counts so the output does not depend on enumeration order.
+struct CandidateRanking {
+    int top_k;  // <= 0 disables ranking
+    double element_penalty_ppm[FormulaAnnotation::MAX_ELEMENTS];
+};
+
+// Half-width of the accepted mass window, shared by decomposition, cleaning, filtering and cost
+// estimation. With m' = max(mass, ppm_floor_mass), the relative part is a calibrated polynomial
+// ppm(m') = ppm + ppm_per_da * m' + ppm_per_da_squared * m'^2 applied to m', and the window is
+// never narrower than absolute_floor_da. ppm_tolerance() is the historical max(mass, 200) * ppm.
+struct MassTolerance {
+    double ppm;
+    double ppm_per_da;
+    double ppm_per_da_squared;
+    double ppm_floor_mass;
+    double absolute_floor_da;
+
+    double window(double mass) const {
+        const double reference_mass = std::max(mass, ppm_floor_mass);
+        const double reference_ppm = ppm + (ppm_per_da + ppm_per_da_squared * reference_mass) * reference_mass;
+        return std::max(absolute_floor_da, std::max(0.0, reference_mass * reference_ppm / 1e6));
+    }
+};
+
+inline MassTolerance ppm_tolerance(double tolerance_ppm) {
+    return MassTolerance{tolerance_ppm, 0.0, 0.0, 200.0, 0.0};
+}
+
+// Isotope envelope evidence from MS1 (decompose_masses_with_isotopes_parallel). The envelope is
+// aggregated per nominal shift: M+1 sums every peak in the m/z range of the +1 isotopologues
+// (13C, 15N, ...), M+2 that of the +2 ones (34S, 37Cl, 81Br, 13C2, ...), so it does not depend on
+// whether the MS1 resolution separates the isotopic fine structure. With one heavy isotope per
+// element the predicted ratios to M are exact:
+//   M+1/M = sum_e n_e r1_e
+//   M+2/M = sum_e n_e r2_e + ((M+1/M)^2 - sum_e n_e r1_e^2) / 2
+// where r_e is the heavy / light abundance ratio of element e.
+constexpr int NUM_ISOTOPE_SHIFTS = 2;
+
+struct IsotopeScoring {
+    bool enabled;
+    double element_ratio[NUM_ISOTOPE_SHIFTS][FormulaAnnotation::MAX_ELEMENTS];  // r1, r2; 0 without such an isotope
+    double shift_min[NUM_ISOTOPE_SHIFTS];  // m/z range of the M+1 / M+2 isotopologues relative to M
+    double shift_max[NUM_ISOTOPE_SHIFTS];
+    MassTolerance ms1_tolerance;         // locates M around the precursor m/z
+    MassTolerance isotopic_tolerance;    // widens the M+1 / M+2 ranges
+    // Same meaning as in deduce_isotopic_pattern: peaks below minimum_intensity count as absent,
+    // observed intensities I are uncertain by I * relative + absolute.
+    double minimum_intensity;
+    double intensity_absolute_tolerance;
+    double intensity_relative_tolerance;
+    double weight_ppm;  // added to the ranking score per squared normalized ratio deviation
+};
+
+// Accepted ratio to M per shift: [lower, upper] around the observed ratio (0 and the detection limit
+// when the peak is absent). Without a monoisotopic peak the envelope carries no constraint.
+struct IsotopeEnvelope {
+    bool observed;
+    double observed_ratio[NUM_ISOTOPE_SHIFTS];
+    double lower[NUM_ISOTOPE_SHIFTS];
+    double upper[NUM_ISOTOPE_SHIFTS];
+};
+
+IsotopeEnvelope observe_isotope_envelope(
+    double precursor_mz, DoubleSpan ms1_mzs, DoubleSpan ms1_intensities, const IsotopeScoring& scoring);
+
+// Predicted M+1/M and M+2/M of a formula.
+void predicted_isotope_ratios(const Formula& formula, const IsotopeScoring& scoring, double* ratios);
+
+// Narrows max_bounds to the counts the envelope allows on their own (n_e r_e <= upper, as every
+// term of a predicted ratio is non-negative), so enumeration subtrees are pruned before any formula
+// is built.
+void tighten_bounds_by_isotopes(const IsotopeEnvelope& envelope, const IsotopeScoring& scoring, Formula& max_bounds);
+
+// Sum over shifts of the squared deviation of the predicted from the observed ratio, normalized by
+// the accepted interval on that side (so each term is in [0, 1]); -1 if a prediction is outside.
+double isotope_envelope_deviation(const Formula& formula, const IsotopeEnvelope& envelope, const IsotopeScoring& scoring);
+
+// One feature of the joint precursor + isotope decomposition.
+struct MassWithIsotopes {
+    double target_mass;       // neutral mass to decompose
+    double precursor_mz;      // m/z of M in the MS1 spectrum
+    DoubleSpan ms1_mzs;
+    DoubleSpan ms1_intensities;
+    Formula min_bounds;
+    Formula max_bounds;
+};
+
 // Parameters structure for decomposition
 struct DecompositionParams {
-    double tolerance_ppm;
+    MassTolerance tolerance;
     double min_dbe;
     double max_dbe;
     // double max_hetero_ratio;
     int max_results;
+    bool dbe_pruning;  // prune enumeration subtrees whose reachable DBE range misses [min_dbe, max_dbe]
+    int fragment_engine;  // FragmentEngine, only used by the known-precursor fragment routines
+    long long max_subformula_lattice_size;  // above this many sub-formulas, fall back to money-changing
+    int n_threads;            // OpenMP team size, <= 0 for the OpenMP default
+    int schedule;             // ParallelSchedule
+    int schedule_chunk_size;  // iterations per scheduling chunk, <= 0 for the schedule's default
+    bool cost_ordering;       // process items in descending estimate_decomposition_cost order
+    ChemistryRules chemistry_rules;  // ignored by the sub-formula index engine
+    int top_k_precursors;     // decompose_spectrum keeps this many best-explaining precursors, <= 0 keeps all
+    CandidateRanking ranking; // decompose()/count() only; max_results is ignored while ranking is on
+    IsotopeScoring isotope_scoring;  // decompose_masses_with_isotopes_parallel only
     Formula min_bounds;
     Formula max_bounds;
+    // Alphabet of the whole call, taken once by the caller (see element_table()); every kernel of
+    // the call reads this snapshot rather than the registered table.
+    std::shared_ptr<const FormulaAnnotation::ElementTable> elements;
+};
+
+// Extended Residue Table (ERT) for one active element alphabet.
+// The table depends only on which elements may appear (max bound > 0), never on the
+// count bounds themselves, so it can be shared by every decomposer using that alphabet.
+struct ResidueTable {
+    std::vector<int> original_indices;      // element index per weight, sorted by increasing mass
+    std::vector<double> masses;             // monoisotopic mass per weight
+    std::vector<long long> integer_masses;  // discretized mass per weight (after gcd division)
+    std::vector<long long> ert;             // flattened [residue * num_weights + weight]
+    double precision;
+    double min_error;
+    double max_error;
+
+    std::size_t num_weights() const { return original_indices.size(); }
+    std::size_t memory_bytes() const {
+        return sizeof(ResidueTable)
+            + original_indices.capacity() * sizeof(int)
+            + masses.capacity() * sizeof(double)
+            + integer_masses.capacity() * sizeof(long long)
+            + ert.capacity() * sizeof(long long);
+    }
+};
+
+struct ResidueTableCacheStats {
+    long long hits;
+    long long misses;
+    long long evictions;
+    long long entries;
+    long long memory_bytes;
+    long long capacity_bytes;
+};
+
+// Process-wide LRU cache of residue tables keyed by the element table generation and the active
+// element bitmask.
+// Why: per-mass and per-spectrum bounds create a fresh MassDecomposer for every item,
+// and rebuilding the ERT dominated the runtime of those calls.
+class ResidueTableCache {
+public:
+    static ResidueTableCache& instance();
+
+    std::shared_ptr<const ResidueTable> get(
+        const FormulaAnnotation::ElementTable& elements, std::uint32_t active_element_mask);
+    void set_capacity_bytes(std::size_t capacity_bytes);
+    void clear();
+    ResidueTableCacheStats stats() const;
+
+    static std::uint32_t active_element_mask(const Formula& max_bounds);
+
+private:
+    ResidueTableCache() = default;
+    void evict_to_capacity_locked();
+
+    // generation << 32 | active element mask
+    using Entry = std::pair<std::uint64_t, std::shared_ptr<const ResidueTable>>;
+    mutable std::mutex mutex_;
+    std::list<Entry> lru_;  // most recently used at the front
+    std::unordered_map<std::uint64_t, std::list<Entry>::iterator> index_;
+    std::size_t capacity_bytes_ = 256ull * 1024ull * 1024ull;
+    std::size_t memory_bytes_ = 0;
+    long long hits_ = 0;
+    long long misses_ = 0;
+    long long evictions_ = 0;
+};
+
+std::shared_ptr<const ResidueTable> build_residue_table(
+    const FormulaAnnotation::ElementTable& elements, std::uint32_t active_element_mask);
+
+// Thin free functions so Cython does not need to bind the singleton class.
+ResidueTableCacheStats get_residue_table_cache_stats();
+void set_residue_table_cache_capacity(std::size_t capacity_bytes);
+void clear_residue_table_cache();
+
+// All sub-formulas of a known precursor that pass the DBE filter, sorted by exact mass.
+// Why: fragments of a known precursor can only be sub-formulas of it, so the finite lattice
+// can be enumerated once and every fragment mass answered by binary search instead of a
+// full money-changing decomposition per fragment.
+class SubformulaIndex {
+public:
+    // Only sub-formulas up to max_mass are kept (the heaviest fragment plus its tolerance).
+    SubformulaIndex(
+        const Formula& precursor_formula, const FormulaAnnotation::ElementTable& elements,
+        double min_dbe, double max_dbe, double max_mass);
+
+    // Building costs ~10ns per lattice entry while a money-changing fragment query costs a few us,
+    // so the index only pays off when the lattice is below this many entries per fragment.
+    static constexpr long long BREAK_EVEN_ENTRIES_PER_FRAGMENT = 256;
+
+    // Number of sub-formulas (including the empty one), saturating at cap + 1.
+    static long long lattice_size(const Formula& precursor_formula, long long cap);
+
+    // All indexed sub-formulas within the tolerance window of target_mass, in increasing mass order,
+    // over the elements of the precursor.
+    FormulaList query(double target_mass, const MassTolerance& tolerance, int max_results) const;
+
+    std::size_t size() const { return masses_.size(); }
+
+private:
+    std::vector<int> active_elements_;        // element indices with a non-zero precursor count
+    std::vector<std::uint32_t> radices_;      // precursor count + 1 per active element
+    std::vector<double> masses_;              // sorted exact masses
+    std::vector<std::uint32_t> codes_;        // mixed-radix sub-formula codes aligned with masses_
 };
 
+// Relative cost of decompose(target_mass) with the given bounds: tolerance window in integer-mass
+// steps times the bound volume of the enumeration. Only meaningful for comparing items, e.g. to
+// schedule expensive masses first or to shard batches evenly across processes.
+double estimate_decomposition_cost(
+    double target_mass, const Formula& min_bounds, const Formula& max_bounds, const MassTolerance& tolerance,
+    const FormulaAnnotation::ElementTable& elements);
+
+// Exact mass and 2*DBE of candidate formulas in structure-of-arrays blocks: counts of the active
+// elements are transposed into one column per element, so each per-element update is a
+// contiguous multiply-add over the block that the compiler vectorizes, and inactive elements
+// cost nothing. Masses are summed in element order, like a plain loop over the formula.
+class FormulaBlockEvaluator {
+public:
+    static constexpr std::size_t BLOCK_SIZE = 256;
+
+    // slots are the active elements, in increasing order; formulas must be zero elsewhere.
+    FormulaBlockEvaluator(const std::vector<int>& slots, const FormulaAnnotation::ElementTable& elements);
+
+    // n <= BLOCK_SIZE rows of FormulaList counts over slots (e.g. FormulaList::row(first));
+    // writes n masses and n 2*DBE values.
+    void evaluate(const int32_t* rows, std::size_t n, double* masses, int32_t* twice_dbes) {
+        evaluate_rows(rows, slot_count(), positions_in_row_.data(), n, masses, twice_dbes);
+    }
+
+    // The same for n dense rows of row_width counts each, indexed by element slot.
+    void evaluate_dense(const int32_t* rows, std::size_t row_width, std::size_t n, double* masses, int32_t* twice_dbes) {
+        evaluate_rows(rows, row_width, active_elements_.data(), n, masses, twice_dbes);
+    }
+
+    // DBE rule of the decomposer: min_dbe <= DBE <= max_dbe and DBE integer.
+    static bool twice_dbe_accepted(int32_t twice_dbe, double min_dbe, double max_dbe) {
+        return twice_dbe >= 2.0 * min_dbe && twice_dbe <= 2.0 * max_dbe && (twice_dbe & 1) == 0;
+    }
+
+private:
+    std::size_t slot_count() const { return active_elements_.size(); }
+    void evaluate_rows(
+        const int32_t* rows, std::size_t row_width, const int* positions, std::size_t n,
+        double* masses, int32_t* twice_dbes);
+
+    std::vector<int> active_elements_;
+    std::vector<int> positions_in_row_;  // 0, 1, ...: a FormulaList row holds the active elements in order
+    std::vector<double> element_masses_;
+    std::vector<int32_t> element_twice_dbe_coefficients_;
+    std::vector<int32_t> columns_;  // active_elements_.size() x BLOCK_SIZE element counts
+};
+
+// keep[i] = 1 if formula row i (row_width counts, one per element slot) is within the tolerance
+// window of target_masses[i] (same window as decompose) and passes the DBE rule, else 0.
+void filter_formulas(
+    const int32_t* formulas, std::size_t row_width, const double* target_masses, std::size_t n,
+    const MassTolerance& tolerance, double min_dbe, double max_dbe, std::uint8_t* keep,
+    const FormulaAnnotation::ElementTable& elements);
+
 // Main decomposer class
 class MassDecomposer {
 private:
     Formula min_bounds_;
     Formula max_bounds_;
+    std::shared_ptr<const FormulaAnnotation::ElementTable> elements_;
     
     // For money-changing algorithm
     struct Weight {
-        int original_index; // Index in the global ELEMENT_SYMBOLS array
+        int original_index; // Formula slot of the element
         double mass;
         long long integer_mass;
         int min_count;
         int max_count;
+        int twice_dbe_coefficient;
+    };
+
+    struct DbePruning {
+        bool enabled;
+        double min_twice_dbe;
+        double max_twice_dbe;
     };
     
     std::vector<Weight> weights_;
-    std::vector<std::vector<long long>> ert_;
+    // residual_*_mass_[i]: integer mass range reachable by weights 0..i-1 within their count bounds
+    std::vector<long long> residual_min_mass_;
+    std::vector<long long> residual_max_mass_;
+    // residual_*_twice_dbe_[i]: 2*DBE range contributed by weights 1..i-1 within their count bounds
+    std::vector<int> residual_min_twice_dbe_;
+    std::vector<int> residual_max_twice_dbe_;
+    std::vector<int> weight_positions_;  // position of weights_[j]'s element in a result row (slots_ order)
+    std::vector<int> slots_;             // active elements in increasing order: the slots of the results
+    int carbon_weight_;  // index of carbon in weights_, -1 if carbon is not allowed
+    std::shared_ptr<const ResidueTable> table_;
+    const long long* ert_;  // borrowed from table_, row stride is weights_.size()
     double precision_;
     double min_error_, max_error_;
     bool is_initialized_;
+    FormulaBlockEvaluator candidate_evaluator_;
     
     // Helper methods
     void init_money_changing();
-    inline bool check_dbe(const Formula& formula, double min_dbe, double max_dbe) const;
     // bool check_hetero_ratio(const Formula& formula, double max_ratio) const;
-    long long gcd(long long u, long long v) const;
-    void discretize_masses();
-    void divide_by_gcd();
-    void calc_ert();
-    void compute_errors();
     std::pair<long long, long long> integer_bound(double mass_from, double mass_to) const;
     bool decomposable(int i, long long m, long long a1) const;
     bool decomposable_fast(int i, long long m) const; // Fast check for decomposability
-    std::vector<Formula> integer_decompose(long long mass) const;
+    // Appends the formulas of one integer mass to results (slots_ order).
+    void integer_decompose(
+        long long mass, const DbePruning& dbe_pruning, const ChemistryRules& chemistry_rules, FormulaList& results) const;
+    void enumerate_level(
+        int i, long long remaining, int fixed_twice_dbe, double carbon_needed, std::vector<int>& counts,
+        const DbePruning& dbe_pruning, const ChemistryRules& chemistry_rules, FormulaList& results) const;
+    bool dbe_reachable(int i, long long remaining, int fixed_twice_dbe, const DbePruning& dbe_pruning) const;
+    long long carbon_cap(long long remaining) const;
+    bool lighter_min_ratios_reachable(int i, long long remaining, long long carbon, const ChemistryRules& chemistry_rules) const;
+    // Shared by decompose() and count(): returns the number of accepted formulas and appends
+    // them to results unless it is nullptr.
+    // With isotopes, formulas outside the envelope are dropped and the rest ranked with its deviation.
+    std::size_t decompose_into(
+        double target_mass, const DecompositionParams& params, FormulaList* results,
+        const IsotopeEnvelope* isotopes = nullptr);
     
 public:
-    MassDecomposer(const Formula& min_bounds, const Formula& max_bounds);
+    MassDecomposer(
+        const Formula& min_bounds, const Formula& max_bounds,
+        std::shared_ptr<const FormulaAnnotation::ElementTable> elements);
     ~MassDecomposer() = default;
     
-    // Single mass decomposition
-    std::vector<Formula> decompose(double target_mass, const DecompositionParams& params);
+    // Single mass decomposition; the formulas are over the elements with a positive max bound
+    FormulaList decompose(double target_mass, const DecompositionParams& params);
     
+    // decompose() restricted to formulas matching an observed isotope envelope (see IsotopeScoring)
+    FormulaList decompose(double target_mass, const DecompositionParams& params, const IsotopeEnvelope& isotopes);
+
+    // Number of formulas decompose() would return (capped at max_results, or at ranking.top_k), without keeping them
+    std::size_t count(double target_mass, const DecompositionParams& params);
+
     // Parallel mass decomposition (OpenMP)
-    static std::vector<std::vector<Formula>> decompose_parallel(
+    static std::vector<FormulaList> decompose_parallel(
         const std::vector<double>& target_masses, 
         const DecompositionParams& params);
     
     // New: Parallel mass decomposition with per-mass bounds
-    static std::vector<std::vector<Formula>> decompose_masses_parallel_per_bounds(
+    static std::vector<FormulaList> decompose_masses_parallel_per_bounds(
+        const std::vector<double>& target_masses,
+        const std::vector<std::pair<Formula, Formula>>& per_mass_bounds,
+        const DecompositionParams& params);
+
+    // Joint precursor + isotope decomposition: per feature, the MS1 isotope envelope is read around
+    // precursor_mz, the bounds are tightened by it, and formulas are pruned and ranked by
+    // predicted-vs-observed envelope inside the enumerator (top_k with params.ranking).
+    static std::vector<FormulaList> decompose_masses_with_isotopes_parallel(
+        const std::vector<MassWithIsotopes>& features,
+        const DecompositionParams& params);
+
+    // Count-only counterparts of decompose_parallel / decompose_masses_parallel_per_bounds
+    static std::vector<long long> count_parallel(
+        const std::vector<double>& target_masses,
+        const DecompositionParams& params);
+
+    static std::vector<long long> count_masses_parallel_per_bounds(
         const std::vector<double>& target_masses,
         const std::vector<std::pair<Formula, Formula>>& per_mass_bounds,
         const DecompositionParams& params);
 
-    // Proper spectrum decomposition - ensures fragments are subsets of precursors
+    // Proper spectrum decomposition - ensures fragments are subsets of precursors.
+    // With params.top_k_precursors > 0 only the candidates explaining the most fragment intensity
+    // are kept, best first (ties broken by the smaller absolute precursor error).
     ProperSpectrumResults decompose_spectrum(
         double precursor_mass,
-        const std::vector<double>& fragment_masses,
+        DoubleSpan fragment_masses,
+        DoubleSpan fragment_intensities,
         const DecompositionParams& params);
     
     // Proper parallel spectrum decomposition - processes multiple spectra properly in parallel
@@ -166,21 +679,30 @@ public:
         const DecompositionParams& params);
     
     // Known precursor spectrum decomposition - decomposes fragments with known precursor formula
-    std::vector<std::vector<Formula>> decompose_spectrum_known_precursor(
+    std::vector<FormulaList> decompose_spectrum_known_precursor(
         const Formula& precursor_formula,
-        const std::vector<double>& fragment_masses,
+        DoubleSpan fragment_masses,
         const DecompositionParams& params);
     
+    // decompose_spectrum_known_precursor for several candidate precursors of one spectrum, as
+    // [candidate][fragment][formula]. Fragments are decomposed once against the element-wise maximum
+    // of the candidates and assigned by sub-formula containment; falls back to per-candidate
+    // decomposition if a fragment hits max_results.
+    std::vector<std::vector<FormulaList>> decompose_spectrum_candidate_precursors(
+        const FormulaList& precursor_formulas,
+        DoubleSpan fragment_masses,
+        const DecompositionParams& params);
+
     // Parallel known precursor spectrum decomposition - processes multiple spectra with different known precursor formulas
-    static std::vector<std::vector<std::vector<Formula>>> decompose_spectra_known_precursor_parallel(
+    static std::vector<std::vector<FormulaList>> decompose_spectra_known_precursor_parallel(
         const std::vector<SpectrumWithKnownPrecursor>& spectra,
         const DecompositionParams& params);
 
     // New: input struct for cleaning with intensities
     struct CleanSpectrumWithKnownPrecursor {
         Formula precursor_formula;
-        std::vector<double> fragment_masses;
-        std::vector<double> fragment_intensities;
+        DoubleSpan fragment_masses;
+        DoubleSpan fragment_intensities;
         // Observed precursor mass (unnormalized) and ppm filter threshold after normalization
         double precursor_mass;
         double max_allowed_normalized_mass_error_ppm;
@@ -190,15 +712,15 @@ public:
     struct CleanedSpectrumResult {
         std::vector<double> masses;   // kept fragment masses
         std::vector<double> intensities; // kept fragment intensities
-        std::vector<std::vector<Formula>> fragment_formulas;     // per kept fragment
+        std::vector<FormulaList> fragment_formulas;              // per kept fragment
         std::vector<std::vector<double>> fragment_errors_ppm;    // per kept fragment (aligned with formulas)
     };
 
     // New: clean a single spectrum with known precursor formula
     CleanedSpectrumResult clean_spectrum_known_precursor(
         const Formula& precursor_formula,
-        const std::vector<double>& fragment_masses,
-        const std::vector<double>& fragment_intensities,
+        DoubleSpan fragment_masses,
+        DoubleSpan fragment_intensities,
         const DecompositionParams& params);
 
     // New: parallel cleaner for many spectra with known precursor formula
@@ -209,13 +731,13 @@ public:
     struct CleanedAndNormalizedSpectrumResult {
         std::vector<double> masses_normalized;          // one per kept fragment (target + final_mean_error)
         std::vector<double> intensities;                // aligned with masses_normalized
-        std::vector<Formula> fragment_formulas;         // one per kept fragment
+        FormulaList fragment_formulas;                  // one per kept fragment
         std::vector<double> fragment_errors_ppm;        // one per kept fragment (after normalization)
     }; 
     CleanedAndNormalizedSpectrumResult clean_and_normalize_spectrum_known_precursor(
         const Formula& precursor_formula,
-        const std::vector<double>& fragment_masses,
-        const std::vector<double>& fragment_intensities,
+        DoubleSpan fragment_masses,
+        DoubleSpan fragment_intensities,
         double precursor_mass,
         double max_allowed_normalized_mass_error_ppm,
         const DecompositionParams& params);
@@ -224,5 +746,42 @@ public:
     static std::vector<CleanedAndNormalizedSpectrumResult> clean_and_normalize_spectra_known_precursor_parallel(
         const std::vector<CleanSpectrumWithKnownPrecursor>& spectra,
         const DecompositionParams& params);
+
+    // One fragment spectrum with several candidate precursor formulas (e.g. every decomposition of
+    // the precursor mass); precursor_formulas points into caller-owned storage of
+    // n_precursor_formulas rows with one count per element of params.elements.
+    struct CleanSpectrumWithCandidatePrecursors {
+        const int32_t* precursor_formulas;
+        std::size_t n_precursor_formulas;
+        DoubleSpan fragment_masses;
+        DoubleSpan fragment_intensities;
+        double precursor_mass;
+        double max_allowed_normalized_mass_error_ppm;
+    };
+    // clean_and_normalize_spectrum_known_precursor for every candidate, with the fragment solutions
+    // of decompose_spectrum_candidate_precursors.
+    std::vector<CleanedAndNormalizedSpectrumResult> clean_and_normalize_spectrum_candidate_precursors(
+        const FormulaList& precursor_formulas,
+        DoubleSpan fragment_masses,
+        DoubleSpan fragment_intensities,
+        double precursor_mass,
+        double max_allowed_normalized_mass_error_ppm,
+        const DecompositionParams& params);
+
+    // Results are flattened candidate by candidate: all candidates of spectrum 0, then spectrum 1, ...
+    static std::vector<CleanedAndNormalizedSpectrumResult> clean_and_normalize_spectra_candidate_precursors_parallel(
+        const std::vector<CleanSpectrumWithCandidatePrecursors>& spectra,
+        const DecompositionParams& params);
+
+private:
+    // Selection, calibration and filtering steps of clean_and_normalize_spectrum_known_precursor,
+    // given the candidate formulas of every fragment.
+    CleanedAndNormalizedSpectrumResult normalize_fragment_solutions(
+        const Formula& precursor_formula,
+        DoubleSpan fragment_masses,
+        DoubleSpan fragment_intensities,
+        double precursor_mass,
+        double max_allowed_normalized_mass_error_ppm,
+        const std::vector<FormulaList>& fragment_solutions) const;
 };
 #endif // MASS_DECOMPOSER_COMMON_HPP
\ No newline at end of file
@@ -7,9 +7,13 @@ cimport cython
 from libcpp.vector cimport vector
 from libcpp.string cimport string
 from libcpp.utility cimport pair
+from libcpp.memory cimport shared_ptr
+from cython.operator cimport dereference as deref
 # import memcpy
 from libc.string cimport memcpy
+from libc.stdint cimport uint8_t, int32_t, int64_t, uint64_t
 import pyarrow as pa
+import pyarrow.compute as pc
 import polars as pl
 # cimport pyarrow as pa
 # The libcpp.array import is no longer needed
@@ -19,12 +23,21 @@ cimport numpy as np
 
 # C++ declarations from the header file
 cdef extern from "mass_decomposer_common.hpp" namespace "FormulaAnnotation":
-    cdef int NUM_ELEMENTS
-    cdef const char** ELEMENT_SYMBOLS
-    cdef const double* ATOMIC_MASSES
-    size_t FORMULA_NBYTES() nogil
-    const int* formula_data_const(const Formula_cpp&) nogil
-    int* formula_data(Formula_cpp&) nogil
+    # Capacity of the C++ formula and element arrays; the alphabet in use is ElementTable.num_elements long.
+    enum: MAX_ELEMENTS
+
+    cdef cppclass ElementTable:
+        int num_elements
+        uint64_t generation
+        string symbols[MAX_ELEMENTS]
+        double masses[MAX_ELEMENTS]
+        int twice_dbe_coefficients[MAX_ELEMENTS]
+        int valences[MAX_ELEMENTS]
+        int carbon_index
+
+    shared_ptr[const ElementTable] element_table() nogil
+    void register_element_table_cpp "FormulaAnnotation::register_element_table"(
+        const vector[string]&, const vector[double]&, const vector[int]&, const vector[int]&) except +
 
 cdef extern from "mass_decomposer_common.hpp":
     # Define Formula_cpp as a cppclass and declare the methods we use on it.
@@ -33,164 +46,509 @@ cdef extern from "mass_decomposer_common.hpp":
         Formula_cpp() nogil
         void fill(int) nogil
         int& operator[](size_t) nogil
+        int* data() nogil
+
+    # Formulas storing only the counts of their active elements; write_dense widens them.
+    cdef cppclass FormulaList:
+        size_t size() nogil const
+        void write_dense(int32_t*, int) nogil const
+
+    cdef cppclass DoubleSpan:
+        DoubleSpan() nogil
+        DoubleSpan(const double*, size_t) nogil
 
     cdef struct Spectrum:
         double precursor_mass
-        vector[double] fragment_masses
+        DoubleSpan fragment_masses
+        DoubleSpan fragment_intensities
     
     cdef struct SpectrumWithBounds:
         double precursor_mass
-        vector[double] fragment_masses
+        DoubleSpan fragment_masses
+        DoubleSpan fragment_intensities
         Formula_cpp precursor_min_bounds
         Formula_cpp precursor_max_bounds
 
     cdef struct SpectrumWithKnownPrecursor:
         Formula_cpp precursor_formula
-        vector[double] fragment_masses
+        DoubleSpan fragment_masses
     
     cdef struct SpectrumDecomposition:
         Formula_cpp precursor
-        vector[vector[Formula_cpp]] fragments
+        vector[FormulaList] fragments
         double precursor_mass
         double precursor_error_ppm
+        double explained_intensity
         vector[vector[double]] fragment_masses
         vector[vector[double]] fragment_errors_ppm
 
     cdef struct ProperSpectrumResults:
         vector[SpectrumDecomposition] decompositions
     
+    cdef struct ChemistryRules:
+        bint enabled
+        double min_ratio_to_carbon[MAX_ELEMENTS]
+        double max_ratio_to_carbon[MAX_ELEMENTS]
+        bint senior_rules
+
+    cdef struct CandidateRanking:
+        int top_k
+        double element_penalty_ppm[MAX_ELEMENTS]
+
+    cdef struct MassTolerance:
+        double ppm
+        double ppm_per_da
+        double ppm_per_da_squared
+        double ppm_floor_mass
+        double absolute_floor_da
+
+    MassTolerance ppm_tolerance(double) nogil
+
+    cdef struct IsotopeScoring:
+        bint enabled
+        double element_ratio[2][MAX_ELEMENTS]
+        double shift_min[2]
+        double shift_max[2]
+        MassTolerance ms1_tolerance
+        MassTolerance isotopic_tolerance
+        double minimum_intensity
+        double intensity_absolute_tolerance
+        double intensity_relative_tolerance
+        double weight_ppm
+
+    cdef struct MassWithIsotopes:
+        double target_mass
+        double precursor_mz
+        DoubleSpan ms1_mzs
+        DoubleSpan ms1_intensities
+        Formula_cpp min_bounds
+        Formula_cpp max_bounds
+
     cdef struct DecompositionParams:
-        double tolerance_ppm
+        MassTolerance tolerance
         double min_dbe
         double max_dbe
         # double max_hetero_ratio
         int max_results
+        bint dbe_pruning
+        int fragment_engine
+        long long max_subformula_lattice_size
+        int n_threads
+        int schedule
+        int schedule_chunk_size
+        bint cost_ordering
+        ChemistryRules chemistry_rules
+        int top_k_precursors
+        CandidateRanking ranking
+        IsotopeScoring isotope_scoring
         Formula_cpp min_bounds
         Formula_cpp max_bounds
+        shared_ptr[const ElementTable] elements
 
     # Declarations for cleaning API (nested types in C++ are aliased here)
     cdef cppclass CleanSpectrumWithKnownPrecursor_cpp "MassDecomposer::CleanSpectrumWithKnownPrecursor":
         Formula_cpp precursor_formula
-        vector[double] fragment_masses
-        vector[double] fragment_intensities
+        DoubleSpan fragment_masses
+        DoubleSpan fragment_intensities
+        double precursor_mass
+        double max_allowed_normalized_mass_error_ppm
+
+    cdef cppclass CleanSpectrumWithCandidatePrecursors_cpp "MassDecomposer::CleanSpectrumWithCandidatePrecursors":
+        const int32_t* precursor_formulas
+        size_t n_precursor_formulas
+        DoubleSpan fragment_masses
+        DoubleSpan fragment_intensities
         double precursor_mass
         double max_allowed_normalized_mass_error_ppm
 
     cdef cppclass CleanedSpectrumResult_cpp "MassDecomposer::CleanedSpectrumResult":
         vector[double] masses
         vector[double] intensities
-        vector[vector[Formula_cpp]] fragment_formulas
+        vector[FormulaList] fragment_formulas
         vector[vector[double]] fragment_errors_ppm
 
     # New: result for single-formula-per-fragment, normalized masses
     cdef cppclass CleanedAndNormalizedSpectrumResult_cpp "MassDecomposer::CleanedAndNormalizedSpectrumResult":
         vector[double] masses_normalized
         vector[double] intensities
-        vector[Formula_cpp] fragment_formulas
+        FormulaList fragment_formulas
         vector[double] fragment_errors_ppm
 
+    cdef struct ResidueTableCacheStats:
+        long long hits
+        long long misses
+        long long evictions
+        long long entries
+        long long memory_bytes
+        long long capacity_bytes
+
+    ResidueTableCacheStats get_residue_table_cache_stats() nogil
+    void set_residue_table_cache_capacity(size_t) nogil
+    void clear_residue_table_cache() nogil
+    double estimate_decomposition_cost(double, const Formula_cpp&, const Formula_cpp&, const MassTolerance&, const ElementTable&) nogil
+    void filter_formulas_cpp "filter_formulas"(const int32_t*, size_t, const double*, size_t, const MassTolerance&, double, double, uint8_t*, const ElementTable&) nogil
+    size_t total_items(const vector[FormulaList]&) nogil
+    int64_t flatten_formula_rows(vector[FormulaList]&, int64_t, int64_t*, int32_t*, int, bint) nogil
+    int64_t flatten_rows[T](vector[vector[T]]&, int64_t, int64_t*, T*, bint) nogil
+
+    # All methods are nogil: the Python wrappers marshal inputs first, run the OpenMP
+    # computation with the GIL released, and only then build the Polars results.
     cdef cppclass MassDecomposer:
-        MassDecomposer(const Formula_cpp&, const Formula_cpp&)
-        vector[Formula_cpp] decompose(double, const DecompositionParams&)
         @staticmethod
-        vector[vector[Formula_cpp]] decompose_parallel(const vector[double]&, const DecompositionParams&)
+        vector[FormulaList] decompose_parallel(const vector[double]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[vector[Formula_cpp]] decompose_masses_parallel_per_bounds(const vector[double]&, const vector[pair[Formula_cpp, Formula_cpp]]&, const DecompositionParams&)
-        ProperSpectrumResults decompose_spectrum(double, const vector[double]&, const DecompositionParams&)
+        vector[FormulaList] decompose_masses_parallel_per_bounds(const vector[double]&, const vector[pair[Formula_cpp, Formula_cpp]]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[ProperSpectrumResults] decompose_spectra_parallel(const vector[Spectrum]&, const DecompositionParams&)
+        vector[FormulaList] decompose_masses_with_isotopes_parallel(const vector[MassWithIsotopes]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[ProperSpectrumResults] decompose_spectra_parallel_per_bounds(const vector[SpectrumWithBounds]&, const DecompositionParams&)
-        vector[vector[Formula_cpp]] decompose_spectrum_known_precursor(const Formula_cpp&, const vector[double]&, const DecompositionParams&)
+        vector[long long] count_parallel(const vector[double]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[vector[vector[Formula_cpp]]] decompose_spectra_known_precursor_parallel(const vector[SpectrumWithKnownPrecursor]&, const DecompositionParams&)
+        vector[long long] count_masses_parallel_per_bounds(const vector[double]&, const vector[pair[Formula_cpp, Formula_cpp]]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[CleanedSpectrumResult_cpp] clean_spectra_known_precursor_parallel(const vector[CleanSpectrumWithKnownPrecursor_cpp]&, const DecompositionParams&)
+        vector[ProperSpectrumResults] decompose_spectra_parallel(const vector[Spectrum]&, const DecompositionParams&) nogil
         @staticmethod
-        vector[CleanedAndNormalizedSpectrumResult_cpp] clean_and_normalize_spectra_known_precursor_parallel(const vector[CleanSpectrumWithKnownPrecursor_cpp]&, const DecompositionParams&)
+        vector[ProperSpectrumResults] decompose_spectra_parallel_per_bounds(const vector[SpectrumWithBounds]&, const DecompositionParams&) nogil
+        @staticmethod
+        vector[vector[FormulaList]] decompose_spectra_known_precursor_parallel(const vector[SpectrumWithKnownPrecursor]&, const DecompositionParams&) nogil
+        @staticmethod
+        vector[CleanedSpectrumResult_cpp] clean_spectra_known_precursor_parallel(const vector[CleanSpectrumWithKnownPrecursor_cpp]&, const DecompositionParams&) nogil
+        @staticmethod
+        vector[CleanedAndNormalizedSpectrumResult_cpp] clean_and_normalize_spectra_known_precursor_parallel(const vector[CleanSpectrumWithKnownPrecursor_cpp]&, const DecompositionParams&) nogil
+        @staticmethod
+        vector[CleanedAndNormalizedSpectrumResult_cpp] clean_and_normalize_spectra_candidate_precursors_parallel(const vector[CleanSpectrumWithCandidatePrecursors_cpp]&, const DecompositionParams&) nogil
 # Typedef for numpy arrays
 ctypedef np.int32_t F_DTYPE_t
 
 def get_num_elements():
-    return NUM_ELEMENTS
+    """Length of the registered element alphabet, 0 before _register_element_table."""
+    return deref(element_table()).num_elements
 
 # Helper functions for converting Python objects to C++ and vice-versa
 
-cdef Formula_cpp _convert_numpy_to_formula(np.ndarray arr):
-    """Convert a contiguous NumPy int32 array to a C++ Formula via memcpy."""
-    _validate_bounds_array(arr, "formula/bounds")
+cdef shared_ptr[const ElementTable] _registered_element_table() except *:
+    """
+    Snapshot of the registered alphabet. Every public function takes one and sizes its inputs,
+    params and outputs from it, so a concurrent _register_element_table cannot change the
+    formula width in the middle of a call.
+    """
+    cdef shared_ptr[const ElementTable] elements = element_table()
+    if deref(elements).num_elements == 0:
+        raise RuntimeError("No element table registered; call _register_element_table first "
+                           "(importing hrms_utils.formula_annotation.mass_decomposition does).")
+    return elements
+
+cdef Formula_cpp _convert_numpy_to_formula(np.ndarray arr, int n_elements):
+    """Convert a contiguous NumPy int32 array of n_elements counts to a C++ Formula via memcpy."""
+    _validate_bounds_array(arr, "formula/bounds", n_elements)
     # Ensure C-contiguous view; if not, make one-time contiguous copy (small).
     cdef np.ndarray contig = np.ascontiguousarray(arr, dtype=np.int32)
     cdef Formula_cpp formula
+    formula.fill(0)
     # Typed memoryview guarantees C-contiguous layout for memcpy
     cdef F_DTYPE_t[::1] mv = contig
-    cdef size_t nbytes = NUM_ELEMENTS * sizeof(F_DTYPE_t)
-    memcpy(<void*>&formula[0], <const void*>&mv[0], nbytes)
+    memcpy(<void*>formula.data(), <const void*>&mv[0], n_elements * sizeof(F_DTYPE_t))
     return formula
 
-# Module-level cached byte size for memcpy of a single Formula
-cdef size_t FORMULA_NBYTES_C = 0
-FORMULA_NBYTES_C = FORMULA_NBYTES()
-
-cdef np.ndarray _convert_formula_to_array(const Formula_cpp& cpp_formula):
-    """Convert C++ Formula to a NumPy array using a single memcpy."""
-    cdef np.ndarray arr = np.empty(NUM_ELEMENTS, dtype=np.int32)
-    cdef void* dst = <void*> np.PyArray_DATA(arr)
-    cdef const void* src = <const void*> formula_data_const(cpp_formula)
-    memcpy(dst, src, FORMULA_NBYTES_C)
-    return arr
-
-
-cdef void _validate_bounds_array(np.ndarray arr, str name):
+# Arrow result builders: offsets are int64 (large_list, Polars' native List layout) and values are
+# filled straight from the C++ vectors, so pa.array / pl.Series wrap the numpy buffers without copies.
+
+cdef object _large_list_array(np.ndarray offsets, object values):
+    """LargeListArray over values; offsets is int64 with one more entry than rows."""
+    return pa.LargeListArray.from_arrays(pa.array(offsets, type=pa.int64()), values)
+
+cdef object _formula_values_array(np.ndarray formulas):
+    """FixedSizeList(int32, n_elements) array over a C-contiguous (n, n_elements) int32 buffer."""
+    return pa.FixedSizeListArray.from_arrays(pa.array(formulas.reshape(-1), type=pa.int32()), formulas.shape[1])
+
+cdef object _formula_lists_array(vector[FormulaList]& rows, int n_elements):
+    """List(Array(Int32, n_elements)) Arrow array with one row per C++ row; rows are freed once copied."""
+    cdef np.ndarray offsets = np.empty(rows.size() + 1, dtype=np.int64)
+    cdef np.ndarray formulas = np.empty((total_items(rows), n_elements), dtype=np.int32)
+    cdef int64_t* offsets_ptr = <int64_t*> np.PyArray_DATA(offsets)
+    cdef int32_t* formulas_ptr = <int32_t*> np.PyArray_DATA(formulas)
+    with nogil:
+        flatten_formula_rows(rows, 0, offsets_ptr, formulas_ptr, n_elements, True)
+    return _large_list_array(offsets, _formula_values_array(formulas))
+
+cdef object _nested_formula_lists_array(vector[vector[FormulaList]]& nested, int n_elements):
+    """List(List(Array(Int32, n_elements))) Arrow array, e.g. [spectrum][fragment][formula]."""
+    cdef size_t n_outer = nested.size()
+    cdef size_t n_inner = 0
+    cdef size_t n_formulas = 0
+    cdef size_t i
+    for i in range(n_outer):
+        n_inner += nested[i].size()
+        n_formulas += total_items(nested[i])
+    cdef np.ndarray outer_offsets = np.empty(n_outer + 1, dtype=np.int64)
+    cdef np.ndarray inner_offsets = np.empty(n_inner + 1, dtype=np.int64)
+    cdef np.ndarray formulas = np.empty((n_formulas, n_elements), dtype=np.int32)
+    cdef int64_t* outer_ptr = <int64_t*> np.PyArray_DATA(outer_offsets)
+    cdef int64_t* inner_ptr = <int64_t*> np.PyArray_DATA(inner_offsets)
+    cdef int32_t* formulas_ptr = <int32_t*> np.PyArray_DATA(formulas)
+    cdef int64_t inner_row = 0
+    cdef int64_t formula_cursor = 0
+    with nogil:
+        outer_ptr[0] = 0
+        inner_ptr[0] = 0
+        for i in range(n_outer):
+            formula_cursor = flatten_formula_rows(nested[i], formula_cursor, inner_ptr + inner_row, formulas_ptr, n_elements, True)
+            inner_row += nested[i].size()
+            outer_ptr[i + 1] = inner_row
+    return _large_list_array(outer_offsets, _large_list_array(inner_offsets, _formula_values_array(formulas)))
+
+
+cdef void _validate_bounds_array(np.ndarray arr, str name, int n_elements) except *:
     if arr.ndim != 1:
         raise TypeError(f"{name} must be a 1D array")
-    if arr.shape[0] != NUM_ELEMENTS:
-        raise ValueError(f"{name} must have length {NUM_ELEMENTS}")
+    if arr.shape[0] != n_elements:
+        raise ValueError(f"{name} must have length {n_elements}")
     if arr.dtype != np.int32:
         raise TypeError(f"{name} must be of type numpy.int32")
 
+def _list_float64_buffers(series: pl.Series):
+    """
+    Read a List(Float64) Series straight from its Arrow buffers.
+    Returns (offsets, values): offsets is int64 with len(series) + 1 entries indexing into the
+    float64 values array, so row i is values[offsets[i]:offsets[i + 1]]. Both are zero-copy views
+    unless the column has null rows or null elements (null rows become empty, null elements NaN).
+    """
+    arr = series.rechunk().to_arrow()
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    if arr.null_count > 0:
+        # Offsets of null rows are unspecified in Arrow; rebuild them from the valid rows only.
+        lengths = np.asarray(pc.fill_null(pc.list_value_length(arr), 0), dtype=np.int64)
+        offsets = np.zeros(len(arr) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = arr.flatten()
+    else:
+        offsets = np.asarray(arr.offsets, dtype=np.int64)
+        values = arr.values
+    if values.null_count > 0:
+        values = pc.fill_null(values, float("nan"))
+    values = np.ascontiguousarray(values.to_numpy(zero_copy_only=False), dtype=np.float64)
+    return offsets, values
+
+# Must mirror the FragmentEngine enum in mass_decomposer_common.hpp
+FRAGMENT_ENGINES = {"money_changing": 0, "subformula_index": 1}
+
+def _list_formula_buffers(series: pl.Series, n_elements: int):
+    """
+    Read a List(Array(Int32, n_elements)) Series from its Arrow buffers.
+    Returns (offsets, formulas): offsets is int64 with len(series) + 1 entries, formulas a
+    C-contiguous (n_formulas, n_elements) int32 array, so row i is formulas[offsets[i]:offsets[i + 1]].
+    Null rows become empty.
+    """
+    arr = series.rechunk().to_arrow()
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    # Offsets of null rows are unspecified in Arrow; rebuild them from the row lengths.
+    lengths = np.asarray(pc.fill_null(pc.list_value_length(arr), 0), dtype=np.int64)
+    offsets = np.zeros(len(arr) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    formula_values = arr.flatten()
+    if getattr(formula_values.type, "list_size", n_elements) != n_elements:
+        raise ValueError(f"Formulas must have {n_elements} elements (got {formula_values.type.list_size}).")
+    values = formula_values.flatten()
+    formulas = np.ascontiguousarray(values.to_numpy(zero_copy_only=False), dtype=np.int32).reshape(-1, n_elements)
+    return offsets, formulas
+
+cdef int _fragment_engine_code(str fragment_engine):
+    if fragment_engine not in FRAGMENT_ENGINES:
+        raise ValueError(f"fragment_engine must be one of {list(FRAGMENT_ENGINES)}, got {fragment_engine!r}")
+    return FRAGMENT_ENGINES[fragment_engine]
+
+# Must mirror the ParallelSchedule enum in mass_decomposer_common.hpp (omp_sched_t values)
+PARALLEL_SCHEDULES = {"static": 1, "dynamic": 2, "guided": 3}
+
+cdef void _set_parallel_params(DecompositionParams* params, int n_threads, str schedule, int schedule_chunk_size, bint cost_ordering) except *:
+    """OpenMP team size (<= 0: OpenMP default), loop schedule, scheduling chunk size and whether items run in descending estimated cost."""
+    if schedule not in PARALLEL_SCHEDULES:
+        raise ValueError(f"schedule must be one of {list(PARALLEL_SCHEDULES)}, got {schedule!r}")
+    params.n_threads = n_threads
+    params.schedule = PARALLEL_SCHEDULES[schedule]
+    params.schedule_chunk_size = schedule_chunk_size
+    params.cost_ordering = cost_ordering
+
+cdef void _set_chemistry_rules(
+    DecompositionParams* params, object min_ratio_to_carbon, object max_ratio_to_carbon, bint senior_rules) except *:
+    """Element/carbon ratio bounds (one float64 per registered element, NaN disables an element) and Senior rules; all None/False disables the filter."""
+    cdef int n_elements = deref(params.elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] min_ratios = np.full(n_elements, np.nan) if min_ratio_to_carbon is None else np.ascontiguousarray(min_ratio_to_carbon, dtype=np.float64)
+    cdef np.ndarray[double, ndim=1, mode="c"] max_ratios = np.full(n_elements, np.nan) if max_ratio_to_carbon is None else np.ascontiguousarray(max_ratio_to_carbon, dtype=np.float64)
+    if min_ratios.shape[0] != n_elements or max_ratios.shape[0] != n_elements:
+        raise ValueError(f"Ratio arrays must have {n_elements} entries.")
+    cdef int e
+    params.chemistry_rules.enabled = min_ratio_to_carbon is not None or max_ratio_to_carbon is not None or senior_rules
+    params.chemistry_rules.senior_rules = senior_rules
+    for e in range(MAX_ELEMENTS):
+        # C++ disables a minimum at <= 0 and a maximum at < 0
+        params.chemistry_rules.min_ratio_to_carbon[e] = 0.0 if e >= n_elements or np.isnan(min_ratios[e]) else min_ratios[e]
+        params.chemistry_rules.max_ratio_to_carbon[e] = -1.0 if e >= n_elements or np.isnan(max_ratios[e]) else max_ratios[e]
+
+cdef void _set_ranking(DecompositionParams* params, int top_k, object element_penalty_ppm) except *:
+    """Top-k ranking of decompose()/count() results (top_k <= 0 disables); element_penalty_ppm has one float64 per registered element, or None."""
+    cdef int n_elements = deref(params.elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] penalties = np.zeros(n_elements) if element_penalty_ppm is None else np.ascontiguousarray(element_penalty_ppm, dtype=np.float64)
+    if penalties.shape[0] != n_elements:
+        raise ValueError(f"element_penalty_ppm must have {n_elements} entries.")
+    cdef int e
+    params.ranking.top_k = top_k
+    for e in range(MAX_ELEMENTS):
+        params.ranking.element_penalty_ppm[e] = penalties[e] if e < n_elements else 0.0
+
+cdef MassTolerance _mass_tolerance(double tolerance_ppm, object tolerance_model) except *:
+    """tolerance_ppm over max(mass, 200) when tolerance_model is None, else a (ppm, ppm_per_da, ppm_per_da_squared, ppm_floor_mass, absolute_floor_da) sequence."""
+    if tolerance_model is None:
+        return ppm_tolerance(tolerance_ppm)
+    if len(tolerance_model) != 5:
+        raise ValueError("tolerance_model must be (ppm, ppm_per_da, ppm_per_da_squared, ppm_floor_mass, absolute_floor_da).")
+    cdef MassTolerance tolerance
+    tolerance.ppm = tolerance_model[0]
+    tolerance.ppm_per_da = tolerance_model[1]
+    tolerance.ppm_per_da_squared = tolerance_model[2]
+    tolerance.ppm_floor_mass = tolerance_model[3]
+    tolerance.absolute_floor_da = tolerance_model[4]
+    return tolerance
+
+cdef void _set_tolerance(DecompositionParams* params, double tolerance_ppm, object tolerance_model) except *:
+    """Mass window of every decomposition, cleaning and filtering step; see _mass_tolerance."""
+    params.tolerance = _mass_tolerance(tolerance_ppm, tolerance_model)
+
+cdef void _set_isotope_scoring(
+    DecompositionParams* params, object isotope_ratios, object isotope_shift_windows,
+    object ms1_tolerance_model, object isotopic_tolerance_model, double minimum_intensity,
+    double intensity_absolute_tolerance, double intensity_relative_tolerance, double isotope_weight_ppm) except *:
+    """MS1 isotope envelope scoring; isotope_ratios is (n_elements, 2) float64 (M+1, M+2 heavy/light ratio per registered element), isotope_shift_windows (2, 2) [min, max] m/z shift of M+1 and M+2, None disables."""
+    params.isotope_scoring.enabled = isotope_ratios is not None
+    if isotope_ratios is None:
+        return
+    cdef int n_elements = deref(params.elements).num_elements
+    cdef np.ndarray[double, ndim=2, mode="c"] ratios = np.ascontiguousarray(isotope_ratios, dtype=np.float64)
+    cdef np.ndarray[double, ndim=2, mode="c"] windows = np.ascontiguousarray(isotope_shift_windows, dtype=np.float64)
+    if ratios.shape[0] != n_elements or ratios.shape[1] != 2:
+        raise ValueError(f"isotope_ratios must have shape ({n_elements}, 2).")
+    if windows.shape[0] != 2 or windows.shape[1] != 2:
+        raise ValueError("isotope_shift_windows must have shape (2, 2).")
+    cdef int e, k
+    for k in range(2):
+        params.isotope_scoring.shift_min[k] = windows[k, 0]
+        params.isotope_scoring.shift_max[k] = windows[k, 1]
+        for e in range(MAX_ELEMENTS):
+            params.isotope_scoring.element_ratio[k][e] = ratios[e, k] if e < n_elements else 0.0
+    params.isotope_scoring.ms1_tolerance = _mass_tolerance(5.0, ms1_tolerance_model)
+    params.isotope_scoring.isotopic_tolerance = _mass_tolerance(3.0, isotopic_tolerance_model)
+    params.isotope_scoring.minimum_intensity = minimum_intensity
+    params.isotope_scoring.intensity_absolute_tolerance = intensity_absolute_tolerance
+    params.isotope_scoring.intensity_relative_tolerance = intensity_relative_tolerance
+    params.isotope_scoring.weight_ppm = isotope_weight_ppm
+
 cdef DecompositionParams _convert_params(
+    shared_ptr[const ElementTable] elements,
     double tolerance_ppm, double min_dbe, double max_dbe,
     # double max_hetero_ratio,
     int max_results,
-    np.ndarray min_bounds, np.ndarray max_bounds):
-    """Convert Python parameters to C++ DecompositionParams."""
-    _validate_bounds_array(min_bounds, "min_bounds")
-    _validate_bounds_array(max_bounds, "max_bounds")
+    np.ndarray min_bounds, np.ndarray max_bounds,
+    bint dbe_pruning=True,
+    str fragment_engine="money_changing",
+    long long max_subformula_lattice_size=2_000_000):
+    """Convert Python parameters to C++ DecompositionParams over the element table snapshot elements."""
+    cdef int n_elements = deref(elements).num_elements
+    _validate_bounds_array(min_bounds, "min_bounds", n_elements)
+    _validate_bounds_array(max_bounds, "max_bounds", n_elements)
     
     cdef DecompositionParams params
-    params.tolerance_ppm = tolerance_ppm
+    params.elements = elements
+    _set_tolerance(&params, tolerance_ppm, None)
     params.min_dbe = min_dbe
     params.max_dbe = max_dbe
     # params.max_hetero_ratio = max_hetero_ratio
     params.max_results = max_results
-    params.min_bounds = _convert_numpy_to_formula(min_bounds)
-    params.max_bounds = _convert_numpy_to_formula(max_bounds)
+    params.dbe_pruning = dbe_pruning
+    params.fragment_engine = _fragment_engine_code(fragment_engine)
+    params.max_subformula_lattice_size = max_subformula_lattice_size
+    _set_parallel_params(&params, 0, "dynamic", 1, True)
+    _set_chemistry_rules(&params, None, None, False)
+    params.top_k_precursors = 0
+    _set_ranking(&params, 0, None)
+    _set_isotope_scoring(&params, None, None, None, None, 0.0, 0.0, 0.0, 0.0)
+    params.min_bounds = _convert_numpy_to_formula(min_bounds, n_elements)
+    params.max_bounds = _convert_numpy_to_formula(max_bounds, n_elements)
     return params
 
 # Public Python functions
 
+def residue_table_cache_stats() -> dict:
+    """Hit/miss/eviction counters and memory usage of the process-wide ERT cache."""
+    cdef ResidueTableCacheStats stats = get_residue_table_cache_stats()
+    return {
+        'hits': stats.hits,
+        'misses': stats.misses,
+        'evictions': stats.evictions,
+        'entries': stats.entries,
+        'memory_bytes': stats.memory_bytes,
+        'capacity_bytes': stats.capacity_bytes,
+    }
+
+def set_residue_table_cache_capacity_bytes(capacity_bytes: int) -> None:
+    """Set the ERT cache memory cap; least recently used tables are evicted immediately if over it."""
+    set_residue_table_cache_capacity(<size_t>capacity_bytes)
+
+def clear_residue_table_cache_tables() -> None:
+    """Drop all cached ERTs and reset the counters."""
+    clear_residue_table_cache()
+
 def get_element_info() -> dict:
-    """Returns a dictionary with element information."""
+    """Returns a dictionary with the element alphabet currently used by the C++ code."""
+    cdef shared_ptr[const ElementTable] elements = element_table()
+    cdef int n_elements = deref(elements).num_elements
     return {
-        # Iterate C arrays by index
-        'order': [ELEMENT_SYMBOLS[i].decode('utf-8') for i in range(NUM_ELEMENTS)],
-        'masses': [ATOMIC_MASSES[i] for i in range(NUM_ELEMENTS)],
-        'count': NUM_ELEMENTS
+        'order': [deref(elements).symbols[i].decode('utf-8') for i in range(n_elements)],
+        'masses': [deref(elements).masses[i] for i in range(n_elements)],
+        'twice_dbe_coefficients': [deref(elements).twice_dbe_coefficients[i] for i in range(n_elements)],
+        'valences': [deref(elements).valences[i] for i in range(n_elements)],
+        'count': n_elements
     }
 
+def _register_element_table(symbols, masses, twice_dbe_coefficients, valences) -> None:
+    """
+    Set the element alphabet: one entry per formula slot, up to MAX_ELEMENTS (32) elements. Calls
+    already running keep the table they started with; later calls use the new one. Clears the
+    residue table cache.
+
+    Private: mass_decomposition registers element_table.ELEMENTS once at import, and its wrappers
+    size their arrays from that module. To change the alphabet, edit element_table.ELEMENTS
+    before importing hrms_utils.formula_annotation.
+    """
+    cdef vector[string] symbols_vec = [symbol.encode('utf-8') for symbol in symbols]
+    register_element_table_cpp(symbols_vec, [float(mass) for mass in masses],
+                               [int(c) for c in twice_dbe_coefficients], [int(v) for v in valences])
+
 
 
 def decompose_mass_parallel(
     target_masses: pl.Series, # 1D array of target masses
-    min_bounds: np.ndarray, # 1D array of min bounds (shape must match NUM_ELEMENTS)
-    max_bounds: np.ndarray, # 1D array of max bounds (shape must match NUM_ELEMENTS)
+    min_bounds: np.ndarray, # 1D array of min bounds (shape must match n_elements)
+    max_bounds: np.ndarray, # 1D array of max bounds (shape must match n_elements)
     tolerance_ppm: float = 5.0,
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,
     max_hetero_ratio: float = 100.0,
-    max_results: int = 100000
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    min_ratio_to_carbon: np.ndarray | None = None,
+    max_ratio_to_carbon: np.ndarray | None = None,
+    senior_rules: bool = False,
+    top_k: int = 0,
+    element_penalty_ppm: np.ndarray | None = None,
+    tolerance_model: tuple | None = None,
 ) -> pl.Series:
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
     target_masses = target_masses.to_numpy()
 
     cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses, dtype=np.float64)
@@ -200,70 +558,69 @@ def decompose_mass_parallel(
     cdef vector[double] masses_vec
     masses_vec.assign(masses_ptr, masses_ptr + n_masses)
 
-    cdef DecompositionParams params = _convert_params(tolerance_ppm, min_dbe, max_dbe, max_results,min_bounds, max_bounds)
-    cdef vector[vector[Formula_cpp]] all_results
-    
-    all_results = MassDecomposer.decompose_parallel(masses_vec, params)
-    
-    cdef size_t num_masses = all_results.size()
-    cdef size_t total_formulas = 0
-    cdef size_t i, j, k
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe, max_results,min_bounds, max_bounds, dbe_pruning)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    _set_chemistry_rules(&params, min_ratio_to_carbon, max_ratio_to_carbon, senior_rules)
+    _set_ranking(&params, top_k, element_penalty_ppm)
+    cdef vector[FormulaList] all_results
     
-    # First pass: calculate total number of formulas to pre-allocate memory
-    for i in range(num_masses):
-        total_formulas += all_results[i].size()
-        
-    # Allocate flat numpy arrays for offsets and the flattened formula data
-    
-    cdef np.ndarray offsets_array = np.empty(num_masses + 1, dtype=np.int32)
-    cdef np.int32_t[::1] offsets_view = offsets_array  # define view for writing offsets
-    cdef np.ndarray flat_formulas_array = np.empty(total_formulas * NUM_ELEMENTS, dtype=np.int32)
-
-    # Use raw pointer + memcpy per formula (faster than k-loop)
-    cdef F_DTYPE_t* dst_base = <F_DTYPE_t*> np.PyArray_DATA(flat_formulas_array)
-    cdef size_t current_offset = 0
-    cdef size_t formula_idx = 0
-    cdef size_t num_formulas_for_mass
-
-    for i in range(num_masses):
-        offsets_view[i] = current_offset
-        num_formulas_for_mass = all_results[i].size()
-        for j in range(num_formulas_for_mass):
-            memcpy(
-                <void*> (dst_base + formula_idx * NUM_ELEMENTS),
-                <const void*> formula_data_const(all_results[i][j]),
-                FORMULA_NBYTES_C
-            )
-            formula_idx += 1
-        current_offset += num_formulas_for_mass
-
-    offsets_view[num_masses] = total_formulas
-    
-    # Create Arrow arrays from the numpy arrays (zero-copy).
-    # These are Python objects, so we don't use cdef.
-    value_array = pa.array(flat_formulas_array, type=pa.int32())
-    offset_array = pa.array(offsets_array, type=pa.int32())
-    
-    # Build the nested array structure
-    # 1. Innermost array: FixedSizeList for each formula
-    formula_list_array = pa.FixedSizeListArray.from_arrays(value_array, NUM_ELEMENTS)
-    # 2. Outermost array: ListArray for the list of formulas per mass
-    final_array = pa.ListArray.from_arrays(offset_array, formula_list_array)
+    with nogil:
+        all_results = MassDecomposer.decompose_parallel(masses_vec, params)
     
     return pl.from_arrow(
-        data=final_array,
-        schema={"decomposed_formula":pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))})
+        data=_formula_lists_array(all_results, n_elements),
+        schema={"decomposed_formula":pl.List(pl.Array(pl.Int32, n_elements))})
+
+cdef vector[pair[Formula_cpp, Formula_cpp]] _per_mass_bounds_vector(
+    np.ndarray[np.int32_t, ndim=2, mode="c"] contig_min_bounds,
+    np.ndarray[np.int32_t, ndim=2, mode="c"] contig_max_bounds,
+    int n_elements):
+    """Pack (n, n_elements) min/max bound rows into the C++ per-mass bounds vector."""
+    cdef size_t n_masses = contig_min_bounds.shape[0]
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec
+    bounds_vec.reserve(n_masses)
+    if n_masses == 0:
+        return bounds_vec
+
+    cdef np.int32_t* min_bounds_ptr = &contig_min_bounds[0, 0]
+    cdef np.int32_t* max_bounds_ptr = &contig_max_bounds[0, 0]
+    cdef size_t i
+    cdef Formula_cpp min_f, max_f
+    cdef size_t formula_size_bytes = n_elements * sizeof(F_DTYPE_t)
+    # Slots past the registered alphabet stay zero.
+    min_f.fill(0)
+    max_f.fill(0)
+
+    for i in range(n_masses):
+        memcpy(<void*>min_f.data(), min_bounds_ptr + i * n_elements, formula_size_bytes)
+        memcpy(<void*>max_f.data(), max_bounds_ptr + i * n_elements, formula_size_bytes)
+        bounds_vec.push_back(pair[Formula_cpp, Formula_cpp](min_f, max_f))
+    return bounds_vec
 
 def decompose_mass_parallel_per_bounds(
     target_masses: pl.Series, # 1D array of target masses
-    min_bounds_per_mass: pl.Series, # series of 1D arrays of min bounds, each with shape (NUM_ELEMENTS,)
-    max_bounds_per_mass: pl.Series, #   series of 1D arrays of max bounds, each with shape (NUM_ELEMENTS,)
+    min_bounds_per_mass: pl.Series, # series of 1D arrays of min bounds, each with shape (n_elements,)
+    max_bounds_per_mass: pl.Series, #   series of 1D arrays of max bounds, each with shape (n_elements,)
     tolerance_ppm: float = 5.0,
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,
     max_hetero_ratio: float = 100.0,
-    max_results: int = 100000
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    min_ratio_to_carbon: np.ndarray | None = None,
+    max_ratio_to_carbon: np.ndarray | None = None,
+    senior_rules: bool = False,
+    top_k: int = 0,
+    element_penalty_ppm: np.ndarray | None = None,
+    tolerance_model: tuple | None = None,
 ) -> pl.Series:
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
 
     # target_masses = target_masses.to_numpy()
     # min_bounds_per_mass = min_bounds_per_mass.to_numpy()
@@ -277,208 +634,520 @@ def decompose_mass_parallel_per_bounds(
     if n_masses == 0:
         # Returning an empty series is more consistent than raising an error
         # for an empty input, matching the behavior of other functions.
-        return pl.Series("decomposed_formula", [], dtype=pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)))
+        return pl.Series("decomposed_formula", [], dtype=pl.List(pl.Array(pl.Int32, n_elements)))
     if contig_min_bounds.shape[0] != n_masses or contig_max_bounds.shape[0] != n_masses:
         raise ValueError("Number of rows in min_bounds_per_mass and max_bounds_per_mass must match the number of target masses.")
-    if contig_min_bounds.shape[1] != NUM_ELEMENTS or contig_max_bounds.shape[1] != NUM_ELEMENTS:
-        raise ValueError(f"Number of columns in bounds arrays must be {NUM_ELEMENTS}.")
+    if contig_min_bounds.shape[1] != n_elements or contig_max_bounds.shape[1] != n_elements:
+        raise ValueError(f"Number of columns in bounds arrays must be {n_elements}.")
 
         # Create a dummy params object; min/max_bounds are ignored by the C++ function
-    cdef np.ndarray dummy_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
-    cdef DecompositionParams params = _convert_params(tolerance_ppm, min_dbe, max_dbe,
+    cdef np.ndarray dummy_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe,
                                                      max_results,
-                                                     dummy_bounds, dummy_bounds)
+                                                     dummy_bounds, dummy_bounds, dbe_pruning)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    _set_chemistry_rules(&params, min_ratio_to_carbon, max_ratio_to_carbon, senior_rules)
+    _set_ranking(&params, top_k, element_penalty_ppm)
     
     # Efficiently populate C++ vectors from numpy arrays
     cdef vector[double] masses_vec
     cdef double* masses_ptr = &contig_masses[0]
     masses_vec.assign(masses_ptr, masses_ptr + n_masses)
 
-    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec
-    bounds_vec.reserve(n_masses)
-
-    cdef np.int32_t* min_bounds_ptr = &contig_min_bounds[0, 0]
-    cdef np.int32_t* max_bounds_ptr = &contig_max_bounds[0, 0]
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec = _per_mass_bounds_vector(contig_min_bounds, contig_max_bounds, n_elements)
     cdef size_t i
-    cdef Formula_cpp min_f, max_f
-    cdef size_t formula_size_bytes = NUM_ELEMENTS * sizeof(F_DTYPE_t)
-
-    for i in range(n_masses):
-        memcpy(<void*>&min_f[0], min_bounds_ptr + i * NUM_ELEMENTS, formula_size_bytes)
-        memcpy(<void*>&max_f[0], max_bounds_ptr + i * NUM_ELEMENTS, formula_size_bytes)
-        bounds_vec.push_back(pair[Formula_cpp, Formula_cpp](min_f, max_f))
 
-    cdef vector[vector[Formula_cpp]] all_results
-    all_results = MassDecomposer.decompose_masses_parallel_per_bounds(masses_vec, bounds_vec, params)
+    cdef vector[FormulaList] all_results
+    with nogil:
+        all_results = MassDecomposer.decompose_masses_parallel_per_bounds(masses_vec, bounds_vec, params)
 
-    cdef size_t num_masses = all_results.size()
-    cdef size_t total_formulas = 0
-    cdef size_t k
+    return pl.from_arrow(
+        data=_formula_lists_array(all_results, n_elements),
+        schema={"decomposed_formula": pl.List(pl.Array(pl.Int32, n_elements))})
+
+def decompose_mass_with_isotopes_parallel(
+    target_masses: pl.Series,           # Float64 neutral mass per feature
+    precursor_mzs: pl.Series,           # Float64 m/z of the monoisotopic peak per feature
+    ms1_mzs_series: pl.Series,          # list[float] MS1 peaks per feature
+    ms1_intensities_series: pl.Series,  # list[float] aligned with ms1_mzs_series
+    min_bounds_per_mass: pl.Series,     # pl.Array(int32, n_elements) per feature
+    max_bounds_per_mass: pl.Series,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    min_ratio_to_carbon: np.ndarray | None = None,
+    max_ratio_to_carbon: np.ndarray | None = None,
+    senior_rules: bool = False,
+    top_k: int = 0,
+    element_penalty_ppm: np.ndarray | None = None,
+    tolerance_model: tuple | None = None,
+    isotope_ratios: np.ndarray | None = None,
+    isotope_shift_windows: np.ndarray | None = None,
+    ms1_tolerance_model: tuple | None = None,
+    isotopic_tolerance_model: tuple | None = None,
+    minimum_intensity: float = 5e4,
+    intensity_absolute_tolerance: float = 5e4,
+    intensity_relative_tolerance: float = 0.05,
+    isotope_weight_ppm: float = 1.0,
+) -> pl.Series:
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses.to_numpy(), dtype=np.float64)
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_mzs = np.ascontiguousarray(precursor_mzs.to_numpy(), dtype=np.float64)
+    cdef size_t n = contig_masses.shape[0]
+    cdef vector[FormulaList] all_results
+    if n == 0:
+        return pl.Series("decomposed_formula", [], dtype=pl.List(pl.Array(pl.Int32, n_elements)))
+    if contig_mzs.shape[0] != n or ms1_mzs_series.len() != n or ms1_intensities_series.len() != n:
+        raise ValueError("precursor_mzs and the MS1 peak lists must have one row per target mass.")
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_min_bounds = np.ascontiguousarray(min_bounds_per_mass.to_numpy(), dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_max_bounds = np.ascontiguousarray(max_bounds_per_mass.to_numpy(), dtype=np.int32)
+    if contig_min_bounds.shape[0] != n or contig_max_bounds.shape[0] != n:
+        raise ValueError("Number of rows in min_bounds_per_mass and max_bounds_per_mass must match the number of target masses.")
+    if contig_min_bounds.shape[1] != n_elements or contig_max_bounds.shape[1] != n_elements:
+        raise ValueError(f"Number of columns in bounds arrays must be {n_elements}.")
+    mz_offsets_arr, mz_values_arr = _list_float64_buffers(ms1_mzs_series)
+    inten_offsets_arr, inten_values_arr = _list_float64_buffers(ms1_intensities_series)
+    if not np.array_equal(np.diff(mz_offsets_arr), np.diff(inten_offsets_arr)):
+        raise ValueError("Each MS1 spectrum needs one intensity per m/z.")
+
+    cdef np.ndarray dummy_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe,
+                                                     max_results,
+                                                     dummy_bounds, dummy_bounds, dbe_pruning)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    _set_chemistry_rules(&params, min_ratio_to_carbon, max_ratio_to_carbon, senior_rules)
+    _set_ranking(&params, top_k, element_penalty_ppm)
+    _set_isotope_scoring(&params, isotope_ratios, isotope_shift_windows, ms1_tolerance_model, isotopic_tolerance_model,
+                         minimum_intensity, intensity_absolute_tolerance, intensity_relative_tolerance, isotope_weight_ppm)
+
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec = _per_mass_bounds_vector(contig_min_bounds, contig_max_bounds, n_elements)
+    cdef const np.int64_t[::1] mz_offsets = mz_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const double* mz_values = <const double*> np.PyArray_DATA(mz_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
+    cdef vector[MassWithIsotopes] features_vec
+    features_vec.reserve(n)
+    cdef MassWithIsotopes feature
+    cdef size_t i
+    for i in range(n):
+        feature.target_mass = contig_masses[i]
+        feature.precursor_mz = contig_mzs[i]
+        feature.ms1_mzs = DoubleSpan(mz_values + mz_offsets[i], <size_t>(mz_offsets[i + 1] - mz_offsets[i]))
+        feature.ms1_intensities = DoubleSpan(inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
+        feature.min_bounds = bounds_vec[i].first
+        feature.max_bounds = bounds_vec[i].second
+        features_vec.push_back(feature)
 
-    for i in range(num_masses):
-        total_formulas += all_results[i].size()
+    with nogil:
+        all_results = MassDecomposer.decompose_masses_with_isotopes_parallel(features_vec, params)
 
-    cdef np.ndarray offsets_array = np.empty(num_masses + 1, dtype=np.int32)
-    cdef np.int32_t[::1] offsets_view = offsets_array  # define view for writing offsets
-    cdef np.ndarray flat_formulas_array = np.empty(total_formulas * NUM_ELEMENTS, dtype=np.int32)
+    return pl.from_arrow(
+        data=_formula_lists_array(all_results, n_elements),
+        schema={"decomposed_formula": pl.List(pl.Array(pl.Int32, n_elements))})
 
-    cdef F_DTYPE_t* dst_base = <F_DTYPE_t*> np.PyArray_DATA(flat_formulas_array)
-    cdef size_t current_offset = 0
-    cdef size_t formula_idx = 0
-    cdef size_t num_formulas_for_mass
+def count_mass_parallel(
+    target_masses: pl.Series,
+    min_bounds: np.ndarray,
+    max_bounds: np.ndarray,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    min_ratio_to_carbon: np.ndarray | None = None,
+    max_ratio_to_carbon: np.ndarray | None = None,
+    senior_rules: bool = False,
+    top_k: int = 0,
+    element_penalty_ppm: np.ndarray | None = None,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    """Number of formulas decompose_mass_parallel would return per mass, without materializing them."""
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses.to_numpy(), dtype=np.float64)
+    cdef size_t n_masses = contig_masses.shape[0]
+    cdef vector[double] masses_vec
+    if n_masses > 0:
+        masses_vec.assign(&contig_masses[0], &contig_masses[0] + n_masses)
+
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe, max_results, min_bounds, max_bounds, dbe_pruning)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    _set_chemistry_rules(&params, min_ratio_to_carbon, max_ratio_to_carbon, senior_rules)
+    _set_ranking(&params, top_k, element_penalty_ppm)
+    cdef vector[long long] counts
+    with nogil:
+        counts = MassDecomposer.count_parallel(masses_vec, params)
+
+    return pl.Series("candidate_count", np.array(<long long[:n_masses]> counts.data(), dtype=np.int64, copy=True) if n_masses > 0 else [], dtype=pl.Int64)
+
+def count_mass_parallel_per_bounds(
+    target_masses: pl.Series,
+    min_bounds_per_mass: pl.Series,
+    max_bounds_per_mass: pl.Series,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    max_results: int = 100000,
+    dbe_pruning: bool = True,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    min_ratio_to_carbon: np.ndarray | None = None,
+    max_ratio_to_carbon: np.ndarray | None = None,
+    senior_rules: bool = False,
+    top_k: int = 0,
+    element_penalty_ppm: np.ndarray | None = None,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    """Number of formulas decompose_mass_parallel_per_bounds would return per mass, without materializing them."""
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses.to_numpy(), dtype=np.float64)
+    cdef size_t n_masses = contig_masses.shape[0]
+    if n_masses == 0:
+        return pl.Series("candidate_count", [], dtype=pl.Int64)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_min_bounds = np.ascontiguousarray(min_bounds_per_mass.to_numpy(), dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_max_bounds = np.ascontiguousarray(max_bounds_per_mass.to_numpy(), dtype=np.int32)
+    if contig_min_bounds.shape[0] != n_masses or contig_max_bounds.shape[0] != n_masses:
+        raise ValueError("Number of rows in min_bounds_per_mass and max_bounds_per_mass must match the number of target masses.")
+    if contig_min_bounds.shape[1] != n_elements or contig_max_bounds.shape[1] != n_elements:
+        raise ValueError(f"Number of columns in bounds arrays must be {n_elements}.")
+
+    cdef np.ndarray dummy_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe, max_results, dummy_bounds, dummy_bounds, dbe_pruning)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    _set_chemistry_rules(&params, min_ratio_to_carbon, max_ratio_to_carbon, senior_rules)
+    _set_ranking(&params, top_k, element_penalty_ppm)
+    cdef vector[double] masses_vec
+    masses_vec.assign(&contig_masses[0], &contig_masses[0] + n_masses)
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec = _per_mass_bounds_vector(contig_min_bounds, contig_max_bounds, n_elements)
 
-    for i in range(num_masses):
-        offsets_view[i] = current_offset
-        num_formulas_for_mass = all_results[i].size()
-        for j in range(num_formulas_for_mass):
-            memcpy(
-                <void*> (dst_base + formula_idx * NUM_ELEMENTS),
-                <const void*> formula_data_const(all_results[i][j]),
-                FORMULA_NBYTES_C
-            )
-            formula_idx += 1
-        current_offset += num_formulas_for_mass
+    cdef vector[long long] counts
+    with nogil:
+        counts = MassDecomposer.count_masses_parallel_per_bounds(masses_vec, bounds_vec, params)
 
-    offsets_view[num_masses] = total_formulas
+    return pl.Series("candidate_count", np.array(<long long[:n_masses]> counts.data(), dtype=np.int64, copy=True), dtype=pl.Int64)
 
-    value_array = pa.array(flat_formulas_array, type=pa.int32())
-    offset_array = pa.array(offsets_array, type=pa.int32())
+def estimate_decomposition_cost_parallel(
+    target_masses: pl.Series,
+    min_bounds_per_mass: np.ndarray,
+    max_bounds_per_mass: np.ndarray,
+    tolerance_ppm: float = 5.0,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    """Relative decomposition cost per mass; bounds are (n_masses, n_elements) int32 arrays."""
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses.to_numpy(), dtype=np.float64)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_min_bounds = np.ascontiguousarray(min_bounds_per_mass, dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_max_bounds = np.ascontiguousarray(max_bounds_per_mass, dtype=np.int32)
+    cdef size_t n_masses = contig_masses.shape[0]
+    if <size_t> contig_min_bounds.shape[0] != n_masses or <size_t> contig_max_bounds.shape[0] != n_masses:
+        raise ValueError("Number of rows in min_bounds_per_mass and max_bounds_per_mass must match the number of target masses.")
+    if contig_min_bounds.shape[1] != n_elements or contig_max_bounds.shape[1] != n_elements:
+        raise ValueError(f"Number of columns in bounds arrays must be {n_elements}.")
 
-    formula_list_array = pa.FixedSizeListArray.from_arrays(value_array, NUM_ELEMENTS)
-    final_array = pa.ListArray.from_arrays(offset_array, formula_list_array)
+    cdef np.ndarray[double, ndim=1, mode="c"] costs = np.empty(n_masses, dtype=np.float64)
+    if n_masses == 0:
+        return pl.Series("estimated_cost", costs, dtype=pl.Float64)
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec = _per_mass_bounds_vector(contig_min_bounds, contig_max_bounds, n_elements)
+    cdef double* masses_ptr = &contig_masses[0]
+    cdef double* costs_ptr = &costs[0]
+    cdef MassTolerance tolerance = _mass_tolerance(tolerance_ppm, tolerance_model)
+    cdef const ElementTable* table = elements.get()
+    cdef size_t i
+    with nogil:
+        for i in range(n_masses):
+            costs_ptr[i] = estimate_decomposition_cost(masses_ptr[i], bounds_vec[i].first, bounds_vec[i].second, tolerance, deref(table))
+    return pl.Series("estimated_cost", costs, dtype=pl.Float64)
+
+def filter_formulas_parallel(
+    formulas: np.ndarray,
+    target_masses: np.ndarray,
+    tolerance_ppm: float = 5.0,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    tolerance_model: tuple | None = None,
+) -> np.ndarray:
+    """Boolean mask over (n, n_elements) int32 formulas: exact mass within tolerance of the row's target and DBE accepted."""
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_formulas = np.ascontiguousarray(formulas, dtype=np.int32)
+    cdef np.ndarray[double, ndim=1, mode="c"] contig_masses = np.ascontiguousarray(target_masses, dtype=np.float64)
+    cdef size_t n_formulas = contig_formulas.shape[0]
+    if contig_formulas.shape[1] != n_elements:
+        raise ValueError(f"formulas must have {n_elements} columns.")
+    if <size_t> contig_masses.shape[0] != n_formulas:
+        raise ValueError("target_masses must have one mass per formula.")
+    cdef np.ndarray[np.uint8_t, ndim=1, mode="c"] keep = np.zeros(n_formulas, dtype=np.uint8)
+    if n_formulas == 0:
+        return keep.view(np.bool_)
+    cdef const int32_t* formulas_ptr = <const int32_t*> np.PyArray_DATA(contig_formulas)
+    cdef double* masses_ptr = &contig_masses[0]
+    cdef uint8_t* keep_ptr = &keep[0]
+    cdef MassTolerance tolerance = _mass_tolerance(tolerance_ppm, tolerance_model)
+    cdef double lower_dbe = min_dbe, upper_dbe = max_dbe
+    cdef const ElementTable* table = elements.get()
+    with nogil:
+        filter_formulas_cpp(formulas_ptr, n_elements, masses_ptr, n_formulas, tolerance, lower_dbe, upper_dbe, keep_ptr, deref(table))
+    return keep.view(np.bool_)
+
+cdef object _spectrum_decompositions_series(vector[ProperSpectrumResults]& all_results, int n_elements):
+    """
+    List(Struct) Series with one row per spectrum and one struct per precursor explanation:
+    precursor, precursor_mass, precursor_error_ppm, explained_intensity, and the per-fragment
+    formulas, masses and errors.
+    """
+    cdef size_t si, di, nf
+    cdef size_t n_specs = all_results.size()
+    cdef size_t n_decompositions = 0
+    cdef size_t n_fragments = 0
+    cdef size_t n_formulas = 0
+    for si in range(n_specs):
+        n_decompositions += all_results[si].decompositions.size()
+        for di in range(all_results[si].decompositions.size()):
+            n_fragments += all_results[si].decompositions[di].fragments.size()
+            n_formulas += total_items(all_results[si].decompositions[di].fragments)
+
+    cdef np.ndarray spec_offsets = np.empty(n_specs + 1, dtype=np.int64)
+    cdef np.ndarray decomposition_offsets = np.empty(n_decompositions + 1, dtype=np.int64)
+    cdef np.ndarray fragment_offsets = np.empty(n_fragments + 1, dtype=np.int64)
+    cdef np.ndarray precursors = np.empty((n_decompositions, n_elements), dtype=np.int32)
+    cdef np.ndarray precursor_masses = np.empty(n_decompositions, dtype=np.float64)
+    cdef np.ndarray precursor_errors = np.empty(n_decompositions, dtype=np.float64)
+    cdef np.ndarray explained_intensities = np.empty(n_decompositions, dtype=np.float64)
+    cdef np.ndarray fragment_formulas = np.empty((n_formulas, n_elements), dtype=np.int32)
+    cdef np.ndarray fragment_masses = np.empty(n_formulas, dtype=np.float64)
+    cdef np.ndarray fragment_errors = np.empty(n_formulas, dtype=np.float64)
+    cdef int64_t* spec_offsets_ptr = <int64_t*> np.PyArray_DATA(spec_offsets)
+    cdef int64_t* decomposition_offsets_ptr = <int64_t*> np.PyArray_DATA(decomposition_offsets)
+    cdef int64_t* fragment_offsets_ptr = <int64_t*> np.PyArray_DATA(fragment_offsets)
+    cdef int32_t* precursors_ptr = <int32_t*> np.PyArray_DATA(precursors)
+    cdef double* precursor_masses_ptr = <double*> np.PyArray_DATA(precursor_masses)
+    cdef double* precursor_errors_ptr = <double*> np.PyArray_DATA(precursor_errors)
+    cdef double* explained_intensities_ptr = <double*> np.PyArray_DATA(explained_intensities)
+    cdef int32_t* fragment_formulas_ptr = <int32_t*> np.PyArray_DATA(fragment_formulas)
+    cdef double* fragment_masses_ptr = <double*> np.PyArray_DATA(fragment_masses)
+    cdef double* fragment_errors_ptr = <double*> np.PyArray_DATA(fragment_errors)
+
+    cdef size_t decomposition_cursor = 0
+    cdef size_t fragment_cursor = 0
+    cdef int64_t formula_cursor = 0
+    with nogil:
+        spec_offsets_ptr[0] = 0
+        decomposition_offsets_ptr[0] = 0
+        fragment_offsets_ptr[0] = 0
+        for si in range(n_specs):
+            for di in range(all_results[si].decompositions.size()):
+                memcpy(<void*>(precursors_ptr + decomposition_cursor * n_elements),
+                       <const void*> all_results[si].decompositions[di].precursor.data(), n_elements * sizeof(int32_t))
+                precursor_masses_ptr[decomposition_cursor] = all_results[si].decompositions[di].precursor_mass
+                precursor_errors_ptr[decomposition_cursor] = all_results[si].decompositions[di].precursor_error_ppm
+                explained_intensities_ptr[decomposition_cursor] = all_results[si].decompositions[di].explained_intensity
+                flatten_formula_rows(all_results[si].decompositions[di].fragments, formula_cursor,
+                                     fragment_offsets_ptr + fragment_cursor, fragment_formulas_ptr, n_elements, True)
+                flatten_rows[double](all_results[si].decompositions[di].fragment_masses, formula_cursor,
+                                     fragment_offsets_ptr + fragment_cursor, fragment_masses_ptr, True)
+                formula_cursor = flatten_rows[double](all_results[si].decompositions[di].fragment_errors_ppm, formula_cursor,
+                                                      fragment_offsets_ptr + fragment_cursor, fragment_errors_ptr, True)
+                nf = all_results[si].decompositions[di].fragments.size()
+                fragment_cursor += nf
+                decomposition_cursor += 1
+                decomposition_offsets_ptr[decomposition_cursor] = fragment_cursor
+            spec_offsets_ptr[si + 1] = decomposition_cursor
+
+    decompositions = pa.StructArray.from_arrays(
+        [
+            _formula_values_array(precursors),
+            pa.array(precursor_masses, type=pa.float64()),
+            pa.array(precursor_errors, type=pa.float64()),
+            pa.array(explained_intensities, type=pa.float64()),
+            _large_list_array(decomposition_offsets, _large_list_array(fragment_offsets, _formula_values_array(fragment_formulas))),
+            _large_list_array(decomposition_offsets, _large_list_array(fragment_offsets, pa.array(fragment_masses, type=pa.float64()))),
+            _large_list_array(decomposition_offsets, _large_list_array(fragment_offsets, pa.array(fragment_errors, type=pa.float64()))),
+        ],
+        names=["precursor", "precursor_mass", "precursor_error_ppm", "explained_intensity", "fragments", "fragment_masses", "fragment_errors_ppm"],
+    )
+    return pl.Series(_large_list_array(spec_offsets, decompositions))
 
-    return pl.from_arrow(
-        data=final_array,
-        schema={"decomposed_formula": pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))})
+def _spectra_buffers(precursor_masses, fragment_masses_series, fragment_intensities_series):
+    """
+    Arrow buffers of spectra for the unknown-precursor routines: (precursor masses, mass offsets,
+    mass values, intensity offsets, intensity values). Without intensities every offset is 0, so
+    each spectrum gets an empty intensity span and all fragments weigh 1.
+    """
+    n = len(precursor_masses)
+    if fragment_masses_series.len() != n:
+        raise ValueError("fragment_masses_series length must match the number of precursor masses.")
+    masses = np.ascontiguousarray(pl.Series(precursor_masses).fill_null(0.0).to_numpy(), dtype=np.float64)
+    mass_offsets, mass_values = _list_float64_buffers(fragment_masses_series)
+    if fragment_intensities_series is None:
+        return masses, mass_offsets, mass_values, np.zeros(n + 1, dtype=np.int64), np.empty(0, dtype=np.float64)
+    if fragment_intensities_series.len() != n:
+        raise ValueError("fragment_intensities_series length must match the number of precursor masses.")
+    inten_offsets, inten_values = _list_float64_buffers(fragment_intensities_series)
+    if not np.array_equal(np.diff(mass_offsets), np.diff(inten_offsets)):
+        raise ValueError("Each spectrum needs one intensity per fragment mass.")
+    return masses, mass_offsets, mass_values, inten_offsets, inten_values
 
-#TODO: make this run. currently its too nested, but this is the actual output we want- 
-# for each spectrum, we want a list of possbile explanations, each consisting of a precursor formula and a list of fragment formulas, where each fragment can have several explanations! also we want the masses and errors.
-# now this is very complicated, so it might be better to force the user to first decompose the precursor, then pass each precursor formula with the fragments to a function that decomposes the fragments with known precursor.
-# we can't do it here, since this is ti be used as a polras expression, and either we get extremely nested data structures which is the current state, or we return a diferenct number of rows, which is not allowed.
 def decompose_spectra_parallel(
-    spectra_data: Iterable[dict], # list of dicts with 'precursor_mass' and 'fragment_masses'
+    precursor_masses: pl.Series,             # Float64 per spectrum
+    fragment_masses_series: pl.Series,       # list[float] per spectrum
+    fragment_intensities_series,             # list[float] per spectrum, or None to weight fragments equally
     min_bounds: np.ndarray,
     max_bounds: np.ndarray,
     tolerance_ppm: float = 5.0,
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,
     max_hetero_ratio: float = 100.0,
-    max_results: int = 100000
-) -> list:
-    # Convert iterable to list to allow checking for emptiness and getting length
-    spectra_data_list = list(spectra_data)
-    if not spectra_data_list:
-        return []
-    cdef DecompositionParams params = _convert_params(tolerance_ppm, min_dbe, max_dbe,
+    max_results: int = 100000,
+    top_k_precursors: int = 0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    masses_arr, mass_offsets_arr, mass_values_arr, inten_offsets_arr, inten_values_arr = _spectra_buffers(
+        precursor_masses, fragment_masses_series, fragment_intensities_series)
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe,
                                                      max_results,
-                                                     min_bounds, max_bounds)
+                                                     min_bounds, max_bounds,
+                                                     True, fragment_engine, max_subformula_lattice_size)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    params.top_k_precursors = top_k_precursors
+
+    cdef const double[::1] masses = masses_arr
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
+    cdef size_t n = masses.shape[0]
     cdef vector[Spectrum] spectra_vec
-    spectra_vec.reserve(len(spectra_data_list))
+    spectra_vec.reserve(n)
     cdef Spectrum s
-    for spec_data in spectra_data_list:
-        s.precursor_mass = spec_data['precursor_mass']
-        s.fragment_masses = spec_data['fragment_masses']
+    cdef size_t i
+    for i in range(n):
+        s.precursor_mass = masses[i]
+        s.fragment_masses = DoubleSpan(mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
+        s.fragment_intensities = DoubleSpan(inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
         spectra_vec.push_back(s)
 
     cdef vector[ProperSpectrumResults] all_cpp_results
-    all_cpp_results = MassDecomposer.decompose_spectra_parallel(spectra_vec, params)
-    all_python_results = []
-    for cpp_results in all_cpp_results:
-        python_results = []
-        for decomp in cpp_results.decompositions:
-            py_decomp = {
-                'precursor': _convert_formula_to_array(decomp.precursor),
-                'precursor_mass': decomp.precursor_mass,
-                'precursor_error_ppm': decomp.precursor_error_ppm,
-                'fragments': [[_convert_formula_to_array(f) for f in frag_list] for frag_list in decomp.fragments],
-                'fragment_masses': [list(fm) for fm in decomp.fragment_masses],
-                'fragment_errors_ppm': [list(fe) for fe in decomp.fragment_errors_ppm]
-            }
-            python_results.append(py_decomp)
-        all_python_results.append(python_results)
+    with nogil:
+        all_cpp_results = MassDecomposer.decompose_spectra_parallel(spectra_vec, params)
+    return _spectrum_decompositions_series(all_cpp_results, n_elements)
 
-    return pl.Series(
-        all_python_results, 
-        dtype=pl.List(
-                pl.Struct(
-                {
-                    "precursor": pl.Array(pl.Int32, len(min_bounds)),  # Precursor formula as an array
-                    "precursor_mass": pl.Float64,  # Calculated mass of the precursor
-                    "precursor_error_ppm": pl.Float64,  # PPM error for precursor   
-                    "fragments": pl.List(pl.List(pl.Array(pl.Int32, len(min_bounds)))),  # Nested structure of fragment formulas
-                    "fragment_masses": pl.List(pl.List(pl.Float64)),  # Corresponding calculated masses
-                    "fragment_errors_ppm": pl.List(pl.List(pl.Float64)),  # Correspond
-                }
-                )
-            ),
-            strict=False
-        )
-
-# TODO: same as above for the uniform bounds version.
 def decompose_spectra_parallel_per_bounds(
-    spectra_data: Iterable[dict], # list of dicts with 'precursor_mass', 'fragment_masses', 'min_bounds', 'max_bounds'
+    precursor_masses: pl.Series,             # Float64 per spectrum
+    fragment_masses_series: pl.Series,       # list[float] per spectrum
+    fragment_intensities_series,             # list[float] per spectrum, or None to weight fragments equally
+    min_bounds_per_spectrum: pl.Series,      # pl.Array(int32, n_elements) per spectrum
+    max_bounds_per_spectrum: pl.Series,
     tolerance_ppm: float = 5.0,
     min_dbe: float = 0.0,
     max_dbe: float = 40.0,
     max_hetero_ratio: float = 100.0,
-    max_results: int = 100000
-) -> list:
-    # Convert iterable to list to allow checking for emptiness and getting length
-    spectra_data_list = list(spectra_data)
-    if not spectra_data_list:
-        return []
-    
-    # Validate only the first bounds arrays
-    _validate_bounds_array(spectra_data_list[0]['min_bounds'], "min_bounds in spectra_data[0]")
-    _validate_bounds_array(spectra_data_list[0]['max_bounds'], "max_bounds in spectra_data[0]")
-
-    cdef np.ndarray dummy_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
-    cdef DecompositionParams params = _convert_params(tolerance_ppm, min_dbe, max_dbe,
+    max_results: int = 100000,
+    top_k_precursors: int = 0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    masses_arr, mass_offsets_arr, mass_values_arr, inten_offsets_arr, inten_values_arr = _spectra_buffers(
+        precursor_masses, fragment_masses_series, fragment_intensities_series)
+    cdef size_t n = masses_arr.shape[0]
+    cdef vector[ProperSpectrumResults] all_cpp_results
+    if n == 0:
+        return _spectrum_decompositions_series(all_cpp_results, n_elements)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_min_bounds = np.ascontiguousarray(min_bounds_per_spectrum.to_numpy(), dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_max_bounds = np.ascontiguousarray(max_bounds_per_spectrum.to_numpy(), dtype=np.int32)
+    if contig_min_bounds.shape[0] != n or contig_max_bounds.shape[0] != n:
+        raise ValueError("min_bounds_per_spectrum and max_bounds_per_spectrum must have one row per spectrum.")
+    if contig_min_bounds.shape[1] != n_elements or contig_max_bounds.shape[1] != n_elements:
+        raise ValueError(f"Bounds must have {n_elements} elements per spectrum.")
+
+    cdef np.ndarray dummy_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef DecompositionParams params = _convert_params(elements, tolerance_ppm, min_dbe, max_dbe,
                                                      max_results,
-                                                     dummy_bounds, dummy_bounds)
+                                                     dummy_bounds, dummy_bounds,
+                                                     True, fragment_engine, max_subformula_lattice_size)
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+    params.top_k_precursors = top_k_precursors
+
+    cdef vector[pair[Formula_cpp, Formula_cpp]] bounds_vec = _per_mass_bounds_vector(contig_min_bounds, contig_max_bounds, n_elements)
+    cdef const double[::1] masses = masses_arr
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
     cdef vector[SpectrumWithBounds] spectra_vec
-    spectra_vec.reserve(len(spectra_data_list))
+    spectra_vec.reserve(n)
     cdef SpectrumWithBounds s
-    for spec_data in spectra_data_list:
-        s.precursor_mass = spec_data['precursor_mass']
-        s.fragment_masses = spec_data['fragment_masses']
-        # No need to validate here, just convert
-        s.precursor_min_bounds = _convert_numpy_to_formula(spec_data['min_bounds'])
-        s.precursor_max_bounds = _convert_numpy_to_formula(spec_data['max_bounds'])
+    cdef size_t i
+    for i in range(n):
+        s.precursor_mass = masses[i]
+        s.fragment_masses = DoubleSpan(mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
+        s.fragment_intensities = DoubleSpan(inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
+        s.precursor_min_bounds = bounds_vec[i].first
+        s.precursor_max_bounds = bounds_vec[i].second
         spectra_vec.push_back(s)
 
-    cdef vector[ProperSpectrumResults] all_cpp_results
-    all_cpp_results = MassDecomposer.decompose_spectra_parallel_per_bounds(spectra_vec, params)
-    all_python_results = []
-    for cpp_results in all_cpp_results:
-        python_results = []
-        for decomp in cpp_results.decompositions:
-            py_decomp = {
-                'precursor': _convert_formula_to_array(decomp.precursor),
-                'precursor_mass': decomp.precursor_mass,
-                'precursor_error_ppm': decomp.precursor_error_ppm,
-                'fragments': [[_convert_formula_to_array(f) for f in frag_list] for frag_list in decomp.fragments],
-                'fragment_masses': [list(fm) for fm in decomp.fragment_masses],
-                'fragment_errors_ppm': [list(fe) for fe in decomp.fragment_errors_ppm]
-            }
-            python_results.append(py_decomp)
-        all_python_results.append(python_results)
-    return all_python_results
+    with nogil:
+        all_cpp_results = MassDecomposer.decompose_spectra_parallel_per_bounds(spectra_vec, params)
+    return _spectrum_decompositions_series(all_cpp_results, n_elements)
 
 
 def decompose_spectra_known_precursor_parallel(
-    precursor_formula_series: pl.Series,  # series of 1D arrays shape (NUM_ELEMENTS,), dtype=int32 (pl.Array)
+    precursor_formula_series: pl.Series,  # series of 1D arrays shape (n_elements,), dtype=int32 (pl.Array)
     fragment_masses_series: pl.Series,    # series of lists[float], variable length per spectrum
     tolerance_ppm: float = 5.0,
-    max_results: int = 100000
+    max_results: int = 100000,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
 ) -> pl.Series:
     """
     Convert Polars Series to contiguous buffers and pass to C++ parallel routine.
-    - precursor_formula_series: pl.Series of fixed-size arrays (NUM_ELEMENTS) of int32.
+    - precursor_formula_series: pl.Series of fixed-size arrays (n_elements) of int32.
     - fragment_masses_series: pl.Series of Python lists (variable length).
-    Returns a Polars Series of List(List(Array(int32, NUM_ELEMENTS))) matching
-    [spectrum][fragment][formula[NUM_ELEMENTS]] structure.
+    Returns a Polars Series of List(List(Array(int32, n_elements))) matching
+    [spectrum][fragment][formula[n_elements]] structure.
     """
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
     # Convert precursor formulas to a contiguous 2D int32 array
     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_precursors = np.ascontiguousarray(
         precursor_formula_series.to_numpy(), dtype=np.int32
@@ -490,22 +1159,25 @@ def decompose_spectra_known_precursor_parallel(
         return pl.Series(
             "fragment_formulas",
             [],
-            dtype=pl.List(pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))),
+            dtype=pl.List(pl.List(pl.Array(pl.Int32, n_elements))),
         )
-    if contig_precursors.shape[1] != NUM_ELEMENTS:
-        raise ValueError(f"Each precursor formula must have length {NUM_ELEMENTS} (got {contig_precursors.shape[1]}).")
+    if contig_precursors.shape[1] != n_elements:
+        raise ValueError(f"Each precursor formula must have length {n_elements} (got {contig_precursors.shape[1]}).")
 
     if fragment_masses_series.len() != n:
         raise ValueError("fragment_masses_series length must match precursor_formula_series length.")
 
     # Params: bounds are ignored by the C++ routine here; pass zeros.
-    cdef np.ndarray min_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
-    cdef np.ndarray max_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
+    cdef np.ndarray min_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef np.ndarray max_bounds = np.zeros(n_elements, dtype=np.int32)
     cdef DecompositionParams params = _convert_params(
-        tolerance_ppm, 0.0, 30.0,  # dbe range for fragments with known precursor
+        elements, tolerance_ppm, 0.0, 30.0,  # dbe range for fragments with known precursor
         max_results,
-        min_bounds, max_bounds
+        min_bounds, max_bounds,
+        True, fragment_engine, max_subformula_lattice_size,
     )
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
 
     # Prepare C++ input vector<SpectrumWithKnownPrecursor>
     cdef vector[SpectrumWithKnownPrecursor] spectra_vec
@@ -514,244 +1186,175 @@ def decompose_spectra_known_precursor_parallel(
     cdef np.int32_t* prec_ptr = &contig_precursors[0, 0]
     cdef size_t i
     cdef Formula_cpp prec
-    cdef size_t formula_size_bytes = NUM_ELEMENTS * sizeof(F_DTYPE_t)
+    cdef size_t formula_size_bytes = n_elements * sizeof(F_DTYPE_t)
+    prec.fill(0)
 
-    # Extract fragment masses lists from Polars once (object Python lists)
-    frag_lists = fragment_masses_series.to_list()
+    # Fragment masses are read from the Arrow buffers; C++ receives spans into them.
+    mass_offsets_arr, mass_values_arr = _list_float64_buffers(fragment_masses_series)
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
 
     cdef SpectrumWithKnownPrecursor s
-    cdef np.ndarray[double, ndim=1, mode="c"] frag_contig
-    cdef double* fptr
-    cdef Py_ssize_t flen
 
     for i in range(n):
         # Copy precursor formula row i -> C++ Formula (memcpy for speed)
-        memcpy(<void*>&prec[0], <const void*>(prec_ptr + i * NUM_ELEMENTS), formula_size_bytes)
+        memcpy(<void*>prec.data(), <const void*>(prec_ptr + i * n_elements), formula_size_bytes)
 
         s.precursor_formula = prec
-
-        # Convert fragment list i -> contiguous double buffer and assign into vector<double>
-        seq = frag_lists[i] if frag_lists[i] is not None else []
-        frag_contig = np.ascontiguousarray(seq, dtype=np.float64)
-        flen = frag_contig.shape[0]
-        if flen > 0:
-            fptr = &frag_contig[0]
-            s.fragment_masses.assign(fptr, fptr + flen)
-        else:
-            s.fragment_masses.clear()
+        s.fragment_masses = DoubleSpan(
+            mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
 
         spectra_vec.push_back(s)
 
     # Call C++ parallel routine
-    cdef vector[vector[vector[Formula_cpp]]] all_results
-    all_results = MassDecomposer.decompose_spectra_known_precursor_parallel(spectra_vec, params)
-
-    # Convert nested results -> Python nested lists of numpy int32 arrays
-    # Shape: [n_spectra][n_fragments_for_spec][formula_array(NUM_ELEMENTS)]
-    py_results = []
-    cdef size_t si, fj, fk
-    cdef size_t n_specs = all_results.size()
-    for si in range(n_specs):
-        spec_out = []
-        for fj in range(all_results[si].size()):
-            frag_out = []
-            for fk in range(all_results[si][fj].size()):
-                frag_out.append(_convert_formula_to_array(all_results[si][fj][fk]))
-            spec_out.append(frag_out)
-        py_results.append(spec_out)
+    cdef vector[vector[FormulaList]] all_results
+    with nogil:
+        all_results = MassDecomposer.decompose_spectra_known_precursor_parallel(spectra_vec, params)
 
-    # Return as Polars Series with explicit nested dtype
-    return pl.Series(py_results, dtype=pl.List(pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))))
+    # Shape: [n_spectra][n_fragments_for_spec][formula_array(n_elements)]
+    return pl.Series(_nested_formula_lists_array(all_results, n_elements))
 
     
 def clean_spectra_known_precursor_parallel(
-    precursor_formula_series: pl.Series,   # Series of pl.Array(int32, NUM_ELEMENTS)
+    precursor_formula_series: pl.Series,   # Series of pl.Array(int32, n_elements)
     fragment_masses_series: pl.Series,     # Series of list[float]
     fragment_intensities_series: pl.Series,# Series of list[float]
     tolerance_ppm: float = 5.0,
-    max_results: int = 100000
+    max_results: int = 100000,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
 ) -> pl.Series:
     """
     Parallel cleaner with known precursor.
     Returns a Series[Struct] with fields:
       - masses: List[Float64]
       - intensities: List[Float64]
-      - fragment_formulas: List[List[Array(Int32, NUM_ELEMENTS)]]
+      - fragment_formulas: List[List[Array(Int32, n_elements)]]
       - fragment_errors_ppm: List[List[Float64]]
     Arrow-backed construction avoids per-row Python lists.
     """
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
     # Convert precursor formulas to 2D contiguous int32
     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_precursors = np.ascontiguousarray(
         precursor_formula_series.to_numpy(), dtype=np.int32
     )
     cdef int n = <int>contig_precursors.shape[0]
-    if contig_precursors.shape[1] != NUM_ELEMENTS:
-        raise ValueError(f"Each precursor formula must have length {NUM_ELEMENTS} (got {contig_precursors.shape[1]}).")
+    if contig_precursors.shape[1] != n_elements:
+        raise ValueError(f"Each precursor formula must have length {n_elements} (got {contig_precursors.shape[1]}).")
     if fragment_masses_series.len() != n or fragment_intensities_series.len() != n:
         raise ValueError("fragment_masses_series and fragment_intensities_series lengths must match precursor_formula_series length.")
     if n == 0:
         # Return empty struct series with correct schema
         s_masses = pl.Series("normalized_masses", [], dtype=pl.List(pl.Float64))
         s_intens = pl.Series("cleaned_intensities", [], dtype=pl.List(pl.Float64))
-        s_frm = pl.Series("fragment_formulas", [], dtype=pl.List(pl.List(pl.Array(pl.Int32, NUM_ELEMENTS))))
+        s_frm = pl.Series("fragment_formulas", [], dtype=pl.List(pl.List(pl.Array(pl.Int32, n_elements))))
         s_err = pl.Series("fragment_errors_ppm", [], dtype=pl.List(pl.List(pl.Float64)))
         return pl.struct(s_masses, s_intens, s_frm, s_err, eager=True)
 
     # Params: set DBE bounds for fragments; bounds ignored; pass zeros.
-    cdef np.ndarray min_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
-    cdef np.ndarray max_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
+    cdef np.ndarray min_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef np.ndarray max_bounds = np.zeros(n_elements, dtype=np.int32)
     cdef DecompositionParams params = _convert_params(
-        tolerance_ppm, 0.0, 30.0,
+        elements, tolerance_ppm, 0.0, 30.0,
         max_results,
-        min_bounds, max_bounds
+        min_bounds, max_bounds,
+        True, fragment_engine, max_subformula_lattice_size,
     )
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
 
     # Prepare input vector<CleanSpectrumWithKnownPrecursor>
     cdef vector[CleanSpectrumWithKnownPrecursor_cpp] spectra_vec
     spectra_vec.reserve(n)
 
-    frag_mass_lists = fragment_masses_series.to_list()
-    frag_int_lists = fragment_intensities_series.to_list()
+    # Fragment masses/intensities are read from the Arrow buffers; C++ receives spans into them.
+    mass_offsets_arr, mass_values_arr = _list_float64_buffers(fragment_masses_series)
+    inten_offsets_arr, inten_values_arr = _list_float64_buffers(fragment_intensities_series)
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
 
     cdef np.int32_t* prec_ptr = &contig_precursors[0, 0]
-    cdef size_t formula_size_bytes = NUM_ELEMENTS * sizeof(F_DTYPE_t)
+    cdef size_t formula_size_bytes = n_elements * sizeof(F_DTYPE_t)
     cdef size_t i
     cdef Formula_cpp prec
+    prec.fill(0)
     cdef CleanSpectrumWithKnownPrecursor_cpp s
 
-    cdef np.ndarray[double, ndim=1, mode="c"] mass_contig
-    cdef np.ndarray[double, ndim=1, mode="c"] inten_contig
-    cdef double* mptr
-    cdef double* iptr
-    cdef Py_ssize_t mlen, ilen
-
     for i in range(n):
         # Copy precursor row i
-        memcpy(<void*>&prec[0], <const void*>(prec_ptr + i * NUM_ELEMENTS), formula_size_bytes)
+        memcpy(<void*>prec.data(), <const void*>(prec_ptr + i * n_elements), formula_size_bytes)
         s.precursor_formula = prec
 
-        # Masses list -> contiguous buffer
-        seq_m = frag_mass_lists[i] if frag_mass_lists[i] is not None else []
-        mass_contig = np.ascontiguousarray(seq_m, dtype=np.float64)
-        mlen = mass_contig.shape[0]
-        if mlen > 0:
-            mptr = &mass_contig[0]
-            s.fragment_masses.assign(mptr, mptr + mlen)
-        else:
-            s.fragment_masses.clear()
-
-        # Intensities list -> contiguous buffer
-        seq_i = frag_int_lists[i] if frag_int_lists[i] is not None else []
-        inten_contig = np.ascontiguousarray(seq_i, dtype=np.float64)
-        ilen = inten_contig.shape[0]
-        if ilen > 0:
-            iptr = &inten_contig[0]
-            s.fragment_intensities.assign(iptr, iptr + ilen)
-        else:
-            s.fragment_intensities.clear()
+        s.fragment_masses = DoubleSpan(
+            mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
+        s.fragment_intensities = DoubleSpan(
+            inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
 
         spectra_vec.push_back(s)
 
     # Call C++ parallel cleaner
     cdef vector[CleanedSpectrumResult_cpp] all_results
-    all_results = MassDecomposer.clean_spectra_known_precursor_parallel(spectra_vec, params)
+    with nogil:
+        all_results = MassDecomposer.clean_spectra_known_precursor_parallel(spectra_vec, params)
 
     # First pass: sizes for outer (per-spectrum) and inner (per-fragment) lists
-    cdef size_t si, fj, fk
+    cdef size_t si, nf
     cdef size_t n_specs = all_results.size()
     cdef size_t total_frags = 0
     cdef size_t total_formulas = 0
-    cdef size_t total_masses = 0      # also equals total_frags
-    cdef size_t total_intens = 0      # also equals total_frags
-    cdef size_t nf = 0
     for si in range(n_specs):
-        nf = all_results[si].fragment_formulas.size()
-        total_frags += nf
-        total_masses += all_results[si].masses.size()
-        total_intens += all_results[si].intensities.size()
-        for fj in range(nf):
-            total_formulas += all_results[si].fragment_formulas[fj].size()
-
-    # Offsets arrays
-    cdef np.ndarray offs_frags = np.empty(n_specs + 1, dtype=np.int32)
-    cdef np.int32_t[::1] offs_frags_v = offs_frags
-    offs_frags_v[0] = 0
-
-    cdef np.ndarray offs_formulas = np.empty(total_frags + 1, dtype=np.int32)
-    cdef np.int32_t[::1] offs_formulas_v = offs_formulas
-    offs_formulas_v[0] = 0
-
-    # Flat buffers
-    cdef np.ndarray flat_masses = np.empty(total_masses, dtype=np.float64)
+        total_frags += all_results[si].fragment_formulas.size()
+        total_formulas += total_items(all_results[si].fragment_formulas)
+
+    # Masses and intensities have one entry per kept fragment and share the per-spectrum offsets;
+    # formulas and errors share the per-fragment offsets.
+    cdef np.ndarray offs_frags = np.empty(n_specs + 1, dtype=np.int64)
+    cdef np.ndarray offs_formulas = np.empty(total_frags + 1, dtype=np.int64)
+    cdef np.ndarray flat_masses = np.empty(total_frags, dtype=np.float64)
+    cdef np.ndarray flat_intens = np.empty(total_frags, dtype=np.float64)
+    cdef np.ndarray flat_formulas = np.empty((total_formulas, n_elements), dtype=np.int32)
+    cdef np.ndarray flat_errors = np.empty(total_formulas, dtype=np.float64)
+    cdef int64_t* offs_frags_ptr = <int64_t*> np.PyArray_DATA(offs_frags)
+    cdef int64_t* offs_formulas_ptr = <int64_t*> np.PyArray_DATA(offs_formulas)
     cdef double* masses_dst = <double*> np.PyArray_DATA(flat_masses)
-
-    cdef np.ndarray flat_intens = np.empty(total_intens, dtype=np.float64)
     cdef double* intens_dst = <double*> np.PyArray_DATA(flat_intens)
-
-    cdef np.ndarray flat_formula_vals = np.empty(total_formulas * NUM_ELEMENTS, dtype=np.int32)
-    cdef F_DTYPE_t* fvals_dst = <F_DTYPE_t*> np.PyArray_DATA(flat_formula_vals)
-
-    cdef np.ndarray flat_errors = np.empty(total_formulas, dtype=np.float64)
-    cdef double* ferr_dst = <double*> np.PyArray_DATA(flat_errors)
+    cdef int32_t* formulas_dst = <int32_t*> np.PyArray_DATA(flat_formulas)
+    cdef double* errors_dst = <double*> np.PyArray_DATA(flat_errors)
 
     # Second pass: fill offsets and buffers
     cdef size_t frag_cursor = 0
-    cdef size_t formula_cursor = 0
-    cdef size_t mass_cursor = 0
-    cdef size_t intens_cursor = 0
-    cdef size_t n_mass_i = 0
-    cdef size_t n_int_i = 0
-    cdef size_t nf_pass2 = 0
-    cdef size_t nfk = 0
-
-    for si in range(n_specs):
-        # masses/intensities (one per fragment kept)
-        n_mass_i = all_results[si].masses.size()
-        for fj in range(n_mass_i):
-            masses_dst[mass_cursor + fj] = all_results[si].masses[fj]
-        mass_cursor += n_mass_i
-
-        n_int_i = all_results[si].intensities.size()
-        for fj in range(n_int_i):
-            intens_dst[intens_cursor + fj] = all_results[si].intensities[fj]
-        intens_cursor += n_int_i
-
-        # per-fragment formulas/errors
-        nf_pass2 = all_results[si].fragment_formulas.size()
-        for fj in range(nf_pass2):
-            nfk = all_results[si].fragment_formulas[fj].size()
-            # fill formulas (fixed-size lists) and errors for this fragment
-            for fk in range(nfk):
-                memcpy(
-                    <void*>(fvals_dst + (formula_cursor + fk) * NUM_ELEMENTS),
-                    <const void*> formula_data_const(all_results[si].fragment_formulas[fj][fk]),
-                    FORMULA_NBYTES_C
-                )
-                ferr_dst[formula_cursor + fk] = all_results[si].fragment_errors_ppm[fj][fk]
-            formula_cursor += nfk
-            offs_formulas_v[frag_cursor + 1] = <np.int32_t>formula_cursor
-            frag_cursor += 1
-
-        offs_frags_v[si + 1] = <np.int32_t>frag_cursor
+    cdef int64_t formula_cursor = 0
+    with nogil:
+        offs_frags_ptr[0] = 0
+        offs_formulas_ptr[0] = 0
+        for si in range(n_specs):
+            nf = all_results[si].fragment_formulas.size()
+            memcpy(<void*>(masses_dst + frag_cursor), <const void*> all_results[si].masses.data(), nf * sizeof(double))
+            memcpy(<void*>(intens_dst + frag_cursor), <const void*> all_results[si].intensities.data(), nf * sizeof(double))
+            flatten_formula_rows(
+                all_results[si].fragment_formulas, formula_cursor, offs_formulas_ptr + frag_cursor, formulas_dst, n_elements, True)
+            formula_cursor = flatten_rows[double](
+                all_results[si].fragment_errors_ppm, formula_cursor, offs_formulas_ptr + frag_cursor, errors_dst, True)
+            frag_cursor += nf
+            offs_frags_ptr[si + 1] = frag_cursor
 
     # Build Arrow arrays
-    value_masses = pa.array(flat_masses, type=pa.float64())
-    value_intens = pa.array(flat_intens, type=pa.float64())
-    offs_frags_arr = pa.array(offs_frags, type=pa.int32())
-    masses_arr = pa.ListArray.from_arrays(offs_frags_arr, value_masses)
-    intens_arr = pa.ListArray.from_arrays(offs_frags_arr, value_intens)
-
-    # formulas nested: List (per spectrum) -> List (per fragment) -> FixedSizeList(NUM_ELEMENTS)
-    formula_values_arr = pa.array(flat_formula_vals, type=pa.int32())
-    fixed_formula_arr = pa.FixedSizeListArray.from_arrays(formula_values_arr, NUM_ELEMENTS)
-    offs_formulas_arr = pa.array(offs_formulas, type=pa.int32())
-    inner_frag_list = pa.ListArray.from_arrays(offs_formulas_arr, fixed_formula_arr)
-    outer_spec_list_formulas = pa.ListArray.from_arrays(offs_frags_arr, inner_frag_list)
-
+    masses_arr = _large_list_array(offs_frags, pa.array(flat_masses, type=pa.float64()))
+    intens_arr = _large_list_array(offs_frags, pa.array(flat_intens, type=pa.float64()))
+    # formulas nested: List (per spectrum) -> List (per fragment) -> FixedSizeList(n_elements)
+    outer_spec_list_formulas = _large_list_array(
+        offs_frags, _large_list_array(offs_formulas, _formula_values_array(flat_formulas)))
     # errors nested same shape as formulas
-    error_values_arr = pa.array(flat_errors, type=pa.float64())
-    inner_err_list = pa.ListArray.from_arrays(offs_formulas_arr, error_values_arr)
-    outer_spec_list_errors = pa.ListArray.from_arrays(offs_frags_arr, inner_err_list)
+    outer_spec_list_errors = _large_list_array(
+        offs_frags, _large_list_array(offs_formulas, pa.array(flat_errors, type=pa.float64())))
 
     # Convert Arrow -> Polars Series and pack into a struct Series
     s_masses = pl.Series("normalized_masses", masses_arr)
@@ -766,174 +1369,236 @@ def clean_spectra_known_precursor_parallel(
         eager=True
     )
 
+cdef object _cleaned_and_normalized_series(const vector[CleanedAndNormalizedSpectrumResult_cpp]& all_results, int n_elements):
+    """Struct Series (masses_normalized, cleaned_intensities, fragment_formulas, fragment_errors_ppm), one row per result."""
+    if all_results.size() == 0:
+        s_masses = pl.Series("masses_normalized", [], dtype=pl.List(pl.Float64))
+        s_intens = pl.Series("cleaned_intensities", [], dtype=pl.List(pl.Float64))
+        s_frm = pl.Series("fragment_formulas", [], dtype=pl.List(pl.Array(pl.Int32, n_elements)))
+        s_err = pl.Series("fragment_errors_ppm", [], dtype=pl.List(pl.Float64))
+        return pl.struct(s_masses, s_intens, s_frm, s_err, eager=True)
+
+    # First pass: count kept fragments per spectrum (one formula per fragment)
+    cdef size_t si, cnt
+    cdef size_t n_specs = all_results.size()
+    cdef size_t total_kept = 0
+    for si in range(n_specs):
+        total_kept += all_results[si].fragment_formulas.size()
+
+    # Offsets per spectrum (shared by masses, intensities, formulas, errors)
+    cdef np.ndarray offs_specs = np.empty(n_specs + 1, dtype=np.int64)
+    cdef np.ndarray flat_masses_norm = np.empty(total_kept, dtype=np.float64)
+    cdef np.ndarray flat_intens = np.empty(total_kept, dtype=np.float64)
+    cdef np.ndarray flat_formulas = np.empty((total_kept, n_elements), dtype=np.int32)
+    cdef np.ndarray flat_errors = np.empty(total_kept, dtype=np.float64)
+    cdef int64_t* offs_specs_ptr = <int64_t*> np.PyArray_DATA(offs_specs)
+    cdef double* mass_dst = <double*> np.PyArray_DATA(flat_masses_norm)
+    cdef double* intens_dst = <double*> np.PyArray_DATA(flat_intens)
+    cdef int32_t* formulas_dst = <int32_t*> np.PyArray_DATA(flat_formulas)
+    cdef double* ferr_dst = <double*> np.PyArray_DATA(flat_errors)
+
+    # Fill buffers
+    cdef size_t cursor = 0
+    with nogil:
+        offs_specs_ptr[0] = 0
+        for si in range(n_specs):
+            cnt = all_results[si].fragment_formulas.size()
+            memcpy(<void*>(mass_dst + cursor), <const void*> all_results[si].masses_normalized.data(), cnt * sizeof(double))
+            memcpy(<void*>(intens_dst + cursor), <const void*> all_results[si].intensities.data(), cnt * sizeof(double))
+            all_results[si].fragment_formulas.write_dense(formulas_dst + cursor * n_elements, n_elements)
+            memcpy(<void*>(ferr_dst + cursor), <const void*> all_results[si].fragment_errors_ppm.data(), cnt * sizeof(double))
+            cursor += cnt
+            offs_specs_ptr[si + 1] = cursor
+
+    # Build Arrow arrays
+    masses_arr = _large_list_array(offs_specs, pa.array(flat_masses_norm, type=pa.float64()))
+    intens_arr = _large_list_array(offs_specs, pa.array(flat_intens, type=pa.float64()))
+    formulas_arr = _large_list_array(offs_specs, _formula_values_array(flat_formulas))
+    errors_arr = _large_list_array(offs_specs, pa.array(flat_errors, type=pa.float64()))
+
+    # Convert Arrow -> Polars Series and pack into a struct Series
+    s_masses = pl.Series("masses_normalized", masses_arr)
+    s_intensities = pl.Series("cleaned_intensities", intens_arr)
+    s_formulas = pl.Series("fragment_formulas", formulas_arr)
+    s_errors = pl.Series("fragment_errors_ppm", errors_arr)
+    return pl.struct(
+        s_masses,
+        s_intensities,
+        s_formulas,
+        s_errors,
+        eager=True
+    )
+
 def clean_and_normalize_spectra_known_precursor_parallel(
-    precursor_formula_series: pl.Series,   # pl.Array(int32, NUM_ELEMENTS)
+    precursor_formula_series: pl.Series,   # pl.Array(int32, n_elements)
     precursor_masses_series: pl.Series,    # Float64 per spectrum (observed)
     fragment_masses_series: pl.Series,     # list[float] per spectrum
     fragment_intensities_series: pl.Series,# list[float] per spectrum
     tolerance_ppm: float = 5.0,
     max_results: int = 100000,
-    max_allowed_normalized_mass_error_ppm: float = 5.0
+    max_allowed_normalized_mass_error_ppm: float = 5.0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
 ) -> pl.Series:
     """
     Normalizes fragment masses using a spectrum-level linear error model augmented by the precursor point.
     After normalization, drops fragments whose abs(normalized error ppm) > max_allowed_normalized_mass_error_ppm.
     Arrow-backed construction avoids per-row Python lists.
     """
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
     # Convert precursor formulas to 2D contiguous int32
     cdef np.ndarray[np.int32_t, ndim=2, mode="c"] contig_precursors = np.ascontiguousarray(
         precursor_formula_series.to_numpy(), dtype=np.int32
     )
     cdef int n = <int>contig_precursors.shape[0]
-    if contig_precursors.shape[1] != NUM_ELEMENTS:
-        raise ValueError(f"Each precursor formula must have length {NUM_ELEMENTS} (got {contig_precursors.shape[1]}).")
+    if contig_precursors.shape[1] != n_elements:
+        raise ValueError(f"Each precursor formula must have length {n_elements} (got {contig_precursors.shape[1]}).")
     if (fragment_masses_series.len() != n or
         fragment_intensities_series.len() != n or
         precursor_masses_series.len() != n):
         raise ValueError("All input series must have the same length.")
     if n == 0:
-        s_masses = pl.Series("masses_normalized", [], dtype=pl.List(pl.Float64))
-        s_intens = pl.Series("cleaned_intensities", [], dtype=pl.List(pl.Float64))
-        s_frm = pl.Series("fragment_formulas", [], dtype=pl.List(pl.Array(pl.Int32, NUM_ELEMENTS)))
-        s_err = pl.Series("fragment_errors_ppm", [], dtype=pl.List(pl.Float64))
-        return pl.struct(s_masses, s_intens, s_frm, s_err, eager=True)
+        return _cleaned_and_normalized_series(vector[CleanedAndNormalizedSpectrumResult_cpp](), n_elements)
 
     # Params: bounds are ignored here; pass zeros; DBE range for fragments
-    cdef np.ndarray min_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
-    cdef np.ndarray max_bounds = np.zeros(NUM_ELEMENTS, dtype=np.int32)
+    cdef np.ndarray min_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef np.ndarray max_bounds = np.zeros(n_elements, dtype=np.int32)
     cdef DecompositionParams params = _convert_params(
-        tolerance_ppm, 0.0, 30.0,
+        elements, tolerance_ppm, 0.0, 30.0,
         max_results,
-        min_bounds, max_bounds
+        min_bounds, max_bounds,
+        True, fragment_engine, max_subformula_lattice_size,
     )
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
 
     # Prepare input vector<CleanSpectrumWithKnownPrecursor>
     cdef vector[CleanSpectrumWithKnownPrecursor_cpp] spectra_vec
     spectra_vec.reserve(n)
 
-    frag_mass_lists = fragment_masses_series.to_list()
-    frag_int_lists = fragment_intensities_series.to_list()
-    prec_mass_list = precursor_masses_series.to_list()
+    # Fragment masses/intensities are read from the Arrow buffers; C++ receives spans into them.
+    mass_offsets_arr, mass_values_arr = _list_float64_buffers(fragment_masses_series)
+    inten_offsets_arr, inten_values_arr = _list_float64_buffers(fragment_intensities_series)
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
+    cdef const double[::1] prec_masses = np.ascontiguousarray(
+        precursor_masses_series.fill_null(0.0).to_numpy(), dtype=np.float64
+    )
 
     cdef np.int32_t* prec_ptr = &contig_precursors[0, 0]
-    cdef size_t formula_size_bytes = NUM_ELEMENTS * sizeof(F_DTYPE_t)
+    cdef size_t formula_size_bytes = n_elements * sizeof(F_DTYPE_t)
     cdef size_t i
     cdef Formula_cpp prec
+    prec.fill(0)
     cdef CleanSpectrumWithKnownPrecursor_cpp s
 
-    cdef np.ndarray[double, ndim=1, mode="c"] mass_contig
-    cdef np.ndarray[double, ndim=1, mode="c"] inten_contig
-    cdef double* mptr
-    cdef double* iptr
-    cdef Py_ssize_t mlen, ilen
-
     for i in range(n):
         # Copy precursor row i
-        memcpy(<void*>&prec[0], <const void*>(prec_ptr + i * NUM_ELEMENTS), formula_size_bytes)
+        memcpy(<void*>prec.data(), <const void*>(prec_ptr + i * n_elements), formula_size_bytes)
         s.precursor_formula = prec
 
         # Observed precursor mass and ppm threshold
-        s.precursor_mass = <double>(prec_mass_list[i] if prec_mass_list[i] is not None else 0.0)
+        s.precursor_mass = prec_masses[i]
         s.max_allowed_normalized_mass_error_ppm = <double>max_allowed_normalized_mass_error_ppm
 
-        # Masses -> contiguous buffer
-        seq_m = frag_mass_lists[i] if frag_mass_lists[i] is not None else []
-        mass_contig = np.ascontiguousarray(seq_m, dtype=np.float64)
-        mlen = mass_contig.shape[0]
-        if mlen > 0:
-            mptr = &mass_contig[0]
-            s.fragment_masses.assign(mptr, mptr + mlen)
-        else:
-            s.fragment_masses.clear()
-
-        # Intensities -> contiguous buffer
-        seq_i = frag_int_lists[i] if frag_int_lists[i] is not None else []
-        inten_contig = np.ascontiguousarray(seq_i, dtype=np.float64)
-        ilen = inten_contig.shape[0]
-        if ilen > 0:
-            iptr = &inten_contig[0]
-            s.fragment_intensities.assign(iptr, iptr + ilen)
-        else:
-            s.fragment_intensities.clear()
+        s.fragment_masses = DoubleSpan(
+            mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
+        s.fragment_intensities = DoubleSpan(
+            inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
 
         spectra_vec.push_back(s)
 
     # Call C++ parallel cleaner + normalizer (single formula per fragment)
     cdef vector[CleanedAndNormalizedSpectrumResult_cpp] all_results
-    all_results = MassDecomposer.clean_and_normalize_spectra_known_precursor_parallel(spectra_vec, params)
-
-    # First pass: count kept fragments per spectrum (one formula per fragment)
-    cdef size_t si, k
-    cdef size_t n_specs = all_results.size()
-    cdef size_t total_kept = 0
-    for si in range(n_specs):
-        total_kept += all_results[si].fragment_formulas.size()
-
-    # Offsets per spectrum (shared by masses, intensities, formulas, errors)
-    cdef np.ndarray offs_specs = np.empty(n_specs + 1, dtype=np.int32)
-    cdef np.int32_t[::1] offs_specs_v = offs_specs
-    offs_specs_v[0] = 0
-
-    # Flat buffers
-    cdef np.ndarray flat_masses_norm = np.empty(total_kept, dtype=np.float64)
-    cdef double* mass_dst = <double*> np.PyArray_DATA(flat_masses_norm)
-
-    cdef np.ndarray flat_intens = np.empty(total_kept, dtype=np.float64)
-    cdef double* intens_dst = <double*> np.PyArray_DATA(flat_intens)
-
-    cdef np.ndarray flat_formula_vals = np.empty(total_kept * NUM_ELEMENTS, dtype=np.int32)
-    cdef F_DTYPE_t* fvals_dst = <F_DTYPE_t*> np.PyArray_DATA(flat_formula_vals)
-
-    cdef np.ndarray flat_errors = np.empty(total_kept, dtype=np.float64)
-    cdef double* ferr_dst = <double*> np.PyArray_DATA(flat_errors)
+    with nogil:
+        all_results = MassDecomposer.clean_and_normalize_spectra_known_precursor_parallel(spectra_vec, params)
 
-    # Fill buffers
-    cdef size_t cursor = 0
-    cdef size_t cnt = 0
-    for si in range(n_specs):
-        cnt = all_results[si].fragment_formulas.size()
-        # masses normalized
-        for k in range(cnt):
-            mass_dst[cursor + k] = all_results[si].masses_normalized[k]
-        # intensities
-        for k in range(cnt):
-            intens_dst[cursor + k] = all_results[si].intensities[k]
-        # single formula per kept fragment
-        for k in range(cnt):
-            memcpy(
-                <void*>(fvals_dst + (cursor + k) * NUM_ELEMENTS),
-                <const void*> formula_data_const(all_results[si].fragment_formulas[k]),
-                FORMULA_NBYTES_C
-            )
-            ferr_dst[cursor + k] = all_results[si].fragment_errors_ppm[k]
-        cursor += cnt
-        offs_specs_v[si + 1] = <np.int32_t>cursor
-
-    # Build Arrow arrays
-    offs_specs_arr = pa.array(offs_specs, type=pa.int32())
+    return _cleaned_and_normalized_series(all_results, n_elements)
 
-    val_masses = pa.array(flat_masses_norm, type=pa.float64())
-    masses_arr = pa.ListArray.from_arrays(offs_specs_arr, val_masses)
+def clean_and_normalize_spectra_candidate_precursors_parallel(
+    candidate_formulas_series: pl.Series,  # pl.List(pl.Array(int32, n_elements)) per spectrum
+    precursor_masses_series: pl.Series,    # Float64 per spectrum (observed)
+    fragment_masses_series: pl.Series,     # list[float] per spectrum
+    fragment_intensities_series: pl.Series,# list[float] per spectrum
+    tolerance_ppm: float = 5.0,
+    max_results: int = 100000,
+    max_allowed_normalized_mass_error_ppm: float = 5.0,
+    fragment_engine: str = "money_changing",
+    max_subformula_lattice_size: int = 2_000_000,
+    n_threads: int = 0,
+    schedule: str = "dynamic",
+    schedule_chunk_size: int = 1,
+    cost_ordering: bool = True,
+    tolerance_model: tuple | None = None,
+) -> pl.Series:
+    """
+    clean_and_normalize_spectra_known_precursor_parallel for every candidate precursor of every
+    spectrum, decomposing each spectrum's fragments once. Returns a List(Struct) Series with one
+    struct per candidate, aligned with candidate_formulas_series.
+    """
+    cdef shared_ptr[const ElementTable] elements = _registered_element_table()
+    cdef int n_elements = deref(elements).num_elements
+    cdef int n = <int>candidate_formulas_series.len()
+    if (fragment_masses_series.len() != n or
+        fragment_intensities_series.len() != n or
+        precursor_masses_series.len() != n):
+        raise ValueError("All input series must have the same length.")
 
-    val_intens = pa.array(flat_intens, type=pa.float64())
-    intens_arr = pa.ListArray.from_arrays(offs_specs_arr, val_intens)
+    cdef np.ndarray min_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef np.ndarray max_bounds = np.zeros(n_elements, dtype=np.int32)
+    cdef DecompositionParams params = _convert_params(
+        elements, tolerance_ppm, 0.0, 30.0,
+        max_results,
+        min_bounds, max_bounds,
+        True, fragment_engine, max_subformula_lattice_size,
+    )
+    _set_parallel_params(&params, n_threads, schedule, schedule_chunk_size, cost_ordering)
+    _set_tolerance(&params, tolerance_ppm, tolerance_model)
+
+    candidate_offsets_arr, candidate_formulas_arr = _list_formula_buffers(candidate_formulas_series, n_elements)
+    mass_offsets_arr, mass_values_arr = _list_float64_buffers(fragment_masses_series)
+    inten_offsets_arr, inten_values_arr = _list_float64_buffers(fragment_intensities_series)
+    cdef const np.int64_t[::1] candidate_offsets = candidate_offsets_arr
+    cdef const np.int64_t[::1] mass_offsets = mass_offsets_arr
+    cdef const np.int64_t[::1] inten_offsets = inten_offsets_arr
+    cdef const int32_t* candidate_formulas = <const int32_t*> np.PyArray_DATA(candidate_formulas_arr)
+    cdef const double* mass_values = <const double*> np.PyArray_DATA(mass_values_arr)
+    cdef const double* inten_values = <const double*> np.PyArray_DATA(inten_values_arr)
+    cdef const double[::1] prec_masses = np.ascontiguousarray(
+        precursor_masses_series.fill_null(0.0).to_numpy(), dtype=np.float64
+    )
 
-    val_formulas = pa.array(flat_formula_vals, type=pa.int32())
-    fixed_formulas = pa.FixedSizeListArray.from_arrays(val_formulas, NUM_ELEMENTS)
-    formulas_arr = pa.ListArray.from_arrays(offs_specs_arr, fixed_formulas)
+    cdef vector[CleanSpectrumWithCandidatePrecursors_cpp] spectra_vec
+    spectra_vec.reserve(n)
+    cdef CleanSpectrumWithCandidatePrecursors_cpp s
+    cdef size_t i
+    for i in range(n):
+        s.precursor_formulas = candidate_formulas + candidate_offsets[i] * n_elements
+        s.n_precursor_formulas = <size_t>(candidate_offsets[i + 1] - candidate_offsets[i])
+        s.precursor_mass = prec_masses[i]
+        s.max_allowed_normalized_mass_error_ppm = <double>max_allowed_normalized_mass_error_ppm
+        s.fragment_masses = DoubleSpan(
+            mass_values + mass_offsets[i], <size_t>(mass_offsets[i + 1] - mass_offsets[i]))
+        s.fragment_intensities = DoubleSpan(
+            inten_values + inten_offsets[i], <size_t>(inten_offsets[i + 1] - inten_offsets[i]))
+        spectra_vec.push_back(s)
 
-    val_errors = pa.array(flat_errors, type=pa.float64())
-    errors_arr = pa.ListArray.from_arrays(offs_specs_arr, val_errors)
+    cdef vector[CleanedAndNormalizedSpectrumResult_cpp] all_results
+    with nogil:
+        all_results = MassDecomposer.clean_and_normalize_spectra_candidate_precursors_parallel(spectra_vec, params)
 
-    # Convert Arrow -> Polars Series and pack into a struct Series
-    s_masses = pl.Series("masses_normalized", masses_arr)
-    s_intensities = pl.Series("cleaned_intensities", intens_arr)
-    s_formulas = pl.Series("fragment_formulas", formulas_arr)
-    s_errors = pl.Series("fragment_errors_ppm", errors_arr)
-    return pl.struct(
-        s_masses,
-        s_intensities,
-        s_formulas,
-        s_errors,
-        eager=True
+    cleaned = _cleaned_and_normalized_series(all_results, n_elements).to_arrow()
+    if isinstance(cleaned, pa.ChunkedArray):
+        cleaned = cleaned.combine_chunks()
+    return pl.Series(
+        "cleaned_spectra",
+        pa.LargeListArray.from_arrays(pa.array(candidate_offsets_arr, type=pa.int64()), cleaned),
     )
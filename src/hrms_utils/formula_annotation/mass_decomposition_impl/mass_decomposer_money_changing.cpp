@@ -2,111 +2,298 @@
 #include <climits>
 #include <stdexcept>
 
-void MassDecomposer::init_money_changing() {
-    weights_.clear();
-    for (int i = 0; i < FormulaAnnotation::NUM_ELEMENTS; ++i) {
-        if (max_bounds_[i] > 0) {
-            Weight w;
-            w.original_index = i;
-            w.mass = FormulaAnnotation::ATOMIC_MASSES[i];
-            w.min_count = min_bounds_[i];
-            w.max_count = max_bounds_[i];
-            weights_.push_back(w);
+namespace {
+    // Discretization step shared by every residue table (SIRIUS default blowup).
+    constexpr double BASE_PRECISION = 1.0 / 5963.337687;
+
+    // Ratio pruning only skips subtrees that fail by more than this, so rounding in the
+    // count / ratio form never removes a formula the exact leaf check would accept.
+    constexpr double RATIO_SLACK = 1e-9;
+
+    long long gcd(long long u, long long v) {
+        while (v != 0) {
+            long long r = u % v;
+            u = v;
+            v = r;
         }
+        return u;
     }
-    // Sort by mass (smallest first for money-changing)
-    std::sort(weights_.begin(), weights_.end(), [](const Weight& a, const Weight& b) {
-        return a.mass < b.mass;
-    });
-}
 
-long long MassDecomposer::gcd(long long u, long long v) const {
-    while (v != 0) {
-        long long r = u % v;
-        u = v;
-        v = r;
+    void divide_by_gcd(ResidueTable& table) {
+        const std::size_t n = table.num_weights();
+        if (n < 2) return;
+
+        long long d = gcd(table.integer_masses[0], table.integer_masses[1]);
+        for (std::size_t i = 2; i < n; ++i) {
+            d = gcd(d, table.integer_masses[i]);
+            if (d == 1) break;
+        }
+
+        if (d > 1) {
+            table.precision *= d;
+            for (auto& integer_mass : table.integer_masses) {
+                integer_mass /= d;
+            }
+        }
+    }
+
+    void calc_ert(ResidueTable& table) {
+        const std::size_t n = table.num_weights();
+        if (n == 0) return;
+        long long first_long_val = table.integer_masses[0];
+        if (first_long_val <= 0) {
+            throw std::runtime_error("First element mass is zero or negative after discretization.");
+        }
+
+        std::vector<long long>& ert = table.ert;
+        ert.assign(static_cast<std::size_t>(first_long_val) * n, 0);
+        auto at = [&ert, n](long long residue, std::size_t j) -> long long& {
+            return ert[static_cast<std::size_t>(residue) * n + j];
+        };
+
+        at(0, 0) = 0;
+        for (long long i = 1; i < first_long_val; ++i) {
+            at(i, 0) = LLONG_MAX;
+        }
+
+        for (std::size_t j = 1; j < n; ++j) {
+            at(0, j) = 0;
+            long long d = gcd(first_long_val, table.integer_masses[j]);
+
+            for (long long p = 0; p < d; ++p) {
+                long long m = LLONG_MAX;
+                for (long long i = p; i < first_long_val; i += d) {
+                    if (at(i, j - 1) < m) {
+                        m = at(i, j - 1);
+                    }
+                }
+
+                if (m == LLONG_MAX) {
+                    for (long long i = p; i < first_long_val; i += d) {
+                        at(i, j) = LLONG_MAX;
+                    }
+                } else {
+                    for (long long i = 0; i < first_long_val / d; ++i) {
+                        m += table.integer_masses[j];
+                        long long r = m % first_long_val;
+                        if (at(r, j - 1) < m) {
+                            m = at(r, j - 1);
+                        }
+                        at(r, j) = m;
+                    }
+                }
+            }
+        }
     }
-    return u;
-}
 
-void MassDecomposer::discretize_masses() {
-    for (auto& weight : weights_) {
-        weight.integer_mass = static_cast<long long>(weight.mass / precision_);
+    void compute_errors(ResidueTable& table) {
+        table.min_error = 0.0;
+        table.max_error = 0.0;
+        for (std::size_t j = 0; j < table.num_weights(); ++j) {
+            const double mass = table.masses[j];
+            if (mass == 0) continue;
+            double error = (table.precision * table.integer_masses[j] - mass) / mass;
+            if (error < table.min_error) table.min_error = error;
+            if (error > table.max_error) table.max_error = error;
+        }
     }
 }
 
-void MassDecomposer::divide_by_gcd() {
-    if (weights_.size() < 2) return;
-    
-    long long d = weights_[0].integer_mass;
-    if (weights_.size() > 1) {
-        d = gcd(weights_[0].integer_mass, weights_[1].integer_mass);
-        for (size_t i = 2; i < weights_.size(); ++i) {
-            d = gcd(d, weights_[i].integer_mass);
-            if (d == 1) break;
+double estimate_decomposition_cost(
+    double target_mass, const Formula& min_bounds, const Formula& max_bounds, const MassTolerance& tolerance,
+    const FormulaAnnotation::ElementTable& elements) {
+    // Integer masses scanned by decompose(): the tolerance window in ERT discretization steps.
+    const double window = 1.0 + 2.0 * tolerance.window(target_mass) / BASE_PRECISION;
+
+    // Enumeration work ~ product of the feasible count ranges of every active element except the
+    // lightest, whose count is fixed by the remaining mass at the leaves.
+    int lightest = -1;
+    for (int e = 0; e < elements.num_elements; ++e) {
+        if (max_bounds[e] <= 0) continue;
+        if (lightest < 0 || elements.masses[e] < elements.masses[lightest]) {
+            lightest = e;
         }
     }
-    
-    if (d > 1) {
-        precision_ *= d;
-        for (auto& weight : weights_) {
-            weight.integer_mass /= d;
+    double volume = 1.0;
+    for (int e = 0; e < elements.num_elements; ++e) {
+        if (max_bounds[e] <= 0 || e == lightest) continue;
+        const double reachable = std::floor(std::max(target_mass, 0.0) / elements.masses[e]);
+        const double highest = std::min(static_cast<double>(max_bounds[e]), reachable);
+        volume *= std::max(0.0, highest - std::max(min_bounds[e], 0)) + 1.0;
+    }
+    return window * volume;
+}
+
+std::shared_ptr<const ResidueTable> build_residue_table(
+    const FormulaAnnotation::ElementTable& elements, std::uint32_t active_element_mask) {
+    auto table = std::make_shared<ResidueTable>();
+    table->precision = BASE_PRECISION;
+
+    for (int i = 0; i < elements.num_elements; ++i) {
+        if (active_element_mask & (1u << i)) {
+            table->original_indices.push_back(i);
         }
     }
+    // Sort by mass (smallest first for money-changing)
+    std::sort(table->original_indices.begin(), table->original_indices.end(), [&elements](int a, int b) {
+        return elements.masses[a] < elements.masses[b];
+    });
+    for (int index : table->original_indices) {
+        const double mass = elements.masses[index];
+        table->masses.push_back(mass);
+        table->integer_masses.push_back(static_cast<long long>(mass / table->precision));
+    }
+
+    divide_by_gcd(*table);
+    calc_ert(*table);
+    compute_errors(*table);
+    return table;
 }
 
-void MassDecomposer::calc_ert() {
-    if (weights_.empty()) return;
-    long long first_long_val = weights_[0].integer_mass;
-    if (first_long_val <= 0) {
-        throw std::runtime_error("First element mass is zero or negative after discretization.");
+ResidueTableCache& ResidueTableCache::instance() {
+    static ResidueTableCache cache;
+    return cache;
+}
+
+std::uint32_t ResidueTableCache::active_element_mask(const Formula& max_bounds) {
+    std::uint32_t mask = 0;
+    for (int i = 0; i < FormulaAnnotation::MAX_ELEMENTS; ++i) {
+        if (max_bounds[i] > 0) mask |= (1u << i);
     }
+    return mask;
+}
 
-    ert_.assign(first_long_val, std::vector<long long>(weights_.size()));
-    
-    ert_[0][0] = 0;
-    for (long long i = 1; i < first_long_val; ++i) {
-        ert_[i][0] = LLONG_MAX;
-    }
-
-    for (size_t j = 1; j < weights_.size(); ++j) {
-        ert_[0][j] = 0;
-        long long d = gcd(first_long_val, weights_[j].integer_mass);
-        
-        for (int p = 0; p < d; ++p) {
-            long long n = LLONG_MAX;
-            for (long long i = p; i < first_long_val; i += d) {
-                if (ert_[i][j-1] < n) {
-                    n = ert_[i][j-1];
-                }
-            }
-            
-            if (n == LLONG_MAX) {
-                for (long long i = p; i < first_long_val; i += d) {
-                    ert_[i][j] = LLONG_MAX;
-                }
-            } else {
-                for (long long i = 0; i < first_long_val / d; ++i) {
-                    n += weights_[j].integer_mass;
-                    int r = static_cast<int>(n % first_long_val);
-                    if (ert_[r][j-1] < n) {
-                        n = ert_[r][j-1];
-                    }
-                    ert_[r][j] = n;
-                }
-            }
+std::shared_ptr<const ResidueTable> ResidueTableCache::get(
+    const FormulaAnnotation::ElementTable& elements, std::uint32_t active_element_mask) {
+    const std::uint64_t key = (elements.generation << 32) | active_element_mask;
+    {
+        std::lock_guard<std::mutex> lock(mutex_);
+        auto found = index_.find(key);
+        if (found != index_.end()) {
+            lru_.splice(lru_.begin(), lru_, found->second);
+            ++hits_;
+            return found->second->second;
         }
+        ++misses_;
+    }
+
+    // Build outside the lock so threads needing other alphabets are not serialized;
+    // a concurrent miss on the same key only costs one redundant build.
+    std::shared_ptr<const ResidueTable> table = build_residue_table(elements, active_element_mask);
+
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto found = index_.find(key);
+    if (found != index_.end()) {
+        lru_.splice(lru_.begin(), lru_, found->second);
+        return found->second->second;
+    }
+    const std::size_t table_bytes = table->memory_bytes();
+    if (table_bytes > capacity_bytes_) {
+        return table;  // larger than the whole cache: hand it out without caching
     }
+    lru_.emplace_front(key, table);
+    index_[key] = lru_.begin();
+    memory_bytes_ += table_bytes;
+    evict_to_capacity_locked();
+    return table;
 }
 
-void MassDecomposer::compute_errors() {
-    min_error_ = 0.0;
-    max_error_ = 0.0;
-    for (const auto& weight : weights_) {
-        if (weight.mass == 0) continue;
-        double error = (precision_ * weight.integer_mass - weight.mass) / weight.mass;
-        if (error < min_error_) min_error_ = error;
-        if (error > max_error_) max_error_ = error;
+void ResidueTableCache::evict_to_capacity_locked() {
+    while (memory_bytes_ > capacity_bytes_ && !lru_.empty()) {
+        const Entry& oldest = lru_.back();
+        memory_bytes_ -= oldest.second->memory_bytes();
+        index_.erase(oldest.first);
+        lru_.pop_back();
+        ++evictions_;
+    }
+}
+
+void ResidueTableCache::set_capacity_bytes(std::size_t capacity_bytes) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    capacity_bytes_ = capacity_bytes;
+    evict_to_capacity_locked();
+}
+
+void ResidueTableCache::clear() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    lru_.clear();
+    index_.clear();
+    memory_bytes_ = 0;
+    hits_ = 0;
+    misses_ = 0;
+    evictions_ = 0;
+}
+
+ResidueTableCacheStats ResidueTableCache::stats() const {
+    std::lock_guard<std::mutex> lock(mutex_);
+    ResidueTableCacheStats out;
+    out.hits = hits_;
+    out.misses = misses_;
+    out.evictions = evictions_;
+    out.entries = static_cast<long long>(lru_.size());
+    out.memory_bytes = static_cast<long long>(memory_bytes_);
+    out.capacity_bytes = static_cast<long long>(capacity_bytes_);
+    return out;
+}
+
+ResidueTableCacheStats get_residue_table_cache_stats() {
+    return ResidueTableCache::instance().stats();
+}
+
+void set_residue_table_cache_capacity(std::size_t capacity_bytes) {
+    ResidueTableCache::instance().set_capacity_bytes(capacity_bytes);
+}
+
+void clear_residue_table_cache() {
+    ResidueTableCache::instance().clear();
+}
+
+void MassDecomposer::init_money_changing() {
+    const FormulaAnnotation::ElementTable& elements = *elements_;
+    table_ = ResidueTableCache::instance().get(elements, ResidueTableCache::active_element_mask(max_bounds_));
+    precision_ = table_->precision;
+    min_error_ = table_->min_error;
+    max_error_ = table_->max_error;
+    ert_ = table_->ert.data();
+
+    // Count bounds are per decomposer; only the alphabet-dependent parts come from the table.
+    weights_.clear();
+    weights_.reserve(table_->num_weights());
+    for (std::size_t j = 0; j < table_->num_weights(); ++j) {
+        Weight w;
+        w.original_index = table_->original_indices[j];
+        w.mass = table_->masses[j];
+        w.integer_mass = table_->integer_masses[j];
+        w.min_count = min_bounds_[w.original_index];
+        w.max_count = max_bounds_[w.original_index];
+        w.twice_dbe_coefficient = elements.twice_dbe_coefficients[w.original_index];
+        weights_.push_back(w);
+    }
+
+    carbon_weight_ = -1;
+    weight_positions_.assign(weights_.size(), 0);
+    for (std::size_t j = 0; j < weights_.size(); ++j) {
+        if (weights_[j].original_index == elements.carbon_index) carbon_weight_ = static_cast<int>(j);
+        weight_positions_[j] = static_cast<int>(
+            std::lower_bound(slots_.begin(), slots_.end(), weights_[j].original_index) - slots_.begin());
+    }
+
+    residual_min_mass_.assign(weights_.size() + 1, 0);
+    residual_max_mass_.assign(weights_.size() + 1, 0);
+    for (std::size_t j = 0; j < weights_.size(); ++j) {
+        residual_min_mass_[j + 1] = residual_min_mass_[j] + weights_[j].min_count * weights_[j].integer_mass;
+        residual_max_mass_[j + 1] = residual_max_mass_[j] + weights_[j].max_count * weights_[j].integer_mass;
+    }
+
+    // 2*DBE range contributed by weights 1..i-1 (the lightest weight is handled per node).
+    residual_min_twice_dbe_.assign(weights_.size() + 1, 0);
+    residual_max_twice_dbe_.assign(weights_.size() + 1, 0);
+    for (std::size_t j = 1; j < weights_.size(); ++j) {
+        const Weight& w = weights_[j];
+        const int at_min = w.twice_dbe_coefficient * w.min_count;
+        const int at_max = w.twice_dbe_coefficient * w.max_count;
+        residual_min_twice_dbe_[j + 1] = residual_min_twice_dbe_[j] + std::min(at_min, at_max);
+        residual_max_twice_dbe_[j + 1] = residual_max_twice_dbe_[j] + std::max(at_min, at_max);
     }
 }
 
@@ -126,81 +313,139 @@ std::pair<long long, long long> MassDecomposer::integer_bound(double mass_from,
 bool MassDecomposer::decomposable(int i, long long m, long long a1) const {
     if (m < 0) return false;
     if (a1 <= 0) return false;
-    return ert_[m % a1][i] <= m;
+    return ert_[(m % a1) * static_cast<long long>(weights_.size()) + i] <= m;
 }
 
 inline bool MassDecomposer::decomposable_fast(int i, long long m) const {
     if (m < 0) return false;
-    return ert_[m % weights_[0].integer_mass][i] <= m;
+    return ert_[(m % weights_[0].integer_mass) * static_cast<long long>(weights_.size()) + i] <= m;
 }
 
-std::vector<Formula> MassDecomposer::integer_decompose(long long mass) const {
-    std::vector<Formula> results;
+void MassDecomposer::integer_decompose(
+    long long mass, const DbePruning& dbe_pruning, const ChemistryRules& chemistry_rules, FormulaList& results) const {
     int k = static_cast<int>(weights_.size()) - 1;
-    if (k < 0) return results;
-    
-    long long a = weights_[0].integer_mass;
-    if (a <= 0) return results;
+    if (k < 0) return;
+    if (weights_[0].integer_mass <= 0) return;
+    if (mass < residual_min_mass_[k + 1] || mass > residual_max_mass_[k + 1]) return;
 
-    std::vector<int> c(k + 1, 0);
-    int i = k;
-    long long m = mass;
-    
-    while (i <= k) {
-        if (!decomposable_fast(i, m)) {  
-            while (i <= k && !decomposable_fast(i, m)) {
-                m += c[i] * weights_[i].integer_mass;
-                c[i] = 0;
-                i++;
-            }
-            
-            if (i <= k) {
-                m -= weights_[i].integer_mass;
-                c[i]++;
-            }
-        } else {
-            while (i > 0 && decomposable_fast(i-1, m)) {
-                i--;
-            }
-            
-            if (i == 0) {
-                if (a > 0) {
-                    c[0] = static_cast<int>(m / a);
-                } else {
-                    c[0] = 0;
-                }
+    std::vector<int> counts(k + 1, 0);
+    enumerate_level(k, mass, 0, 0.0, counts, dbe_pruning, chemistry_rules, results);
+}
 
-                // Check element bounds
-                bool valid_formula = true;
-                for (int j = 0; j <= k; ++j) {
-                    if (c[j] < weights_[j].min_count || c[j] > weights_[j].max_count) {
-                        valid_formula = false;
-                        break;
-                    }
-                }
-                
-                if (valid_formula) {
-                    Formula res{}; // Initialize with zeros
-                    for (int j = 0; j <= k; ++j) {
-                        res[weights_[j].original_index] = c[j];
-                    }
-                    results.push_back(res);
-                }
-                i++;
-            }
-            
-            while (i <= k && c[i] >= weights_[i].max_count) {
-                m += c[i] * weights_[i].integer_mass;
-                c[i] = 0;
-                i++;
+// Depth-first enumeration from the heaviest weight down. Unlike the original SIRIUS
+// backtracking, count bounds are enforced per level: the count range of weight i is
+// clamped so that the leftover mass stays within what weights 0..i-1 can reach, which
+// removes whole subtrees that could only fail the bounds check at the leaf.
+void MassDecomposer::enumerate_level(
+    int i, long long remaining, int fixed_twice_dbe, double carbon_needed, std::vector<int>& counts,
+    const DbePruning& dbe_pruning, const ChemistryRules& chemistry_rules, FormulaList& results) const {
+
+    const Weight& w = weights_[i];
+    if (i == 0) {
+        if (remaining % w.integer_mass != 0) return;
+        const long long count = remaining / w.integer_mass;
+        if (count < w.min_count || count > w.max_count) return;
+        counts[0] = static_cast<int>(count);
+
+        if (chemistry_rules.enabled) {
+            Formula res{}; // Initialize with zeros
+            for (std::size_t j = 0; j < weights_.size(); ++j) {
+                res[weights_[j].original_index] = counts[j];
             }
+            if (!chemistry_rules_accepted(res, chemistry_rules, *elements_)) return;
+        }
+        int32_t* row = results.append_row();
+        for (std::size_t j = 0; j < weights_.size(); ++j) {
+            row[weight_positions_[j]] = counts[j];
+        }
+        return;
+    }
+
+    const long long lighter_min = residual_min_mass_[i];
+    const long long lighter_max = residual_max_mass_[i];
+    if (remaining < lighter_min) return;
+
+    long long lowest = w.min_count;
+    if (remaining > lighter_max) {
+        const long long excess = remaining - lighter_max;
+        lowest = std::max(lowest, (excess + w.integer_mass - 1) / w.integer_mass);
+    }
+    const long long highest = std::min(static_cast<long long>(w.max_count),
+                                       (remaining - lighter_min) / w.integer_mass);
 
-            if (i <= k) {
-                m -= weights_[i].integer_mass;
-                c[i]++;
+    // Element/carbon ratios, checked exactly at the leaf. Above carbon, carbon_needed is the
+    // carbon count the fixed heavier elements require (max count / max ratio); at the carbon
+    // level it is a lower bound for the count.
+    const bool check_ratios = chemistry_rules.enabled;
+    const bool carbon_unfixed = check_ratios && carbon_weight_ < i;
+    const double max_ratio = carbon_unfixed ? chemistry_rules.max_ratio_to_carbon[w.original_index] : -1.0;
+    if (check_ratios && i == carbon_weight_) {
+        lowest = std::max(lowest, static_cast<long long>(std::ceil(carbon_needed - RATIO_SLACK)));
+    }
+
+    for (long long c = lowest; c <= highest; ++c) {
+        const long long rest = remaining - c * w.integer_mass;
+        // If weights 0..i cannot cover rest, adding more of weight i cannot help either.
+        if (!decomposable_fast(i, rest)) break;
+        if (!decomposable_fast(i - 1, rest)) continue;
+        const int twice_dbe = fixed_twice_dbe + w.twice_dbe_coefficient * static_cast<int>(c);
+        if (dbe_pruning.enabled && !dbe_reachable(i, rest, twice_dbe, dbe_pruning)) continue;
+        double needed = carbon_needed;
+        if (carbon_unfixed) {
+            if (max_ratio >= 0.0 && c > 0) {
+                if (max_ratio == 0.0) break;  // element excluded outright
+                needed = std::max(needed, c / max_ratio);
             }
+            // More of this element needs at least as much carbon but leaves less mass for it.
+            if (needed > carbon_cap(rest) + RATIO_SLACK) break;
+        } else if (check_ratios && i == carbon_weight_ && !lighter_min_ratios_reachable(i, rest, c, chemistry_rules)) {
+            // More carbon raises the minimum of the lighter elements and leaves less mass for them.
+            break;
         }
+        counts[i] = static_cast<int>(c);
+        enumerate_level(i - 1, rest, twice_dbe, needed, counts, dbe_pruning, chemistry_rules, results);
     }
-    
-    return results;
-}
\ No newline at end of file
+}
+
+// Largest carbon count weights 0..i-1 can still hold with the remaining mass (0 without carbon).
+long long MassDecomposer::carbon_cap(long long remaining) const {
+    if (carbon_weight_ < 0) return 0;
+    const Weight& carbon = weights_[carbon_weight_];
+    return std::min(static_cast<long long>(carbon.max_count), remaining / carbon.integer_mass);
+}
+
+// With carbon fixed at `carbon` on level i, whether every lighter element with a lower ratio bound
+// can still reach min_ratio * carbon within its count bound and the remaining mass.
+bool MassDecomposer::lighter_min_ratios_reachable(
+    int i, long long remaining, long long carbon, const ChemistryRules& chemistry_rules) const {
+    for (int j = 0; j < i; ++j) {
+        const Weight& w = weights_[j];
+        const double min_ratio = chemistry_rules.min_ratio_to_carbon[w.original_index];
+        if (min_ratio <= 0.0) continue;
+        const long long cap = std::min(static_cast<long long>(w.max_count), remaining / w.integer_mass);
+        if (cap < min_ratio * carbon - RATIO_SLACK) return false;
+    }
+    return true;
+}
+
+// Bounds 2*DBE over all completions of weights 0..i-1. Weights 1..i-1 use their count bounds
+// (precomputed per level); the lightest weight (hydrogen in practice) is additionally capped by
+// the remaining mass, which is what makes the DBE range tight near the leaves.
+bool MassDecomposer::dbe_reachable(
+    int i, long long remaining, int fixed_twice_dbe, const DbePruning& dbe_pruning) const {
+
+    const Weight& lightest = weights_[0];
+    const long long cap = std::min(static_cast<long long>(lightest.max_count), remaining / lightest.integer_mass);
+    if (cap < lightest.min_count) return false;
+
+    double highest = 2.0 + fixed_twice_dbe + residual_max_twice_dbe_[i];
+    double lowest = 2.0 + fixed_twice_dbe + residual_min_twice_dbe_[i];
+    if (lightest.twice_dbe_coefficient > 0) {
+        highest += static_cast<double>(lightest.twice_dbe_coefficient) * cap;
+        lowest += static_cast<double>(lightest.twice_dbe_coefficient) * lightest.min_count;
+    } else {
+        highest += static_cast<double>(lightest.twice_dbe_coefficient) * lightest.min_count;
+        lowest += static_cast<double>(lightest.twice_dbe_coefficient) * cap;
+    }
+    return highest >= dbe_pruning.min_twice_dbe && lowest <= dbe_pruning.max_twice_dbe;
+}
@@ -1,19 +1,77 @@
 #include "mass_decomposer_common.hpp"
 #include <omp.h>
+#include <numeric>
+
+namespace {
+// Applies params.schedule to the calling thread so the `schedule(runtime)` loops below use it,
+// and returns the team size for `num_threads(...)`.
+int configure_parallel_region(const DecompositionParams& params) {
+#if defined(_OPENMP) && _OPENMP >= 200805
+    omp_set_schedule(static_cast<omp_sched_t>(params.schedule), params.schedule_chunk_size);
+#endif
+    return params.n_threads > 0 ? params.n_threads : omp_get_max_threads();
+}
+
+// Item indices in descending estimated cost (identity when cost ordering is off). Starting the
+// most expensive items first keeps one heavy mass from finishing last on a single thread;
+// results are still written to their original slots.
+template <typename CostOf>
+std::vector<int> processing_order(int n_items, const DecompositionParams& params, CostOf cost_of) {
+    std::vector<int> order(n_items);
+    std::iota(order.begin(), order.end(), 0);
+    if (!params.cost_ordering || n_items < 2) return order;
+    std::vector<double> costs(n_items);
+    for (int i = 0; i < n_items; ++i) costs[i] = cost_of(i);
+    std::stable_sort(order.begin(), order.end(), [&costs](int a, int b) { return costs[a] > costs[b]; });
+    return order;
+}
+
+Formula candidate_envelope(const FormulaList& formulas) {
+    Formula envelope{};
+    const std::vector<int>& slots = formulas.slots();
+    for (std::size_t c = 0; c < formulas.size(); ++c) {
+        const int32_t* counts = formulas.row(c);
+        for (std::size_t j = 0; j < slots.size(); ++j) envelope[slots[j]] = std::max(envelope[slots[j]], counts[j]);
+    }
+    return envelope;
+}
+
+double formula_mass(const Formula& formula, const FormulaAnnotation::ElementTable& elements) {
+    double mass = 0.0;
+    for (int e = 0; e < elements.num_elements; ++e) mass += formula[e] * elements.masses[e];
+    return mass;
+}
 
-std::vector<std::vector<Formula>> MassDecomposer::decompose_parallel(
+double known_precursor_cost(
+    const Formula& precursor_formula, DoubleSpan fragment_masses, const MassTolerance& tolerance,
+    const FormulaAnnotation::ElementTable& elements) {
+    const Formula no_minimum{};
+    double cost = 0.0;
+    for (double fragment_mass : fragment_masses) {
+        cost += estimate_decomposition_cost(fragment_mass, no_minimum, precursor_formula, tolerance, elements);
+    }
+    return cost;
+}
+}  // namespace
+
+std::vector<FormulaList> MassDecomposer::decompose_parallel(
     const std::vector<double>& target_masses, 
     const DecompositionParams& params) {
     
     int n_masses = static_cast<int>(target_masses.size());
-    std::vector<std::vector<Formula>> all_results(n_masses);
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_masses, params, [&](int i) {
+        return estimate_decomposition_cost(target_masses[i], params.min_bounds, params.max_bounds, params.tolerance, *params.elements);
+    });
+    std::vector<FormulaList> all_results(n_masses);
     
-    #pragma omp parallel
+    #pragma omp parallel num_threads(n_threads)
     {
-        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds);
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
         
-        #pragma omp for schedule(dynamic)
-        for (int i = 0; i < n_masses; ++i) {
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n_masses; ++rank) {
+            const int i = order[rank];
             all_results[i] = thread_decomposer.decompose(target_masses[i], params);
         }
     }
@@ -21,69 +79,161 @@ std::vector<std::vector<Formula>> MassDecomposer::decompose_parallel(
     return all_results;
 }
 
-std::vector<std::vector<Formula>> MassDecomposer::decompose_masses_parallel_per_bounds(
+std::vector<FormulaList> MassDecomposer::decompose_masses_parallel_per_bounds(
     const std::vector<double>& target_masses,
     const std::vector<std::pair<Formula, Formula>>& per_mass_bounds,
     const DecompositionParams& params) {
 
     int n_masses = static_cast<int>(target_masses.size());
-    std::vector<std::vector<Formula>> all_results(n_masses);
-
-    #pragma omp parallel for schedule(dynamic)
-    for (int i = 0; i < n_masses; ++i) {
-        MassDecomposer thread_decomposer(per_mass_bounds[i].first, per_mass_bounds[i].second);
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_masses, params, [&](int i) {
+        return estimate_decomposition_cost(
+            target_masses[i], per_mass_bounds[i].first, per_mass_bounds[i].second, params.tolerance, *params.elements);
+    });
+    std::vector<FormulaList> all_results(n_masses);
+
+    #pragma omp parallel for num_threads(n_threads) schedule(runtime)
+    for (int rank = 0; rank < n_masses; ++rank) {
+        const int i = order[rank];
+        MassDecomposer thread_decomposer(per_mass_bounds[i].first, per_mass_bounds[i].second, params.elements);
         all_results[i] = thread_decomposer.decompose(target_masses[i], params);
     }
 
     return all_results;
 }
 
-ProperSpectrumResults MassDecomposer::decompose_spectrum(
-    double precursor_mass,
-    const std::vector<double>& fragment_masses,
+std::vector<FormulaList> MassDecomposer::decompose_masses_with_isotopes_parallel(
+    const std::vector<MassWithIsotopes>& features,
     const DecompositionParams& params) {
-    ProperSpectrumResults results;
 
-    // Decompose precursor mass
-    std::vector<Formula> precursor_formulas = decompose(precursor_mass, params);
+    int n_features = static_cast<int>(features.size());
+    const int n_threads = configure_parallel_region(params);
+    // Envelopes and the bounds they allow first, so cost ordering sees the tightened bounds.
+    std::vector<IsotopeEnvelope> envelopes(n_features);
+    std::vector<Formula> max_bounds(n_features);
+    for (int i = 0; i < n_features; ++i) {
+        const MassWithIsotopes& feature = features[i];
+        max_bounds[i] = feature.max_bounds;
+        if (!params.isotope_scoring.enabled) continue;
+        envelopes[i] = observe_isotope_envelope(
+            feature.precursor_mz, feature.ms1_mzs, feature.ms1_intensities, params.isotope_scoring);
+        tighten_bounds_by_isotopes(envelopes[i], params.isotope_scoring, max_bounds[i]);
+    }
+    const std::vector<int> order = processing_order(n_features, params, [&](int i) {
+        return estimate_decomposition_cost(
+            features[i].target_mass, features[i].min_bounds, max_bounds[i], params.tolerance, *params.elements);
+    });
+    std::vector<FormulaList> all_results(n_features);
+
+    #pragma omp parallel for num_threads(n_threads) schedule(runtime)
+    for (int rank = 0; rank < n_features; ++rank) {
+        const int i = order[rank];
+        bool feasible = true;
+        for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) feasible &= features[i].min_bounds[e] <= max_bounds[i][e];
+        if (!feasible) continue;  // the envelope rules out the required minimum counts
+        MassDecomposer thread_decomposer(features[i].min_bounds, max_bounds[i], params.elements);
+        all_results[i] = thread_decomposer.decompose(features[i].target_mass, params, envelopes[i]);
+    }
+
+    return all_results;
+}
+
+std::vector<long long> MassDecomposer::count_parallel(
+    const std::vector<double>& target_masses,
+    const DecompositionParams& params) {
+
+    int n_masses = static_cast<int>(target_masses.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_masses, params, [&](int i) {
+        return estimate_decomposition_cost(target_masses[i], params.min_bounds, params.max_bounds, params.tolerance, *params.elements);
+    });
+    std::vector<long long> counts(n_masses, 0);
 
-    // For each precursor formula reuse existing helper
-    for (const Formula& precursor_formula : precursor_formulas) {
-        SpectrumDecomposition decomp;
-        decomp.precursor = precursor_formula;
+    #pragma omp parallel num_threads(n_threads)
+    {
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
 
-        // Calculate precursor mass and absolute error
-        decomp.precursor_mass = 0.0;
-        for (int i = 0; i < FormulaAnnotation::NUM_ELEMENTS; ++i) {
-            decomp.precursor_mass += precursor_formula[i] * FormulaAnnotation::ATOMIC_MASSES[i];
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n_masses; ++rank) {
+            const int i = order[rank];
+            counts[i] = static_cast<long long>(thread_decomposer.count(target_masses[i], params));
         }
-        decomp.precursor_error_ppm = std::abs(decomp.precursor_mass - precursor_mass);
+    }
 
-        // Get fragment decompositions (unfiltered) using existing function
-        auto fragment_solutions = decompose_spectrum_known_precursor(
-            precursor_formula, fragment_masses, params);
+    return counts;
+}
 
-        decomp.fragments = fragment_solutions;
-        decomp.fragment_masses.resize(fragment_solutions.size());
-        decomp.fragment_errors_ppm.resize(fragment_solutions.size());
+std::vector<long long> MassDecomposer::count_masses_parallel_per_bounds(
+    const std::vector<double>& target_masses,
+    const std::vector<std::pair<Formula, Formula>>& per_mass_bounds,
+    const DecompositionParams& params) {
 
-        // Populate masses & errors with filtering (same logic as before)
-        for (size_t j = 0; j < fragment_solutions.size(); ++j) {
-            double target_mass = fragment_masses[j];
-            // double allowed_error = std::max(target_mass, 200.0) * params.tolerance_ppm / 1e6;
+    int n_masses = static_cast<int>(target_masses.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_masses, params, [&](int i) {
+        return estimate_decomposition_cost(
+            target_masses[i], per_mass_bounds[i].first, per_mass_bounds[i].second, params.tolerance, *params.elements);
+    });
+    std::vector<long long> counts(n_masses, 0);
+
+    #pragma omp parallel for num_threads(n_threads) schedule(runtime)
+    for (int rank = 0; rank < n_masses; ++rank) {
+        const int i = order[rank];
+        MassDecomposer thread_decomposer(per_mass_bounds[i].first, per_mass_bounds[i].second, params.elements);
+        counts[i] = static_cast<long long>(thread_decomposer.count(target_masses[i], params));
+    }
 
-            for (const auto& frag_formula : fragment_solutions[j]) {
-                double calc_mass = 0.0;
-                for (int k = 0; k < FormulaAnnotation::NUM_ELEMENTS; ++k) {
-                    calc_mass += frag_formula[k] * FormulaAnnotation::ATOMIC_MASSES[k];
-                }
-                double error = calc_mass - target_mass;
+    return counts;
+}
+
+ProperSpectrumResults MassDecomposer::decompose_spectrum(
+    double precursor_mass,
+    DoubleSpan fragment_masses,
+    DoubleSpan fragment_intensities,
+    const DecompositionParams& params) {
+    ProperSpectrumResults results;
+
+    // Decompose precursor mass, then the fragments of every candidate in one shared pass
+    const FormulaList precursor_formulas = decompose(precursor_mass, params);
+    auto fragment_solutions = decompose_spectrum_candidate_precursors(precursor_formulas, fragment_masses, params);
+
+    std::vector<SpectrumDecomposition>& decompositions = results.decompositions;
+    decompositions.resize(precursor_formulas.size());
+    for (std::size_t c = 0; c < precursor_formulas.size(); ++c) {
+        SpectrumDecomposition& decomp = decompositions[c];
+        decomp.precursor = precursor_formulas[c];
+        decomp.precursor_mass = formula_mass(decomp.precursor, *elements_);
+        decomp.precursor_error_ppm = (decomp.precursor_mass - precursor_mass) * 1e6 / precursor_mass;
+        decomp.fragments = std::move(fragment_solutions[c]);
+        decomp.explained_intensity = 0.0;
+        for (std::size_t j = 0; j < decomp.fragments.size(); ++j) {
+            if (decomp.fragments[j].empty()) continue;
+            decomp.explained_intensity += fragment_intensities.empty() ? 1.0 : fragment_intensities[j];
+        }
+    }
+
+    // Keep the candidates explaining most of the spectrum before computing their fragment masses.
+    if (params.top_k_precursors > 0) {
+        const std::size_t top_k = std::min(static_cast<std::size_t>(params.top_k_precursors), decompositions.size());
+        std::partial_sort(decompositions.begin(), decompositions.begin() + top_k, decompositions.end(),
+            [](const SpectrumDecomposition& a, const SpectrumDecomposition& b) {
+                if (a.explained_intensity != b.explained_intensity) return a.explained_intensity > b.explained_intensity;
+                return std::abs(a.precursor_error_ppm) < std::abs(b.precursor_error_ppm);
+            });
+        decompositions.resize(top_k);
+    }
+
+    for (SpectrumDecomposition& decomp : decompositions) {
+        decomp.fragment_masses.resize(decomp.fragments.size());
+        decomp.fragment_errors_ppm.resize(decomp.fragments.size());
+        for (std::size_t j = 0; j < decomp.fragments.size(); ++j) {
+            const double target_mass = fragment_masses[j];
+            for (std::size_t f = 0; f < decomp.fragments[j].size(); ++f) {
+                const double calc_mass = formula_mass(decomp.fragments[j][f], *elements_);
                 decomp.fragment_masses[j].push_back(calc_mass);
-                decomp.fragment_errors_ppm[j].push_back(error);
+                decomp.fragment_errors_ppm[j].push_back((calc_mass - target_mass) * 1e6 / target_mass);
             }
         }
-
-        results.decompositions.push_back(std::move(decomp));
     }
 
     return results;
@@ -94,17 +244,22 @@ std::vector<ProperSpectrumResults> MassDecomposer::decompose_spectra_parallel(
     const DecompositionParams& params) {
     
     int n_spectra = static_cast<int>(spectra.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_spectra, params, [&](int i) {
+        return estimate_decomposition_cost(spectra[i].precursor_mass, params.min_bounds, params.max_bounds, params.tolerance, *params.elements);
+    });
     std::vector<ProperSpectrumResults> all_results(n_spectra);
     
-    #pragma omp parallel
+    #pragma omp parallel num_threads(n_threads)
     {
-        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds);
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
         
-        #pragma omp for schedule(dynamic)
-        for (int i = 0; i < n_spectra; ++i) {
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n_spectra; ++rank) {
+            const int i = order[rank];
             const Spectrum& spectrum = spectra[i];
             all_results[i] = thread_decomposer.decompose_spectrum(
-                spectrum.precursor_mass, spectrum.fragment_masses, params);
+                spectrum.precursor_mass, spectrum.fragment_masses, spectrum.fragment_intensities, params);
         }
     }
     
@@ -116,31 +271,56 @@ std::vector<ProperSpectrumResults> MassDecomposer::decompose_spectra_parallel_pe
     const DecompositionParams& params) {
     
     int n_spectra = static_cast<int>(spectra.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_spectra, params, [&](int i) {
+        return estimate_decomposition_cost(
+            spectra[i].precursor_mass, spectra[i].precursor_min_bounds, spectra[i].precursor_max_bounds, params.tolerance,
+            *params.elements);
+    });
     std::vector<ProperSpectrumResults> all_results(n_spectra);
     
-    #pragma omp parallel for schedule(dynamic)
-    for (int i = 0; i < n_spectra; ++i) {
+    #pragma omp parallel for num_threads(n_threads) schedule(runtime)
+    for (int rank = 0; rank < n_spectra; ++rank) {
+        const int i = order[rank];
         const auto& spectrum = spectra[i];
-        MassDecomposer thread_decomposer(spectrum.precursor_min_bounds, spectrum.precursor_max_bounds);
+        MassDecomposer thread_decomposer(spectrum.precursor_min_bounds, spectrum.precursor_max_bounds, params.elements);
         all_results[i] = thread_decomposer.decompose_spectrum(
-            spectrum.precursor_mass, spectrum.fragment_masses, params);
+            spectrum.precursor_mass, spectrum.fragment_masses, spectrum.fragment_intensities, params);
     }
     
     return all_results;
 }
 
-std::vector<std::vector<Formula>> MassDecomposer::decompose_spectrum_known_precursor(
+std::vector<FormulaList> MassDecomposer::decompose_spectrum_known_precursor(
     const Formula& precursor_formula,
-    const std::vector<double>& fragment_masses,
+    DoubleSpan fragment_masses,
     const DecompositionParams& params) {
     
-    std::vector<std::vector<Formula>> fragment_results;
+    std::vector<FormulaList> fragment_results;
     fragment_results.resize(fragment_masses.size());
+
+    const long long lattice_budget = std::min(
+        params.max_subformula_lattice_size,
+        static_cast<long long>(fragment_masses.size()) * SubformulaIndex::BREAK_EVEN_ENTRIES_PER_FRAGMENT);
+    if (params.fragment_engine == FRAGMENT_ENGINE_SUBFORMULA_INDEX &&
+        SubformulaIndex::lattice_size(precursor_formula, lattice_budget) <= lattice_budget) {
+        double max_mass = 0.0;
+        for (double fragment_mass : fragment_masses) {
+            max_mass = std::max(max_mass, fragment_mass + params.tolerance.window(fragment_mass));
+        }
+        const SubformulaIndex index(precursor_formula, *elements_, params.min_dbe, params.max_dbe, max_mass);
+        for (size_t j = 0; j < fragment_masses.size(); ++j) {
+            fragment_results[j] = index.query(fragment_masses[j], params.tolerance, params.max_results);
+        }
+        return fragment_results;
+    }
+    // Lattice too large for the number of fragments (or money-changing requested):
+    // decompose each fragment bounded by the precursor.
     
     Formula fragment_min_bounds{};
     Formula fragment_max_bounds = precursor_formula;
     
-    MassDecomposer fragment_decomposer(fragment_min_bounds, fragment_max_bounds);
+    MassDecomposer fragment_decomposer(fragment_min_bounds, fragment_max_bounds, elements_);
     DecompositionParams fragment_params = params;
 
     
@@ -151,20 +331,26 @@ std::vector<std::vector<Formula>> MassDecomposer::decompose_spectrum_known_precu
     return fragment_results;
 }
 
-std::vector<std::vector<std::vector<Formula>>> MassDecomposer::decompose_spectra_known_precursor_parallel(
+std::vector<std::vector<FormulaList>> MassDecomposer::decompose_spectra_known_precursor_parallel(
     const std::vector<SpectrumWithKnownPrecursor>& spectra,
     const DecompositionParams& params) {
     
     int n_spectra = static_cast<int>(spectra.size());
-    std::vector<std::vector<std::vector<Formula>>> all_results(n_spectra);
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n_spectra, params, [&](int i) {
+        return known_precursor_cost(
+            spectra[i].precursor_formula, spectra[i].fragment_masses, params.tolerance, *params.elements);
+    });
+    std::vector<std::vector<FormulaList>> all_results(n_spectra);
     
-    #pragma omp parallel for schedule(dynamic)
-    for (int i = 0; i < n_spectra; ++i) {
+    #pragma omp parallel for num_threads(n_threads) schedule(runtime)
+    for (int rank = 0; rank < n_spectra; ++rank) {
+        const int i = order[rank];
         const SpectrumWithKnownPrecursor& spectrum = spectra[i];
         
         Formula fragment_min_bounds{};
         Formula fragment_max_bounds = spectrum.precursor_formula;
-        MassDecomposer thread_decomposer(fragment_min_bounds, fragment_max_bounds);
+        MassDecomposer thread_decomposer(fragment_min_bounds, fragment_max_bounds, params.elements);
 
         all_results[i] = thread_decomposer.decompose_spectrum_known_precursor(
             spectrum.precursor_formula, spectrum.fragment_masses, params);
@@ -175,8 +361,8 @@ std::vector<std::vector<std::vector<Formula>>> MassDecomposer::decompose_spectra
 
 MassDecomposer::CleanedSpectrumResult MassDecomposer::clean_spectrum_known_precursor(
     const Formula& precursor_formula,
-    const std::vector<double>& fragment_masses,
-    const std::vector<double>& fragment_intensities,
+    DoubleSpan fragment_masses,
+    DoubleSpan fragment_intensities,
     const DecompositionParams& params) {
 
     MassDecomposer::CleanedSpectrumResult out;
@@ -199,7 +385,7 @@ MassDecomposer::CleanedSpectrumResult MassDecomposer::clean_spectrum_known_precu
         const double target = fragment_masses[i];
         const double denom_allowed = std::max(target, 200.0);            // filtering
 
-        const auto& formulas = fragment_solutions[i];
+        auto& formulas = fragment_solutions[i];
         if (formulas.empty()) {
             continue; // drop fragment with no formulas
         }
@@ -210,12 +396,8 @@ MassDecomposer::CleanedSpectrumResult MassDecomposer::clean_spectrum_known_precu
         // Recompute error for reporting in ppm using the actual target mass
         const double denom_report = (target != 0.0) ? target : denom_allowed;
 
-        for (const auto& f : formulas) {
-            double calc_mass = 0.0;
-            for (int k = 0; k < FormulaAnnotation::NUM_ELEMENTS; ++k) {
-                calc_mass += f[k] * FormulaAnnotation::ATOMIC_MASSES[k];
-            }
-            const double error = calc_mass - target;
+        for (std::size_t f = 0; f < formulas.size(); ++f) {
+            const double error = formula_mass(formulas[f], *elements_) - target;
             const double ppm = error * 1e6 / denom_report; // report relative to actual mass
             errors_ppm.push_back(ppm);
         }
@@ -223,7 +405,7 @@ MassDecomposer::CleanedSpectrumResult MassDecomposer::clean_spectrum_known_precu
 
         out.masses.push_back(target);
         out.intensities.push_back(fragment_intensities[i]);
-        out.fragment_formulas.push_back(formulas);
+        out.fragment_formulas.push_back(std::move(formulas));
         out.fragment_errors_ppm.push_back(std::move(errors_ppm));
     }
 
@@ -235,15 +417,21 @@ std::vector<MassDecomposer::CleanedSpectrumResult> MassDecomposer::clean_spectra
     const DecompositionParams& params) {
 
     const int n = static_cast<int>(spectra.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n, params, [&](int i) {
+        return known_precursor_cost(
+            spectra[i].precursor_formula, spectra[i].fragment_masses, params.tolerance, *params.elements);
+    });
     std::vector<MassDecomposer::CleanedSpectrumResult> all_results(n);
 
-    #pragma omp parallel
+    #pragma omp parallel num_threads(n_threads)
     {
         // Thread-local decomposer instance to call non-static member
-        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds);
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
 
-        #pragma omp for schedule(dynamic)
-        for (int i = 0; i < n; ++i) {
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n; ++rank) {
+            const int i = order[rank];
             const auto& s = spectra[i];
             all_results[i] = thread_decomposer.clean_spectrum_known_precursor(
                 s.precursor_formula, s.fragment_masses, s.fragment_intensities, params);
@@ -254,41 +442,41 @@ std::vector<MassDecomposer::CleanedSpectrumResult> MassDecomposer::clean_spectra
 
 MassDecomposer::CleanedAndNormalizedSpectrumResult MassDecomposer::clean_and_normalize_spectrum_known_precursor(
     const Formula& precursor_formula,
-    const std::vector<double>& fragment_masses,
-    const std::vector<double>& fragment_intensities,
+    DoubleSpan fragment_masses,
+    DoubleSpan fragment_intensities,
     double precursor_mass,
     double max_allowed_normalized_mass_error_ppm,
     const DecompositionParams& params) {
 
+    // Compute all candidate formulas per fragment under the precursor constraint
+    const auto fragment_solutions = decompose_spectrum_known_precursor(
+        precursor_formula, fragment_masses, params);
+    return normalize_fragment_solutions(
+        precursor_formula, fragment_masses, fragment_intensities,
+        precursor_mass, max_allowed_normalized_mass_error_ppm, fragment_solutions);
+}
 
+MassDecomposer::CleanedAndNormalizedSpectrumResult MassDecomposer::normalize_fragment_solutions(
+    const Formula& precursor_formula,
+    DoubleSpan fragment_masses,
+    DoubleSpan fragment_intensities,
+    double precursor_mass,
+    double max_allowed_normalized_mass_error_ppm,
+    const std::vector<FormulaList>& fragment_solutions) const {
 
     const size_t n = fragment_masses.size();
     MassDecomposer::CleanedAndNormalizedSpectrumResult out;
     out.masses_normalized.reserve(n);
     out.intensities.reserve(n);
-    out.fragment_formulas.reserve(n);
     out.fragment_errors_ppm.reserve(n);
 
-    // Compute all candidate formulas per fragment under the precursor constraint
-    const auto fragment_solutions = decompose_spectrum_known_precursor(
-        precursor_formula, fragment_masses, params);
-
     // Selection bookkeeping
     std::vector<bool> keep(n, false);
     std::vector<Formula> chosen_formula(n);
     std::vector<double> chosen_error_unscaled(n, 0.0); // calc_mass - target_mass
 
-    // Helper: compute molecular mass for a formula
-    auto compute_mass_for = [](const Formula& f) {
-        double m = 0.0;
-        for (int k = 0; k < FormulaAnnotation::NUM_ELEMENTS; ++k) {
-            m += f[k] * FormulaAnnotation::ATOMIC_MASSES[k];
-        }
-        return m;
-    };
-
     // Compute precursor modeled mass and error once; will be used as an extra calibration point.
-    const double precursor_calc_mass = compute_mass_for(precursor_formula);
+    const double precursor_calc_mass = formula_mass(precursor_formula, *elements_);
     const double precursor_err = precursor_calc_mass - precursor_mass;
 
     // 1) Initial weighted linear fit err ~ a + b * mass using single-option fragments only.
@@ -310,7 +498,7 @@ MassDecomposer::CleanedAndNormalizedSpectrumResult MassDecomposer::clean_and_nor
         const auto& formulas = fragment_solutions[i];
         if (formulas.size() == 1) {
             const double target = fragment_masses[i];
-            const double calc_mass = compute_mass_for(formulas[0]);
+            const double calc_mass = formula_mass(formulas[0], *elements_);
             const double err = calc_mass - target;
             const double w = target; // mass-weight
 
@@ -361,7 +549,7 @@ MassDecomposer::CleanedAndNormalizedSpectrumResult MassDecomposer::clean_and_nor
         double best_err = 0.0;
 
         for (int c = 0; c < static_cast<int>(formulas.size()); ++c) {
-            const double calc_mass = compute_mass_for(formulas[c]);
+            const double calc_mass = formula_mass(formulas[c], *elements_);
             const double err = calc_mass - target;
             const double dev = std::abs(err - model); // abs vs squared yields same argmin
             if (dev < best_abs) {
@@ -407,6 +595,9 @@ MassDecomposer::CleanedAndNormalizedSpectrumResult MassDecomposer::clean_and_nor
     std::tie(a, b) = finalize_fit(Sw, Sx, Sy, Sxx, Sxy);
 
     // 4) Compute normalized results for all kept fragments, then filter by max_allowed_normalized_mass_error_ppm.
+    // Fragments are sub-formulas of the precursor, so the precursor's elements are their slots.
+    out.fragment_formulas = FormulaList(FormulaList::support(precursor_formula));
+    out.fragment_formulas.reserve(n);
     std::vector<double> tmp_masses_normalized;
     std::vector<double> tmp_intensities;
     std::vector<Formula> tmp_fragment_formulas;
@@ -456,15 +647,21 @@ MassDecomposer::clean_and_normalize_spectra_known_precursor_parallel(
     const DecompositionParams& params) {
 
     const int n = static_cast<int>(spectra.size());
+    const int n_threads = configure_parallel_region(params);
+    const std::vector<int> order = processing_order(n, params, [&](int i) {
+        return known_precursor_cost(
+            spectra[i].precursor_formula, spectra[i].fragment_masses, params.tolerance, *params.elements);
+    });
     std::vector<MassDecomposer::CleanedAndNormalizedSpectrumResult> all_results(n);
 
-    #pragma omp parallel
+    #pragma omp parallel num_threads(n_threads)
     {
         // Thread-local decomposer instance to call non-static member
-        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds);
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
 
-        #pragma omp for schedule(dynamic)
-        for (int i = 0; i < n; ++i) {
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n; ++rank) {
+            const int i = order[rank];
             const auto& s = spectra[i];
             all_results[i] = thread_decomposer.clean_and_normalize_spectrum_known_precursor(
                 s.precursor_formula,
@@ -476,4 +673,115 @@ MassDecomposer::clean_and_normalize_spectra_known_precursor_parallel(
         }
     }
     return all_results;
-}
\ No newline at end of file
+}
+
+std::vector<std::vector<FormulaList>> MassDecomposer::decompose_spectrum_candidate_precursors(
+    const FormulaList& precursor_formulas,
+    DoubleSpan fragment_masses,
+    const DecompositionParams& params) {
+
+    const std::size_t n_precursor_formulas = precursor_formulas.size();
+    std::vector<std::vector<FormulaList>> out(n_precursor_formulas);
+    auto decompose_each_candidate = [&]() {
+        for (std::size_t c = 0; c < n_precursor_formulas; ++c) {
+            out[c] = decompose_spectrum_known_precursor(precursor_formulas[c], fragment_masses, params);
+        }
+    };
+    if (n_precursor_formulas < 2) {
+        decompose_each_candidate();
+        return out;
+    }
+
+    // Every sub-formula of a candidate is a sub-formula of the element-wise maximum.
+    const Formula envelope = candidate_envelope(precursor_formulas);
+    const auto envelope_solutions = decompose_spectrum_known_precursor(envelope, fragment_masses, params);
+    for (const auto& formulas : envelope_solutions) {
+        // A truncated list could miss formulas a single candidate would have kept.
+        if (static_cast<int>(formulas.size()) >= params.max_results) {
+            decompose_each_candidate();
+            return out;
+        }
+    }
+
+    for (std::size_t c = 0; c < n_precursor_formulas; ++c) {
+        const Formula precursor_formula = precursor_formulas[c];
+        out[c].reserve(envelope_solutions.size());
+        for (const FormulaList& fragment_formulas : envelope_solutions) {
+            const std::vector<int>& slots = fragment_formulas.slots();
+            out[c].emplace_back(slots);
+            for (std::size_t f = 0; f < fragment_formulas.size(); ++f) {
+                const int32_t* counts = fragment_formulas.row(f);
+                bool contained = true;
+                for (std::size_t j = 0; j < slots.size() && contained; ++j) {
+                    contained = counts[j] <= precursor_formula[slots[j]];
+                }
+                if (contained) out[c].back().push_back(fragment_formulas, f);
+            }
+        }
+    }
+    return out;
+}
+
+std::vector<MassDecomposer::CleanedAndNormalizedSpectrumResult>
+MassDecomposer::clean_and_normalize_spectrum_candidate_precursors(
+    const FormulaList& precursor_formulas,
+    DoubleSpan fragment_masses,
+    DoubleSpan fragment_intensities,
+    double precursor_mass,
+    double max_allowed_normalized_mass_error_ppm,
+    const DecompositionParams& params) {
+
+    const auto candidate_solutions = decompose_spectrum_candidate_precursors(precursor_formulas, fragment_masses, params);
+    std::vector<MassDecomposer::CleanedAndNormalizedSpectrumResult> out;
+    out.reserve(precursor_formulas.size());
+    for (std::size_t c = 0; c < precursor_formulas.size(); ++c) {
+        out.push_back(normalize_fragment_solutions(
+            precursor_formulas[c], fragment_masses, fragment_intensities,
+            precursor_mass, max_allowed_normalized_mass_error_ppm, candidate_solutions[c]));
+    }
+    return out;
+}
+
+std::vector<MassDecomposer::CleanedAndNormalizedSpectrumResult>
+MassDecomposer::clean_and_normalize_spectra_candidate_precursors_parallel(
+    const std::vector<MassDecomposer::CleanSpectrumWithCandidatePrecursors>& spectra,
+    const DecompositionParams& params) {
+
+    const int n = static_cast<int>(spectra.size());
+    const int n_threads = configure_parallel_region(params);
+    // Candidates as formula lists over the elements they use.
+    std::vector<FormulaList> candidates(n);
+    for (int i = 0; i < n; ++i) {
+        candidates[i] = FormulaList::from_dense_rows(
+            spectra[i].precursor_formulas, spectra[i].n_precursor_formulas, params.elements->num_elements);
+    }
+    const std::vector<int> order = processing_order(n, params, [&](int i) {
+        if (candidates[i].empty()) return 0.0;
+        return known_precursor_cost(
+            candidate_envelope(candidates[i]), spectra[i].fragment_masses, params.tolerance, *params.elements);
+    });
+    // Candidate results of spectrum i start at first_result[i].
+    std::vector<std::size_t> first_result(n + 1, 0);
+    for (int i = 0; i < n; ++i) first_result[i + 1] = first_result[i] + spectra[i].n_precursor_formulas;
+    std::vector<MassDecomposer::CleanedAndNormalizedSpectrumResult> all_results(first_result[n]);
+
+    #pragma omp parallel num_threads(n_threads)
+    {
+        MassDecomposer thread_decomposer(params.min_bounds, params.max_bounds, params.elements);
+
+        #pragma omp for schedule(runtime)
+        for (int rank = 0; rank < n; ++rank) {
+            const int i = order[rank];
+            const auto& s = spectra[i];
+            auto candidate_results = thread_decomposer.clean_and_normalize_spectrum_candidate_precursors(
+                candidates[i],
+                s.fragment_masses,
+                s.fragment_intensities,
+                s.precursor_mass,
+                s.max_allowed_normalized_mass_error_ppm,
+                params);
+            std::move(candidate_results.begin(), candidate_results.end(), all_results.begin() + first_result[i]);
+        }
+    }
+    return all_results;
+}
@@ -0,0 +1,113 @@
+#include "mass_decomposer_common.hpp"
+
+long long SubformulaIndex::lattice_size(const Formula& precursor_formula, long long cap) {
+    long long size = 1;
+    for (int e = 0; e < FormulaAnnotation::MAX_ELEMENTS; ++e) {
+        const long long radix = static_cast<long long>(std::max(precursor_formula[e], 0)) + 1;
+        size *= radix;
+        if (size > cap) return cap + 1;
+    }
+    return size;
+}
+
+SubformulaIndex::SubformulaIndex(
+    const Formula& precursor_formula, const FormulaAnnotation::ElementTable& elements,
+    double min_dbe, double max_dbe, double max_mass) {
+    for (int e = 0; e < elements.num_elements; ++e) {
+        if (precursor_formula[e] > 0) {
+            active_elements_.push_back(e);
+            radices_.push_back(static_cast<std::uint32_t>(precursor_formula[e]) + 1u);
+        }
+    }
+    const std::size_t k = active_elements_.size();
+    const double min_twice_dbe = 2.0 * min_dbe;
+    const double max_twice_dbe = 2.0 * max_dbe;
+
+    std::vector<std::pair<double, std::uint32_t>> entries;
+    if (k == 0) {
+        // Empty precursor: the only sub-formula is the empty one (2*DBE = 2).
+        if (min_twice_dbe <= 2.0 && 2.0 <= max_twice_dbe) entries.emplace_back(0.0, 0u);
+    } else {
+        // Odometer over active elements 1..k-1; the first active element (hydrogen in practice,
+        // with the largest radix) is the innermost loop so each entry costs O(1).
+        // Codes are mixed-radix indices with the first active element fastest.
+        const std::uint32_t inner_radix = radices_[0];
+        const double inner_mass = elements.masses[active_elements_[0]];
+        const int inner_twice_dbe = elements.twice_dbe_coefficients[active_elements_[0]];
+        std::vector<std::uint32_t> counts(k, 0);
+        std::uint32_t outer_code = 0;
+        while (true) {
+            int outer_twice_dbe = 2;
+            double outer_mass = 0.0;
+            for (std::size_t j = 1; j < k; ++j) {
+                outer_twice_dbe += elements.twice_dbe_coefficients[active_elements_[j]] * static_cast<int>(counts[j]);
+                outer_mass += counts[j] * elements.masses[active_elements_[j]];
+            }
+            for (std::uint32_t x = 0; x < inner_radix; ++x) {
+                const double mass = outer_mass + x * inner_mass;
+                if (mass > max_mass) break;
+                // Same DBE rule as FormulaBlockEvaluator::twice_dbe_accepted: in range and integer.
+                const int twice_dbe = outer_twice_dbe + inner_twice_dbe * static_cast<int>(x);
+                if (twice_dbe < min_twice_dbe || twice_dbe > max_twice_dbe || (twice_dbe & 1)) continue;
+                entries.emplace_back(mass, outer_code + x);
+            }
+
+            std::size_t pos = 1;
+            while (pos < k && counts[pos] + 1 == radices_[pos]) {
+                counts[pos] = 0;
+                ++pos;
+            }
+            if (pos == k) break;
+            ++counts[pos];
+            outer_code += inner_radix;
+        }
+    }
+
+    // Counting sort into fine mass bins, then insertion sort inside each bin: the lattice is spread
+    // thinly over the mass axis, so this is linear in practice while std::sort dominated the build.
+    constexpr double BIN_WIDTH = 0.01;
+    const std::size_t n_bins = static_cast<std::size_t>(std::max(max_mass, 0.0) / BIN_WIDTH) + 2;
+    std::vector<std::uint32_t> bin_starts(n_bins + 1, 0);
+    for (const auto& entry : entries) {
+        ++bin_starts[static_cast<std::size_t>(entry.first / BIN_WIDTH) + 1];
+    }
+    for (std::size_t b = 0; b < n_bins; ++b) bin_starts[b + 1] += bin_starts[b];
+
+    masses_.resize(entries.size());
+    codes_.resize(entries.size());
+    for (const auto& entry : entries) {
+        const std::uint32_t slot = bin_starts[static_cast<std::size_t>(entry.first / BIN_WIDTH)]++;
+        masses_[slot] = entry.first;
+        codes_[slot] = entry.second;
+    }
+    for (std::size_t i = 1; i < masses_.size(); ++i) {
+        const double mass = masses_[i];
+        const std::uint32_t code = codes_[i];
+        std::size_t j = i;
+        for (; j > 0 && masses_[j - 1] > mass; --j) {
+            masses_[j] = masses_[j - 1];
+            codes_[j] = codes_[j - 1];
+        }
+        masses_[j] = mass;
+        codes_[j] = code;
+    }
+}
+
+FormulaList SubformulaIndex::query(double target_mass, const MassTolerance& mass_tolerance, int max_results) const {
+    // Same tolerance window as MassDecomposer::decompose.
+    const double tolerance = mass_tolerance.window(target_mass);
+    FormulaList results(active_elements_);
+    auto it = std::lower_bound(masses_.begin(), masses_.end(), target_mass - tolerance);
+    for (; it != masses_.end() && *it <= target_mass + tolerance; ++it) {
+        if (std::abs(*it - target_mass) > tolerance) continue;
+        // Mixed-radix code -> counts of the active elements, which are the slots of the results
+        std::uint32_t code = codes_[static_cast<std::size_t>(it - masses_.begin())];
+        int32_t* counts = results.append_row();
+        for (std::size_t j = 0; j < active_elements_.size(); ++j) {
+            counts[j] = static_cast<int32_t>(code % radices_[j]);
+            code /= radices_[j];
+        }
+        if (static_cast<int>(results.size()) >= max_results) break;
+    }
+    return results;
+}
@@ -38,7 +38,8 @@ extensions = [
             "mass_decomposer_cpp.pyx", 
             "mass_decomposer_common.cpp",
             "mass_decomposer_money_changing.cpp",
-            "mass_decomposer_parallel.cpp"
+            "mass_decomposer_parallel.cpp",
+            "mass_decomposer_subformula.cpp"
         ],
         include_dirs=[numpy.get_include(), "."],
         extra_compile_args=cpp_compile_args + openmp_compile_args,
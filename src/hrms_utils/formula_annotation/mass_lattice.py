@@ -0,0 +1,265 @@
+import json
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+from pathlib import Path
+from typing import Any
+from .element_table import (
+    ELEMENT_SYMBOLS,
+    ELEMENT_MASSES,
+    ELEMENT_TWICE_DBE_COEFFICIENTS,
+    ELEMENT_VALENCES,
+)
+from .mass_tolerance import mass_tolerance_config, _tolerance_kwargs
+from .mass_decomposition import (
+    NUM_ELEMENTS,
+    chemistry_rules_config,
+    decompose_mass_parallel,
+    filter_formulas_parallel,
+    _chemistry_kwargs,
+    _formula_rows,
+    _kept_formula_lists,
+    _parallel_kwargs,
+)
+
+_METADATA_FILE = "lattice.json"
+_MASSES_FILE = "masses.npy"
+_LATTICE_FORMAT_VERSION = 1
+# windows enumerated per decomposer call while building, and written as one chunk: bounds the
+# build memory to the formulas of 256 * step_da Da
+_BUILD_WINDOWS_PER_CALL = 256
+
+
+def build_mass_lattice(
+    path: str | Path,
+    min_bounds: NDArray[np.int32],
+    max_bounds: NDArray[np.int32],
+    max_mass: float,
+    min_dbe: float = 0.0,
+    max_dbe: float = 40.0,
+    chemistry_rules: chemistry_rules_config | None = None,
+    step_da: float = 0.05,
+    n_threads: int | None = None,
+    schedule: str | None = None,
+    schedule_chunk_size: int | None = None,
+) -> 'mass_lattice':
+    """
+    Enumerate every formula within [min_bounds, max_bounds], [min_dbe, max_dbe] and chemistry_rules
+    up to max_mass once, and write them to the directory path sorted by exact mass: masses.npy
+    (float64), one <symbol>.npy count column per element whose bounds differ (smallest unsigned
+    dtype that holds max_bounds), and lattice.json with the build settings. Returns the opened
+    mass_lattice.
+
+    The enumeration tiles [0, max_mass] with absolute windows of step_da (slightly overlapping, each
+    formula assigned to the window its mass falls in), using the C++ decomposer. The file size is
+    about 8 + (number of varying elements) bytes per formula; check count_mass_decompositions on a
+    few masses before building wide bounds up to high masses. The files are written one chunk of
+    windows at a time, so memory holds the formulas of one chunk, not of the whole lattice.
+    """
+    min_bounds = np.asarray(min_bounds)
+    max_bounds = np.asarray(max_bounds)
+    assert min_bounds.shape == (NUM_ELEMENTS,) and max_bounds.shape == (NUM_ELEMENTS,), (
+        f"min_bounds and max_bounds should have shape ({NUM_ELEMENTS},), but got {min_bounds.shape} and {max_bounds.shape}"
+    )
+    assert min_bounds.dtype == np.int32 and max_bounds.dtype == np.int32, (
+        f"min_bounds and max_bounds should be of type int32, but got {min_bounds.dtype} and {max_bounds.dtype}"
+    )
+    assert np.all(min_bounds >= 0) and np.all(min_bounds <= max_bounds), "bounds should satisfy 0 <= min_bounds <= max_bounds"
+    assert isinstance(max_mass, (float, int)) and max_mass > 0, f"max_mass should be a positive number, but got {max_mass}"
+    assert isinstance(min_dbe, (float, int)) and isinstance(max_dbe, (float, int)) and min_dbe <= max_dbe, (
+        f"min_dbe and max_dbe should be numbers with min_dbe <= max_dbe, but got {min_dbe} and {max_dbe}"
+    )
+    assert isinstance(step_da, (float, int)) and step_da > 0, f"step_da should be a positive number, but got {step_da}"
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    n_windows = int(np.ceil(max_mass / step_da))
+    # half-width a little above step_da / 2 so formulas on a window edge are found on both sides
+    window_kwargs = mass_tolerance_config.absolute(step_da * (0.5 + 1e-6))._wrapper_kwargs()
+    element_masses = np.asarray(ELEMENT_MASSES, dtype=np.float64)
+    masses_file = _npy_appender(path / _MASSES_FILE, np.float64)
+    column_files = {}
+    columns = {}
+    for index, symbol in enumerate(ELEMENT_SYMBOLS):
+        if min_bounds[index] == max_bounds[index]:
+            continue
+        dtype = np.uint8 if max_bounds[index] <= np.iinfo(np.uint8).max else np.uint16
+        column_files[index] = _npy_appender(path / f"{symbol}.npy", dtype)
+        columns[symbol] = f"{symbol}.npy"
+    try:
+        # windows are enumerated in ascending mass and each formula is kept by the one window its
+        # mass falls in, so chunks sorted on their own are written in global mass order
+        for first_window in range(0, n_windows, _BUILD_WINDOWS_PER_CALL):
+            windows = np.arange(first_window, min(first_window + _BUILD_WINDOWS_PER_CALL, n_windows))
+            results = decompose_mass_parallel(
+                target_masses=pl.Series((windows + 0.5) * step_da, dtype=pl.Float64),
+                min_bounds=min_bounds,
+                max_bounds=max_bounds,
+                **window_kwargs,
+                min_dbe=min_dbe,
+                max_dbe=max_dbe,
+                max_results=np.iinfo(np.int32).max,
+                **_chemistry_kwargs(chemistry_rules),
+                **_parallel_kwargs(n_threads, schedule, schedule_chunk_size),
+            )
+            offsets, formulas = _formula_rows(results)
+            masses = formulas @ element_masses
+            owner = np.repeat(windows, np.diff(offsets))
+            keep = np.flatnonzero((np.floor(masses / step_da) == owner) & (masses <= max_mass))
+            order = keep[np.argsort(masses[keep], kind="stable")]
+            masses_file.append(masses[order])
+            for index, column_file in column_files.items():
+                column_file.append(formulas[order, index])
+    finally:
+        masses_file.close()
+        for column_file in column_files.values():
+            column_file.close()
+    metadata = {
+        "format_version": _LATTICE_FORMAT_VERSION,
+        "n_formulas": masses_file.length,
+        "max_mass": float(max_mass),
+        "min_bounds": min_bounds.tolist(),
+        "max_bounds": max_bounds.tolist(),
+        "min_dbe": float(min_dbe),
+        "max_dbe": float(max_dbe),
+        "chemistry": _metadata_value(_chemistry_kwargs(chemistry_rules)),
+        "elements": [list(ELEMENT_SYMBOLS), list(ELEMENT_MASSES), list(ELEMENT_TWICE_DBE_COEFFICIENTS), list(ELEMENT_VALENCES)],
+        "columns": columns,
+    }
+    with open(path / _METADATA_FILE, "w") as handle:
+        json.dump(metadata, handle, indent=1)
+    return mass_lattice(path)
+
+
+class mass_lattice:
+    """
+    Read-only, memory-mapped index of every formula within fixed bounds up to a maximum mass,
+    written by build_mass_lattice. Opening it maps the column files without reading them, so
+    worker processes opening the same directory share one copy in the OS page cache.
+
+    decompose resolves a batch of masses by binary search of the sorted masses plus the
+    decomposer's exact-mass and DBE filter: for masses up to max_mass it returns the same formulas
+    as decompose_mass with the build bounds, DBE range and chemistry rules, sorted by mass instead
+    of in enumeration order.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path / _METADATA_FILE) as handle:
+            metadata = json.load(handle)
+        assert metadata["format_version"] == _LATTICE_FORMAT_VERSION, (
+            f"{self.path} has lattice format {metadata['format_version']}, expected {_LATTICE_FORMAT_VERSION}"
+        )
+        if metadata["elements"][0] != list(ELEMENT_SYMBOLS) or not np.allclose(
+            metadata["elements"][1], ELEMENT_MASSES, rtol=0, atol=1e-12
+        ):
+            raise ValueError(f"{self.path} was built with a different element table")
+        self.max_mass = metadata["max_mass"]
+        self.min_dbe = metadata["min_dbe"]
+        self.max_dbe = metadata["max_dbe"]
+        self.min_bounds = np.array(metadata["min_bounds"], dtype=np.int32)
+        self.max_bounds = np.array(metadata["max_bounds"], dtype=np.int32)
+        self.chemistry = metadata["chemistry"]
+        self.masses = np.load(self.path / _MASSES_FILE, mmap_mode="r")
+        self._columns = {
+            ELEMENT_SYMBOLS.index(symbol): np.load(self.path / file_name, mmap_mode="r")
+            for symbol, file_name in metadata["columns"].items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.masses)
+
+    def formulas(self, indices: NDArray[np.int64]) -> NDArray[np.int32]:
+        """(len(indices), NUM_ELEMENTS) int32 formulas at the given positions of the mass order."""
+        formulas = np.empty((len(indices), NUM_ELEMENTS), dtype=np.int32)
+        formulas[:] = self.min_bounds
+        for index, column in self._columns.items():
+            formulas[:, index] = column[indices]
+        return formulas
+
+    def decompose(
+        self,
+        mass_series: pl.Series,
+        tolerance_ppm: float = 5.0,
+        min_dbe: float | None = None,
+        max_dbe: float | None = None,
+        max_results: int = 100000,
+        tolerance: mass_tolerance_config | None = None,
+    ) -> pl.Series:
+        """
+        Formulas of each mass in mass_series, like decompose_mass: a List(Array(Int32, NUM_ELEMENTS))
+        Series named "decomposed_formula", sorted by mass within each row and capped at max_results.
+        min_dbe / max_dbe narrow the build DBE range (None keeps it); masses above max_mass get the
+        part of their window the lattice covers. Null masses give empty lists.
+        """
+        assert isinstance(mass_series, pl.Series), f"mass_series should be a Polars Series, but got {type(mass_series)}"
+        assert mass_series.dtype == pl.Float64, f"mass_series should be of type Float64, but got {mass_series.dtype}"
+        assert isinstance(tolerance_ppm, (float, int)) and tolerance_ppm > 0, f"tolerance_ppm should be a positive value, but got {tolerance_ppm}"
+        assert isinstance(max_results, int) and max_results > 0, f"max_results should be a positive integer, but got {max_results}"
+        min_dbe = self.min_dbe if min_dbe is None else min_dbe
+        max_dbe = self.max_dbe if max_dbe is None else max_dbe
+        assert self.min_dbe <= min_dbe <= max_dbe <= self.max_dbe, (
+            f"the DBE range should lie within the lattice's [{self.min_dbe}, {self.max_dbe}], but got [{min_dbe}, {max_dbe}]"
+        )
+        masses = mass_series.fill_null(np.nan).to_numpy()
+        window = (tolerance if tolerance is not None else mass_tolerance_config(ppm=tolerance_ppm)).tolerance_da(masses)
+        # a little wider than the window, the exact test is the filter below
+        margin = window * 1e-6 + 1e-9
+        lower = np.searchsorted(self.masses, masses - window - margin, side="left")
+        upper = np.searchsorted(self.masses, masses + window + margin, side="right")
+        lengths = np.where(np.isfinite(masses), upper - lower, 0).astype(np.int64)
+        starts = np.repeat(lower - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        indices = starts + np.arange(lengths.sum(), dtype=np.int64)
+        formulas = self.formulas(indices)
+        keep = filter_formulas_parallel(
+            formulas=formulas,
+            target_masses=np.repeat(masses, lengths),
+            tolerance_ppm=tolerance_ppm,
+            **_tolerance_kwargs(tolerance),
+            min_dbe=min_dbe,
+            max_dbe=max_dbe,
+        )
+        return _kept_formula_lists(formulas, lengths, keep, max_results)
+
+
+class _npy_appender:
+    """
+    A 1-D .npy file written chunk by chunk: the header is rewritten with the final length on close,
+    in place, since numpy pads the header so that the length can grow.
+    """
+
+    def __init__(self, path: Path, dtype: Any):
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._file = open(path, "wb")
+        self._header_size = self._write_header()
+
+    def _write_header(self) -> int:
+        self._file.seek(0)
+        np.lib.format.write_array_header_1_0(
+            self._file, {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.length,)}
+        )
+        return self._file.tell()
+
+    def append(self, values: NDArray) -> None:
+        self._file.seek(0, 2)
+        np.ascontiguousarray(values, dtype=self.dtype).tofile(self._file)
+        self.length += len(values)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        header_size = self._write_header()
+        self._file.close()
+        assert header_size == self._header_size, "the .npy header grew while writing, the column file is corrupt"
+
+
+def _metadata_value(value: Any) -> Any:
+    """JSON-compatible copy of the chemistry wrapper kwargs (NaN ratios become None)."""
+    if isinstance(value, dict):
+        return {key: _metadata_value(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return [None if isinstance(v, float) and np.isnan(v) else v for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -0,0 +1,61 @@
+import numpy as np
+from numpy.typing import ArrayLike, NDArray
+from dataclasses import dataclass
+from typing import Any, Dict
+
+
+@dataclass(frozen=True)
+class mass_tolerance_config:
+    """
+    Half-width of the accepted mass window, shared by the mass decomposition, the spectrum cleaning
+    and the isotopic pattern deduction, so one object describes the instrument everywhere.
+
+    With m' = max(mass, ppm_floor_mass):
+        tolerance(mass) = max(absolute_floor_da, m' * (ppm + ppm_per_da * m' + ppm_per_da_squared * m'**2) / 1e6)
+
+    The defaults reproduce the plain tolerance_ppm window (ppm over max(mass, 200)). Below
+    ppm_floor_mass that window is constant in Da, i.e. wider than ppm in relative terms, which is
+    where most spurious fragment candidates come from; lower ppm_floor_mass (and set
+    absolute_floor_da to the instrument's mDa floor) to tighten it, and use the polynomial terms for
+    a calibrated mass dependence of the error. Negative ppm values are clipped to a zero window.
+    """
+    ppm: float = 5.0
+    ppm_per_da: float = 0.0
+    ppm_per_da_squared: float = 0.0
+    ppm_floor_mass: float = 200.0
+    absolute_floor_da: float = 0.0
+
+    def __post_init__(self):
+        for name in self.__dataclass_fields__:
+            value = getattr(self, name)
+            assert isinstance(value, (float, int)) and np.isfinite(value), f"{name} should be a finite number, but got {value}"
+        assert self.ppm_floor_mass >= 0, f"ppm_floor_mass should be non-negative, but got {self.ppm_floor_mass}"
+        assert self.absolute_floor_da >= 0, f"absolute_floor_da should be non-negative, but got {self.absolute_floor_da}"
+        assert self.ppm > 0 or self.absolute_floor_da > 0, "either ppm or absolute_floor_da should be positive"
+
+    @classmethod
+    def absolute(cls, tolerance_da: float) -> 'mass_tolerance_config':
+        """A fixed window of tolerance_da at every mass."""
+        return cls(ppm=0.0, ppm_floor_mass=0.0, absolute_floor_da=tolerance_da)
+
+    def tolerance_da(self, mass: ArrayLike) -> NDArray[np.float64]:
+        """Window half-width in Da at each mass; same arithmetic as MassTolerance::window in C++."""
+        reference_mass = np.maximum(np.asarray(mass, dtype=np.float64), self.ppm_floor_mass)
+        reference_ppm = self.ppm + (self.ppm_per_da + self.ppm_per_da_squared * reference_mass) * reference_mass
+        return np.maximum(self.absolute_floor_da, np.maximum(0.0, reference_mass * reference_ppm / 1e6))
+
+    def _wrapper_kwargs(self) -> Dict[str, Any]:
+        """The (ppm, ppm_per_da, ppm_per_da_squared, ppm_floor_mass, absolute_floor_da) tuple for the Cython wrappers."""
+        return {
+            "tolerance_model": (
+                float(self.ppm), float(self.ppm_per_da), float(self.ppm_per_da_squared),
+                float(self.ppm_floor_mass), float(self.absolute_floor_da),
+            )
+        }
+
+
+def _tolerance_kwargs(tolerance: mass_tolerance_config | None) -> Dict[str, Any]:
+    assert tolerance is None or isinstance(tolerance, mass_tolerance_config), (
+        f"tolerance should be None or a mass_tolerance_config, but got {type(tolerance)}"
+    )
+    return {} if tolerance is None else tolerance._wrapper_kwargs()
@@ -4,10 +4,11 @@ import polars as pl
 from aiohttp import ClientSession
 import asyncio
 from ..formula_annotation.utils import format_formula_string_to_array
+from ..formula_annotation.element_table import NUM_ELEMENTS
 from pathlib import Path
 import numpy as np
 from typing import Any, List, Tuple, Dict, Optional
-num_elements = 15
+num_elements = NUM_ELEMENTS
 
 def get_all_compounds(project_name):
     sirius_base_url = _get_sirius_base_url()
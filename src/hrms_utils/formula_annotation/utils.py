@@ -1,9 +1,10 @@
 import re
 import numpy as np
 import polars as pl
+import pyarrow.compute as pc
 import math
 from functools import lru_cache
-from typing import TypeVar, overload
+from typing import Sequence, TypeVar, overload
 from .element_table import (
     NUM_ELEMENTS,
     ELEMENTS,
@@ -129,6 +130,64 @@ def formula_to_array(df: T, input_col_name: str, output_col_name: str) -> T:
     df = df.drop(list(ELEMENT_SYMBOLS))
     return df
 
+def _formula_element_expression(formula: pl.Expr, index: int) -> pl.Expr:
+    return formula.arr.get(index).cast(pl.Int32).alias(ELEMENT_SYMBOLS[index])
+
+def compact_formulas(formulas: pl.Series, elements: Sequence[str] | None = None) -> pl.Series:
+    """
+    Sparse columnar form of formula arrays: a pl.Struct with one Int32 field per kept element, named
+    by symbol, so stored or long-lived results take memory for the elements in use instead of all
+    NUM_ELEMENTS slots (a CHNO batch takes 4 ints per formula whatever the alphabet). It is a conversion of
+    the decomposers' output, which still has NUM_ELEMENTS slots per formula. Accepts pl.Array(int, NUM_ELEMENTS) Series and
+    the nested pl.List(pl.Array(...)) output of the decomposers, which becomes pl.List(pl.Struct).
+
+    elements lists the fields to keep, in any order; None keeps every element that is non-zero in at
+    least one formula (all-zero input keeps the first element, structs need a field). Pass it to
+    get the same schema for every batch, e.g. before writing parquet partitions. Counts of left-out
+    elements must be zero. expand_formulas restores the arrays.
+    """
+    nested = isinstance(formulas.dtype, pl.List)
+    array_dtype = formulas.dtype.inner if nested else formulas.dtype
+    assert isinstance(array_dtype, pl.Array) and array_dtype.size == NUM_ELEMENTS, (
+        f"formulas should be pl.Array(int, {NUM_ELEMENTS}) or a pl.List of it, but got {formulas.dtype}"
+    )
+    flat = pl.Series(pc.list_flatten(formulas.to_arrow())) if nested else formulas
+    counts = flat.drop_nulls().to_numpy().reshape(-1, NUM_ELEMENTS)
+    used = np.flatnonzero((counts != 0).any(axis=0))
+    if elements is None:
+        kept = used if used.size > 0 else np.array([0])
+    else:
+        unknown = [symbol for symbol in elements if symbol not in ELEMENT_SYMBOLS]
+        assert not unknown, f"Unknown elements {unknown}, expected symbols from {ELEMENT_SYMBOLS}"
+        kept = np.array(sorted(ELEMENT_SYMBOLS.index(symbol) for symbol in set(elements)), dtype=np.int64)
+        dropped = [ELEMENT_SYMBOLS[i] for i in used if i not in kept]
+        assert not dropped, f"elements leaves out {dropped}, which are non-zero in some formulas"
+
+    if nested:
+        return formulas.list.eval(pl.struct([_formula_element_expression(pl.element(), int(i)) for i in kept]))
+    return formulas.to_frame("formula").select(
+        pl.struct([_formula_element_expression(pl.col("formula"), int(i)) for i in kept]).alias(formulas.name)
+    ).to_series()
+
+def expand_formulas(compact: pl.Series) -> pl.Series:
+    """Inverse of compact_formulas: pl.Struct (or pl.List(pl.Struct)) element counts back to pl.Array(pl.Int32, NUM_ELEMENTS), missing elements as 0."""
+    nested = isinstance(compact.dtype, pl.List)
+    struct_dtype = compact.dtype.inner if nested else compact.dtype
+    assert isinstance(struct_dtype, pl.Struct), f"compact should be a pl.Struct or a pl.List of it, but got {compact.dtype}"
+    fields = {field.name for field in struct_dtype.fields}
+    unknown = sorted(fields - set(ELEMENT_SYMBOLS))
+    assert not unknown, f"Unknown element fields {unknown}, expected symbols from {ELEMENT_SYMBOLS}"
+
+    def expand(struct: pl.Expr) -> pl.Expr:
+        return pl.concat_list([
+            struct.struct.field(symbol).cast(pl.Int32) if symbol in fields else pl.lit(0, dtype=pl.Int32)
+            for symbol in ELEMENT_SYMBOLS
+        ]).list.to_array(NUM_ELEMENTS)
+
+    if nested:
+        return compact.list.eval(expand(pl.element()))
+    return compact.to_frame("compact").select(expand(pl.col("compact")).alias(compact.name)).to_series()
+
 if __name__ == '__main__':
     main_df = pl.DataFrame({
         'MOLECULAR_FORMULA': ['C11H14BrNO2', 'C9H12BrN', 'C9H12BN', 'C9H12Br','C9H12B','Br', 'Br2']
@@ -1,11 +1,53 @@
 import polars as pl
 import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
 from typing import Any
 from pathlib import Path
+from hrms_utils.formula_annotation import element_table
+from hrms_utils.formula_annotation.mass_decomposition_impl import mass_decomposer_cpp
+from hrms_utils.formula_annotation.isotopic_pattern import isotope_ratio_table, isotopic_pattern_dict, sulfur_halogen_ratio_table, NITROGEN_SEPARATION_RESOLUTION
 from hrms_utils.formula_annotation import (
     decompose_mass,
     decompose_mass_per_bounds,
-    decompose_spectra_known_precursor
+    decompose_mass_with_isotopes,
+    iter_decompose_mass,
+    count_mass_decompositions,
+    estimate_decomposition_cost,
+    filter_formulas,
+    decompose_spectra,
+    chemistry_rules_config,
+    candidate_ranking_config,
+    isotope_scoring_config,
+    decomposition_cache,
+    build_mass_lattice,
+    mass_lattice,
+    deduce_isotopic_pattern,
+    deduce_isotopic_bounds,
+    fits_isotopic_pattern_batch,
+    fits_isotopic_pattern_arrays,
+    isotopic_pattern_config,
+    predict_isotope_envelopes,
+    score_isotope_envelopes,
+    get_isotope_envelope_cache_stats,
+    set_isotope_envelope_cache_capacity,
+    clear_isotope_envelope_cache,
+    use_decomposition_cache,
+    mass_tolerance_config,
+    element_masses,
+    compact_formulas,
+    expand_formulas,
+    use_parallel_config,
+    get_parallel_config,
+    decompose_spectra_known_precursor,
+    clean_and_normalize_spectra_known_precursor,
+    clean_and_normalize_spectra_candidate_precursors,
+    get_residue_table_cache_stats,
+    clear_residue_table_cache,
 )
 
 def mass_decomposition_test(size:int):
@@ -345,10 +387,987 @@ def compare_spectrum_decomposition_strategies(size=1000):
     
 
 
+def residue_table_cache_test(size: int = 200) -> None:
+    """
+    Per-mass bounds that differ only in counts (same element alphabet) must share one cached ERT,
+    and the results must not depend on whether the table came from the cache.
+    """
+    rng = np.random.default_rng(0)
+    masses = pl.Series("mass", rng.uniform(80.0, 300.0, size))
+    min_bounds = np.zeros((size, 15), dtype=np.int32)
+    max_bounds = np.tile(np.array(MAX_FORMULA, dtype=np.int32), (size, 1))
+    max_bounds[:, 2] = rng.integers(5, 30, size)  # vary only the carbon upper bound
+
+    clear_residue_table_cache()
+    cold = decompose_mass_per_bounds(masses, pl.Series(min_bounds), pl.Series(max_bounds), tolerance_ppm=5.0)
+    stats = get_residue_table_cache_stats()
+    assert stats["misses"] == 1, f"expected a single ERT build for one element alphabet, got {stats}"
+    assert stats["hits"] == size - 1, f"expected every other mass to hit the cache, got {stats}"
+
+    warm = decompose_mass_per_bounds(masses, pl.Series(min_bounds), pl.Series(max_bounds), tolerance_ppm=5.0)
+    assert cold.to_list() == warm.to_list(), "cached ERT changed the decomposition results"
+    print(f"Residue table cache: {get_residue_table_cache_stats()}")
+
+def bound_pruning_test(size: int = 12, grid_size: int = 200) -> None:
+    """
+    The per-level residual-mass and DBE pruning must not drop formulas: dbe_pruning on and off agree
+    with tight lower bounds on heavy masses, and a small CHNOSCl grid matches brute-force enumeration.
+    """
+    from itertools import product
+    from hrms_utils.formula_annotation.element_table import ELEMENT_INDEX, ELEMENT_MASSES, ELEMENT_TWICE_DBE_COEFFICIENTS
+    rng = np.random.default_rng(2)
+    masses = pl.Series("mass", rng.uniform(600.0, 1100.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    min_bounds[ELEMENT_INDEX["Cl"]] = 2
+    min_bounds[ELEMENT_INDEX["Br"]] = 1
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    for symbol, n in {"B": 0, "N": 10, "O": 15, "F": 5, "Si": 0, "P": 2, "Cl": 4, "As": 0, "I": 1}.items():
+        max_bounds[ELEMENT_INDEX[symbol]] = n
+    pruned = decompose_mass(masses, min_bounds, max_bounds, min_dbe=2.0, max_dbe=12.0, dbe_pruning=True).to_list()
+    unpruned = decompose_mass(masses, min_bounds, max_bounds, min_dbe=2.0, max_dbe=12.0, dbe_pruning=False).to_list()
+    assert pruned == unpruned, "dbe_pruning changed the decomposition results"
+    assert max(map(len, pruned)) < 100000, "max_results truncated the comparison"
+    assert all(f[ELEMENT_INDEX["Cl"]] >= 2 and f[ELEMENT_INDEX["Br"]] >= 1 for formulas in pruned for f in formulas)
+
+    grid_max = {"C": 12, "H": 24, "N": 3, "O": 4, "S": 2, "Cl": 3}
+    grid_min = {"C": 1, "Cl": 1}
+    columns = [ELEMENT_INDEX[symbol] for symbol in grid_max]
+    counts = np.array(list(product(*(range(grid_min.get(symbol, 0), n + 1) for symbol, n in grid_max.items()))), dtype=np.int32)
+    grid = np.zeros((len(counts), 15), dtype=np.int32)
+    grid[:, columns] = counts
+    grid_masses = grid @ np.array(ELEMENT_MASSES)
+    grid_twice_dbes = 2 + grid @ np.array(ELEMENT_TWICE_DBE_COEFFICIENTS)
+    targets = grid_masses[rng.choice(len(grid), grid_size, replace=False)] + rng.uniform(-0.002, 0.002, grid_size)
+    grid_min_bounds = np.zeros(15, dtype=np.int32)
+    grid_max_bounds = np.zeros(15, dtype=np.int32)
+    for symbol, n in grid_min.items():
+        grid_min_bounds[ELEMENT_INDEX[symbol]] = n
+    grid_max_bounds[columns] = list(grid_max.values())
+    decomposed = decompose_mass(pl.Series("mass", targets), grid_min_bounds, grid_max_bounds, tolerance_ppm=5.0, min_dbe=0.0, max_dbe=10.0)
+    n_found = 0
+    for target, formulas in zip(targets, decomposed.to_list()):
+        window = 5.0 * max(target, 200.0) / 1e6
+        fits = (np.abs(grid_masses - target) <= window) & (grid_twice_dbes >= 0) & (grid_twice_dbes <= 20) & (grid_twice_dbes % 2 == 0)
+        expected = sorted(map(tuple, grid[fits].tolist()))
+        assert sorted(map(tuple, formulas)) == expected, f"decomposition of {target} differs from brute force"
+        n_found += len(expected)
+    print(f"Bound pruning: {sum(map(len, pruned))} heavy formulas with and without DBE pruning, {n_found} grid formulas match brute force")
+
+def fragment_engine_test(n_spectra: int = 50, n_fragments: int = 300) -> None:
+    """
+    The sub-formula index and money-changing must return the same fragment formulas
+    (the index returns them sorted by mass, so compare as sets). With max_subformula_lattice_size=0
+    every precursor falls back to money-changing, so the results are identical.
+    """
+    rng = np.random.default_rng(1)
+    atomic_masses = np.array(element_table.ELEMENT_MASSES)
+    precursors = np.zeros((n_spectra, element_table.NUM_ELEMENTS), dtype=np.int32)
+    for symbol, low, high in (("H", 10, 40), ("C", 5, 25), ("N", 0, 4), ("O", 0, 8), ("Cl", 0, 2)):
+        precursors[:, element_table.ELEMENT_INDEX[symbol]] = rng.integers(low, high, n_spectra)
+    fragment_masses = [
+        [float(rng.integers(0, precursor + 1) @ atomic_masses) + rng.normal(0, 1e-4) for _ in range(n_fragments)]
+        for precursor in precursors
+    ]
+    precursor_series = pl.Series(precursors, dtype=pl.Array(pl.Int32, element_table.NUM_ELEMENTS))
+    fragment_series = pl.Series(fragment_masses, dtype=pl.List(pl.Float64))
+
+    timings = {}
+    results = {}
+    for name, engine, options in (
+        ("money_changing", "money_changing", {}),
+        ("subformula_index", "subformula_index", {}),
+        ("subformula_fallback", "subformula_index", {"max_subformula_lattice_size": 0}),
+    ):
+        start = perf_counter()
+        results[name] = decompose_spectra_known_precursor(
+            precursor_series, fragment_series, tolerance_ppm=5.0, fragment_engine=engine, **options
+        ).to_list()
+        timings[name] = perf_counter() - start
+
+    assert len(results["money_changing"]) == len(results["subformula_index"]) == n_spectra, "spectrum counts differ"
+    for spectrum_a, spectrum_b in zip(results["money_changing"], results["subformula_index"]):
+        assert len(spectrum_a) == len(spectrum_b) == n_fragments, "fragment counts differ"
+        for formulas_a, formulas_b in zip(spectrum_a, spectrum_b):
+            assert {tuple(f) for f in formulas_a} == {tuple(f) for f in formulas_b}, "fragment engines disagree"
+    assert results["subformula_fallback"] == results["money_changing"], (
+        "the money-changing fallback of the sub-formula index differs from money-changing"
+    )
+    print(f"Fragment engines agree; times: {timings}")
+
+def gil_release_test() -> None:
+    """
+    The C++ decomposition runs with the GIL released: the main thread keeps running while the
+    decomposition call itself is in progress in a worker thread. Progress is measured as the share
+    of 10 ms slices of the call in which the main thread ran; a GIL-holding call (sorted) is the
+    control, it only leaves the main thread the slices around one switch interval.
+    """
+    import threading
+    from time import perf_counter
+    slice_seconds = 0.01
+
+    def main_thread_coverage(call) -> float:
+        inside = threading.Event()
+        span = []
+
+        def run() -> None:
+            inside.set()
+            start = perf_counter()
+            call()
+            span.extend([start, perf_counter()])
+            inside.clear()
+
+        seen = []
+        worker = threading.Thread(target=run)
+        worker.start()
+        while worker.is_alive():
+            if inside.is_set():
+                seen.append(perf_counter())
+        worker.join()
+        start, end = span
+        seen = np.array(seen)
+        seen = seen[(seen >= start) & (seen <= end)]
+        n_slices = max(1, int(np.ceil((end - start) / slice_seconds)))
+        return len(np.unique(((seen - start) // slice_seconds).astype(np.int64))) / n_slices
+
+    masses = pl.Series("mass", np.random.default_rng(5).uniform(380.0, 420.0, 48))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    decompose_mass(masses.head(1), min_bounds, max_bounds)
+    decomposition = main_thread_coverage(lambda: decompose_mass(masses, min_bounds, max_bounds, n_threads=1))
+    values = np.random.default_rng(6).random(3_000_000).tolist()
+    control = main_thread_coverage(lambda: sorted(values))
+    assert control < 0.25, f"the GIL-holding control left the main thread {control:.0%} of its slices, the measurement is broken"
+    assert decomposition > 0.5, f"main thread ran in only {decomposition:.0%} of the decomposition's slices, the GIL is held"
+    print(f"GIL released during decomposition: main thread ran in {decomposition:.0%} of its 10 ms slices ({control:.0%} for a GIL-holding call)")
+
+def chunked_decomposition_test(size: int = 500, chunk_size: int = 128) -> None:
+    """Chunked decomposition and count-only mode must agree with the one-shot decomposition."""
+    rng = np.random.default_rng(2)
+    masses = pl.Series("mass", rng.uniform(100.0, 450.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+
+    full = decompose_mass(masses, min_bounds, max_bounds)
+    chunks = list(iter_decompose_mass(masses, min_bounds, max_bounds, chunk_size=chunk_size))
+    assert len(chunks) == -(-size // chunk_size), f"expected {-(-size // chunk_size)} chunks, got {len(chunks)}"
+    streamed = pl.concat(chunks)
+    assert streamed["mass_index"].to_list() == list(range(size)), "mass_index should cover every mass in order"
+    assert streamed["decomposed_formula"].to_list() == full.to_list(), "chunked results differ from one-shot results"
+
+    counts = count_mass_decompositions(masses, min_bounds, max_bounds)
+    assert counts.to_list() == full.list.len().to_list(), "count-only mode disagrees with decompose_mass"
+    print(f"Chunked decomposition: {len(chunks)} chunks, {counts.sum()} formulas")
+
+def parallel_config_test(size: int = 200) -> None:
+    """Thread count and schedule change only how the work is split, never the results."""
+    rng = np.random.default_rng(3)
+    masses = pl.Series("mass", rng.uniform(100.0, 400.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    reference = decompose_mass(masses, min_bounds, max_bounds).to_list()
+
+    for schedule in ("static", "dynamic", "guided"):
+        for n_threads in (1, 2):
+            result = decompose_mass(masses, min_bounds, max_bounds, n_threads=n_threads, schedule=schedule, schedule_chunk_size=8)
+            assert result.to_list() == reference, f"results changed with n_threads={n_threads}, schedule={schedule}"
+
+    default_config = get_parallel_config()
+    with use_parallel_config(n_threads=1, schedule="guided"):
+        assert get_parallel_config().n_threads == 1 and get_parallel_config().schedule == "guided"
+        assert decompose_mass(masses, min_bounds, max_bounds).to_list() == reference
+    assert get_parallel_config() == default_config, "use_parallel_config should restore the previous config"
+    print("Parallel config: results independent of thread count and schedule")
+
+def cost_ordering_test(size: int = 200) -> None:
+    """Cost ordering changes only the processing order; the estimate grows with mass and bound volume."""
+    rng = np.random.default_rng(4)
+    masses = pl.Series("mass", rng.uniform(100.0, 400.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    with use_parallel_config(cost_ordering=False):
+        reference = decompose_mass(masses, min_bounds, max_bounds).to_list()
+    with use_parallel_config(cost_ordering=True):
+        assert decompose_mass(masses, min_bounds, max_bounds).to_list() == reference, "cost ordering changed the results"
+
+    costs = estimate_decomposition_cost(pl.Series([150.0, 300.0, 600.0]), min_bounds, max_bounds)
+    assert costs.dtype == pl.Float64 and costs.len() == 3
+    assert costs[0] < costs[1] < costs[2], f"cost should grow with mass, got {costs.to_list()}"
+
+    narrow_max = np.array(MAX_FORMULA, dtype=np.int32)
+    narrow_max[7:] = 0  # CHNOF + B only
+    per_bounds_costs = estimate_decomposition_cost(
+        pl.Series([300.0, 300.0]),
+        pl.Series([min_bounds, min_bounds], dtype=pl.Array(pl.Int32, len(MIN_FORMULA))),
+        pl.Series([max_bounds, narrow_max], dtype=pl.Array(pl.Int32, len(MAX_FORMULA))),
+    )
+    assert per_bounds_costs[0] > per_bounds_costs[1], "fewer elements should be cheaper"
+    assert per_bounds_costs[0] == costs[1], "uniform and per-mass bounds should agree"
+    print("Cost ordering: results unchanged, estimates ordered by mass and bound volume")
+
+def filter_formulas_test(size: int = 50) -> None:
+    """filter_formulas applied to a loose decomposition reproduces the tighter decomposition."""
+    rng = np.random.default_rng(5)
+    masses = pl.Series("mass", rng.uniform(100.0, 400.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    loose = pl.DataFrame({
+        "mass": masses,
+        "decomposed_formula": decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0, min_dbe=0.0, max_dbe=40.0),
+    }).explode("decomposed_formula").drop_nulls()
+    tight = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=2.0, min_dbe=1.0, max_dbe=10.0)
+
+    fits = filter_formulas(loose["decomposed_formula"], loose["mass"], tolerance_ppm=2.0, dbe_range=(1.0, 10.0))
+    filtered = loose.filter(fits).group_by("mass", maintain_order=True).agg("decomposed_formula")
+    expected = {mass: formulas for mass, formulas in zip(masses.to_list(), tight.to_list()) if formulas}
+    assert dict(zip(filtered["mass"].to_list(), filtered["decomposed_formula"].to_list())) == expected, (
+        "filter_formulas disagrees with decompose_mass"
+    )
+    assert filter_formulas(loose["decomposed_formula"].head(0), 300.0).len() == 0
+    print(f"filter_formulas: {fits.sum()}/{fits.len()} candidates kept, matches decompose_mass")
+
+def chemistry_rules_test(size: int = 30) -> None:
+    """Formulas kept by the in-enumerator chemistry rules equal a plain post-filter of the unfiltered output."""
+    from hrms_utils.formula_annotation.element_table import ELEMENT_INDEX
+    senior_valences = np.array([1, 3, 4, 3, 2, 1, 1, 4, 3, 2, 1, 1, 3, 1, 1])
+    rules = chemistry_rules_config()
+    max_ratios = {"H": rules.max_h_to_c, "N": rules.max_n_to_c, "O": rules.max_o_to_c, "P": rules.max_p_to_c,
+                  "S": rules.max_s_to_c, "Si": rules.max_si_to_c, "F": rules.max_f_to_c, "Cl": rules.max_cl_to_c,
+                  "Br": rules.max_br_to_c}
+
+    def plausible(formula: list[int]) -> bool:
+        counts = np.array(formula)
+        carbon = counts[ELEMENT_INDEX["C"]]
+        if any(counts[ELEMENT_INDEX[symbol]] > ratio * carbon for symbol, ratio in max_ratios.items()):
+            return False
+        if counts[ELEMENT_INDEX["H"]] < rules.min_h_to_c * carbon:
+            return False
+        valence_sum = int(senior_valences @ counts)
+        return valence_sum % 2 == 0 and valence_sum >= 2 * senior_valences[counts > 0].max() and valence_sum >= 2 * (counts.sum() - 1)
+
+    rng = np.random.default_rng(6)
+    masses = pl.Series("mass", rng.uniform(100.0, 400.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    unfiltered = decompose_mass(masses, min_bounds, max_bounds).to_list()
+    filtered = decompose_mass(masses, min_bounds, max_bounds, chemistry_rules=rules).to_list()
+    for mass, all_formulas, kept in zip(masses.to_list(), unfiltered, filtered):
+        assert kept == [f for f in all_formulas if plausible(f)], f"chemistry rules mismatch at mass {mass}"
+    counts = count_mass_decompositions(masses, min_bounds, max_bounds, chemistry_rules=rules)
+    assert counts.to_list() == [len(kept) for kept in filtered]
+    n_all, n_kept = sum(map(len, unfiltered)), sum(map(len, filtered))
+    print(f"Chemistry rules: kept {n_kept}/{n_all} formulas, identical to post-filtering")
+
+def candidate_precursors_test(size: int = 20) -> None:
+    """Grouped cleaning over all candidate precursors equals cleaning each exploded candidate."""
+    rng = np.random.default_rng(7)
+    precursor_masses = rng.uniform(250.0, 400.0, size)
+    max_bounds = np.array([60, 0, 30, 6, 8, 2, 0, 0, 1, 1, 2, 0, 0, 1, 0], dtype=np.int32)
+    spectra = pl.DataFrame({
+        "candidates": decompose_mass(pl.Series(precursor_masses), np.zeros(15, dtype=np.int32), max_bounds, tolerance_ppm=3.0),
+        "precursor_mass": precursor_masses,
+        "fragment_masses": pl.Series([sorted(rng.uniform(50.0, mass - 10.0, 20).tolist()) for mass in precursor_masses], dtype=pl.List(pl.Float64)),
+        "fragment_intensities": pl.Series([rng.uniform(1.0, 100.0, 20).tolist() for _ in precursor_masses], dtype=pl.List(pl.Float64)),
+    })
+    kwargs = dict(tolerance_ppm=5.0, max_allowed_normalized_mass_error_ppm=4.0)
+
+    grouped = clean_and_normalize_spectra_candidate_precursors(
+        spectra["candidates"], spectra["precursor_mass"], spectra["fragment_masses"], spectra["fragment_intensities"], **kwargs
+    )
+    assert grouped.list.len().to_list() == spectra["candidates"].list.len().to_list()
+    exploded = spectra.explode("candidates").drop_nulls("candidates")
+    per_candidate = clean_and_normalize_spectra_known_precursor(
+        exploded["candidates"], exploded["precursor_mass"], exploded["fragment_masses"], exploded["fragment_intensities"], **kwargs
+    )
+    assert grouped.explode().drop_nulls().to_list() == per_candidate.to_list(), "grouped cleaning differs from per-candidate cleaning"
+    print(f"Candidate precursors: {per_candidate.len()} candidates over {size} spectra, identical to per-candidate cleaning")
+
+
+def nested_output_test(size: int = 30) -> None:
+    """Nested results built from Arrow buffers keep one row per input and one inner list per fragment."""
+    rng = np.random.default_rng(11)
+    precursors = pl.Series([[30, 0, 20, 4, 6, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0]] * size, dtype=pl.Array(pl.Int32, 15))
+    fragment_counts = rng.integers(0, 12, size)
+    fragments = pl.Series([sorted(rng.uniform(60.0, 450.0, k).tolist()) for k in fragment_counts], dtype=pl.List(pl.Float64))
+    nested = decompose_spectra_known_precursor(precursors, fragments, tolerance_ppm=5.0)
+    assert nested.dtype == pl.List(pl.List(pl.Array(pl.Int32, 15))), f"unexpected dtype {nested.dtype}"
+    assert nested.list.len().to_list() == fragment_counts.tolist(), "one inner list per fragment expected"
+    # Each row must match decomposing that spectrum on its own.
+    for row in rng.choice(size, 5, replace=False):
+        single = decompose_spectra_known_precursor(precursors[row : row + 1], fragments[row : row + 1], tolerance_ppm=5.0)
+        assert single.to_list() == nested[row : row + 1].to_list(), f"row {row} differs from its single-spectrum decomposition"
+    empty = decompose_spectra_known_precursor(precursors[:0], fragments[:0], tolerance_ppm=5.0)
+    assert empty.len() == 0 and empty.dtype == nested.dtype
+    print(f"Nested output: {nested.list.len().sum()} fragments over {size} spectra")
+
+
+def spectra_decomposition_test(size: int = 40, top_k: int = 3) -> None:
+    """decompose_spectra equals decompose_mass + explode + decompose_spectra_known_precursor, and top_k keeps the best-explaining candidates."""
+    rng = np.random.default_rng(3)
+    max_bounds = np.array([60, 0, 30, 6, 8, 2, 0, 0, 1, 1, 2, 0, 0, 1, 0], dtype=np.int32)
+    min_bounds = np.zeros(15, dtype=np.int32)
+    precursor_masses = pl.Series(rng.uniform(250.0, 450.0, size))
+    fragment_masses = pl.Series([sorted(rng.uniform(60.0, mass - 15.0, 25).tolist()) for mass in precursor_masses], dtype=pl.List(pl.Float64))
+    fragment_intensities = pl.Series([rng.uniform(1.0, 100.0, 25).tolist() for _ in range(size)], dtype=pl.List(pl.Float64))
+
+    fused = decompose_spectra(precursor_masses, fragment_masses, min_bounds, max_bounds, tolerance_ppm=5.0, fragment_intensities_series=fragment_intensities)
+    exploded = pl.DataFrame({
+        "candidates": decompose_mass(precursor_masses, min_bounds, max_bounds, tolerance_ppm=5.0),
+        "fragment_masses": fragment_masses,
+    }).explode("candidates").drop_nulls("candidates")
+    known = decompose_spectra_known_precursor(exploded["candidates"], exploded["fragment_masses"], tolerance_ppm=5.0)
+    flat = fused.explode().drop_nulls()
+    assert flat.struct.field("precursor").to_list() == exploded["candidates"].to_list(), "precursor candidates differ from decompose_mass"
+    assert flat.struct.field("fragments").to_list() == known.to_list(), "fragment formulas differ from decompose_spectra_known_precursor"
+
+    top = decompose_spectra(precursor_masses, fragment_masses, min_bounds, max_bounds, tolerance_ppm=5.0, fragment_intensities_series=fragment_intensities, top_k=top_k)
+    for all_candidates, kept in zip(fused.to_list(), top.to_list()):
+        best = sorted(all_candidates, key=lambda d: (-d["explained_intensity"], abs(d["precursor_error_ppm"])))[:top_k]
+        assert [d["precursor"] for d in kept] == [d["precursor"] for d in best], "top_k did not keep the best-explaining candidates"
+
+    per_bounds = decompose_spectra(
+        precursor_masses, fragment_masses,
+        pl.Series([min_bounds] * size, dtype=pl.Array(pl.Int32, 15)),
+        pl.Series([max_bounds] * size, dtype=pl.Array(pl.Int32, 15)),
+        tolerance_ppm=5.0, fragment_intensities_series=fragment_intensities,
+    )
+    assert per_bounds.to_list() == fused.to_list(), "per-spectrum bounds differ from uniform bounds"
+    print(f"Spectra decomposition: {len(flat)} candidates over {size} spectra, identical to explode + known precursor")
+
+
+def candidate_ranking_test(size: int = 20, top_k: int = 25) -> None:
+    """Top-k ranking keeps the best-scoring formulas of the full decomposition, best first."""
+    rng = np.random.default_rng(5)
+    masses = pl.Series(rng.uniform(300.0, 500.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    full = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0, max_results=10**7)
+    for ranking, penalties in [
+        (candidate_ranking_config(top_k=top_k), np.zeros(15)),
+        (candidate_ranking_config(top_k=top_k, element_penalty_ppm={"F": 0.5, "Si": 1.0}), np.eye(15)[5] * 0.5 + np.eye(15)[7]),
+    ]:
+        ranked = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0, ranking=ranking)
+        counts = count_mass_decompositions(masses, min_bounds, max_bounds, tolerance_ppm=5.0, ranking=ranking)
+        assert counts.to_list() == ranked.list.len().to_list(), "count_mass_decompositions differs from the ranked lengths"
+        for mass, all_formulas, kept in zip(masses, full, ranked):
+            def scores(formulas):
+                formulas = np.array(formulas.to_list(), dtype=np.float64).reshape(-1, 15)
+                return np.abs(formulas @ element_masses - mass) * 1e6 / mass + formulas @ penalties
+            expected = np.sort(scores(all_formulas))[:top_k]
+            got = scores(kept)
+            # Scores are compared with a tolerance: near-exact ties may order differently after rounding.
+            assert np.allclose(got, expected, atol=1e-6), f"ranked formulas of {mass} are not the best {top_k}"
+            assert np.all(np.diff(got) >= -1e-6), f"ranked formulas of {mass} are not best first"
+    print(f"Candidate ranking: top {top_k} of up to {full.list.len().max()} formulas per mass")
+
+
+def mass_tolerance_test(size: int = 40) -> None:
+    """A mass_tolerance_config window is applied exactly, and the default config matches tolerance_ppm."""
+    rng = np.random.default_rng(9)
+    masses = pl.Series(rng.uniform(60.0, 400.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+
+    plain = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0)
+    assert decompose_mass(masses, min_bounds, max_bounds, tolerance=mass_tolerance_config(ppm=5.0)).equals(plain), (
+        "default mass_tolerance_config differs from tolerance_ppm"
+    )
+
+    wide = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=20.0)
+    for tolerance in [
+        mass_tolerance_config(ppm=5.0, ppm_floor_mass=0.0, absolute_floor_da=2e-4),
+        mass_tolerance_config(ppm=2.0, ppm_per_da=0.005, ppm_floor_mass=100.0),
+        mass_tolerance_config.absolute(5e-4),
+    ]:
+        got = decompose_mass(masses, min_bounds, max_bounds, tolerance=tolerance)
+        counts = count_mass_decompositions(masses, min_bounds, max_bounds, tolerance=tolerance)
+        assert counts.to_list() == got.list.len().to_list(), f"count_mass_decompositions differs from decompose_mass for {tolerance}"
+        windows = tolerance.tolerance_da(masses.to_numpy())
+        assert np.all(windows < 20.0 * np.maximum(masses.to_numpy(), 200.0) / 1e6), "test windows should fit in the reference window"
+        for mass, window, kept, reference in zip(masses, windows, got, wide):
+            reference = np.array(reference.to_list(), dtype=np.int64).reshape(-1, 15)
+            expected = {tuple(f) for f in reference[np.abs(reference @ element_masses - mass) <= window]}
+            # formulas within ~1e-12 Da of the window edge may fall either way
+            kept = {tuple(f) for f in kept.to_list()}
+            assert kept ^ expected == {f for f in kept ^ expected if abs(abs(np.dot(f, element_masses) - mass) - window) < 1e-9}, (
+                f"formulas of {mass} do not match the {tolerance} window"
+            )
+        exploded_masses = pl.Series(np.repeat(masses.to_numpy(), got.list.len().to_numpy()))
+        assert filter_formulas(got.explode(empty_as_null=False), exploded_masses, tolerance=tolerance).all(), (
+            f"filter_formulas rejects formulas decomposed with {tolerance}"
+        )
+        print(f"Mass tolerance: {got.list.len().sum()} formulas vs {plain.list.len().sum()} at 5 ppm over max(mass, 200)")
+
+def element_table_test(size: int = 40) -> None:
+    """The C++ alphabet comes from element_table and can grow (Se, D) at runtime; compact_formulas/expand_formulas round-trip decomposer output."""
+    info = mass_decomposer_cpp.get_element_info()
+    assert info["order"] == list(element_table.ELEMENT_SYMBOLS), f"C++ element order {info['order']} differs from element_table"
+    assert np.allclose(info["masses"], element_table.ELEMENT_MASSES, rtol=0, atol=1e-12), "C++ masses differ from element_table"
+    for bad_table in (
+        (["C", "H"], [12.0], [2, -1], [4, 1]),  # lengths differ
+        (["X"] * 33, [10.0] * 33, [0] * 33, [1] * 33),  # more elements than a C++ formula holds
+    ):
+        try:
+            mass_decomposer_cpp._register_element_table(*bad_table)
+            raise AssertionError("_register_element_table accepted an invalid table")
+        except ValueError:
+            pass
+    assert mass_decomposer_cpp.get_element_info() == info, "a rejected table replaced the registered one"
+
+    rng = np.random.default_rng(16)
+    masses = pl.Series(rng.uniform(150.0, 450.0, size))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    reference = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0)
+    mass_decomposer_cpp._register_element_table(
+        element_table.ELEMENT_SYMBOLS, element_table.ELEMENT_MASSES,
+        element_table.ELEMENT_TWICE_DBE_COEFFICIENTS, element_table.ELEMENT_VALENCES,
+    )
+    assert decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0).equals(reference), (
+        "re-registering the same element table changed the results"
+    )
+
+    # A 17-element alphabet without a rebuild: D (2.0141018, valence 1, counts like H) and Se
+    # (79.9165218, valence 2, no DBE contribution), inserted in mass order.
+    symbols, element_masses_ = list(element_table.ELEMENT_SYMBOLS), list(element_table.ELEMENT_MASSES)
+    twice_dbe, valences = list(element_table.ELEMENT_TWICE_DBE_COEFFICIENTS), list(element_table.ELEMENT_VALENCES)
+    wide_min, wide_max = list(MIN_FORMULA), list(MAX_FORMULA)
+    for symbol, mass, coefficient, valence, max_count in (("D", 2.0141018, -1, 1, 5), ("Se", 79.9165218, 0, 2, 1)):
+        index = int(np.searchsorted(element_masses_, mass))
+        symbols.insert(index, symbol)
+        element_masses_.insert(index, mass)
+        twice_dbe.insert(index, coefficient)
+        valences.insert(index, valence)
+        wide_min.insert(index, 0)
+        wide_max.insert(index, max_count)
+    n_wide = len(symbols)
+    # selenophenol, C6H6Se, and toluene-d3, C7H5D3
+    selenophenol = np.zeros(n_wide, dtype=np.int32)
+    selenophenol[[symbols.index("C"), symbols.index("H"), symbols.index("Se")]] = [6, 6, 1]
+    toluene_d3 = np.zeros(n_wide, dtype=np.int32)
+    toluene_d3[[symbols.index("C"), symbols.index("H"), symbols.index("D")]] = [7, 5, 3]
+    try:
+        mass_decomposer_cpp._register_element_table(symbols, element_masses_, twice_dbe, valences)
+        assert mass_decomposer_cpp.get_num_elements() == n_wide
+        found = mass_decomposer_cpp.decompose_mass_parallel(
+            pl.Series([float(selenophenol @ np.array(element_masses_)), float(toluene_d3 @ np.array(element_masses_))]),
+            np.array(wide_min, dtype=np.int32), np.array(wide_max, dtype=np.int32), tolerance_ppm=2.0,
+        )
+        assert found.dtype == pl.List(pl.Array(pl.Int32, n_wide)), f"expected {n_wide}-element formulas, got {found.dtype}"
+        assert selenophenol.tolist() in found[0].to_list(), "the Se formula was not found in the grown alphabet"
+        assert toluene_d3.tolist() in found[1].to_list(), "the D formula was not found in the grown alphabet"
+    finally:
+        mass_decomposer_cpp._register_element_table(
+            element_table.ELEMENT_SYMBOLS, element_table.ELEMENT_MASSES,
+            element_table.ELEMENT_TWICE_DBE_COEFFICIENTS, element_table.ELEMENT_VALENCES,
+        )
+    assert decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0).equals(reference), (
+        "restoring the element table did not restore the results"
+    )
+
+    compact = compact_formulas(reference)
+    assert expand_formulas(compact).equals(reference), "nested compact_formulas/expand_formulas round trip failed"
+    flat = reference.explode(empty_as_null=False).drop_nulls()
+    # K is never used (MAX_FORMULA bounds it to 0), but a requested element keeps its field
+    kept = [field.name for field in compact.dtype.inner.fields] + ["K"]
+    flat_compact = compact_formulas(flat, elements=kept)
+    assert [field.name for field in flat_compact.dtype.fields] == [s for s in element_table.ELEMENT_SYMBOLS if s in kept]
+    assert expand_formulas(flat_compact).equals(flat), "flat compact_formulas/expand_formulas round trip failed"
+    assert compact.estimated_size() < reference.estimated_size(), "compact formulas should take less memory"
+    print(
+        f"Element table: {flat.len()} formulas, {reference.estimated_size()} bytes as arrays, "
+        f"{compact.estimated_size()} bytes as {len(compact.dtype.inner.fields)}-element structs"
+    )
+
+_GROWN_ALPHABET_SCRIPT = textwrap.dedent("""
+    import numpy as np
+    import polars as pl
+    from hrms_utils.formula_annotation import (
+        element_table, decompose_mass, decompose_mass_per_bounds, chemistry_rules_config,
+        candidate_ranking_config, decomposition_cache,
+    )
+    from hrms_utils.formula_annotation.mass_decomposition_impl import mass_decomposer_cpp
+    symbols = list(element_table.ELEMENT_SYMBOLS)
+    n = len(symbols)
+    assert n == 17 and mass_decomposer_cpp.get_element_info()["order"] == symbols, symbols
+    masses = np.array(element_table.ELEMENT_MASSES)
+    # selenophenol, C6H6Se, and toluene-d3, C7H5D3
+    selenophenol, toluene_d3 = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int32)
+    selenophenol[[symbols.index("C"), symbols.index("H"), symbols.index("Se")]] = [6, 6, 1]
+    toluene_d3[[symbols.index("C"), symbols.index("H"), symbols.index("D")]] = [7, 5, 3]
+    targets = pl.Series([float(selenophenol @ masses), float(toluene_d3 @ masses)])
+    min_bounds = np.array([element_table.DEFAULT_MIN_BOUND[s] for s in symbols], dtype=np.int32)
+    max_bounds = np.array([element_table.DEFAULT_MAX_BOUND[s] for s in symbols], dtype=np.int32)
+    options = dict(
+        tolerance_ppm=2.0,
+        chemistry_rules=chemistry_rules_config(),
+        ranking=candidate_ranking_config(element_penalty_ppm={"Se": 1.0, "D": 1.0}),
+    )
+    with_cache = lambda path: decompose_mass(targets, min_bounds, max_bounds, cache=decomposition_cache(path), **options)
+    results = [
+        decompose_mass(targets, min_bounds, max_bounds, **options),
+        with_cache(CACHE_DIR),
+        with_cache(CACHE_DIR),  # served from the cache
+        decompose_mass_per_bounds(
+            targets,
+            pl.Series([min_bounds] * 2, dtype=pl.Array(pl.Int32, n)),
+            pl.Series([max_bounds] * 2, dtype=pl.Array(pl.Int32, n)),
+            **options,
+        ),
+    ]
+    for found in results:
+        assert found.dtype == pl.List(pl.Array(pl.Int32, n)), found.dtype
+        assert selenophenol.tolist() in found[0].to_list(), found[0].to_list()
+        assert toluene_d3.tolist() in found[1].to_list(), found[1].to_list()
+    assert all(found.equals(results[0]) for found in results[1:]), "wrapper options disagree on the grown alphabet"
+""")
+
+def grown_alphabet_test() -> None:
+    """
+    Adding elements to element_table.ELEMENTS (here D and Se) is enough for the mass_decomposition
+    wrappers, including chemistry_rules, ranking and cache. Runs in a fresh interpreter on a copy of
+    the package, since the alphabet is fixed once hrms_utils.formula_annotation is imported.
+    """
+    package_dir = Path(element_table.__file__).parents[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = Path(tmp) / "src" / package_dir.name
+        shutil.copytree(package_dir, copy, ignore=shutil.ignore_patterns("__pycache__"))
+        table_path = copy / "formula_annotation" / "element_table.py"
+        source = table_path.read_text()
+        for anchor, added in (
+            ("    ElementInfo('B',", "    ElementInfo('D',   2.0141018,   r'D(\\d+|[A-Z]|$){1}',    '2H',   0.0, None, -1, 1),\n"),
+            ("    ElementInfo('I',", "    ElementInfo('Se', 79.9165218,   r'Se(\\d+|[A-Z]|$){1}',  '80Se',  0.0, None, 0, 2),\n"),
+            ("    'B': 0,", "    'D': 5,\n"),
+            ("    'I': 5,", "    'Se': 1,\n"),
+        ):
+            assert source.count(anchor) == 1, f"element_table.py no longer has {anchor!r}"
+            source = source.replace(anchor, added + anchor)
+        table_path.write_text(source)
+        script = f"CACHE_DIR = {str(Path(tmp) / 'cache')!r}\n" + _GROWN_ALPHABET_SCRIPT
+        run = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True,
+            env={**os.environ, "PYTHONPATH": str(copy.parent)},
+        )
+        assert run.returncode == 0, f"the wrappers failed on a 17-element alphabet:\n{run.stderr}"
+    print("Grown alphabet: decompose_mass options and decompose_mass_per_bounds find the D and Se formulas")
+
+def isotope_decomposition_test(size: int = 40, top_k: int = 5) -> None:
+    """decompose_mass_with_isotopes keeps the formula whose simulated MS1 envelope is observed, within the per-bounds results."""
+    rng = np.random.default_rng(17)
+    masses = pl.Series(rng.uniform(150.0, 450.0, size))
+    min_bounds = pl.Series([np.array(MIN_FORMULA, dtype=np.int32)] * size, dtype=pl.Array(pl.Int32, 15))
+    max_bounds = pl.Series([np.array(MAX_FORMULA, dtype=np.int32)] * size, dtype=pl.Array(pl.Int32, 15))
+    candidates = decompose_mass_per_bounds(masses, min_bounds, max_bounds, tolerance_ppm=5.0)
+    has_candidates = candidates.list.len().to_numpy() > 0
+    masses, min_bounds, max_bounds, candidates = (s.filter(has_candidates) for s in (masses, min_bounds, max_bounds, candidates))
+
+    # one candidate per mass plays the measured compound; its M+1 / M+2 peaks follow the isotope model
+    ratios = np.zeros((15, 2))
+    for index, symbol in enumerate(element_table.ELEMENT_SYMBOLS):
+        distribution = element_table.ELEMENTS[index].isotopic_distribution
+        if distribution is not None:
+            ratios[index, int(round(distribution.mass_differences[0])) - 1] = distribution.abundances[1] / distribution.abundances[0]
+    true_formulas = np.array([c.to_numpy()[rng.integers(len(c))] for c in candidates], dtype=np.int64)
+    first = true_formulas @ ratios[:, 0]
+    second = true_formulas @ ratios[:, 1] + 0.5 * (first ** 2 - true_formulas @ ratios[:, 0] ** 2)
+    precursor_mzs = masses + 1.007276
+    ms1_mzs = pl.Series([[mz, mz + 1.00336, mz + 1.9971] for mz in precursor_mzs])
+    ms1_intensities = pl.Series([[1e7, 1e7 * a, 1e7 * b] for a, b in zip(first, second)])
+
+    joint = decompose_mass_with_isotopes(masses, precursor_mzs, ms1_mzs, ms1_intensities, min_bounds, max_bounds, tolerance_ppm=5.0)
+    ranked = decompose_mass_with_isotopes(
+        masses, precursor_mzs, ms1_mzs, ms1_intensities, min_bounds, max_bounds, tolerance_ppm=5.0,
+        ranking=candidate_ranking_config(top_k=top_k),
+    )
+    for true_formula, kept, best, all_candidates in zip(true_formulas, joint, ranked, candidates):
+        kept = {tuple(f) for f in kept.to_list()}
+        assert tuple(true_formula) in kept, f"the formula of the simulated envelope {true_formula} was pruned"
+        assert kept <= {tuple(f) for f in all_candidates.to_list()}, "isotope scoring added formulas outside the bounds"
+        best = {tuple(f) for f in best.to_list()}
+        assert best <= kept and len(best) == min(top_k, len(kept)), "the ranked formulas should be the top_k of the kept ones"
+
+    # without a monoisotopic peak there is no isotope constraint
+    no_peaks = pl.Series([[] for _ in range(masses.len())], dtype=pl.List(pl.Float64))
+    unconstrained = decompose_mass_with_isotopes(
+        masses, precursor_mzs, no_peaks, no_peaks, min_bounds, max_bounds, tolerance_ppm=5.0,
+        isotopes=isotope_scoring_config(weight_ppm=2.0),
+    )
+    assert unconstrained.equals(candidates), "features without MS1 peaks should match decompose_mass_per_bounds"
+    print(f"Isotope decomposition: {joint.list.len().sum()} formulas kept of {candidates.list.len().sum()} within the bounds")
+
+
+def decomposition_cache_test(size: int = 40) -> None:
+    """Cached decompositions equal computed ones, on a cold and a warm cache, and survive reopening the file."""
+    rng = np.random.default_rng(18)
+    masses = pl.Series(np.concatenate([rng.uniform(150.0, 450.0, size), rng.uniform(150.0, 450.0, 5).repeat(4)]))
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.array(MAX_FORMULA, dtype=np.int32)
+    reference = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0)
+    per_min = pl.Series([min_bounds] * masses.len(), dtype=pl.Array(pl.Int32, 15))
+    per_max = pl.Series(
+        [max_bounds if i % 2 else np.minimum(max_bounds, 10).astype(np.int32) for i in range(masses.len())],
+        dtype=pl.Array(pl.Int32, 15),
+    )
+    per_reference = decompose_mass_per_bounds(masses, per_min, per_max, tolerance_ppm=5.0)
+    with_nulls = pl.Series([masses[0], None, float("nan"), masses[1]], dtype=pl.Float64)
+    null_reference = decompose_mass(with_nulls, min_bounds, max_bounds, tolerance_ppm=5.0)
+    null_per_reference = decompose_mass_per_bounds(with_nulls, per_min.head(4), per_max.head(4), tolerance_ppm=5.0)
+    assert null_reference.list.len().to_list()[1:3] == [0, 0]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "decompositions.sqlite")
+        with decomposition_cache(path) as cache:
+            cold = decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0, cache=cache)
+            assert cold.equals(reference), "cold cache result differs from the direct decomposition"
+            cold_stats = cache.stats()
+            assert cold_stats["misses"] > 0 and cold_stats["stores"] > 0, cold_stats
+            assert decompose_mass_per_bounds(masses, per_min, per_max, tolerance_ppm=5.0, cache=cache).equals(per_reference)
+        with decomposition_cache(path) as cache, use_decomposition_cache(cache):
+            assert decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=5.0).equals(reference), (
+                "warm cache result differs from the direct decomposition"
+            )
+            assert decompose_mass_per_bounds(masses, per_min, per_max, tolerance_ppm=5.0).equals(per_reference)
+            warm_stats = cache.stats()
+            assert warm_stats["misses"] == 0 and warm_stats["hits"] > 0, warm_stats
+            # null and NaN masses give empty lists, as without a cache
+            assert decompose_mass(with_nulls, min_bounds, max_bounds, tolerance_ppm=5.0).equals(null_reference), (
+                "null masses through the cache differ from the direct decomposition"
+            )
+            assert decompose_mass_per_bounds(with_nulls, per_min.head(4), per_max.head(4), tolerance_ppm=5.0).equals(null_per_reference)
+        with decomposition_cache(path, max_bytes=50_000) as cache:
+            assert decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=10.0, cache=cache).equals(
+                decompose_mass(masses, min_bounds, max_bounds, tolerance_ppm=10.0)
+            )
+            small_stats = cache.stats()
+            assert small_stats["evictions"] > 0 and small_stats["stored_bytes"] <= 50_000, small_stats
+
+        # entries are keyed by the element table registered in C++: C6H6Se is not found under As,
+        # and must be found once Se replaces As, instead of a stale entry
+        arsenic = element_table.ELEMENT_INDEX["As"]
+        symbols, element_masses_ = list(element_table.ELEMENT_SYMBOLS), list(element_table.ELEMENT_MASSES)
+        twice_dbe, valences = list(element_table.ELEMENT_TWICE_DBE_COEFFICIENTS), list(element_table.ELEMENT_VALENCES)
+        symbols[arsenic], element_masses_[arsenic], twice_dbe[arsenic], valences[arsenic] = "Se", 79.9165218, 0, 2
+        selenophenol = np.zeros(15, dtype=np.int32)
+        selenophenol[[element_table.ELEMENT_INDEX["C"], element_table.ELEMENT_INDEX["H"], arsenic]] = [6, 6, 1]
+        selenophenol_mass = pl.Series([float(selenophenol @ np.array(element_masses_))])
+        with decomposition_cache(Path(directory) / "elements.sqlite") as cache:
+            before = decompose_mass(selenophenol_mass, min_bounds, max_bounds, tolerance_ppm=2.0, cache=cache)
+            assert selenophenol.tolist() not in before[0].to_list()
+            try:
+                mass_decomposer_cpp._register_element_table(symbols, element_masses_, twice_dbe, valences)
+                swapped = decompose_mass(selenophenol_mass, min_bounds, max_bounds, tolerance_ppm=2.0, cache=cache)
+                assert swapped.equals(decompose_mass(selenophenol_mass, min_bounds, max_bounds, tolerance_ppm=2.0)), (
+                    "a cache entry of the previous element table was reused"
+                )
+                assert selenophenol.tolist() in swapped[0].to_list()
+            finally:
+                mass_decomposer_cpp._register_element_table(
+                    element_table.ELEMENT_SYMBOLS, element_table.ELEMENT_MASSES,
+                    element_table.ELEMENT_TWICE_DBE_COEFFICIENTS, element_table.ELEMENT_VALENCES,
+                )
+        home = os.environ.get("HOME")
+        os.environ["HOME"] = directory
+        try:
+            with decomposition_cache("~/home.sqlite") as cache:
+                assert cache.path == Path(directory) / "home.sqlite", "decomposition_cache should expand ~ in its path"
+        finally:
+            if home is None:
+                del os.environ["HOME"]
+            else:
+                os.environ["HOME"] = home
+    print(f"Decomposition cache: cold {cold_stats}, warm {warm_stats}")
+
+def mass_lattice_test(size: int = 200, max_mass: float = 300.0) -> None:
+    """A prebuilt lattice, written chunk by chunk, returns the formulas of decompose_mass (sorted by mass) for fixed bounds."""
+    min_bounds = np.array(MIN_FORMULA, dtype=np.int32)
+    max_bounds = np.minimum(np.array(MAX_FORMULA, dtype=np.int32), [40, 0, 20, 6, 6, 3, 0, 0, 1, 1, 2, 0, 0, 1, 1]).astype(np.int32)
+    rng = np.random.default_rng(19)
+    masses = pl.Series(rng.uniform(50.0, max_mass, size))
+    tolerances = [None, mass_tolerance_config(ppm=3.0, ppm_floor_mass=0.0, absolute_floor_da=3e-4)]
+    with tempfile.TemporaryDirectory() as directory:
+        start = perf_counter()
+        build_mass_lattice(directory, min_bounds, max_bounds, max_mass)
+        build_time = perf_counter() - start
+        lattice = mass_lattice(directory)
+        for tolerance in tolerances:
+            direct = decompose_mass(masses, min_bounds, max_bounds, tolerance=tolerance)
+            start = perf_counter()
+            looked_up = lattice.decompose(masses, tolerance=tolerance)
+            lookup_time = perf_counter() - start
+            for expected, found in zip(direct.to_list(), looked_up.to_list()):
+                assert sorted(map(tuple, expected)) == sorted(map(tuple, found)), "lattice and decompose_mass formulas differ"
+            for found in looked_up.to_list():
+                found_masses = np.array(found, dtype=np.float64).reshape(-1, 15) @ element_masses
+                assert np.all(np.diff(found_masses) >= 0), "lattice formulas should be sorted by mass"
+        # a narrower DBE range, at the default tolerance of both calls
+        narrow = lattice.decompose(masses, min_dbe=2.0, max_dbe=5.0)
+        direct_narrow = decompose_mass(masses, min_bounds, max_bounds, min_dbe=2.0, max_dbe=5.0)
+        for expected, found in zip(direct_narrow.to_list(), narrow.to_list()):
+            assert sorted(map(tuple, expected)) == sorted(map(tuple, found)), "narrowed lattice and decompose_mass formulas differ"
+        assert narrow.list.len().sum() < lattice.decompose(masses).list.len().sum(), "the narrower DBE range should drop formulas"
+    print(f"Mass lattice: {len(lattice)} formulas built in {build_time:.2f} s, {size} masses looked up in {lookup_time:.4f} s")
+
+def isotopic_pattern_batch_test(size: int = 300) -> None:
+    """
+    deduce_isotopic_pattern bounds contain the true C counts, resolve S/Cl/Br mixtures at any m/z,
+    and do not depend on the peak order.
+    """
+    rng = np.random.default_rng(21)
+    element_index = {symbol: i for i, symbol in enumerate(element_table.ELEMENT_SYMBOLS)}
+    n_elements = len(element_table.ELEMENT_SYMBOLS)
+    true_counts = np.stack([
+        rng.integers(5, 40, size), rng.integers(0, 3, size), rng.integers(0, 4, size), rng.integers(0, 2, size)
+    ], axis=1)
+    precursor_mzs = rng.uniform(150.0, 800.0, size)
+    # S+Br and S+Cl2 above m/z 420, where the 34S peak is within 3 ppm of the 37Cl/81Br one
+    true_counts = np.vstack([true_counts, [[25, 2, 0, 1], [25, 1, 2, 0]]])
+    precursor_mzs = np.append(precursor_mzs, [600.0, 600.0])
+    size = len(precursor_mzs)
+    columns = [element_index[symbol] for symbol in ("C", "S", "Cl", "Br")]
+    carbon = element_table.ELEMENTS[columns[0]].isotopic_distribution
+    sulfur_shift = isotopic_pattern_dict["S"]["mass_difference"]
+    sulfur = isotope_ratio_table("S", 2)
+    ratios = sulfur_halogen_ratio_table(2, 3, 1)
+    ms1_mzs, ms1_intensities = [], []
+    for mz, counts in zip(precursor_mzs, true_counts):
+        intensity = 10 ** rng.uniform(6.5, 8)
+        peaks = {mz: intensity, mz + carbon.mass_differences[0]: intensity * counts[0] * carbon.abundances[1] / carbon.abundances[0]}
+        # M+2, M+4, M+6: the 34S-only share at the sulfur shifts, the rest between the 37Cl and 81Br shifts
+        for peak, ratio in enumerate(ratios[counts[1], counts[2], counts[3]]):
+            sulfur_ratio = sulfur[counts[1], peak + 1]
+            if sulfur_ratio > 0:
+                peaks[mz + (peak + 1) * sulfur_shift] = intensity * sulfur_ratio
+            if ratio - sulfur_ratio > 1e-12:
+                peaks[mz + (peak + 1) * 1.9975] = intensity * (ratio - sulfur_ratio)
+        noise = rng.uniform(mz - 3, mz + 5, 4)
+        peaks.update(zip(noise, 10 ** rng.uniform(3, 4.5, 4)))
+        ms1_mzs.append(list(peaks.keys()))
+        ms1_intensities.append(list(peaks.values()))
+    precursors = pl.Series(precursor_mzs)
+    bounds = deduce_isotopic_pattern(
+        precursors, pl.Series(ms1_mzs), pl.Series(ms1_intensities), minimum_intensity=1e4, intensity_absolute_tolerance=1e4,
+    ).to_numpy()
+    lower, upper = bounds[:, columns], bounds[:, [c + n_elements for c in columns]]
+    assert np.all((lower[:, 0] <= true_counts[:, 0]) & (true_counts[:, 0] <= upper[:, 0])), "carbon bounds miss the true count"
+    exact = (lower[:, 1:] == true_counts[:, 1:]) & (true_counts[:, 1:] == upper[:, 1:])
+    assert np.all(exact), (
+        f"the M+2, M+4 and M+6 peaks should give the exact S, Cl and Br counts, not for rows {np.flatnonzero(~exact.all(axis=1)).tolist()}"
+    )
+
+    order = [rng.permutation(len(row)) for row in ms1_mzs]
+    shuffled = deduce_isotopic_pattern(
+        precursors,
+        pl.Series([np.asarray(row)[o].tolist() for row, o in zip(ms1_mzs, order)]),
+        pl.Series([np.asarray(row)[o].tolist() for row, o in zip(ms1_intensities, order)]),
+        minimum_intensity=1e4, intensity_absolute_tolerance=1e4,
+    ).to_numpy()
+    assert np.array_equal(bounds, shuffled), "sorted and unsorted MS1 peaks gave different bounds"
+
+    missing = deduce_isotopic_pattern(
+        pl.Series([precursor_mzs[0] + 0.5, None, precursor_mzs[1]]),
+        pl.Series([ms1_mzs[0], ms1_mzs[1], None], dtype=pl.List(pl.Float64)),
+        pl.Series([ms1_intensities[0], ms1_intensities[1], None], dtype=pl.List(pl.Float64)),
+    ).to_numpy()
+    assert np.all(missing[:, columns] == -1) and np.all(missing[:, [c + n_elements for c in columns]] == -1), (
+        "rows without a precursor peak should get -1 bounds"
+    )
+
+    features = pl.LazyFrame({"mz": precursors, "ms1_mzs": pl.Series(ms1_mzs), "ms1_intensities": pl.Series(ms1_intensities)})
+    expression = features.select(
+        pl.col("mz").hrms.isotope_bounds("ms1_mzs", "ms1_intensities", minimum_intensity=1e4, intensity_absolute_tolerance=1e4).alias("bounds")
+    ).unnest("bounds").collect(engine="streaming")
+    assert expression.columns == ["min_bounds", "max_bounds"] and expression.schema["min_bounds"] == pl.Array(pl.Int32, n_elements)
+    assert np.array_equal(np.hstack([expression["min_bounds"].to_numpy(), expression["max_bounds"].to_numpy()]), bounds), (
+        "the hrms.isotope_bounds expression differs from deduce_isotopic_pattern"
+    )
+    assert features.select(pl.col("mz").hrms.isotope_bounds("ms1_mzs", "ms1_intensities")).collect_schema().names() == ["mz"], (
+        "the hrms.isotope_bounds expression should keep the name of its input column"
+    )
+    assert deduce_isotopic_bounds(precursors.head(0), pl.Series([], dtype=pl.List(pl.Float64)), pl.Series([], dtype=pl.List(pl.Float64))).len() == 0
+    print(f"Isotopic pattern batch: {size} features, carbon range width {np.mean(upper[:, 0] - lower[:, 0]):.1f} on average")
+
+def fits_isotopic_pattern_arrays_test(size: int = 60) -> None:
+    """
+    fits_isotopic_pattern_arrays agrees with the formula-string fits_isotopic_pattern_batch, flat and
+    nested, and both with a pure-Python version of the original per-element checks, on sorted and
+    shuffled peak lists.
+    """
+    isotopes = isotopic_pattern_dict
+
+    def peak_fits(config, mzs, intensities, precursor_mz, precursor_intensity, mass_difference, relative_intensity) -> bool:
+        computed_isotope_intensity = precursor_intensity * relative_intensity
+        if computed_isotope_intensity < config.minimum_intensity:
+            return True
+        computed_isotope_mass = precursor_mz + mass_difference
+        best_fit_index = np.abs(mzs - computed_isotope_mass).argmin()
+        if not np.isclose(mzs[best_fit_index], computed_isotope_mass, rtol=config.mass_tolerance):
+            return False
+        intensity_ratio = intensities[best_fit_index] / computed_isotope_intensity
+        return not (intensity_ratio > config.max_intensity_ratio or intensity_ratio < 1 / config.max_intensity_ratio)
+
+    def element_fits(config, mzs, intensities, precursor_mz, precursor_intensity, symbol, count) -> bool:
+        if count == 0:
+            return True
+        isotope = isotopes[symbol]
+        relative_intensity = isotope["first_isotope_probability"] * count / np.power(isotope["zero_isotope_probability"], count)
+        return peak_fits(config, mzs, intensities, precursor_mz, precursor_intensity, isotope["mass_difference"], relative_intensity)
+
+    def reference_fits(formula, mzs, intensities, precursor_mz, config) -> bool:
+        """The checks of fits_isotopic_pattern_batch before the compiled kernel: check_element_fit / check_CN_fit."""
+        mzs, intensities = np.asarray(mzs), np.asarray(intensities)
+        precursor_intensity = intensities[np.abs(mzs - precursor_mz).argmin()]
+        counts = dict(zip(element_table.ELEMENT_SYMBOLS, formula))
+        fits = [element_fits(config, mzs, intensities, precursor_mz, precursor_intensity, symbol, counts[symbol]) for symbol in ("S", "Cl", "Br")]
+        if config.ms1_resolution > NITROGEN_SEPARATION_RESOLUTION:
+            fits += [element_fits(config, mzs, intensities, precursor_mz, precursor_intensity, symbol, counts[symbol]) for symbol in ("C", "N")]
+        elif counts["N"] == 0 or counts["C"] == 0:
+            symbol = "C" if counts["N"] == 0 else "N"
+            fits.append(element_fits(config, mzs, intensities, precursor_mz, precursor_intensity, symbol, counts[symbol]))
+        else:
+            carbon, nitrogen = isotopes["C"], isotopes["N"]
+            zero_isotope_intensity = np.power(carbon["zero_isotope_probability"], counts["C"]) * np.power(nitrogen["zero_isotope_probability"], counts["N"])
+            relative_intensity = (carbon["first_isotope_probability"] * counts["C"] + nitrogen["first_isotope_probability"] * counts["N"]) / zero_isotope_intensity
+            fits.append(peak_fits(config, mzs, intensities, precursor_mz, precursor_intensity, carbon["mass_difference"], relative_intensity))
+        return all(fits)
+
+    rng = np.random.default_rng(22)
+    masses = pl.Series(rng.uniform(150.0, 450.0, size))
+    candidates = decompose_mass(masses, np.array(MIN_FORMULA, dtype=np.int32), np.array(MAX_FORMULA, dtype=np.int32), max_results=30)
+    precursor_mzs = masses + 1.007276
+    shifts = np.array([0.0, 1.003355, 0.997035, 1.99705, 1.99795, 1.995796])
+    # the last spectrum has no peaks
+    ms1_mzs = pl.Series([(mz + shifts + rng.normal(0, 3e-4, len(shifts))).tolist() for mz in precursor_mzs[:-1]] + [[]])
+    ms1_intensities = pl.Series([(1e7 * np.concatenate([[1.0], rng.uniform(0.0, 0.6, len(shifts) - 1)])).tolist() for _ in range(size - 1)] + [[]])
+    for config in (
+        isotopic_pattern_config(mass_tolerance=5e-6, ms1_resolution=6e4),
+        isotopic_pattern_config(mass_tolerance=5e-6, ms1_resolution=2e5, minimum_intensity=1e4),
+        isotopic_pattern_config(mass_tolerance=2e-6, ms1_resolution=3e4, minimum_intensity=1e5, max_intensity_ratio=1.3),
+    ):
+        nested = fits_isotopic_pattern_arrays(candidates, precursor_mzs, ms1_mzs, ms1_intensities, config)
+        assert nested.dtype == pl.List(pl.Boolean) and nested.list.len().equals(candidates.list.len())
+        assert nested[size - 1].null_count() == len(nested[size - 1]), "a spectrum without peaks should give nulls"
+
+        rows = pl.DataFrame({"formula": candidates, "mz": precursor_mzs, "ms1_mzs": ms1_mzs, "ms1_intensities": ms1_intensities}).head(size - 1)
+        rows = rows.explode("formula", empty_as_null=False).drop_nulls("formula")
+        flat = fits_isotopic_pattern_arrays(rows["formula"], rows["mz"], rows["ms1_mzs"], rows["ms1_intensities"], config)
+        assert flat.equals(nested.head(size - 1).explode(empty_as_null=False).drop_nulls(), check_names=False)
+
+        formula_strings = [
+            "".join(f"{symbol}{count}" for symbol, count in zip(element_table.ELEMENT_SYMBOLS, formula) if count > 0)
+            for formula in rows["formula"].to_list()
+        ]
+        reference = fits_isotopic_pattern_batch(
+            [np.array(m) for m in rows["ms1_mzs"].to_list()], [np.array(i) for i in rows["ms1_intensities"].to_list()],
+            formula_strings, rows["mz"].to_numpy(), config,
+        )
+        assert np.array_equal(flat.to_numpy(), reference), "array and formula-string isotope fits differ"
+        original = np.array([
+            reference_fits(formula, mzs, intensities, mz, config)
+            for formula, mz, mzs, intensities in zip(rows["formula"].to_list(), rows["mz"], rows["ms1_mzs"].to_list(), rows["ms1_intensities"].to_list())
+        ])
+        assert np.array_equal(flat.to_numpy(), original), "compiled isotope fits differ from the original per-element checks"
+
+        # the same spectra with shuffled peaks (the kernel bisects sorted lists and scans the others)
+        order = [rng.permutation(len(mzs)) for mzs in rows["ms1_mzs"].to_list()]
+        shuffled = fits_isotopic_pattern_arrays(
+            rows["formula"], rows["mz"],
+            pl.Series([np.asarray(m)[o].tolist() for m, o in zip(rows["ms1_mzs"].to_list(), order)], dtype=pl.List(pl.Float64)),
+            pl.Series([np.asarray(i)[o].tolist() for i, o in zip(rows["ms1_intensities"].to_list(), order)], dtype=pl.List(pl.Float64)),
+            config,
+        )
+        assert np.array_equal(shuffled.to_numpy(), original), "shuffled peaks changed the isotope fits"
+    print(f"Isotopic pattern fits: {rows.height} candidates, {flat.sum()} fit with the last configuration")
+
+def isotope_envelope_test(size: int = 40) -> None:
+    """predict_isotope_envelopes against closed forms, its memo, and score_isotope_envelopes on simulated spectra."""
+    def formula(**counts: int) -> list[int]:
+        return [counts.get(symbol, 0) for symbol in element_table.ELEMENT_SYMBOLS]
+
+    from math import comb
+    p_13c = dict(element_table.ELEMENT_ISOTOPE_ABUNDANCES["C"])[1.0033548]
+    p_37cl = dict(element_table.ELEMENT_ISOTOPE_ABUNDANCES["Cl"])[1.9970499]
+    envelopes = predict_isotope_envelopes(pl.Series([formula(C=20), formula(Cl=2), formula(F=3)], dtype=pl.Array(pl.Int32, 15)), n_peaks=5)
+    abundance = np.array(envelopes.struct.field("abundance").to_list())
+    mass_shift = np.array(envelopes.struct.field("mass_shift").to_list())
+    assert np.allclose(abundance[0], [comb(20, k) * p_13c**k * (1 - p_13c)**(20 - k) for k in range(5)], rtol=1e-12, atol=0)
+    assert np.allclose(mass_shift[0], 1.0033548 * np.arange(5), rtol=1e-12)
+    assert np.allclose(abundance[1], [(1 - p_37cl)**2, 0.0, 2 * p_37cl * (1 - p_37cl), 0.0, p_37cl**2], rtol=1e-12, atol=0)
+    assert np.isnan(mass_shift[1][1]) and np.isclose(mass_shift[1][4], 2 * 1.9970499)
+    assert abundance[2][0] == 1.0, "a monoisotopic formula has a single peak"
+
+    masses = pl.Series(np.random.default_rng(23).uniform(150.0, 450.0, size))
+    candidates = decompose_mass(masses, np.array(MIN_FORMULA, dtype=np.int32), np.array(MAX_FORMULA, dtype=np.int32), max_results=30)
+    has_candidates = candidates.list.len() > 0
+    masses, candidates = masses.filter(has_candidates), candidates.filter(has_candidates)
+    size = len(masses)
+    flat = candidates.explode(empty_as_null=False)
+    clear_isotope_envelope_cache()
+    start = perf_counter()
+    first = predict_isotope_envelopes(flat)
+    elapsed = perf_counter() - start
+    assert np.all(np.array(first.struct.field("abundance").to_list()).sum(axis=1) <= 1.0 + 1e-12)
+    stats = get_isotope_envelope_cache_stats()
+    assert stats["hits"] == 0 and stats["entries"] == flat.n_unique()
+    assert predict_isotope_envelopes(flat).equals(first), "memoized envelopes differ"
+    assert get_isotope_envelope_cache_stats()["hits"] == flat.n_unique()
+
+    # beyond capacity the least recently used envelopes are evicted, recently used ones stay
+    unique = flat.unique(maintain_order=True)
+    half = len(unique) // 2
+    set_isotope_envelope_cache_capacity(half + 1)
+    try:
+        predict_isotope_envelopes(unique.head(half))
+        predict_isotope_envelopes(unique.head(1))
+        predict_isotope_envelopes(unique.tail(len(unique) - half))
+        assert get_isotope_envelope_cache_stats()["entries"] == half + 1
+        before = get_isotope_envelope_cache_stats()["hits"]
+        assert predict_isotope_envelopes(unique.head(1)).equals(first.head(1)), "memoized envelopes differ"
+        assert get_isotope_envelope_cache_stats()["hits"] == before + 1, "the recently used envelope was evicted"
+        predict_isotope_envelopes(unique.slice(1, 1))
+        assert get_isotope_envelope_cache_stats()["hits"] == before + 1, "a least recently used envelope was kept"
+    finally:
+        set_isotope_envelope_cache_capacity(1_000_000)
+
+    # spectra simulated from the first candidate of each mass, bright enough for every peak to be above minimum_intensity
+    truths = candidates.list.first()
+    truth_envelopes = predict_isotope_envelopes(truths).struct.unnest()
+    precursor_mzs = masses + 1.007276
+    ms1_mzs = pl.Series([
+        (mz + np.nan_to_num(shift)).tolist()
+        for mz, shift in zip(precursor_mzs, truth_envelopes["mass_shift"].to_list())
+    ])
+    ms1_intensities = pl.Series([(1e10 * np.array(a) / a[0]).tolist() for a in truth_envelopes["abundance"].to_list()])
+    scores = score_isotope_envelopes(candidates, precursor_mzs, ms1_mzs, ms1_intensities)
+    assert scores.dtype == pl.List(pl.Float64) and scores.list.len().equals(candidates.list.len())
+    assert np.allclose(scores.list.first().to_numpy(), 0.0, atol=1e-12), "the simulated formula should fit its own envelope"
+    assert score_isotope_envelopes(truths, precursor_mzs, ms1_mzs, ms1_intensities).equals(scores.list.first(), check_names=False)
+    no_peaks = pl.Series([[]] * size, dtype=pl.List(pl.Float64))
+    assert score_isotope_envelopes(truths, precursor_mzs, no_peaks, no_peaks).null_count() == size
+    print(f"Isotope envelopes: {flat.n_unique()} formulas in {elapsed:.3f} s, {int(np.isinf(scores.explode(empty_as_null=False).to_numpy()).sum())} of {len(flat)} candidates rejected")
 
 if __name__ == "__main__":
     from time import perf_counter
     ########################## H,  B, C,  N,  O,  F, Na,Si, P, S, Cl, K, As,Br, I
     MIN_FORMULA: list[int] = [ 0,  0, 0,  0,  0,  0, 0, 0,  0, 0, 0,  0, 0, 0,  0]
     MAX_FORMULA: list[int] = [100, 1, 60, 30, 30, 30, 0, 5, 10, 5, 10, 0, 1, 2,  3]
+    residue_table_cache_test()
+    bound_pruning_test()
+    fragment_engine_test()
+    gil_release_test()
+    chunked_decomposition_test()
+    parallel_config_test()
+    cost_ordering_test()
+    filter_formulas_test()
+    chemistry_rules_test()
+    candidate_precursors_test()
+    nested_output_test()
+    spectra_decomposition_test()
+    candidate_ranking_test()
+    mass_tolerance_test()
+    element_table_test()
+    grown_alphabet_test()
+    isotope_decomposition_test()
+    decomposition_cache_test()
+    mass_lattice_test()
+    isotopic_pattern_batch_test()
+    fits_isotopic_pattern_arrays_test()
+    isotope_envelope_test()
     mass_decomposition_test(size=100)
\ No newline at end of file